@@ -13,13 +13,16 @@ Features:
 - Can replace Groq when ready
 """
 
-import sqlite3
+import hashlib
 import json
 import os
+import shutil
 import time
 from datetime import datetime
-from training_data_manager import TrainingDataManager, TRAINING_DB_PATH
-import numpy as np
+
+import psycopg2
+
+from streaming_export import iter_row_chunks
 
 # Check for ML libraries with graceful fallback
 try:
@@ -28,13 +31,15 @@ try:
         AutoTokenizer, 
         TrainingArguments, 
         Trainer,
-        DataCollatorForLanguageModeling
+        TrainerCallback
     )
+    from transformers.trainer_utils import get_last_checkpoint
     from datasets import Dataset
     import torch
     HAS_TRANSFORMERS = True
 except ImportError:
     HAS_TRANSFORMERS = False
+    TrainerCallback = object
     print("⚠️  Transformers not installed. Install with: pip install transformers torch datasets")
 
 # Model configuration
@@ -42,18 +47,231 @@ MODEL_NAME = "microsoft/DialoGPT-small"  # Lightweight conversational model
 MODEL_DIR = "trained_models"
 CHECKPOINT_DIR = os.path.join(MODEL_DIR, "checkpoints")
 METRICS_FILE = os.path.join(MODEL_DIR, "training_metrics.json")
+DATASET_CACHE_DIR = os.path.join(MODEL_DIR, "dataset_cache")
+
+# Bump when the example format changes so cached shards are rebuilt
+DATASET_FORMAT_VERSION = 1
+FETCH_BATCH_SIZE = 2000   # training_chats rows per server-side cursor round trip
+SHARD_SIZE = 2000         # tokenized examples per on-disk shard
+
+TURN_PREFIXES = {'user': 'Patient: ', 'ai': 'Therapist: '}
+PROGRESS_INTERVAL_SECONDS = 15
+
+# Every turn of a session that has new rows, so new replies keep their earlier context
+SESSION_TURNS_QUERY = """
+    SELECT id, session_hash, message_role, message_content
+    FROM training_chats
+    WHERE session_hash IN (
+        SELECT DISTINCT session_hash FROM training_chats WHERE id > %s AND id <= %s
+    ) AND id <= %s
+    ORDER BY session_hash, id
+"""
+
+
+def iter_sessions(conn, from_id, to_id, batch_size=FETCH_BATCH_SIZE):
+    """Yield (session_hash, [(id, role, content), ...]) streamed from a server-side cursor."""
+    current, turns = None, []
+    for rows in iter_row_chunks(conn, SESSION_TURNS_QUERY, (from_id, to_id, to_id),
+                                chunk_size=batch_size, name_prefix='training_chats'):
+        for row_id, session_hash, role, content in rows:
+            if session_hash != current:
+                if turns:
+                    yield current, turns
+                current, turns = session_hash, []
+            turns.append((row_id, role, content))
+    if turns:
+        yield current, turns
+
+
+def build_context_windows(sessions, tokenizer, max_length=512, from_id=0):
+    """
+    Yield one token list per therapist reply newer than from_id: as much of
+    the preceding conversation as fits, then the reply.
+
+    Each turn is tokenized exactly once (one batched tokenizer call per
+    session) and terminated with EOS, DialoGPT-style. Contexts are built by
+    slicing a rolling token history capped at max_length, so cost is linear
+    in conversation length.
+    """
+    eos = tokenizer.eos_token_id
+    for _, turns in sessions:
+        texts = [f"{TURN_PREFIXES.get(role, '')}{content or ''}" for _, role, content in turns]
+        encoded = tokenizer(texts, add_special_tokens=False)['input_ids']
+
+        history = []
+        for (row_id, role, _), ids in zip(turns, encoded):
+            ids = list(ids) + [eos]
+            if role == 'ai' and row_id > from_id and history:
+                response = ids[:max_length]
+                budget = max_length - len(response)
+                yield (history[-budget:] if budget > 0 else []) + response
+            history.extend(ids)
+            if len(history) > max_length:
+                del history[:-max_length]
+
+
+def dataset_cache_key(tokenizer, max_length, from_id, to_id):
+    name = getattr(tokenizer, 'name_or_path', '') or type(tokenizer).__name__
+    raw = f"{DATASET_FORMAT_VERSION}|{name}|{len(tokenizer)}|{max_length}|{from_id}|{to_id}"
+    return hashlib.sha256(raw.encode()).hexdigest()[:16]
+
+
+def build_tokenized_shards(conn, tokenizer, from_id, to_id, max_length=512,
+                           cache_dir=DATASET_CACHE_DIR, shard_size=SHARD_SIZE):
+    """
+    Tokenize training_chats (from_id, to_id] into Arrow shards on disk and
+    return the manifest. A completed build for the same rows, tokenizer and
+    max_length is reused as-is (no database reads), so resumed runs and
+    every epoch memory-map the same shards. The manifest is written last,
+    so an interrupted build is simply redone.
+    """
+    import pyarrow as pa
+
+    key = dataset_cache_key(tokenizer, max_length, from_id, to_id)
+    directory = os.path.join(cache_dir, key)
+    manifest_path = os.path.join(directory, 'manifest.json')
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as f:
+            return json.load(f)
+
+    os.makedirs(directory, exist_ok=True)
+    schema = pa.schema([('input_ids', pa.list_(pa.int32())), ('length', pa.int32())])
+    shards, sessions, examples, buffer = [], 0, 0, []
+
+    def flush():
+        path = os.path.join(directory, f"shard-{len(shards):05d}.arrow")
+        table = pa.table({'input_ids': buffer, 'length': [len(ids) for ids in buffer]}, schema=schema)
+        with pa.OSFile(path, 'wb') as sink, pa.ipc.new_stream(sink, schema) as writer:
+            writer.write_table(table)
+        shards.append(path)
+        buffer.clear()
+
+    def counted(stream):
+        nonlocal sessions
+        for item in stream:
+            sessions += 1
+            yield item
+
+    for ids in build_context_windows(counted(iter_sessions(conn, from_id, to_id)), tokenizer, max_length, from_id):
+        buffer.append(ids)
+        examples += 1
+        if len(buffer) >= shard_size:
+            flush()
+    if buffer:
+        flush()
+
+    manifest = {'key': key, 'from_id': from_id, 'to_id': to_id, 'max_length': max_length,
+                'examples': examples, 'sessions': sessions, 'shards': shards}
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(manifest_path + '.tmp', manifest_path)
+    return manifest
+
+
+def load_shards(manifest):
+    """Memory-map a shard manifest as one datasets.Dataset."""
+    from datasets import concatenate_datasets
+    return concatenate_datasets([Dataset.from_file(path) for path in manifest['shards']])
+
+
+class CausalLMCollator:
+    """
+    Pads a batch of token lists on the right and masks only the padding
+    from the loss (by attention_mask, not by token id).
+
+    pad_token is EOS for DialoGPT, and DataCollatorForLanguageModeling
+    masks every position equal to pad_token_id, which would also drop the
+    EOS ending each turn - the token that teaches the model to stop.
+    """
+
+    def __init__(self, pad_token_id):
+        self.pad_token_id = pad_token_id
+
+    def __call__(self, features):
+        lengths = [len(f['input_ids']) for f in features]
+        input_ids = torch.full((len(features), max(lengths)), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros_like(input_ids)
+        for i, (feature, length) in enumerate(zip(features, lengths)):
+            input_ids[i, :length] = torch.as_tensor(feature['input_ids'], dtype=torch.long)
+            attention_mask[i, :length] = 1
+        labels = input_ids.masked_fill(attention_mask == 0, -100)
+        return {'input_ids': input_ids, 'attention_mask': attention_mask, 'labels': labels}
+
+
+def latest_model_path():
+    """Final model saved by the most recent successful run, if it is still on disk"""
+    if not os.path.exists(METRICS_FILE):
+        return None
+    try:
+        with open(METRICS_FILE, 'r') as f:
+            runs = json.load(f).get('training_runs', [])
+    except (OSError, ValueError):
+        return None
+    path = runs[-1].get('model_path') if runs else None
+    return path if path and os.path.isdir(path) else None
+
+
+class TrainingCancelled(Exception):
+    """Raised when a training run was stopped by a cancellation request."""
+
+
+class ProgressCallback(TrainerCallback):
+    """
+    Reports Trainer progress through report(progress) -> bool at most every
+    interval seconds (and at the end). report returning False asks the
+    Trainer to stop after the current step.
+    """
+
+    def __init__(self, report, interval=PROGRESS_INTERVAL_SECONDS, clock=time.monotonic):
+        self.report = report
+        self.interval = interval
+        self.clock = clock
+        self.cancelled = False
+        self.loss = None
+        self._last_report = None
+
+    def _progress(self, state, phase):
+        progress = {'phase': phase, 'step': state.global_step, 'max_steps': state.max_steps,
+                    'epoch': round(state.epoch or 0, 3), 'loss': self.loss}
+        if state.max_steps:
+            progress['percent'] = round(100.0 * state.global_step / state.max_steps, 1)
+        return progress
+
+    def _send(self, state, control, phase):
+        self._last_report = self.clock()
+        if self.report(self._progress(state, phase)) is False:
+            self.cancelled = True
+            control.should_training_stop = True
+        return control
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        return self._send(state, control, 'training')
+
+    def on_log(self, args, state, control, logs=None, **kwargs):
+        if logs and 'loss' in logs:
+            self.loss = logs['loss']
+        return control
+
+    def on_step_end(self, args, state, control, **kwargs):
+        if self._last_report is None or self.clock() - self._last_report >= self.interval:
+            return self._send(state, control, 'training')
+        return control
+
+    def on_train_end(self, args, state, control, **kwargs):
+        return self._send(state, control, 'cancelled' if self.cancelled else 'saving')
+
 
 class BackgroundAITrainer:
     """Trains local AI model from app data without interrupting live service"""
     
-    def __init__(self):
+    def __init__(self, connect=None):
         if not HAS_TRANSFORMERS:
             raise RuntimeError(
                 "Transformers library required. Install with:\n"
                 "pip install transformers torch datasets accelerate"
             )
         
-        self.training_db = TRAINING_DB_PATH
+        self.connect = connect or (lambda: psycopg2.connect(os.getenv("DATABASE_URL")))
         self.model = None
         self.tokenizer = None
         self.last_trained_id = self._get_last_trained_id()
@@ -63,7 +281,20 @@ class BackgroundAITrainer:
         os.makedirs(CHECKPOINT_DIR, exist_ok=True)
     
     def _get_last_trained_id(self):
-        """Get ID of last message used in training"""
+        """Get ID of last message used in training (training_watermark, else metrics file)"""
+        try:
+            conn = self.connect()
+            try:
+                cur = conn.cursor()
+                cur.execute("SELECT last_trained_id FROM training_watermark WHERE id = 1")
+                row = cur.fetchone()
+            finally:
+                conn.close()
+            if row:
+                return row[0]
+        except psycopg2.Error as e:
+            print(f"⚠️  Could not read training watermark: {e}")
+        
         if os.path.exists(METRICS_FILE):
             try:
                 with open(METRICS_FILE, 'r') as f:
@@ -90,13 +321,18 @@ class BackgroundAITrainer:
             json.dump(existing, f, indent=2)
     
     def load_or_initialize_model(self):
-        """Load existing checkpoint or initialize new model"""
+        """Load the last trained model (or legacy checkpoint), else initialize the base model"""
         print("🤖 Loading AI model...")
         
-        # Check for latest checkpoint
+        model_path = latest_model_path()
+        # Legacy layout: checkpoints written straight into CHECKPOINT_DIR
         checkpoints = [d for d in os.listdir(CHECKPOINT_DIR) if d.startswith('checkpoint-')]
         
-        if checkpoints:
+        if model_path:
+            print(f"📂 Loading model: {model_path}")
+            self.model = AutoModelForCausalLM.from_pretrained(model_path)
+            self.tokenizer = AutoTokenizer.from_pretrained(model_path)
+        elif checkpoints:
             # Load latest checkpoint
             latest = max(checkpoints, key=lambda x: int(x.split('-')[1]))
             checkpoint_path = os.path.join(CHECKPOINT_DIR, latest)
@@ -116,117 +352,62 @@ class BackgroundAITrainer:
         
         print("✅ Model loaded successfully")
     
-    def fetch_new_training_data(self, limit=1000):
-        """Fetch new conversations since last training"""
-        print(f"📊 Fetching training data (ID > {self.last_trained_id})...")
-        
-        conn = sqlite3.connect(self.training_db)
-        cur = conn.cursor()
-        
-        # Get new conversations
-        conversations = cur.execute(
-            """SELECT id, session_hash, message_role, message_content, mood_context
-               FROM training_chats
-               WHERE id > ?
-               ORDER BY id ASC
-               LIMIT ?""",
-            (self.last_trained_id, limit)
-        ).fetchall()
-        
-        conn.close()
-        
-        if not conversations:
-            print("ℹ️  No new training data available")
+    def build_training_dataset(self, max_length=512, to_id=None):
+        """
+        Stream new training_chats into cached token shards; returns (dataset, manifest) or None.
+        A fixed to_id (pinned by the training job) keeps the dataset identical across resumes.
+        """
+        print(f"📊 Building training dataset (ID > {self.last_trained_id})...")
+        
+        conn = self.connect()
+        try:
+            if to_id is None:
+                cur = conn.cursor()
+                cur.execute("SELECT COALESCE(MAX(id), 0) FROM training_chats")
+                to_id = cur.fetchone()[0]
+            if to_id <= self.last_trained_id:
+                print("ℹ️  No new training data available")
+                return None
+            manifest = build_tokenized_shards(conn, self.tokenizer, self.last_trained_id, to_id, max_length)
+        finally:
+            conn.close()
+        
+        print(f"✅ {manifest['examples']} samples from {manifest['sessions']} sessions "
+              f"in {len(manifest['shards'])} shard(s)")
+        if not manifest['shards']:
             return None
-        
-        # Group by session
-        sessions = {}
-        max_id = 0
-        
-        for conv_id, session_hash, role, content, mood in conversations:
-            if session_hash not in sessions:
-                sessions[session_hash] = []
-            sessions[session_hash].append({
-                'role': role,
-                'content': content,
-                'mood': mood
-            })
-            max_id = max(max_id, conv_id)
-        
-        print(f"✅ Fetched {len(conversations)} messages from {len(sessions)} sessions")
-        return sessions, max_id
+        return load_shards(manifest), manifest
     
-    def prepare_training_dataset(self, sessions):
-        """Convert conversations to training format"""
-        print("🔄 Preparing training dataset...")
-        
-        training_texts = []
-        
-        for session_hash, messages in sessions.items():
-            # Build conversation context
-            conversation = []
-            
-            for msg in messages:
-                if msg['role'] == 'user':
-                    conversation.append(f"Patient: {msg['content']}")
-                elif msg['role'] == 'ai':
-                    conversation.append(f"Therapist: {msg['content']}")
-            
-            # Create training samples (therapist responses in context)
-            for i in range(1, len(conversation)):
-                context = " ".join(conversation[:i])
-                response = conversation[i]
-                
-                if response.startswith("Therapist:"):
-                    # Format: [Context] <|endoftext|> [Response]
-                    training_text = f"{context}{self.tokenizer.eos_token}{response}"
-                    training_texts.append(training_text)
-        
-        print(f"✅ Created {len(training_texts)} training samples")
-        
-        # Tokenize
-        tokenized = self.tokenizer(
-            training_texts,
-            truncation=True,
-            max_length=512,
-            padding='max_length',
-            return_tensors='pt'
-        )
-        
-        # Create dataset
-        dataset = Dataset.from_dict({
-            'input_ids': tokenized['input_ids'],
-            'attention_mask': tokenized['attention_mask']
-        })
-        
-        return dataset
-    
-    def train_incremental(self, num_epochs=3, batch_size=4):
-        """Train model on new data"""
+    def train_incremental(self, num_epochs=3, batch_size=4, max_length=512, to_id=None,
+                          output_dir=None, callbacks=None):
+        """
+        Train model on new data.
+        
+        With an output_dir per job, an interrupted run resumes from its last
+        checkpoint there. Raises TrainingCancelled if a ProgressCallback
+        stopped the run.
+        """
         print(f"\n🎓 Starting incremental training...")
         print(f"   Epochs: {num_epochs}, Batch size: {batch_size}")
         
-        # Fetch new data
-        result = self.fetch_new_training_data()
-        if result is None:
-            return False
-        
-        sessions, max_id = result
-        
-        # Load model if not loaded
+        # Load model if not loaded (the tokenizer is needed to build the dataset)
         if self.model is None:
             self.load_or_initialize_model()
         
-        # Prepare dataset
-        dataset = self.prepare_training_dataset(sessions)
-        
-        if len(dataset) == 0:
-            print("⚠️  No valid training samples")
+        result = self.build_training_dataset(max_length=max_length, to_id=to_id)
+        if result is None:
             return False
         
+        dataset, manifest = result
+        max_id = manifest['to_id']
+        output_dir = output_dir or CHECKPOINT_DIR
+        resume_from = get_last_checkpoint(output_dir) if os.path.isdir(output_dir) else None
+        if resume_from:
+            print(f"↩️  Resuming from checkpoint: {resume_from}")
+        
         # Training configuration
         training_args = TrainingArguments(
-            output_dir=CHECKPOINT_DIR,
+            output_dir=output_dir,
             num_train_epochs=num_epochs,
             per_device_train_batch_size=batch_size,
             save_steps=500,
@@ -237,31 +418,38 @@ class BackgroundAITrainer:
             weight_decay=0.01,
             logging_dir=os.path.join(MODEL_DIR, 'logs'),
             report_to='none',  # Disable external reporting
-            no_cuda=not torch.cuda.is_available()
+            no_cuda=not torch.cuda.is_available(),
+            # Examples are unpadded: batch similar lengths together and pad per batch
+            group_by_length=True,
+            length_column_name='length'
         )
         
-        # Data collator for language modeling
-        data_collator = DataCollatorForLanguageModeling(
-            tokenizer=self.tokenizer,
-            mlm=False  # Causal LM, not masked LM
-        )
+        # Pads each batch to its longest example; turn-ending EOS tokens stay in the loss
+        data_collator = CausalLMCollator(self.tokenizer.pad_token_id)
         
         # Initialize trainer
         trainer = Trainer(
             model=self.model,
             args=training_args,
             train_dataset=dataset,
-            data_collator=data_collator
+            data_collator=data_collator,
+            callbacks=callbacks
         )
         
         # Train
         print("🏋️  Training in progress...")
         start_time = time.time()
         
-        train_result = trainer.train()
+        train_result = trainer.train(resume_from_checkpoint=resume_from)
         
         training_time = time.time() - start_time
         
+        if any(getattr(cb, 'cancelled', False) for cb in callbacks or ()):
+            # A cancelled job is never resumed
+            if output_dir != CHECKPOINT_DIR:
+                shutil.rmtree(output_dir, ignore_errors=True)
+            raise TrainingCancelled(f"Training stopped at step {trainer.state.global_step}")
+        
         # Save final model
         final_path = os.path.join(MODEL_DIR, f"model_{datetime.now().strftime('%Y%m%d_%H%M%S')}")
         trainer.save_model(final_path)
@@ -275,7 +463,7 @@ class BackgroundAITrainer:
             'timestamp': datetime.now().isoformat(),
             'last_trained_id': max_id,
             'num_samples': len(dataset),
-            'num_sessions': len(sessions),
+            'num_sessions': manifest['sessions'],
             'training_time_seconds': training_time,
             'train_loss': train_result.training_loss,
             'model_path': final_path
@@ -284,10 +472,14 @@ class BackgroundAITrainer:
         self._save_metrics(metrics)
         self.last_trained_id = max_id
         
+        # Checkpoints only matter for resuming this run
+        if output_dir != CHECKPOINT_DIR:
+            shutil.rmtree(output_dir, ignore_errors=True)
+        
         print(f"\n📈 Metrics:")
         print(f"   Loss: {train_result.training_loss:.4f}")
         print(f"   Samples: {len(dataset)}")
-        print(f"   Sessions: {len(sessions)}")
+        print(f"   Sessions: {manifest['sessions']}")
         
         return True
     
@@ -1,4 +1,4 @@
-from flask import Flask, request, jsonify, render_template, send_from_directory, make_response, Response, g, session
+from flask import Flask, request, jsonify, render_template, send_from_directory, make_response, Response, g, session, stream_with_context, has_request_context
 from flask_cors import CORS
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
@@ -10,15 +10,13 @@ from psycopg2.extras import RealDictCursor, execute_batch
 import os
 import json
 import hashlib
+import math
 import socket
 import requests
 from datetime import datetime, timedelta, date
 import sys
 import secrets
-import smtplib
 import time
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
 import logging
 import logging.handlers
 import threading
@@ -67,11 +65,13 @@ except ImportError as e:
 # Import MessageService for comprehensive messaging system
 try:
     from message_service import MessageService
+    from message_dispatcher import get_dispatch_stats
     HAS_MESSAGE_SERVICE = True
 except ImportError as e:
     app_logger.warning(f"message_service module not found. New messaging system disabled: {e}")
     HAS_MESSAGE_SERVICE = False
     MessageService = None
+    get_dispatch_stats = None
 
 # --- Pet Table Ensurer ---
 def ensure_pet_table():
@@ -177,7 +177,20 @@ def normalize_pet_row(pet_row):
 # Import existing modules
 from secrets_manager import SecretsManager
 from audit import log_event
-# NOTE: No longer importing fhir_export (FHIR functionality moved to Flask API)
+from email_outbox import (enqueue_email, get_outbox_stats, smtp_configured,
+                          PRIORITY_CRISIS, PRIORITY_SECURITY, PRIORITY_ALERT, PRIORITY_REMINDER)
+from streaming_export import iter_rows, csv_chunks, ndjson_chunks, json_array_chunks
+from report_service import (REPORT_WELLNESS_PDF, REPORT_CLINICAL_SUMMARY, CLINICAL_REPORT_TYPES,
+                            report_data_version, report_cache_key, find_artifact, get_artifact,
+                            store_artifact, enqueue_report)
+import fhir_export
+import training_jobs
+import migrations
+from principal_cache import Principal, PrincipalCache
+from rate_limit import GCRALimiter, PostgresLimitStore, SharedGCRALimiter
+from request_metrics import PostgresMetricsStore, RequestMetrics, render_prometheus, summarize
+from sql_profiler import PostgresProfileStore, ProfilingCursor, SQLProfiler, profile_execute
+from date_range import day_range, month_range, parse_date_range, range_query
 # NOTE: No longer importing TRAINING_DB_PATH (using PostgreSQL only)
 
 # Import password hashing libraries with fallbacks (same logic as main.py)
@@ -249,7 +262,9 @@ def _get_db_pool():
                     database=db_name,
                     user=db_user,
                     password=db_password,
-                    connect_timeout=30
+                    connect_timeout=30,
+                    # Records statements while SQL_PROFILER is on; a plain cursor otherwise
+                    cursor_factory=ProfilingCursor
                 )
                 app_logger.info("TIER 1.9: Database connection pool created (min=2, max=20)")
     
@@ -318,7 +333,8 @@ limiter = Limiter(
     app=app,
     key_func=get_remote_address,
     default_limits=["200 per day", "50 per hour"],
-    storage_uri="memory://",
+    # memory:// is per worker; point at a shared store (e.g. redis://) for cluster-wide limits
+    storage_uri=os.getenv('RATELIMIT_STORAGE_URI', 'memory://'),
     strategy="fixed-window"
 )
 
@@ -340,6 +356,76 @@ def teardown_db_pool(exc=None):
         except Exception as e:
             app_logger.error(f"Failed to return connection to pool: {e}")
 
+def use_memory_backend(setting):
+    """True when the shared state selected by `setting` (e.g. RATE_LIMIT_BACKEND=memory) stays per process"""
+    return os.getenv('TESTING') == '1' or os.getenv(setting, 'postgres') == 'memory'
+
+# ===== Request metrics (served at /metrics) =====
+# Registered before the other request hooks so requests they reject are counted too;
+# METRICS_BACKEND=memory keeps the totals per worker
+if use_memory_backend('METRICS_BACKEND'):
+    request_metrics = RequestMetrics()
+else:
+    request_metrics = RequestMetrics(PostgresMetricsStore())
+
+
+def _record_request(status, size):
+    started = g.pop('_request_started', None)
+    if started is None:
+        return
+    endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    request_metrics.request_finished(endpoint, request.method, status, time.perf_counter() - started, size)
+
+
+@app.before_request
+def start_request_metrics():
+    g._request_started = time.perf_counter()
+    request_metrics.request_started()
+
+
+@app.after_request
+def record_request_metrics(response):
+    try:
+        _record_request(response.status_code, 0 if response.is_streamed else (response.content_length or 0))
+    except Exception as e:
+        app_logger.debug(f"Request metrics not recorded: {e}")
+    return response
+
+
+@app.teardown_request
+def finish_request_metrics(exc=None):
+    # Only still pending when after_request did not run
+    try:
+        _record_request(500, 0)
+    except Exception:
+        pass
+
+# ===== SQL profiler (SQL_PROFILER=1) =====
+# Flags requests over SQL_QUERY_BUDGET statements or repeating one more than
+# SQL_REPEAT_LIMIT times (N+1); offenders show on the developer dashboard.
+# SQL_PROFILER_BACKEND=memory keeps them per worker
+if use_memory_backend('SQL_PROFILER_BACKEND'):
+    sql_profiler = SQLProfiler(log=app_logger.warning)
+else:
+    sql_profiler = SQLProfiler(store=PostgresProfileStore(), log=app_logger.warning)
+
+
+@app.before_request
+def start_sql_profile():
+    g._sql_profile = (sql_profiler.begin(), time.perf_counter())
+
+
+@app.teardown_request
+def finish_sql_profile(exc=None):
+    token, started = g.pop('_sql_profile', (None, None))
+    if token is None:
+        return
+    endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    try:
+        sql_profiler.end(token, endpoint, request.method, time.perf_counter() - started)
+    except Exception as e:
+        app_logger.debug(f"SQL profile not recorded: {e}")
+
 # Register CBT Tools Blueprint (TIER 0.5 - PostgreSQL migration)
 try:
     from cbt_tools import cbt_tools_bp, init_cbt_tools_schema
@@ -2492,78 +2578,29 @@ def get_auth_status():
 
 
 # ==================== RATE LIMITING ====================
-# In-memory rate limiter (for single-instance deployments)
-# For production multi-instance, use Redis-based rate limiting
-from collections import defaultdict
-import threading
-
-class RateLimiter:
-    """Simple in-memory rate limiter with IP and user tracking"""
-
-    def __init__(self):
-        self.requests = defaultdict(list)  # key -> list of timestamps
-        self.lock = threading.Lock()
-        # Rate limit configurations: (max_requests, window_seconds)
-        self.limits = {
-            'login': (5, 60),                    # 5 login attempts per minute
-            'verify_code': (10, 60),             # 10 code verification attempts per minute (Phase 1D)
-            'register': (50, 60) if DEBUG else (3, 300),  # DEV: 50/min, PROD: 3/5min
-            'send_verification': (3, 300),       # 3 verification sends per 5 minutes (prevent spam)
-            'confirm_reset': (5, 300),           # 5 password reset confirms per 5 minutes
-            'clinician_register': (2, 3600),     # 2 clinician registrations per hour (manual review)
-            'developer_register': (1, 3600),     # 1 developer registration per hour (manual review)
-            'forgot_password': (3, 300),         # 3 password resets per 5 minutes (enumeration prevention)
-            'phq9': (2, 1209600),                # 2 PHQ-9 submissions per 14 days (fortnightly)
-            'gad7': (2, 1209600),                # 2 GAD-7 submissions per 14 days (fortnightly)
-            'ai_chat': (30, 60),                 # 30 AI chat messages per minute
-            'default': (60, 60),                 # 60 requests per minute default
-        }
-
-    def is_allowed(self, key: str, limit_type: str = 'default') -> bool:
-        """Check if request is allowed under rate limit"""
-        max_requests, window = self.limits.get(limit_type, self.limits['default'])
-
-        with self.lock:
-            now = time.time()
-            # Clean old entries
-            self.requests[key] = [t for t in self.requests[key] if now - t < window]
-
-            # Check limit
-            if len(self.requests[key]) >= max_requests:
-                return False
-
-            # Record request
-            self.requests[key].append(now)
-            return True
-
-    def get_wait_time(self, key: str, limit_type: str = 'default') -> int:
-        """Get seconds until next allowed request"""
-        max_requests, window = self.limits.get(limit_type, self.limits['default'])
-
-        with self.lock:
-            now = time.time()
-            self.requests[key] = [t for t in self.requests[key] if now - t < window]
-
-            if len(self.requests[key]) < max_requests:
-                return 0
-
-            oldest = min(self.requests[key])
-            return int(window - (now - oldest)) + 1
-
-    def cleanup(self):
-        """Remove stale entries (call periodically)"""
-        with self.lock:
-            now = time.time()
-            max_window = max(w for _, w in self.limits.values())
-            keys_to_remove = []
-            for key, timestamps in self.requests.items():
-                self.requests[key] = [t for t in timestamps if now - t < max_window]
-                if not self.requests[key]:
-                    keys_to_remove.append(key)
-            for key in keys_to_remove:
-                del self.requests[key]
+# GCRA rate limiter (rate_limit.py): one timestamp per key. State is shared by every
+# worker and node through PostgreSQL (rate_limits table) so limits are not multiplied
+# by the worker count; RATE_LIMIT_BACKEND=memory keeps it per process
+RATE_LIMITS = {
+    # (max_requests, window_seconds)
+    'login': (5, 60),                    # 5 login attempts per minute
+    'verify_code': (10, 60),             # 10 code verification attempts per minute (Phase 1D)
+    'register': (50, 60) if DEBUG else (3, 300),  # DEV: 50/min, PROD: 3/5min
+    'send_verification': (3, 300),       # 3 verification sends per 5 minutes (prevent spam)
+    'confirm_reset': (5, 300),           # 5 password reset confirms per 5 minutes
+    'clinician_register': (2, 3600),     # 2 clinician registrations per hour (manual review)
+    'developer_register': (1, 3600),     # 1 developer registration per hour (manual review)
+    'forgot_password': (3, 300),         # 3 password resets per 5 minutes (enumeration prevention)
+    'phq9': (2, 1209600),                # 2 PHQ-9 submissions per 14 days (fortnightly)
+    'gad7': (2, 1209600),                # 2 GAD-7 submissions per 14 days (fortnightly)
+    'ai_chat': (30, 60),                 # 30 AI chat messages per minute
+    'default': (60, 60),                 # 60 requests per minute default
+}
 
-rate_limiter = RateLimiter()
+if use_memory_backend('RATE_LIMIT_BACKEND'):
+    rate_limiter = GCRALimiter(RATE_LIMITS)
+else:
+    rate_limiter = SharedGCRALimiter(RATE_LIMITS, PostgresLimitStore())
 
 def check_rate_limit(limit_type: str = 'default'):
     """Decorator to apply rate limiting to endpoints"""
@@ -2582,26 +2619,28 @@ def check_rate_limit(limit_type: str = 'default'):
 
             # Rate limit by IP
             ip_key = f"ip:{ip}:{limit_type}"
-            if not rate_limiter.is_allowed(ip_key, limit_type):
-                wait_time = rate_limiter.get_wait_time(ip_key, limit_type)
+            decision = rate_limiter.check(ip_key, limit_type)
+            if not decision.allowed:
+                wait_time = math.ceil(decision.retry_after)
                 log_event(username or ip, 'security', 'rate_limit_exceeded', f'{limit_type} from {ip}')
                 return jsonify({
                     'error': f'Too many requests. Please wait {wait_time} seconds.',
                     'code': 'RATE_LIMITED',
                     'retry_after': wait_time
-                }), 429
+                }), 429, {'Retry-After': str(wait_time)}
 
             # Also rate limit by username if available (prevents distributed attacks)
             if username:
                 user_key = f"user:{username}:{limit_type}"
-                if not rate_limiter.is_allowed(user_key, limit_type):
-                    wait_time = rate_limiter.get_wait_time(user_key, limit_type)
+                decision = rate_limiter.check(user_key, limit_type)
+                if not decision.allowed:
+                    wait_time = math.ceil(decision.retry_after)
                     log_event(username, 'security', 'rate_limit_exceeded', f'{limit_type} for user {username}')
                     return jsonify({
                         'error': f'Too many requests. Please wait {wait_time} seconds.',
                         'code': 'RATE_LIMITED',
                         'retry_after': wait_time
-                    }), 429
+                    }), 429, {'Retry-After': str(wait_time)}
 
             return f(*args, **kwargs)
         return wrapped
@@ -2670,7 +2709,7 @@ class PostgreSQLCursorWrapper:
     
     def execute(self, query, params=()):
         """Execute and return self for method chaining"""
-        self.cursor.execute(query, params)
+        profile_execute(self.cursor, query, params)
         return self
     
     def fetchone(self):
@@ -2691,7 +2730,7 @@ def get_wrapped_cursor(conn):
     cursor = conn.cursor()
     try:
         # Wrap psycopg2 cursors to support chaining
-        if 'psycopg2' in str(type(cursor)):
+        if isinstance(cursor, psycopg2.extensions.cursor):
             return PostgreSQLCursorWrapper(cursor)
     except:
         pass
@@ -3217,6 +3256,11 @@ The user may be experiencing some difficulty. Please:
         return self.get_response(text)
 
 
+# AI_PROVIDER=local serves replies from the locally trained model (local_inference.py)
+if os.environ.get('AI_PROVIDER', 'groq').lower() == 'local':
+    from local_inference import LocalTherapistAI as TherapistAI
+
+
 CRISIS_RESOURCES = {
     'uk': {
         'samaritans': '116 123',
@@ -4920,7 +4964,11 @@ def validate_secret_key():
 
 
 def init_db():
-    """Initialize database - create critical tables if they don't exist"""
+    """Initialize database - create critical tables if they don't exist
+    
+    This is migration 1 (the baseline) in migrations.py and runs in the release
+    step, never at worker boot. New schema changes go in migrations.py.
+    """
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
@@ -5127,7 +5175,6 @@ def init_db():
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_notifications_recipient ON notifications(recipient_username)")
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_recipient ON messages(recipient_username)")
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_sender ON messages(sender_username)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_mood_logs_timestamp ON mood_logs(entry_timestamp DESC)")
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_clinical_scales_timestamp ON clinical_scales(entry_timestamp DESC)")
         # Phase 1.7: Recovery milestones table
         cursor.execute("""
@@ -5644,6 +5691,17 @@ def init_db():
             print(f"Migration note (messages enhancement): {e}")
             conn.rollback()
 
+        # 2a. Keyset paging index for conversation threads (newest-first by sent_at, id)
+        #     and partial index so the scheduled-message dispatcher only scans due rows
+        try:
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_conversation_sent ON messages(conversation_id, sent_at DESC, id DESC)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_unread_recipient ON messages(conversation_id, recipient_username) WHERE is_read = 0")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_scheduled_due ON messages(scheduled_for) WHERE delivery_status = 'scheduled'")
+            conn.commit()
+        except Exception as e:
+            print(f"Migration note (messages thread indexes): {e}")
+            conn.rollback()
+
         # 2b. Ensure soft-delete columns exist (fix for production DBs created before these were added)
         try:
             cursor.execute("ALTER TABLE messages ADD COLUMN IF NOT EXISTS is_deleted_by_sender INTEGER DEFAULT 0")
@@ -5859,10 +5917,320 @@ def init_db():
             print(f"Migration note (message_search_index): {e}")
             conn.rollback()
 
+        # 9. Broadcast fan-out jobs (progress record polled by the admin messaging page)
+        try:
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS broadcast_jobs (
+                    id SERIAL PRIMARY KEY,
+                    message_id INTEGER NOT NULL REFERENCES messages(id) ON DELETE CASCADE,
+                    conversation_id INTEGER NOT NULL REFERENCES conversations(id) ON DELETE CASCADE,
+                    sender_username VARCHAR(255) NOT NULL,
+                    recipient_filter VARCHAR(50) NOT NULL DEFAULT 'all',
+                    status VARCHAR(20) NOT NULL DEFAULT 'pending',
+                    total_recipients INTEGER NOT NULL DEFAULT 0,
+                    processed_recipients INTEGER NOT NULL DEFAULT 0,
+                    last_username VARCHAR(255),
+                    error TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    started_at TIMESTAMP,
+                    completed_at TIMESTAMP
+                )
+            """)
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_broadcast_jobs_open ON broadcast_jobs(id) WHERE status IN ('pending', 'running')")
+            conn.commit()
+        except Exception as e:
+            print(f"Migration note (broadcast_jobs): {e}")
+            conn.rollback()
+
+        # 10. Outbound email queue (drained by email_outbox.py)
+        try:
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS email_outbox (
+                    id SERIAL PRIMARY KEY,
+                    category VARCHAR(50) NOT NULL DEFAULT 'general',
+                    priority SMALLINT NOT NULL DEFAULT 2,
+                    to_email TEXT NOT NULL,
+                    subject TEXT NOT NULL,
+                    html_body TEXT,
+                    from_name VARCHAR(100) NOT NULL DEFAULT 'Healing Space UK',
+                    status VARCHAR(20) NOT NULL DEFAULT 'pending',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    last_error TEXT,
+                    next_attempt_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                    sent_at TIMESTAMP
+                )
+            """)
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_email_outbox_due ON email_outbox(priority, next_attempt_at, id) WHERE status = 'pending'")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_email_outbox_created ON email_outbox(created_at)")
+            conn.commit()
+        except Exception as e:
+            print(f"Migration note (email_outbox): {e}")
+            conn.rollback()
+
+        # 11. Cached report artifacts (PDFs rendered by report_service.py)
+        try:
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS report_artifacts (
+                    id SERIAL PRIMARY KEY,
+                    cache_key CHAR(64) NOT NULL UNIQUE,
+                    patient_username TEXT NOT NULL,
+                    report_type VARCHAR(50) NOT NULL,
+                    range_start DATE,
+                    range_end DATE,
+                    data_version TEXT NOT NULL,
+                    requested_by TEXT NOT NULL,
+                    status VARCHAR(20) NOT NULL DEFAULT 'queued',
+                    content BYTEA,
+                    content_type VARCHAR(100),
+                    filename TEXT,
+                    error TEXT,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                    started_at TIMESTAMP,
+                    completed_at TIMESTAMP
+                )
+            """)
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_report_artifacts_queue ON report_artifacts(created_at, id) WHERE status IN ('queued', 'rendering')")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_report_artifacts_patient ON report_artifacts(patient_username, report_type)")
+            conn.commit()
+        except Exception as e:
+            print(f"Migration note (report_artifacts): {e}")
+            conn.rollback()
+
+        # 12. FHIR bulk export jobs + NDJSON output parts (written by fhir_export.py)
+        try:
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS fhir_export_jobs (
+                    id SERIAL PRIMARY KEY,
+                    requested_by TEXT NOT NULL,
+                    scope VARCHAR(20) NOT NULL,
+                    patient_usernames TEXT[] NOT NULL,
+                    status VARCHAR(20) NOT NULL DEFAULT 'queued',
+                    progress JSONB NOT NULL DEFAULT '{}'::jsonb,
+                    manifest JSONB,
+                    signature JSONB,
+                    error TEXT,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                    started_at TIMESTAMP,
+                    heartbeat_at TIMESTAMP,
+                    completed_at TIMESTAMP
+                )
+            """)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS fhir_export_parts (
+                    job_id INTEGER NOT NULL REFERENCES fhir_export_jobs(id) ON DELETE CASCADE,
+                    part_no INTEGER NOT NULL,
+                    resource_type VARCHAR(50) NOT NULL,
+                    resource_count INTEGER NOT NULL,
+                    sha256 CHAR(64) NOT NULL,
+                    content BYTEA NOT NULL,
+                    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (job_id, part_no)
+                )
+            """)
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_fhir_export_jobs_queue ON fhir_export_jobs(created_at, id) WHERE status IN ('queued', 'running')")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_fhir_export_jobs_requested_by ON fhir_export_jobs(requested_by, created_at DESC)")
+            conn.commit()
+        except Exception as e:
+            print(f"Migration note (fhir_export_jobs): {e}")
+            conn.rollback()
+
+        # 13. Research export watermarks (written by research_export.py)
+        try:
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS research_export_watermarks (
+                    dataset VARCHAR(50) PRIMARY KEY,
+                    last_id BIGINT NOT NULL DEFAULT 0,
+                    rows_exported BIGINT NOT NULL DEFAULT 0,
+                    last_run_rows INTEGER NOT NULL DEFAULT 0,
+                    exported_at TIMESTAMP
+                )
+            """)
+            conn.commit()
+        except Exception as e:
+            print(f"Migration note (research_export_watermarks): {e}")
+            conn.rollback()
+
+        # 14. Training data tables + auto-training watermark and job queue (training_jobs.py)
+        try:
+            cursor.execute("CREATE TABLE IF NOT EXISTS training_chats (id SERIAL PRIMARY KEY, session_hash TEXT, user_hash TEXT, message_role TEXT, message_content TEXT, timestamp TIMESTAMP, mood_context INTEGER, assessment_severity TEXT)")
+            cursor.execute("CREATE TABLE IF NOT EXISTS training_audit (id SERIAL PRIMARY KEY, user_hash TEXT, action TEXT, details TEXT, timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP)")
+            # ai_trainer streams whole sessions in (session_hash, id) order
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_training_chats_session ON training_chats(session_hash, id)")
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS training_jobs (
+                    id SERIAL PRIMARY KEY,
+                    trigger VARCHAR(20) NOT NULL,
+                    requested_by TEXT,
+                    status VARCHAR(20) NOT NULL DEFAULT 'queued',
+                    pending_rows BIGINT,
+                    from_id BIGINT,
+                    trained_to_id BIGINT,
+                    error TEXT,
+                    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                    started_at TIMESTAMP,
+                    finished_at TIMESTAMP
+                )
+            """)
+            # At most one queued/running training job cluster-wide
+            cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_training_jobs_one_active ON training_jobs ((true)) WHERE status IN ('queued', 'running')")
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS training_watermark (
+                    id INTEGER PRIMARY KEY CHECK (id = 1),
+                    last_trained_id BIGINT NOT NULL DEFAULT 0,
+                    pending_rows BIGINT NOT NULL DEFAULT 0,
+                    scheduled_job_id INTEGER,
+                    trained_at TIMESTAMP
+                )
+            """)
+            cursor.execute("""
+                INSERT INTO training_watermark (id, pending_rows)
+                SELECT 1, COUNT(*) FROM training_chats
+                ON CONFLICT (id) DO NOTHING
+            """)
+            cursor.execute("""
+                CREATE OR REPLACE FUNCTION training_chats_count_pending() RETURNS trigger AS $$
+                BEGIN
+                    UPDATE training_watermark
+                    SET pending_rows = pending_rows + (SELECT COUNT(*) FROM new_rows)
+                    WHERE id = 1;
+                    RETURN NULL;
+                END
+                $$ LANGUAGE plpgsql
+            """)
+            cursor.execute("DROP TRIGGER IF EXISTS trg_training_chats_pending ON training_chats")
+            cursor.execute("""
+                CREATE TRIGGER trg_training_chats_pending
+                AFTER INSERT ON training_chats
+                REFERENCING NEW TABLE AS new_rows
+                FOR EACH STATEMENT EXECUTE FUNCTION training_chats_count_pending()
+            """)
+            conn.commit()
+        except Exception as e:
+            print(f"Migration note (training_watermark): {e}")
+            conn.rollback()
+
+        # 15. Training runner progress, heartbeat and cancellation (train_scheduler.py)
+        try:
+            cursor.execute("""
+                ALTER TABLE training_jobs
+                    ADD COLUMN IF NOT EXISTS to_id BIGINT,
+                    ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 0,
+                    ADD COLUMN IF NOT EXISTS progress JSONB,
+                    ADD COLUMN IF NOT EXISTS heartbeat_at TIMESTAMP,
+                    ADD COLUMN IF NOT EXISTS cancel_requested BOOLEAN NOT NULL DEFAULT FALSE
+            """)
+            conn.commit()
+        except Exception as e:
+            print(f"Migration note (training_jobs runner): {e}")
+            conn.rollback()
+
+        # 16. Shared rate-limit state (rate_limit.SharedGCRALimiter). UNLOGGED: losing
+        # limiter state in a crash only resets limits, and it skips WAL on every request
+        try:
+            cursor.execute("""
+                CREATE UNLOGGED TABLE IF NOT EXISTS rate_limits (
+                    limit_type TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    tat DOUBLE PRECISION NOT NULL,
+                    PRIMARY KEY (limit_type, key)
+                )
+            """)
+            # SQL twin of rate_limit.gcra_acquire; the server clock is shared by every node
+            cursor.execute("""
+                CREATE OR REPLACE FUNCTION rate_limit_acquire(p_type TEXT, p_key TEXT,
+                                                              p_interval DOUBLE PRECISION,
+                                                              p_window DOUBLE PRECISION, p_want INTEGER)
+                RETURNS TABLE (granted INTEGER, retry_after DOUBLE PRECISION) AS $$
+                DECLARE
+                    now_s DOUBLE PRECISION := EXTRACT(EPOCH FROM clock_timestamp());
+                    base DOUBLE PRECISION;
+                    n INTEGER;
+                BEGIN
+                    INSERT INTO rate_limits AS r (limit_type, key, tat) VALUES (p_type, p_key, now_s)
+                    ON CONFLICT (limit_type, key) DO UPDATE SET tat = GREATEST(r.tat, now_s)
+                    RETURNING r.tat INTO base;
+                    n := LEAST(p_want, floor((now_s + p_window - base) / p_interval + 1e-9)::INTEGER);
+                    IF n < 1 THEN
+                        RETURN QUERY SELECT 0, base + p_interval - p_window - now_s;
+                        RETURN;
+                    END IF;
+                    UPDATE rate_limits SET tat = base + n * p_interval
+                    WHERE limit_type = p_type AND key = p_key;
+                    RETURN QUERY SELECT n, 0.0::DOUBLE PRECISION;
+                END
+                $$ LANGUAGE plpgsql
+            """)
+            conn.commit()
+        except Exception as e:
+            print(f"Migration note (rate_limits): {e}")
+            conn.rollback()
+
         print("=" * 60)
         print("✅ Messaging System Database Migrations Complete!")
         print("=" * 60)
 
+        # ============================================================================
+        # Community feed: denormalized reaction/reply counters + keyset feed indexes
+        # ============================================================================
+        try:
+            cursor.execute("""
+                SELECT EXISTS (
+                    SELECT 1 FROM information_schema.columns
+                    WHERE table_name = 'community_posts' AND column_name = 'reaction_counts'
+                )
+            """)
+            if not cursor.fetchone()[0]:
+                print("Migrating: Adding community_posts reaction/reply counters...")
+                cursor.execute("ALTER TABLE community_posts ADD COLUMN IF NOT EXISTS reaction_counts JSONB NOT NULL DEFAULT '{}'::jsonb")
+                cursor.execute("ALTER TABLE community_posts ADD COLUMN IF NOT EXISTS reply_count INTEGER NOT NULL DEFAULT 0")
+                cursor.execute("UPDATE community_posts SET is_pinned = 0 WHERE is_pinned IS NULL")
+                refresh_community_post_counters(cursor)
+                print("✓ Migration: community_posts counters backfilled")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_community_posts_feed ON community_posts(is_pinned DESC, entry_timestamp DESC, id DESC)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_community_posts_category_feed ON community_posts(category, is_pinned DESC, entry_timestamp DESC, id DESC)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_community_likes_post_user ON community_likes(post_id, username)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_community_replies_post ON community_replies(post_id, timestamp, id)")
+            conn.commit()
+        except Exception as e:
+            print(f"Migration note (community feed counters): {e}")
+            conn.rollback()
+
+        # Community channel index: per-channel stats + one read marker per (user, channel)
+        try:
+            cursor.execute("""
+                SELECT EXISTS (
+                    SELECT 1 FROM information_schema.tables
+                    WHERE table_name = 'community_channel_stats'
+                )
+            """)
+            if not cursor.fetchone()[0]:
+                print("Migrating: Creating community_channel_stats table...")
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS community_channel_stats (
+                        channel TEXT PRIMARY KEY,
+                        post_count INTEGER NOT NULL DEFAULT 0,
+                        latest_post_at TIMESTAMP,
+                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    )
+                """)
+                refresh_community_channel_stats(cursor)
+                print("✓ Migration: community_channel_stats table created")
+            # ON CONFLICT (username, channel) needs a unique index; keep the newest marker per pair
+            cursor.execute("""
+                DELETE FROM community_channel_reads a USING community_channel_reads b
+                WHERE a.username = b.username AND a.channel = b.channel
+                AND (a.last_read < b.last_read OR (a.last_read = b.last_read AND a.id < b.id))
+            """)
+            cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_community_channel_reads_user_channel ON community_channel_reads(username, channel)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_community_posts_category_time ON community_posts(category, entry_timestamp)")
+            conn.commit()
+        except Exception as e:
+            print(f"Migration note (community_channel_stats): {e}")
+            conn.rollback()
+
         # ============================================================================
         # AI Memory system tables (for existing databases)
         # ============================================================================
@@ -6502,92 +6870,50 @@ def init_db():
         except:
             pass
         return False
+
+
+# Per-worker principal cache; writes that change a principal call principal_cache.notify()
+principal_cache = PrincipalCache(listen=os.getenv('TESTING') != '1')
+
+
+def get_current_principal():
+    """Resolve the session's Principal at most once per request (g.principal).
     
-    # Initialize CBT Tools database (TIER 0.5 - PostgreSQL migration)
-    try:
-        if 'init_cbt_tools_schema' in globals():
-            init_cbt_tools_schema()
-            print("✓ CBT Tools database schema initialized")
-        else:
-            print("⚠️  CBT Tools schema initialization skipped (cbt_tools not imported)")
-    except Exception as e:
-        print(f"CBT Tools initialization error: {e}")
+    SECURITY: Session is the ONLY valid authentication source. The session's
+    role must still match the user's row (read through principal_cache);
+    otherwise the session is cleared.
     
-    # Initialize pet database
-    try:
-        ensure_pet_table()
-        print("Pet database initialized successfully")
-    except Exception as e:
-        print(f"Pet database initialization error: {e}")
-
-    # ══ Safeguarding & Duty of Care (2.5) ══════════════════════════════════════
-    try:
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS safeguarding_concerns (
-                id                        SERIAL PRIMARY KEY,
-                patient_username          TEXT NOT NULL,
-                recording_clinician       TEXT NOT NULL,
-                duty_clinician_username   TEXT,
-                concern_category          TEXT NOT NULL,
-                statutory_framework       TEXT,
-                disclosure_method         TEXT NOT NULL DEFAULT 'clinician_observed',
-                disclosure_date           DATE NOT NULL DEFAULT CURRENT_DATE,
-                description               TEXT NOT NULL,
-                immediate_risk            BOOLEAN NOT NULL DEFAULT FALSE,
-                immediate_action_taken    TEXT,
-                patient_under_18          BOOLEAN DEFAULT FALSE,
-                gillick_competent         BOOLEAN,
-                capacity_assessed         BOOLEAN DEFAULT FALSE,
-                capacity_assessment_notes TEXT,
-                referral_required         BOOLEAN DEFAULT FALSE,
-                referral_agency           TEXT,
-                referral_made_at          TIMESTAMP,
-                referral_reference        TEXT,
-                referral_notes            TEXT,
-                supervisor_consulted      BOOLEAN DEFAULT FALSE,
-                supervisor_username       TEXT,
-                supervisor_notes          TEXT,
-                status                    TEXT NOT NULL DEFAULT 'open',
-                closed_at                 TIMESTAMP,
-                closed_by                 TEXT,
-                closure_notes             TEXT,
-                created_at                TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at                TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                CONSTRAINT valid_sg_status CHECK (status IN ('open','referred','monitoring','closed'))
-            )
-        """)
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_sg_patient ON safeguarding_concerns(patient_username)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_sg_clinician ON safeguarding_concerns(recording_clinician)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_sg_status ON safeguarding_concerns(status)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_sg_immediate ON safeguarding_concerns(immediate_risk) WHERE immediate_risk = TRUE")
-        conn.commit()
-        print("\u2713 Safeguarding: safeguarding_concerns table ready")
-    except Exception as e:
-        print(f"Safeguarding concerns migration note: {e}")
-        conn.rollback()
+    Returns: Principal if authenticated, None otherwise
+    """
+    key = (session.get('username'), session.get('role'))
+    if g.get('principal_key') == key:
+        return g.principal
+
+    principal = None
+    if key[0] and key[1]:
+        username, role = key
+        principal = principal_cache.get(username)
+        if principal is None:
+            generation = principal_cache.generation
+            conn = get_db_connection()
+            cur = get_wrapped_cursor(conn)
+            row = cur.execute(
+                "SELECT role, clinician_id FROM users WHERE username = %s",
+                (username,)
+            ).fetchone()
+            if row:
+                principal = Principal(username, row[0], row[1])
+                principal_cache.put(principal, generation)
+        
+        if principal is None or principal.role != role:
+            # User doesn't exist or role mismatch - invalidate session
+            session.clear()
+            principal = None
+            key = (None, None)
 
-    try:
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS duty_clinician (
-                id                  SERIAL PRIMARY KEY,
-                clinician_username  TEXT NOT NULL,
-                duty_date           DATE NOT NULL,
-                duty_start          TIME NOT NULL DEFAULT '08:00',
-                duty_end            TIME NOT NULL DEFAULT '18:00',
-                is_out_of_hours     BOOLEAN DEFAULT FALSE,
-                contact_phone       TEXT,
-                notes               TEXT,
-                created_by          TEXT,
-                created_at          TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE(duty_date, is_out_of_hours)
-            )
-        """)
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_duty_date ON duty_clinician(duty_date)")
-        conn.commit()
-        print("\u2713 Safeguarding: duty_clinician table ready")
-    except Exception as e:
-        print(f"Duty clinician migration note: {e}")
-        conn.rollback()
+    g.principal_key = key
+    g.principal = principal
+    return principal
 
 
 def get_authenticated_username():
@@ -6599,26 +6925,9 @@ def get_authenticated_username():
     Returns: username if authenticated, None otherwise
     """
     try:
-        # Use Flask session (secure, server-side, httponly)
-        if 'username' in session and 'role' in session:
-            username = session.get('username')
-            role = session.get('role')
-            
-            # Verify user still exists in database (prevents stale sessions)
-            conn = get_db_connection()
-            cur = get_wrapped_cursor(conn)
-            result = cur.execute(
-                "SELECT role FROM users WHERE username = %s AND role = %s",
-                (username, role)
-            ).fetchone()
-            conn.close()
-            
-            if result:
-                return username  # Session is valid
-            else:
-                # User doesn't exist or role mismatch - invalidate session
-                session.clear()
-                return None
+        principal = get_current_principal()
+        if principal:
+            return principal.username
         
         # Log any attempts to use header auth (suspicious activity)
         if request.headers.get('X-Username') and not session.get('username'):
@@ -6631,6 +6940,14 @@ def get_authenticated_username():
         print(f"❌ Auth error: {e}")
         return None
 
+
+def get_user_role_row(cur, username):
+    """(role,) row for username, served from g.principal when it is the authenticated user"""
+    principal = g.get('principal') if has_request_context() else None
+    if principal is not None and principal.username == username:
+        return (principal.role,)
+    return cur.execute("SELECT role FROM users WHERE username = %s", (username,)).fetchone()
+
 @CSRFProtection.require_csrf
 @app.route('/api/cbt/breathing', methods=['POST'])
 def create_breathing_exercise():
@@ -6762,11 +7079,6 @@ def summarize_breathing_exercises(username, limit=3):
     except Exception:
         return None
 
-# Initialize database on startup
-try:
-    init_db()
-except Exception as e:
-    print(f"Database initialization: {e}")
 
 # Initialize pet game database on startup
 def init_pet_db():
@@ -6832,7 +7144,7 @@ def admin_wipe_page():
         return redirect('/login')
     conn = get_db_connection()
     cur = get_wrapped_cursor(conn)
-    user_role = cur.execute("SELECT role FROM users WHERE username = %s", (username,)).fetchone()
+    user_role = get_user_role_row(cur, username)
     conn.close()
     if not user_role or user_role[0] != 'developer':
         return redirect('/')
@@ -6963,6 +7275,31 @@ def health_check():
     except Exception as e:
         return jsonify({'status': 'error', 'error': str(e)}), 500
 
+@app.route('/metrics', methods=['GET'])
+@limiter.exempt
+def prometheus_metrics():
+    """Per-endpoint request metrics for every web worker, in Prometheus text format
+
+    Scrapers authenticate with `Authorization: Bearer $METRICS_TOKEN` (when
+    METRICS_TOKEN is configured); otherwise a developer session is required.
+    """
+    token = os.getenv('METRICS_TOKEN')
+    supplied = request.headers.get('Authorization', '').removeprefix('Bearer ').strip()
+    if not (token and secrets.compare_digest(supplied, token)):
+        username = get_authenticated_username()
+        if not username:
+            return jsonify({'error': 'Authentication required'}), 401
+        conn = get_db_connection()
+        try:
+            user_role = get_user_role_row(get_wrapped_cursor(conn), username)
+        finally:
+            conn.close()
+        if not user_role or user_role[0] != 'developer':
+            return jsonify({'error': 'Developer role required'}), 403
+
+    return Response(render_prometheus(request_metrics.snapshot()),
+                    mimetype='text/plain; version=0.0.4; charset=utf-8')
+
 @CSRFProtection.require_csrf
 @app.route('/api/admin/wipe-database', methods=['POST'])
 def admin_wipe_database():
@@ -7475,6 +7812,7 @@ def change_password():
             "UPDATE users SET password=%s WHERE username=%s",
             (new_password_hash, username)
         )
+        principal_cache.notify(cur, username)
         
         # TIER 1.5: Invalidate all existing sessions for this user (force re-login on other devices)
         cur.execute("DELETE FROM sessions WHERE username=%s", (username,))
@@ -7663,26 +8001,35 @@ def forgot_password():
         print(f"Password reset error: {e}")  # Server-side logging only
         return handle_exception(e, 'password_reset')
 
+def queue_email(to_email, subject, html, category, priority, from_name='Healing Space UK'):
+    """
+    Add an email to the outbox for the email_outbox.py sender worker.
+
+    Uses its own pooled connection so the row is committed (and survives)
+    independently of the caller's transaction. Returns True if queued.
+    """
+    if not smtp_configured():
+        print(f"⚠️  {category} email skipped: SMTP not configured")
+        return False
+    try:
+        with get_db_connection_pooled() as conn:
+            cur = conn.cursor()
+            enqueue_email(cur, to_email, subject, html, category=category,
+                          priority=priority, from_name=from_name)
+            conn.commit()
+        return True
+    except Exception as e:
+        app_logger.error(f"Failed to queue {category} email: {e}")
+        return False
+
+
 def send_reset_email(to_email, username, reset_token):
-    """Send branded password reset email via SMTP"""
+    """Queue branded password reset email"""
     try:
-        smtp_server = os.getenv('SMTP_SERVER', 'smtp.gmail.com')
-        smtp_port = int(os.getenv('SMTP_PORT', '587'))
-        smtp_user = os.getenv('SMTP_USER')
-        smtp_password = os.getenv('SMTP_PASSWORD')
-        from_email = os.getenv('FROM_EMAIL', smtp_user)
         base_url = os.getenv('APP_URL', 'http://localhost:5000')
 
-        if not smtp_user or not smtp_password:
-            raise Exception("SMTP credentials not configured. Set SMTP_USER and SMTP_PASSWORD environment variables.")
-
         reset_url = f"{base_url}/reset-password?token={reset_token}&username={username}"
 
-        msg = MIMEMultipart('alternative')
-        msg['Subject'] = 'Healing Space UK — Password Reset'
-        msg['From'] = f'Healing Space UK <{from_email}>'
-        msg['To'] = to_email
-
         html = f"""
         <html>
           <body style="font-family:Inter,Arial,sans-serif;background:#f9fafb;padding:32px 0;margin:0;">
@@ -7722,40 +8069,27 @@ def send_reset_email(to_email, username, reset_token):
         </html>
         """
 
-        msg.attach(MIMEText(html, 'html'))
-
-        with smtplib.SMTP(smtp_server, smtp_port) as server:
-            server.starttls()
-            server.login(smtp_user, smtp_password)
-            server.send_message(msg)
+        if not queue_email(to_email, 'Healing Space UK — Password Reset', html,
+                           'password_reset', PRIORITY_SECURITY):
+            return False
 
-        print(f"✅ Password reset email sent to {to_email}")
+        print(f"✅ Password reset email queued for {to_email}")
         return True
 
     except Exception as e:
-        print(f"❌ Error sending password reset email: {e}")
+        print(f"❌ Error queueing password reset email: {e}")
         return False
 
 
 def send_risk_alert_email(to_email: str, patient_username: str, clinician_username: str,
                           severity: str, alert_type: str, details: str) -> bool:
     """
-    Send a high-risk patient alert email to the assigned clinician.
-    Uses GMAIL_ADDRESS + GMAIL_APP_PASSWORD env vars (falls back to SMTP_* vars).
+    Queue a high-risk patient alert email to the assigned clinician.
+    Critical/high severity alerts are sent ahead of everything else in the outbox.
     """
     try:
-        # Gmail-specific overrides take priority; fall back to generic SMTP vars
-        smtp_server = os.getenv('SMTP_SERVER', 'smtp.gmail.com')
-        smtp_port = int(os.getenv('SMTP_PORT', '587'))
-        smtp_user = os.getenv('GMAIL_ADDRESS') or os.getenv('SMTP_USER')
-        smtp_password = os.getenv('GMAIL_APP_PASSWORD') or os.getenv('SMTP_PASSWORD')
-        from_email = os.getenv('FROM_EMAIL', smtp_user)
         app_url = os.getenv('APP_URL', 'https://healing-space.org.uk')
 
-        if not smtp_user or not smtp_password:
-            print("⚠️  Risk alert email skipped: GMAIL_ADDRESS/GMAIL_APP_PASSWORD not configured")
-            return False
-
         severity_upper = severity.upper()
         severity_color = {
             'critical': '#dc2626',
@@ -7764,11 +8098,6 @@ def send_risk_alert_email(to_email: str, patient_username: str, clinician_userna
             'low':      '#16a34a',
         }.get(severity, '#6b7280')
 
-        msg = MIMEMultipart('alternative')
-        msg['Subject'] = f"⚠️ [{severity_upper}] Risk Alert — Patient: {patient_username}"
-        msg['From'] = f"Healing Space UK Alerts <{from_email}>"
-        msg['To'] = to_email
-
         html = f"""
         <html>
           <body style="font-family:Inter,Arial,sans-serif;background:#f9fafb;padding:32px 0;margin:0;">
@@ -7817,14 +8146,12 @@ def send_risk_alert_email(to_email: str, patient_username: str, clinician_userna
         </html>
         """
 
-        msg.attach(MIMEText(html, 'html'))
-
-        with smtplib.SMTP(smtp_server, smtp_port) as server:
-            server.starttls()
-            server.login(smtp_user, smtp_password)
-            server.send_message(msg)
+        priority = PRIORITY_CRISIS if severity in ('critical', 'high') else PRIORITY_ALERT
+        if not queue_email(to_email, f"⚠️ [{severity_upper}] Risk Alert — Patient: {patient_username}",
+                           html, 'risk_alert', priority, from_name='Healing Space UK Alerts'):
+            return False
 
-        print(f"✅ Risk alert email sent to {to_email} (patient: {patient_username}, severity: {severity})")
+        print(f"✅ Risk alert email queued for {to_email} (patient: {patient_username}, severity: {severity})")
         return True
 
     except Exception as e:
@@ -7832,13 +8159,49 @@ def send_risk_alert_email(to_email: str, patient_username: str, clinician_userna
         return False
 
 
-@CSRFProtection.require_csrf
-@check_rate_limit('confirm_reset')
-@app.route('/api/auth/confirm-reset', methods=['POST'])
-def confirm_password_reset():
-    """Complete password reset with token"""
+def send_appointment_reminder_email(to_email: str, patient_username: str, subject: str, body: str) -> bool:
+    """Queue an appointment reminder email (lowest outbox priority)."""
     try:
-        data = request.json
+        from html import escape as _esc
+        body_html = _esc(body).replace('\n', '<br>')
+
+        html = f"""
+        <html>
+          <body style="font-family:Inter,Arial,sans-serif;background:#f9fafb;padding:32px 0;margin:0;">
+            <div style="max-width:600px;margin:0 auto;background:#fff;border-radius:12px;overflow:hidden;box-shadow:0 4px 24px rgba(0,0,0,0.08);">
+              <div style="background:linear-gradient(135deg,#667eea 0%,#764ba2 100%);padding:24px 32px;">
+                <h1 style="color:#fff;margin:0;font-size:1.25rem;font-weight:700;">Healing Space UK</h1>
+                <p style="color:rgba(255,255,255,0.85);margin:4px 0 0;font-size:0.875rem;">Appointment Reminder</p>
+              </div>
+              <div style="padding:32px;">
+                <p style="color:#6b7280;margin:0 0 16px;font-size:0.9rem;">
+                  Hello <strong style="color:#374151;">{_esc(patient_username)}</strong>,
+                </p>
+                <p style="color:#374151;margin:0 0 24px;font-size:0.9rem;">{body_html}</p>
+                <p style="margin:16px 0 0;font-size:0.8rem;color:#9ca3af;">
+                  &mdash; The Healing Space UK Team<br>
+                  <a href="https://healing-space.org.uk" style="color:#667eea;text-decoration:none;">healing-space.org.uk</a>
+                </p>
+              </div>
+            </div>
+          </body>
+        </html>
+        """
+
+        return queue_email(to_email, subject, html, 'appointment_reminder', PRIORITY_REMINDER)
+
+    except Exception as e:
+        print(f"❌ Appointment reminder email failed: {e}")
+        return False
+
+
+@CSRFProtection.require_csrf
+@check_rate_limit('confirm_reset')
+@app.route('/api/auth/confirm-reset', methods=['POST'])
+def confirm_password_reset():
+    """Complete password reset with token"""
+    try:
+        data = request.json
         username = data.get('username')
         token = data.get('token')
         new_password = data.get('new_password')
@@ -7890,6 +8253,7 @@ def confirm_password_reset():
             "UPDATE users SET password=%s, reset_token=NULL, reset_token_expiry=NULL WHERE username = %s",
             (hashed_password, username)
         )
+        principal_cache.notify(cur, username)
 
         # SECURITY: Invalidate all existing sessions for this user
         cur.execute("DELETE FROM sessions WHERE username=%s", (username,))
@@ -7912,25 +8276,9 @@ def confirm_password_reset():
 
 
 def send_verification_code(identifier, code, method='email'):
-    """Send 2FA verification code via email or SMS"""
+    """Send 2FA verification code via email (queued) or SMS"""
     try:
         if method == 'email':
-            # Get SMTP credentials
-            smtp_server = os.getenv('SMTP_SERVER', 'smtp.gmail.com')
-            smtp_port = int(os.getenv('SMTP_PORT', '587'))
-            smtp_user = os.getenv('SMTP_USER')
-            smtp_password = os.getenv('SMTP_PASSWORD')
-            from_email = os.getenv('FROM_EMAIL', smtp_user)
-            
-            if not smtp_user or not smtp_password:
-                print("⚠️  SMTP not configured - skipping email verification")
-                return False
-            
-            msg = MIMEMultipart('alternative')
-            msg['Subject'] = 'Healing Space UK — Your Verification Code'
-            msg['From'] = f'Healing Space UK <{from_email}>'
-            msg['To'] = identifier
-
             html = f"""
             <html>
               <body style="font-family:Inter,Arial,sans-serif;background:#f9fafb;padding:32px 0;margin:0;">
@@ -7958,14 +8306,11 @@ def send_verification_code(identifier, code, method='email'):
             </html>
             """
 
-            msg.attach(MIMEText(html, 'html'))
-
-            with smtplib.SMTP(smtp_server, smtp_port) as server:
-                server.starttls()
-                server.login(smtp_user, smtp_password)
-                server.send_message(msg)
+            if not queue_email(identifier, 'Healing Space UK — Your Verification Code', html,
+                               'verification_code', PRIORITY_SECURITY):
+                return False
             
-            print(f"✅ Verification code sent to {identifier}")
+            print(f"✅ Verification code queued for {identifier}")
             return True
             
         elif method == 'sms':
@@ -8000,18 +8345,6 @@ def send_verification_code(identifier, code, method='email'):
     except Exception as e:
         print(f"❌ Error sending verification code: {e}")
         return False
-        with smtplib.SMTP(smtp_server, smtp_port) as server:
-            server.starttls()
-            server.login(smtp_user, smtp_password)
-            server.send_message(msg)
-        
-        print(f"Reset email sent to {to_email}")
-        return True
-        
-    except Exception as e:
-        error_msg = f"Email send error: {str(e)}"
-        print(error_msg)
-        raise Exception(error_msg)
 
 @CSRFProtection.require_csrf
 @check_rate_limit('clinician_register')
@@ -8191,7 +8524,7 @@ def execute_terminal():
         # Verify developer role
         conn = get_db_connection()
         cur = get_wrapped_cursor(conn)
-        role = cur.execute("SELECT role FROM users WHERE username=%s", (username,)).fetchone()
+        role = get_user_role_row(cur, username)
 
         if not role or role[0] != 'developer':
             conn.close()
@@ -8319,7 +8652,7 @@ ARCHITECTURE:
 KEY TABLES:
 - users (username, password_hash, role, created_at, last_login)
 - chat_history (session_id, chat_session_id, username, role, message, timestamp)
-- mood_logs (username, mood, entry_timestamp), wellness_logs (username, timestamp)
+- mood_logs (username, mood_val, entrestamp), wellness_logs (username, timestamp)
 - patient_wins (username, win_type, win_text, created_at)
 - ai_memory_core, ai_activity_log, ai_memory_events, ai_memory_flags
 - patient_approvals (patient_username, clinician_username, status)
@@ -8358,7 +8691,7 @@ def developer_ai_chat():
         # Verify developer role
         conn = get_db_connection()
         cur = get_wrapped_cursor(conn)
-        role = cur.execute("SELECT role FROM users WHERE username=%s", (username,)).fetchone()
+        role = get_user_role_row(cur, username)
 
         if not role or role[0] != 'developer':
             conn.close()
@@ -8446,7 +8779,7 @@ def send_dev_message():
         # Check sender exists and get role
         conn = get_db_connection()
         cur = get_wrapped_cursor(conn)
-        sender_user = cur.execute("SELECT role FROM users WHERE username=%s", (from_username,)).fetchone()
+        sender_user = get_user_role_row(cur, from_username)
 
         if not sender_user:
             conn.close()
@@ -8494,7 +8827,7 @@ def send_dev_message():
         
         # Clinician: can only message patients
         elif sender_role == 'clinician':
-            recipient_user = cur.execute("SELECT role FROM users WHERE username=%s", (to_username,)).fetchone()
+            recipient_user = get_user_role_row(cur, to_username)
             if not recipient_user or recipient_user[0] != 'user':
                 conn.close()
                 return jsonify({'error': 'Clinicians can only send messages to patients'}), 403
@@ -8513,7 +8846,7 @@ def send_dev_message():
         
         # Patient: can only message developer
         elif sender_role == 'user':
-            recipient_user = cur.execute("SELECT role FROM users WHERE username=%s", (to_username,)).fetchone()
+            recipient_user = get_user_role_row(cur, to_username)
             if not recipient_user or recipient_user[0] != 'developer':
                 conn.close()
                 return jsonify({'error': 'Patients can only send messages to developers'}), 403
@@ -8552,7 +8885,7 @@ def list_dev_messages():
         cur = get_wrapped_cursor(conn)
 
         # Get role
-        role = cur.execute("SELECT role FROM users WHERE username=%s", (username,)).fetchone()
+        role = get_user_role_row(cur, username)
 
         if role and role[0] == 'developer':
             # Developer sees all messages they sent + replies
@@ -8867,7 +9200,7 @@ def developer_stats():
         # Verify developer role
         conn = get_db_connection()
         cur = get_wrapped_cursor(conn)
-        role = cur.execute("SELECT role FROM users WHERE username=%s", (username,)).fetchone()
+        role = get_user_role_row(cur, username)
 
         if not role or role[0] != 'developer':
             conn.close()
@@ -8908,7 +9241,7 @@ def list_all_users():
         # Verify developer role
         conn = get_db_connection()
         cur = get_wrapped_cursor(conn)
-        role = cur.execute("SELECT role FROM users WHERE username=%s", (username,)).fetchone()
+        role = get_user_role_row(cur, username)
 
         if not role or role[0] != 'developer':
             conn.close()
@@ -8957,14 +9290,14 @@ def delete_user():
         # Verify developer role
         conn = get_db_connection()
         cur = get_wrapped_cursor(conn)
-        role = cur.execute("SELECT role FROM users WHERE username=%s", (dev_username,)).fetchone()
+        role = get_user_role_row(cur, dev_username)
 
         if not role or role[0] != 'developer':
             conn.close()
             return jsonify({'error': 'Unauthorized'}), 403
 
         # Prevent deleting developer account
-        target_role = cur.execute("SELECT role FROM users WHERE username=%s", (target_username,)).fetchone()
+        target_role = get_user_role_row(cur, target_username)
         if not target_role:
             conn.close()
             return jsonify({'error': 'User not found'}), 404
@@ -8991,12 +9324,17 @@ def delete_user():
         cur.execute("DELETE FROM appointments WHERE patient_username=%s OR clinician_username=%s", (target_username, target_username))
         cur.execute("DELETE FROM dev_messages WHERE from_username=%s OR to_username=%s", (target_username, target_username))
         cur.execute("DELETE FROM dev_ai_chats WHERE username=%s", (target_username,))
-        cur.execute("DELETE FROM community_posts WHERE username=%s", (target_username,))
-        cur.execute("DELETE FROM community_likes WHERE username=%s", (target_username,))
-        cur.execute("DELETE FROM community_replies WHERE username=%s", (target_username,))
+        touched_channels = {r[0] for r in cur.execute("DELETE FROM community_posts WHERE username=%s RETURNING category", (target_username,)).fetchall() if r[0]}
+        if touched_channels:
+            refresh_community_channel_stats(cur, sorted(touched_channels))
+        touched_posts = {r[0] for r in cur.execute("DELETE FROM community_likes WHERE username=%s RETURNING post_id", (target_username,)).fetchall()}
+        touched_posts |= {r[0] for r in cur.execute("DELETE FROM community_replies WHERE username=%s RETURNING post_id", (target_username,)).fetchall()}
+        if touched_posts:
+            refresh_community_post_counters(cur, sorted(touched_posts))
         cur.execute("DELETE FROM patient_approvals WHERE patient_username=%s OR clinician_username=%s", (target_username, target_username))
         cur.execute("DELETE FROM verification_codes WHERE identifier=%s", (target_username,))
         cur.execute("DELETE FROM users WHERE username=%s", (target_username,))
+        principal_cache.notify(cur, target_username)
 
         conn.commit()
         conn.close()
@@ -9141,7 +9479,7 @@ def quick_poll():
             (username,)
         ).fetchone()[0]
 
-        role_row = cur.execute("SELECT role FROM users WHERE username=%s", (username,)).fetchone()
+        role_row = get_user_role_row(cur, username)
         role = role_row[0] if role_row else 'user'
 
         risk_count = 0
@@ -9169,16 +9507,17 @@ def quick_poll():
                   AND reminder_48h_sent = FALSE
                   AND attendance_status = 'scheduled'
                   AND deleted_at IS NULL
-                RETURNING id, patient_username, clinician_username, appointment_date, location_type
+                RETURNING id, patient_username, clinician_username, appointment_date, location_type,
+                          (SELECT email FROM users WHERE username = appointments.patient_username)
             """, (_now + _tdr(hours=47), _now + _tdr(hours=49))).fetchall()
             for _r in _due_48h:
-                _apt_id, _pat, _clin, _apt_dt, _loc = _r
+                _apt_id, _pat, _clin, _apt_dt, _loc, _pat_email = _r
                 _loc_str = {'video': '📹 Video Call', 'phone': '📞 Phone', 'in_person': '🏢 In-Person'}.get(_loc or 'in_person', '🏢 In-Person')
                 _apt_str = _apt_dt.strftime('%A %d %B at %H:%M')
                 send_notification(_pat, f'⏰ Reminder: {_loc_str} appointment with {_clin} in 48 hours — {_apt_str}', 'appointment_reminder')
                 send_notification(_clin, f'⏰ Reminder: appointment with {_pat} in 48 hours — {_apt_str}', 'appointment_reminder')
-                try: send_risk_alert_email(_pat, f'Appointment Reminder: {_apt_str}', f'Your {_loc_str} appointment is in 48 hours.\n\nClinician: {_clin}\nDate: {_apt_str}', _clin)
-                except Exception: pass
+                if _pat_email:
+                    send_appointment_reminder_email(_pat_email, _pat, f'Appointment Reminder: {_apt_str}', f'Your {_loc_str} appointment is in 48 hours.\n\nClinician: {_clin}\nDate: {_apt_str}')
 
             _due_24h = cur.execute("""
                 UPDATE appointments SET reminder_24h_sent = TRUE
@@ -9186,18 +9525,19 @@ def quick_poll():
                   AND reminder_24h_sent = FALSE
                   AND attendance_status = 'scheduled'
                   AND deleted_at IS NULL
-                RETURNING id, patient_username, clinician_username, appointment_date, location_type, video_link
+                RETURNING id, patient_username, clinician_username, appointment_date, location_type, video_link,
+                          (SELECT email FROM users WHERE username = appointments.patient_username)
             """, (_now + _tdr(hours=23), _now + _tdr(hours=25))).fetchall()
             for _r in _due_24h:
-                _apt_id, _pat, _clin, _apt_dt, _loc, _vlink = _r
+                _apt_id, _pat, _clin, _apt_dt, _loc, _vlink, _pat_email = _r
                 _loc_str = {'video': '📹 Video Call', 'phone': '📞 Phone', 'in_person': '🏢 In-Person'}.get(_loc or 'in_person', '🏢 In-Person')
                 _apt_str = _apt_dt.strftime('%A %d %B at %H:%M')
                 _link_note = f'\n\nJoin link: {_vlink}' if _loc == 'video' and _vlink else ''
                 _pat_msg = f'⏰ Reminder: {_loc_str} appointment tomorrow — {_apt_str}' + (f'. Join: {_vlink}' if _loc == 'video' and _vlink else '')
                 send_notification(_pat, _pat_msg, 'appointment_reminder')
                 send_notification(_clin, f'⏰ Reminder: appointment with {_pat} tomorrow — {_apt_str}', 'appointment_reminder')
-                try: send_risk_alert_email(_pat, f'Appointment Tomorrow: {_apt_str}', f'Your {_loc_str} appointment is tomorrow.\n\nClinician: {_clin}\nDate: {_apt_str}{_link_note}', _clin)
-                except Exception: pass
+                if _pat_email:
+                    send_appointment_reminder_email(_pat_email, _pat, f'Appointment Tomorrow: {_apt_str}', f'Your {_loc_str} appointment is tomorrow.\n\nClinician: {_clin}\nDate: {_apt_str}{_link_note}')
 
             if _due_48h or _due_24h:
                 conn.commit()
@@ -9301,6 +9641,7 @@ def approve_patient(approval_id):
             "UPDATE users SET clinician_id= %s WHERE username = %s",
             (clinician_username, patient_username)
         )
+        principal_cache.notify(cur, patient_username)
         
         # Notify patient of approval
         cur.execute(
@@ -9561,7 +9902,6 @@ def reward_pet(action, activity_type=None):
     Attributes deplete over time at 0.5 per hour (gentle decay).
     """
     try:
-        ensure_pet_table()
         conn = get_pet_db_connection()
         cur = get_wrapped_cursor(conn)
         cur.execute("SELECT * FROM pet LIMIT 1"); pet = cur.fetchone()
@@ -9694,7 +10034,7 @@ def therapy_chat():
         # Get conversation history from current session
         try:
             history = cur.execute(
-                "SELECT sender, message FROM chat_history WHERE chat_session_id = %s ORDER BY timestamp DESC LIMIT 10",
+                "SELECT sender, message FROM chat_history WHERE chat_session_id = %s ORDER BY id DESC LIMIT 10",
                 (chat_session_id,)
             ).fetchall()
         except Exception as hist_error:
@@ -9834,10 +10174,13 @@ def therapy_chat():
             chat_session_id = active_session[0]
         
         # Save messages with both session_id (for clinician access) and chat_session_id (for user organization)
-        cur.execute("INSERT INTO chat_history (session_id, chat_session_id, sender, message) VALUES (%s,%s,%s,%s)",
+        # The new ids let the client fetch only later messages (/api/therapy/history?after_id=)
+        cur.execute("INSERT INTO chat_history (session_id, chat_session_id, sender, message) VALUES (%s,%s,%s,%s) RETURNING id",
                    (f"{username}_session", chat_session_id, "user", message))
-        cur.execute("INSERT INTO chat_history (session_id, chat_session_id, sender, message) VALUES (%s,%s,%s,%s)",
+        user_message_id = cur.fetchone()[0]
+        cur.execute("INSERT INTO chat_history (session_id, chat_session_id, sender, message) VALUES (%s,%s,%s,%s) RETURNING id",
                    (f"{username}_session", chat_session_id, "ai", response))
+        ai_message_id = cur.fetchone()[0]
         
         # Update session last_active
         cur.execute(
@@ -9892,46 +10235,24 @@ def therapy_chat():
                     mood_context=mood_context
                 )
                 
-                # Check if we should trigger background training (Railway only)
+                # Queue background training once enough new rows have arrived (Railway only).
+                # training_watermark is maintained by a trigger on training_chats, so this
+                # is one primary-key read; training itself runs in train_scheduler.py.
                 try:
                     from training_config import get_training_config, IS_RAILWAY
                     config = get_training_config()
                     
                     if config['enable_auto_training'] and IS_RAILWAY:
-                        # Check number of new messages since last training
-                        conn = get_pet_db_connection()  # Use pet connection for now
-                        cur = get_wrapped_cursor(conn)
-                        
-                        # Get last trained ID from metrics file
-                        import json
-                        metrics_file = os.path.join(config['model_storage'], 'training_metrics.json')
-                        last_trained_id = 0
-                        if os.path.exists(metrics_file):
-                            try:
-                                with open(metrics_file, 'r') as f:
-                                    metrics = json.load(f)
-                                    last_trained_id = metrics.get('last_trained_id', 0)
-                            except:
-                                pass
-                        
-                        new_count = cur.execute(
-                            "SELECT COUNT(*) FROM training_chats WHERE id > %s",
-                            (last_trained_id,)
-                        ).fetchone()[0]
-                        conn.close()
-                        
-                        # Trigger training if threshold reached
-                        if new_count >= config['auto_train_threshold']:
-                            import threading
-                            from ai_trainer import train_background_model
-                            
-                            def train_async():
-                                print(f"🚀 Auto-triggering training ({new_count} new messages)...")
-                                train_background_model(epochs=config['epochs'])
-                            
-                            thread = threading.Thread(target=train_async, daemon=True)
-                            thread.start()
-                            print(f"✅ Background training started ({new_count} new messages)")
+                        conn = get_db_connection()
+                        cur = conn.cursor()
+                        threshold = config['auto_train_threshold']
+                        if training_jobs.should_schedule(cur, threshold):
+                            job_id = training_jobs.schedule_training(cur, threshold)
+                            conn.commit()
+                            if job_id:
+                                print(f"✅ Background training queued (job {job_id})")
+                        else:
+                            conn.rollback()
                 except Exception as e:
                     print(f"Auto-training check error: {e}")
                 
@@ -9952,7 +10273,7 @@ def therapy_chat():
                 conn = get_db_connection()
                 cur = get_wrapped_cursor(conn)
                 recent_history = cur.execute(
-                    "SELECT sender, message FROM chat_history WHERE chat_session_id = %s ORDER BY timestamp DESC LIMIT 6",
+                    "SELECT sender, message FROM chat_history WHERE chat_session_id = %s ORDER BY id DESC LIMIT 6",
                     (chat_session_id,)
                 ).fetchall()
                 conn.close()
@@ -9979,7 +10300,10 @@ def therapy_chat():
         response_data = {
             'success': True,
             'response': response,
-            'timestamp': datetime.now().isoformat()
+            'timestamp': datetime.now().isoformat(),
+            'chat_session_id': chat_session_id,
+            'user_message_id': user_message_id,
+            'ai_message_id': ai_message_id
         }
         
         # Include risk analysis if available
@@ -10004,60 +10328,113 @@ def therapy_chat():
             'code': 'UNEXPECTED_ERROR'
         }), 500
 
+
+CHAT_HISTORY_PAGE_SIZE = 100
+CHAT_HISTORY_MAX_PAGE_SIZE = 500
+
+
+def fetch_chat_history_page(cur, column, value, limit=CHAT_HISTORY_PAGE_SIZE, before_id=None, after_id=None):
+    """Get a keyset page of chat_history rows where `column` (chat_session_id or session_id) = value
+
+    Pages are keyed on the chat_history id, which increases with time:
+      - no cursor: the newest `limit` messages
+      - before_id: the `limit` messages immediately older than before_id
+      - after_id: messages newer than after_id (delta refresh), capped at `limit`
+
+    Messages are returned oldest-first. Returns {history, has_more,
+    next_before_id, latest_id}.
+    """
+    if column not in ('chat_session_id', 'session_id'):
+        raise ValueError(f"Unsupported chat_history key: {column}")
+    if before_id and after_id:
+        raise ValueError("Use either before_id or after_id, not both")
+
+    # Fetch one extra row to learn whether another page exists
+    if after_id:
+        rows = cur.execute(
+            f"SELECT id, sender, message, timestamp FROM chat_history WHERE {column} = %s AND id > %s "
+            "ORDER BY id ASC LIMIT %s",
+            (value, after_id, limit + 1)
+        ).fetchall()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+    else:
+        if before_id:
+            rows = cur.execute(
+                f"SELECT id, sender, message, timestamp FROM chat_history WHERE {column} = %s AND id < %s "
+                "ORDER BY id DESC LIMIT %s",
+                (value, before_id, limit + 1)
+            ).fetchall()
+        else:
+            rows = cur.execute(
+                f"SELECT id, sender, message, timestamp FROM chat_history WHERE {column} = %s "
+                "ORDER BY id DESC LIMIT %s",
+                (value, limit + 1)
+            ).fetchall()
+        has_more = len(rows) > limit
+        rows = list(reversed(rows[:limit]))
+
+    return {
+        'history': [{'id': r[0], 'sender': r[1], 'message': r[2], 'timestamp': r[3]} for r in rows],
+        'has_more': has_more,
+        'next_before_id': rows[0][0] if rows and has_more and not after_id else None,
+        'latest_id': rows[-1][0] if rows else after_id
+    }
+
+
 @app.route('/api/therapy/history', methods=['GET'])
 def get_chat_history():
-    """Get chat history for a user (optionally filtered by chat session)"""
+    """Get a page of chat history for a user (optionally for a specific chat session)
+
+    Pass `next_before_id` back as `before_id` for older messages, or the
+    last seen id (or the ids returned by /api/therapy/chat) as `after_id`
+    to fetch only newer ones.
+    """
     try:
         username = get_authenticated_username()
         if not username:
             return jsonify({'error': 'Authentication required'}), 401
         chat_session_id = request.args.get('chat_session_id')  # Optional: specific session
-        
+
+        limit = request.args.get('limit', CHAT_HISTORY_PAGE_SIZE, type=int)
+        limit = max(1, min(limit, CHAT_HISTORY_MAX_PAGE_SIZE))
+        before_id = request.args.get('before_id', type=int)
+        after_id = request.args.get('after_id', type=int)
+        if before_id and after_id:
+            return jsonify({'error': 'Use either before_id or after_id, not both'}), 400
+
         conn = get_db_connection()
         cur = get_wrapped_cursor(conn)
-        
+
         if chat_session_id:
-            # Get history for specific chat session
-            history = cur.execute(
-                "SELECT sender, message, timestamp FROM chat_history WHERE chat_session_id = %s ORDER BY timestamp ASC",
-                (chat_session_id,)
-            ).fetchall()
+            # History for a specific chat session
+            key = ('chat_session_id', chat_session_id)
         else:
-            # Get history from active session, or all history if no sessions exist yet
+            # History from active session, or all history if no sessions exist yet
             active_session = cur.execute(
                 "SELECT id FROM chat_sessions WHERE username = %s AND is_active=1",
                 (username,)
             ).fetchone()
-            
+
             if active_session:
-                history = cur.execute(
-                    "SELECT sender, message, timestamp FROM chat_history WHERE chat_session_id = %s ORDER BY timestamp ASC",
-                    (active_session[0],)
-                ).fetchall()
+                key = ('chat_session_id', active_session[0])
             else:
-                # Backward compatibility: get all messages with old session_id
-                history = cur.execute(
-                    "SELECT sender, message, timestamp FROM chat_history WHERE session_id = %s ORDER BY timestamp ASC",
-                    (f"{username}_session",)
-                ).fetchall()
-        
+                # Backward compatibility: messages with the old session_id
+                key = ('session_id', f"{username}_session")
+
+        page = fetch_chat_history_page(cur, *key, limit=limit, before_id=before_id, after_id=after_id)
         conn.close()
-        
-        return jsonify({
-            'success': True,
-            'history': [{'sender': h[0], 'message': h[1], 'timestamp': h[2]} for h in history]
-        }), 200
+
+        return jsonify({'success': True, **page}), 200
     except Exception as e:
         return handle_exception(e, request.endpoint or 'unknown')
 
 @CSRFProtection.require_csrf
 @app.route('/api/therapy/export', methods=['POST'])
 def export_chat_history():
-    """Export chat history with date range filter"""
-    import csv
-    import io
-    from datetime import datetime
-    
+    """Export chat history with date range filter (streamed)"""
+    from datetime import datetime, timedelta
+
     try:
         data = request.json
         username = data.get('username')
@@ -10069,81 +10446,54 @@ def export_chat_history():
         if not username or not from_date or not to_date:
             return jsonify({'error': 'Username, from_date, and to_date required'}), 400
         
-        # Convert dates to datetime objects
-        from_datetime = datetime.strptime(from_date, '%Y-%m-%d')
-        to_datetime = datetime.strptime(to_date, '%Y-%m-%d').replace(hour=23, minute=59, second=59)
-        
-        conn = get_db_connection()
-        cur = get_wrapped_cursor(conn)
+        try:
+            window = parse_date_range(from_date, to_date)
+        except ValueError:
+            return jsonify({'error': 'Dates must be YYYY-MM-DD'}), 400
         
         if chat_session_id:
             # Export specific session
-            history = cur.execute(
-                """SELECT sender, message, timestamp FROM chat_history 
-                   WHERE chat_session_id=%s 
-                   AND timestamp BETWEEN datetime(%s) AND datetime(%s)
-                   ORDER BY timestamp ASC""",
-                (chat_session_id, from_datetime.isoformat(), to_datetime.isoformat())
-            ).fetchall()
+            where_clause, scope = "chat_session_id=%s", chat_session_id
         else:
             # Export all sessions for this user
-            history = cur.execute(
-                """SELECT sender, message, timestamp FROM chat_history 
-                   WHERE session_id=%s 
-                   AND timestamp BETWEEN datetime(%s) AND datetime(%s)
-                   ORDER BY timestamp ASC""",
-                (f"{username}_session", from_datetime.isoformat(), to_datetime.isoformat())
-            ).fetchall()
+            where_clause, scope = "session_id=%s", f"{username}_session"
+        query, params = range_query(f"SELECT sender, message, timestamp FROM chat_history WHERE {where_clause}",
+                                    [scope], 'timestamp', window, order='ASC')
         
-        conn.close()
+        def history_rows():
+            conn = get_db_connection()
+            return iter_rows(conn, query, params, name_prefix='chat_export')
+        
+        def history_records():
+            for sender, message, timestamp in history_rows():
+                yield {'sender': sender, 'message': message, 'timestamp': timestamp}
+        
+        def text_export():
+            yield (f"Chat History Export for {username}\n"
+                   f"Date Range: {from_date} to {to_date}\n"
+                   + "=" * 80 + "\n\n")
+            total = 0
+            for sender, message, timestamp in history_rows():
+                dt = timestamp if isinstance(timestamp, datetime) else datetime.fromisoformat(str(timestamp))
+                total += 1
+                yield f"[{dt.strftime('%Y-%m-%d %I:%M %p')}] {(sender or '').upper()}:\n{message}\n\n"
+            yield "=" * 80 + "\n" + f"Total messages: {total}\n"
         
         if export_format == 'json':
-            # JSON export
-            output = json.dumps([{
-                'sender': h[0],
-                'message': h[1],
-                'timestamp': h[2]
-            } for h in history], indent=2)
-            
-            return Response(
-                output,
-                mimetype='application/json',
-                headers={'Content-Disposition': f'attachment; filename=chat_export_{from_date}_to_{to_date}.json'}
-            )
-        
+            body, mimetype, extension = json_array_chunks(history_records()), 'application/json', 'json'
+        elif export_format == 'ndjson':
+            body, mimetype, extension = ndjson_chunks(history_records()), 'application/x-ndjson', 'ndjson'
         elif export_format == 'csv':
-            # CSV export
-            output = io.StringIO()
-            writer = csv.writer(output)
-            writer.writerow(['Sender', 'Message', 'Timestamp'])
-            writer.writerows(history)
-            
-            return Response(
-                output.getvalue(),
-                mimetype='text/csv',
-                headers={'Content-Disposition': f'attachment; filename=chat_export_{from_date}_to_{to_date}.csv'}
-            )
-        
+            body, mimetype, extension = csv_chunks(history_rows(), header=['Sender', 'Message', 'Timestamp']), 'text/csv', 'csv'
         else:
             # Text export (default)
-            output = f"Chat History Export for {username}\n"
-            output += f"Date Range: {from_date} to {to_date}\n"
-            output += "=" * 80 + "\n\n"
-            
-            for sender, message, timestamp in history:
-                dt = datetime.fromisoformat(timestamp)
-                formatted_time = dt.strftime('%Y-%m-%d %I:%M %p')
-                output += f"[{formatted_time}] {sender.upper()}:\n"
-                output += f"{message}\n\n"
-            
-            output += "=" * 80 + "\n"
-            output += f"Total messages: {len(history)}\n"
-            
-            return Response(
-                output,
-                mimetype='text/plain',
-                headers={'Content-Disposition': f'attachment; filename=chat_export_{from_date}_to_{to_date}.txt'}
-            )
+            body, mimetype, extension = text_export(), 'text/plain', 'txt'
+        
+        return Response(
+            stream_with_context(body),
+            mimetype=mimetype,
+            headers={'Content-Disposition': f'attachment; filename=chat_export_{from_date}_to_{to_date}.{extension}'}
+        )
         
     except Exception as e:
         return handle_exception(e, request.endpoint or 'unknown')
@@ -11774,18 +12124,29 @@ def get_cbt_summary():
 
 @app.route('/api/export/fhir', methods=['GET'])
 def export_fhir():
-    """Export user data in FHIR format"""
+    """Export user data in FHIR format (the patient themselves or their approved clinician)"""
     try:
-        username = request.args.get('username')
-        
-        if not username:
-            return jsonify({'error': 'Username required'}), 400
+        session_user = get_authenticated_username()
+        if not session_user:
+            return jsonify({'error': 'Authentication required'}), 401
+
+        username = request.args.get('username') or session_user
+        if username != session_user:
+            conn = get_db_connection()
+            cur = get_wrapped_cursor(conn)
+            approved = cur.execute(
+                "SELECT 1 FROM patient_approvals WHERE clinician_username=%s AND patient_username=%s AND status='approved'",
+                (session_user, username)
+            ).fetchone()
+            conn.close()
+            if not approved:
+                return jsonify({'error': 'Access denied'}), 403
         
-        # Use existing FHIR export function. Only sign if ENCRYPTION_KEY is available.
+        # Only sign if ENCRYPTION_KEY is available
         sign = bool(getattr(fhir_export, 'ENCRYPTION_KEY', None))
-        bundle = fhir_export.export_patient_fhir(username, sign_bundle=sign)
+        bundle = fhir_export.export_patient_fhir(username, sign_bundle=sign, connect=get_db_connection)
         
-        log_event(username, 'api', 'fhir_export', 'FHIR data exported via API')
+        log_event(session_user, 'api', 'fhir_export', f'FHIR data exported via API for {username}')
         
         return jsonify({
             'success': True,
@@ -11795,6 +12156,154 @@ def export_fhir():
     except Exception as e:
         return handle_exception(e, request.endpoint or 'unknown')
 
+FHIR_BULK_MAX_COHORT = 5000
+
+@app.route('/api/export/fhir/bulk', methods=['POST'])
+def start_fhir_bulk_export():
+    """
+    Queue a bulk FHIR export ($export-style NDJSON) for a caseload or cohort.
+
+    Body: {"scope": "caseload"} exports the clinician's approved patients;
+    {"scope": "cohort", "usernames": [...]} exports an explicit list of
+    patients. Clinicians may only list their own approved patients; admins
+    may export any patients, but only with an "override_reason", which is
+    recorded in the audit log.
+    """
+    try:
+        username = get_authenticated_username()
+        if not username:
+            return jsonify({'error': 'Authentication required'}), 401
+
+        if not validate_csrf_token(request.headers.get('X-CSRF-Token')):
+            return jsonify({'error': 'CSRF token invalid'}), 403
+
+        data = request.get_json(silent=True) or {}
+        scope = data.get('scope', 'caseload')
+        if scope not in ('caseload', 'cohort'):
+            return jsonify({'error': "scope must be 'caseload' or 'cohort'"}), 400
+
+        conn = get_db_connection()
+        cur = get_wrapped_cursor(conn)
+
+        role_row = get_user_role_row(cur, username)
+        role = role_row[0] if role_row else None
+        if role not in ('clinician', 'admin'):
+            return jsonify({'error': 'Clinician role required'}), 403
+
+        override_reason = None
+        if role == 'admin':
+            override_reason = str(data.get('override_reason') or '').strip()
+            if scope != 'cohort' or not override_reason:
+                return jsonify({'error': 'Admin exports require a cohort and an override_reason'}), 403
+
+        if scope == 'caseload':
+            rows = cur.execute(
+                "SELECT patient_username FROM patient_approvals WHERE clinician_username=%s AND status='approved' ORDER BY patient_username",
+                (username,)
+            ).fetchall()
+            usernames = [r[0] for r in rows]
+        else:
+            requested = data.get('usernames')
+            if not isinstance(requested, list) or not requested:
+                return jsonify({'error': 'usernames list required for cohort scope'}), 400
+            usernames = sorted({str(u) for u in requested})
+            if len(usernames) > FHIR_BULK_MAX_COHORT:
+                return jsonify({'error': f'Cohort limited to {FHIR_BULK_MAX_COHORT} patients'}), 400
+            patients = cur.execute(
+                "SELECT username FROM users WHERE role = 'user' AND username = ANY(%s)", (usernames,)
+            ).fetchall()
+            if len({r[0] for r in patients}) != len(usernames):
+                return jsonify({'error': 'Cohort includes unknown or non-patient usernames'}), 400
+            if role == 'clinician':
+                approved = cur.execute(
+                    "SELECT patient_username FROM patient_approvals WHERE clinician_username=%s AND status='approved' AND patient_username = ANY(%s)",
+                    (username, usernames)
+                ).fetchall()
+                if len({r[0] for r in approved}) != len(usernames):
+                    return jsonify({'error': 'Cohort includes patients outside your caseload'}), 403
+
+        if not usernames:
+            return jsonify({'error': 'No patients to export'}), 400
+
+        job_id = fhir_export.enqueue_bulk_export(cur, username, scope, usernames)
+        conn.commit()
+
+        log_event(username, 'api', 'fhir_bulk_export_requested', f'{scope} export of {len(usernames)} patients (job {job_id})')
+        if override_reason:
+            log_event(username, 'admin', 'fhir_bulk_export_override',
+                      f'Admin export of {len(usernames)} patients (job {job_id}): {override_reason[:500]}')
+
+        response = jsonify({
+            'success': True,
+            'job_id': job_id,
+            'patient_count': len(usernames),
+            'status_url': f'/api/export/fhir/bulk/{job_id}'
+        })
+        response.headers['Content-Location'] = f'/api/export/fhir/bulk/{job_id}'
+        return response, 202
+    except Exception as e:
+        return handle_exception(e, 'start_fhir_bulk_export')
+
+@app.route('/api/export/fhir/bulk/<int:job_id>', methods=['GET'])
+def get_fhir_bulk_export(job_id):
+    """Bulk export status: 202 with progress while running, 200 with the signed manifest when complete"""
+    try:
+        username = get_authenticated_username()
+        if not username:
+            return jsonify({'error': 'Authentication required'}), 401
+
+        conn = get_db_connection()
+        cur = get_wrapped_cursor(conn)
+        job = fhir_export.get_bulk_export(cur, job_id)
+        if not job or job['requested_by'] != username:
+            return jsonify({'error': 'Export not found'}), 404
+
+        if job['status'] == 'completed':
+            return jsonify({'manifest': job['manifest'], 'signature': job['signature']}), 200
+        if job['status'] == 'failed':
+            return jsonify({'status': 'failed', 'error': job['error']}), 500
+
+        stages = len(fhir_export.BULK_STAGES)
+        response = jsonify({
+            'status': job['status'],
+            'patient_count': job['patient_count'],
+            'resources_written': job['progress'].get('counts', {}),
+            'parts_written': job['progress'].get('part_no', 0)
+        })
+        response.headers['X-Progress'] = f"stage {min(job['progress'].get('stage', 0) + 1, stages)} of {stages}"
+        return response, 202
+    except Exception as e:
+        return handle_exception(e, 'get_fhir_bulk_export')
+
+@app.route('/api/export/fhir/bulk/<int:job_id>/parts/<int:part_no>', methods=['GET'])
+def download_fhir_bulk_part(job_id, part_no):
+    """Download one NDJSON output file listed in the manifest"""
+    try:
+        username = get_authenticated_username()
+        if not username:
+            return jsonify({'error': 'Authentication required'}), 401
+
+        conn = get_db_connection()
+        cur = get_wrapped_cursor(conn)
+        part = cur.execute(
+            """SELECT p.resource_type, p.content FROM fhir_export_parts p
+               JOIN fhir_export_jobs j ON j.id = p.job_id
+               WHERE p.job_id=%s AND p.part_no=%s AND j.requested_by=%s AND j.status='completed'""",
+            (job_id, part_no, username)
+        ).fetchone()
+        if not part:
+            return jsonify({'error': 'Export file not found'}), 404
+
+        log_event(username, 'api', 'fhir_bulk_export_downloaded', f'job {job_id} part {part_no} ({part[0]})')
+
+        return Response(
+            bytes(part[1]),
+            mimetype=fhir_export.FHIR_NDJSON_CONTENT_TYPE,
+            headers={'Content-Disposition': f'attachment; filename={part[0]}.{job_id}.{part_no}.ndjson'}
+        )
+    except Exception as e:
+        return handle_exception(e, 'download_fhir_bulk_part')
+
 @app.route('/api/safety/check', methods=['POST'])
 def safety_check():
     """Check text for safety concerns"""
@@ -11848,7 +12357,6 @@ def pet_status():
             return jsonify({'exists': False, 'error': error}), 200
         conn = get_pet_db_connection()
         cur = get_wrapped_cursor(conn)
-        ensure_pet_table()
         
         pet = cur.execute("SELECT * FROM pet WHERE username = %s", (username,)).fetchone()
         conn.close()
@@ -11870,39 +12378,36 @@ def pet_status():
 
 @app.route('/api/ai/trigger-training', methods=['POST'])
 def trigger_background_training():
-    """Manually trigger background training (admin only)"""
+    """Queue a background training run (clinician/developer only); train_scheduler.py runs it"""
     try:
-        data = request.json
-        username = data.get('username')
+        username = get_authenticated_username()
+        if not username:
+            return jsonify({'error': 'Authentication required'}), 401
         
-        # Verify admin/clinician (you can adjust this check)
         conn = get_db_connection()
         cur = get_wrapped_cursor(conn)
         user = cur.execute(
             "SELECT role FROM users WHERE username = %s",
             (username,)
         ).fetchone()
-        conn.close()
         
-        if not user or user[0] != 'clinician':
+        if not user or user[0] not in ('clinician', 'developer'):
+            conn.close()
             return jsonify({'error': 'Unauthorized - clinician access required'}), 403
         
-        # Start training in background thread
-        import threading
-        from ai_trainer import train_background_model
-        
-        def train_async():
-            print("🚀 Starting background training...")
-            success = train_background_model(epochs=3)
-            print(f"✅ Training completed: {success}")
+        job_id = training_jobs.schedule_training(cur, trigger='manual', requested_by=username)
+        conn.commit()
+        conn.close()
         
-        thread = threading.Thread(target=train_async, daemon=True)
-        thread.start()
+        if not job_id:
+            return jsonify({'error': 'A training job is already queued or running'}), 409
         
+        log_event(username, 'ai', 'training_queued', f'Training job {job_id} queued')
         return jsonify({
             'success': True,
-            'message': 'Background training started. Check status in a few minutes.'
-        }), 200
+            'job_id': job_id,
+            'message': 'Training queued. Follow progress on the developer dashboard.'
+        }), 202
         
     except Exception as e:
         return handle_exception(e, request.endpoint or 'unknown')
@@ -11925,12 +12430,6 @@ def pet_create():
         if not name:
             return jsonify({'error': 'Pet name required'}), 400
 
-        try:
-            ensure_pet_table()
-        except Exception as e:
-            print(f"Error ensuring pet table: {e}")
-            pass  # Table might already exist
-        
         conn = None
         try:
             conn = get_pet_db_connection()
@@ -12730,9 +13229,112 @@ def submit_gad7():
         return handle_exception(e, request.endpoint or 'unknown')
 
 # === COMMUNITY SUPPORT BOARD ===
+COMMUNITY_FEED_PAGE_SIZE = 20
+COMMUNITY_FEED_MAX_PAGE_SIZE = 50
+COMMUNITY_REPLY_PREVIEW_COUNT = 3  # replies inlined per post; the rest via /post/<id>/replies
+
+
+def refresh_community_post_counters(cur, post_ids=None):
+    """Recompute denormalized reaction_counts/likes/reply_count from source rows.
+
+    Used for the one-off backfill and after bulk deletes; normal writes adjust
+    the counters incrementally (see _toggle_community_reaction).
+    """
+    where, params = ("WHERE p.id = ANY(%s)", (list(post_ids),)) if post_ids is not None else ("", ())
+    cur.execute(f"""
+        UPDATE community_posts p SET
+            reaction_counts = COALESCE((
+                SELECT jsonb_object_agg(r.reaction_type, r.n) FROM (
+                    SELECT COALESCE(reaction_type, 'like') AS reaction_type, COUNT(*) AS n
+                    FROM community_likes WHERE post_id = p.id
+                    GROUP BY COALESCE(reaction_type, 'like')
+                ) r
+            ), '{{}}'::jsonb),
+            likes = (SELECT COUNT(*) FROM community_likes WHERE post_id = p.id),
+            reply_count = (SELECT COUNT(*) FROM community_replies WHERE post_id = p.id)
+        {where}
+    """, params)
+
+
+def refresh_community_channel_stats(cur, channels=None):
+    """Recompute community_channel_stats rows from community_posts.
+
+    Used for the one-off backfill and after bulk deletes; creating or
+    deleting a single post adjusts the row incrementally.
+    """
+    where, params = ("WHERE s.channel = ANY(%s)", (list(channels),)) if channels is not None else ("", ())
+    cur.execute(f"""
+        INSERT INTO community_channel_stats (channel, post_count, latest_post_at, updated_at)
+        SELECT category, COUNT(*), MAX(entry_timestamp), CURRENT_TIMESTAMP
+        FROM community_posts
+        WHERE category IS NOT NULL {"AND category = ANY(%s)" if channels is not None else ""}
+        GROUP BY category
+        ON CONFLICT (channel) DO UPDATE
+        SET post_count = EXCLUDED.post_count, latest_post_at = EXCLUDED.latest_post_at,
+            updated_at = CURRENT_TIMESTAMP
+    """, params)
+    # Channels whose last post was removed
+    cur.execute(f"""
+        UPDATE community_channel_stats s
+        SET post_count = 0, latest_post_at = NULL, updated_at = CURRENT_TIMESTAMP
+        {where} {"AND" if where else "WHERE"} NOT EXISTS (SELECT 1 FROM community_posts p WHERE p.category = s.channel)
+    """, params)
+
+
+def _toggle_community_reaction(cur, post_id, username, reaction_type):
+    """Toggle a reaction and adjust the post's counters in place.
+
+    Returns (action, reaction_counts, total_reactions).
+    """
+    removed = cur.execute(
+        "DELETE FROM community_likes WHERE post_id = %s AND username = %s AND reaction_type = %s RETURNING id",
+        (post_id, username, reaction_type)
+    ).fetchall()
+
+    if removed:
+        action, delta = 'removed', -len(removed)
+    else:
+        cur.execute(
+            "INSERT INTO community_likes (post_id, username, reaction_type) VALUES (%s,%s,%s)",
+            (post_id, username, reaction_type)
+        )
+        action, delta = 'added', 1
+
+    row = cur.execute("""
+        UPDATE community_posts
+        SET reaction_counts = jsonb_set(COALESCE(reaction_counts, '{}'::jsonb), ARRAY[%s],
+                to_jsonb(GREATEST(COALESCE((reaction_counts->>%s)::int, 0) + %s, 0))),
+            likes = GREATEST(COALESCE(likes, 0) + %s, 0)
+        WHERE id = %s
+        RETURNING reaction_counts, likes
+    """, (reaction_type, reaction_type, delta, delta, post_id)).fetchone()
+
+    counts = {k: v for k, v in ((row[0] if row else None) or {}).items() if v}
+    return action, counts, (row[1] if row else 0) or 0
+
+
+def _encode_feed_cursor(post_row):
+    """Opaque keyset cursor for (is_pinned, entry_timestamp, id)."""
+    ts = post_row[4]
+    ts = ts.isoformat() if hasattr(ts, 'isoformat') else str(ts)
+    return f"{int(post_row[6] or 0)}_{ts}_{post_row[0]}"
+
+
+def _decode_feed_cursor(cursor):
+    pinned, ts, post_id = cursor.split('_', 2)
+    return int(pinned), datetime.fromisoformat(ts), int(post_id)
+
+
 @app.route('/api/community/posts', methods=['GET'])
 def get_community_posts():
-    """Get recent community posts with reaction counts and replies inline"""
+    """Get a page of community posts with reaction counts and reply previews inline
+
+    Served by a fixed number of queries regardless of page size: the posts
+    page (reaction/reply counters are denormalized on community_posts), the
+    current user's reactions for the page, and the first
+    COMMUNITY_REPLY_PREVIEW_COUNT replies of every post on the page.
+    Pass `next_cursor` back as `before` to get the next (older) page.
+    """
     try:
         username = request.args.get('username', '')  # Optional - to check user's reactions
         category = request.args.get('category', '')  # Optional - filter by category (required for channel view)
@@ -12744,95 +13346,111 @@ def get_community_posts():
             'sleep', 'motivation', 'general', 'celebration', 'question'
         ]
 
-        print(f"[DEBUG] Getting posts: category={category}, username={username}")
+        limit = request.args.get('limit', COMMUNITY_FEED_PAGE_SIZE, type=int)
+        limit = max(1, min(limit, COMMUNITY_FEED_MAX_PAGE_SIZE))
+
+        conditions, params = [], []
+        if category and category in VALID_CATEGORIES:
+            conditions.append("category = %s")
+            params.append(category)
+
+        before = request.args.get('before', '')
+        if before:
+            try:
+                conditions.append("(is_pinned, entry_timestamp, id) < (%s, %s, %s)")
+                params.extend(_decode_feed_cursor(before))
+            except ValueError:
+                return jsonify({'error': 'Invalid cursor'}), 400
+
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
 
         conn = get_db_connection()
         cur = get_wrapped_cursor(conn)
 
-        # Build query with optional category filter - pinned posts first, then by timestamp
-        if category and category in VALID_CATEGORIES:
-            print(f"[DEBUG] Filtering by category: {category}")
-            posts = cur.execute(
-                "SELECT id, username, message, likes, entry_timestamp, category, is_pinned FROM community_posts WHERE category = %s ORDER BY is_pinned DESC, entry_timestamp DESC LIMIT 100",
-                (category,)
-            ).fetchall()
-            print(f"[DEBUG] Found {len(posts)} posts in category {category}")
-            
-            # Mark channel as read for this user
-            if username:
-                try:
-                    cur.execute(
-                        "INSERT INTO community_channel_reads (username, channel, last_read) VALUES (%s, %s, CURRENT_TIMESTAMP) ON CONFLICT (username, channel) DO UPDATE SET last_read = CURRENT_TIMESTAMP",
-                        (username, category)
-                    )
-                    conn.commit()
-                    print(f"[DEBUG] Marked channel {category} as read for {username}")
-                except Exception as read_error:
-                    print(f"[DEBUG] Could not mark channel read (non-critical): {read_error}")
-                    conn.rollback()
-        else:
-            print(f"[DEBUG] Getting all posts (no category filter)")
-            posts = cur.execute(
-                "SELECT id, username, message, likes, entry_timestamp, category, is_pinned FROM community_posts ORDER BY is_pinned DESC, entry_timestamp DESC LIMIT 100"
-            ).fetchall()
-            print(f"[DEBUG] Found {len(posts)} total posts")
+        # Pinned posts first, then newest; one extra row tells us if there is another page
+        posts = cur.execute(
+            f"""SELECT id, username, message, likes, entry_timestamp, category, is_pinned, reaction_counts, reply_count
+                FROM community_posts {where}
+                ORDER BY is_pinned DESC, entry_timestamp DESC, id DESC
+                LIMIT %s""",
+            (*params, limit + 1)
+        ).fetchall()
 
-        post_list = []
-        for p in posts:
-            post_id = p[0]
+        has_more = len(posts) > limit
+        posts = posts[:limit]
+        post_ids = [p[0] for p in posts]
 
-            # Get reaction counts by type
-            reactions = cur.execute(
-                "SELECT reaction_type, COUNT(*) FROM community_likes WHERE post_id = %s GROUP BY reaction_type",
-                (post_id,)
-            ).fetchall()
-            reaction_counts = {r[0]: r[1] for r in reactions}
+        # Mark channel as read for this user (first page only)
+        if username and not before and category in VALID_CATEGORIES:
+            try:
+                cur.execute(
+                    "INSERT INTO community_channel_reads (username, channel, last_read) VALUES (%s, %s, CURRENT_TIMESTAMP) ON CONFLICT (username, channel) DO UPDATE SET last_read = CURRENT_TIMESTAMP",
+                    (username, category)
+                )
+                conn.commit()
+            except Exception as read_error:
+                app_logger.debug(f"Could not mark channel read (non-critical): {read_error}")
+                conn.rollback()
 
-            # Check which reactions current user has made
-            user_reactions = []
+        user_reactions = {}
+        replies_by_post = {}
+        if post_ids:
             if username:
-                user_reacts = cur.execute(
-                    "SELECT reaction_type FROM community_likes WHERE post_id = %s AND username = %s",
-                    (post_id, username)
-                ).fetchall()
-                user_reactions = [r[0] for r in user_reacts]
+                for post_id, reaction_type in cur.execute(
+                    "SELECT post_id, reaction_type FROM community_likes WHERE post_id = ANY(%s) AND username = %s",
+                    (post_ids, username)
+                ).fetchall():
+                    user_reactions.setdefault(post_id, []).append(reaction_type)
+
+            for r in cur.execute(
+                """SELECT post_id, id, username, message, timestamp FROM (
+                       SELECT post_id, id, username, message, timestamp,
+                              ROW_NUMBER() OVER (PARTITION BY post_id ORDER BY timestamp ASC, id ASC) AS rn
+                       FROM community_replies WHERE post_id = ANY(%s)
+                   ) r
+                   WHERE rn <= %s
+                   ORDER BY post_id, timestamp ASC, id ASC""",
+                (post_ids, COMMUNITY_REPLY_PREVIEW_COUNT)
+            ).fetchall():
+                replies_by_post.setdefault(r[0], []).append({
+                    'id': r[1],
+                    'username': r[2],
+                    'message': r[3],
+                    'timestamp': r[4]
+                })
 
-            # Get replies inline
-            replies = cur.execute(
-                "SELECT id, username, message, timestamp FROM community_replies WHERE post_id = %s ORDER BY timestamp ASC",
-                (post_id,)
-            ).fetchall()
-            reply_list = [
-                {
-                    'id': r[0],
-                    'username': r[1],
-                    'message': r[2],
-                    'timestamp': r[3]
-                } for r in replies
-            ]
+        post_list = []
+        for p in posts:
+            post_id = p[0]
+            reactions = {k: v for k, v in (p[7] or {}).items() if v}
+            mine = user_reactions.get(post_id, [])
+            reply_list = replies_by_post.get(post_id, [])
+            reply_count = p[8] if p[8] is not None else len(reply_list)
 
             post_list.append({
                 'id': post_id,
                 'username': p[1],
                 'message': p[2],
                 'likes': p[3] or 0,  # Total reactions (backwards compatible)
-                'reactions': reaction_counts,  # Breakdown by type
-                'user_reactions': user_reactions,  # What current user reacted with
+                'reactions': reactions,  # Breakdown by type
+                'user_reactions': mine,  # What current user reacted with
                 'timestamp': p[4],
                 'category': p[5] or 'general',
-                'is_pinned': bool(p[6]) if len(p) > 6 else False,
-                'replies': reply_list,
-                'reply_count': len(reply_list),
-                'liked_by_user': 'like' in user_reactions  # Backwards compatible
+                'is_pinned': bool(p[6]),
+                'replies': reply_list,  # First COMMUNITY_REPLY_PREVIEW_COUNT replies
+                'reply_count': reply_count,
+                'has_more_replies': reply_count > len(reply_list),
+                'liked_by_user': 'like' in mine  # Backwards compatible
             })
 
         conn.close()
-        print(f"[DEBUG] Returning {len(post_list)} posts to client")
-        return jsonify({'posts': post_list, 'categories': VALID_CATEGORIES}), 200
+        return jsonify({
+            'posts': post_list,
+            'categories': VALID_CATEGORIES,
+            'has_more': has_more,
+            'next_cursor': _encode_feed_cursor(posts[-1]) if has_more else None
+        }), 200
     except Exception as e:
-        print(f"[DEBUG] Error getting posts: {e}")
-        import traceback
-        traceback.print_exc()
         return handle_exception(e, request.endpoint or 'unknown')
 
 @app.route('/api/community/channels', methods=['GET'])
@@ -12867,33 +13485,37 @@ def get_community_channels():
         conn = get_db_connection()
         cur = get_wrapped_cursor(conn)
 
+        # Post count + latest post for every channel (maintained on post create/delete)
+        stats = {
+            r[0]: (r[1] or 0, r[2]) for r in cur.execute(
+                "SELECT channel, post_count, latest_post_at FROM community_channel_stats"
+            ).fetchall()
+        }
+
+        # Unread counts for every channel this user has opened, in one grouped query
+        unread_by_channel = {}
+        if username:
+            unread_by_channel = {
+                r[0]: r[1] for r in cur.execute(
+                    """SELECT r.channel, COUNT(p.id)
+                       FROM community_channel_reads r
+                       LEFT JOIN community_posts p
+                         ON p.category = r.channel AND p.entry_timestamp > r.last_read
+                       WHERE r.username = %s
+                       GROUP BY r.channel""",
+                    (username,)
+                ).fetchall()
+            }
+
         channels = []
         for cat in VALID_CATEGORIES:
             info = CATEGORY_INFO.get(cat, {'emoji': '💬', 'name': cat.title(), 'description': ''})
+            count, latest = stats.get(cat, (0, None))
 
-            # Get post count for this channel
-            count = cur.execute(
-                "SELECT COUNT(*) FROM community_posts WHERE category = %s", (cat,)
-            ).fetchone()[0]
-
-            # Get latest post timestamp
-            latest = cur.execute(
-                "SELECT MAX(entry_timestamp) FROM community_posts WHERE category = %s", (cat,)
-            ).fetchone()[0]
-
-            # Check for unread posts
             unread_count = 0
             if username and latest:
-                last_read = cur.execute(
-                    "SELECT last_read FROM community_channel_reads WHERE username = %s AND channel = %s",
-                    (username, cat)
-                ).fetchone()
-                if last_read:
-                    unread = cur.execute(
-                        "SELECT COUNT(*) FROM community_posts WHERE category = %s AND entry_timestamp > %s",
-                        (cat, last_read[0])
-                    ).fetchone()[0]
-                    unread_count = unread
+                if cat in unread_by_channel:
+                    unread_count = unread_by_channel[cat]
                 else:
                     # Never visited - all posts are unread (max 10 shown)
                     unread_count = min(count, 10)
@@ -12928,7 +13550,7 @@ def pin_community_post(post_id):
         cur = get_wrapped_cursor(conn)
 
         # Check if user is a clinician
-        user = cur.execute("SELECT role FROM users WHERE username=%s", (username,)).fetchone()
+        user = get_user_role_row(cur, username)
         if not user or user[0] != 'clinician':
             conn.close()
             return jsonify({'error': 'Only clinicians can pin posts'}), 403
@@ -12985,6 +13607,14 @@ def create_community_post():
                 "INSERT INTO community_posts (username, message, category) VALUES (%s,%s,%s)",
                 (username, message, category)
             )
+            cur.execute("""
+                INSERT INTO community_channel_stats (channel, post_count, latest_post_at, updated_at)
+                VALUES (%s, 1, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+                ON CONFLICT (channel) DO UPDATE
+                SET post_count = community_channel_stats.post_count + 1,
+                    latest_post_at = GREATEST(community_channel_stats.latest_post_at, EXCLUDED.latest_post_at),
+                    updated_at = CURRENT_TIMESTAMP
+            """, (category,))
             conn.commit()
             print(f"[DEBUG] Post inserted and committed")
             
@@ -13029,38 +13659,8 @@ def react_to_post(post_id):
         conn = get_db_connection()
         cur = get_wrapped_cursor(conn)
 
-        # Check if user already has this reaction on this post
-        existing_reaction = cur.execute(
-            "SELECT 1 FROM community_likes WHERE post_id = %s AND username = %s AND reaction_type = %s",
-            (post_id, username, reaction_type)
-        ).fetchone()
-
-        if existing_reaction:
-            # Remove reaction (toggle off)
-            cur.execute(
-                "DELETE FROM community_likes WHERE post_id = %s AND username = %s AND reaction_type = %s",
-                (post_id, username, reaction_type)
-            )
-            action = 'removed'
-        else:
-            # Add reaction
-            cur.execute(
-                "INSERT INTO community_likes (post_id, username, reaction_type) VALUES (%s,%s,%s)",
-                (post_id, username, reaction_type)
-            )
-            action = 'added'
-
-        # Get updated reaction counts for this post
-        reactions = cur.execute(
-            "SELECT reaction_type, COUNT(*) FROM community_likes WHERE post_id = %s GROUP BY reaction_type",
-            (post_id,)
-        ).fetchall()
-
-        reaction_counts = {r[0]: r[1] for r in reactions}
-
-        # Update total likes count (sum of all reactions) for backwards compatibility
-        total_reactions = sum(reaction_counts.values())
-        cur.execute("UPDATE community_posts SET likes=%s WHERE id=%s", (total_reactions, post_id))
+        # Toggle and adjust the denormalized counters (likes = total for backwards compatibility)
+        action, reaction_counts, total_reactions = _toggle_community_reaction(cur, post_id, username, reaction_type)
 
         conn.commit()
         conn.close()
@@ -13089,22 +13689,7 @@ def like_community_post(post_id):
         conn = get_db_connection()
         cur = get_wrapped_cursor(conn)
 
-        # Check if already liked
-        existing_like = cur.execute(
-            "SELECT 1 FROM community_likes WHERE post_id = %s AND username = %s AND reaction_type='like'",
-            (post_id, username)
-        ).fetchone()
-
-        if existing_like:
-            # Unlike - remove like
-            cur.execute("DELETE FROM community_likes WHERE post_id=%s AND username=%s AND reaction_type='like'", (post_id, username))
-        else:
-            # Like - add like
-            cur.execute("INSERT INTO community_likes (post_id, username, reaction_type) VALUES (%s,%s,'like')", (post_id, username))
-
-        # Update total count
-        total = cur.execute("SELECT COUNT(*) FROM community_likes WHERE post_id=%s", (post_id,)).fetchone()[0]
-        cur.execute("UPDATE community_posts SET likes=%s WHERE id=%s", (total, post_id))
+        _toggle_community_reaction(cur, post_id, username, 'like')
 
         conn.commit()
         conn.close()
@@ -13141,9 +13726,17 @@ def delete_community_post(post_id):
             return jsonify({'error': 'You can only delete your own posts'}), 403
         
         # Delete post and related data
-        cur.execute("DELETE FROM community_posts WHERE id=%s", (post_id,))
+        deleted = cur.execute("DELETE FROM community_posts WHERE id=%s RETURNING category", (post_id,)).fetchone()
         cur.execute("DELETE FROM community_likes WHERE post_id=%s", (post_id,))
         cur.execute("DELETE FROM community_replies WHERE post_id=%s", (post_id,))
+        if deleted and deleted[0]:
+            cur.execute("""
+                UPDATE community_channel_stats
+                SET post_count = GREATEST(post_count - 1, 0),
+                    latest_post_at = (SELECT MAX(entry_timestamp) FROM community_posts WHERE category = %s),
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE channel = %s
+            """, (deleted[0], deleted[0]))
         
         conn.commit()
         conn.close()
@@ -13178,10 +13771,11 @@ def create_reply(post_id):
         conn = get_db_connection()
         cur = get_wrapped_cursor(conn)
         cur.execute(
-            "INSERT INTO community_replies (post_id, username, message) VALUES (%s,%s,%s)",
+            "INSERT INTO community_replies (post_id, username, message) VALUES (%s,%s,%s) RETURNING id",
             (post_id, username, sanitized_message)
         )
         reply_id = cur.fetchone()[0]
+        cur.execute("UPDATE community_posts SET reply_count = reply_count + 1 WHERE id = %s", (post_id,))
 
         # Flag for review if needed
         if moderation_result['flagged']:
@@ -13227,7 +13821,9 @@ def delete_reply(reply_id):
             return jsonify({'error': 'You can only delete your own replies'}), 403
 
         # Delete the reply
-        cur.execute("DELETE FROM community_replies WHERE id=%s", (reply_id,))
+        deleted = cur.execute("DELETE FROM community_replies WHERE id=%s RETURNING post_id", (reply_id,)).fetchone()
+        if deleted:
+            cur.execute("UPDATE community_posts SET reply_count = GREATEST(reply_count - 1, 0) WHERE id = %s", (deleted[0],))
 
         conn.commit()
         conn.close()
@@ -13300,14 +13896,26 @@ def report_community_post(post_id):
 
 @app.route('/api/community/post/<int:post_id>/replies', methods=['GET'])
 def get_replies(post_id):
-    """Get replies for a community post"""
+    """Get replies for a community post (oldest first; after_id/limit page through long threads)"""
     try:
+        after_id = request.args.get('after_id', type=int)
+        limit = request.args.get('limit', 200, type=int)
+        limit = max(1, min(limit, 500))
+
         conn = get_db_connection()
         cur = get_wrapped_cursor(conn)
-        replies = cur.execute(
-            "SELECT id, username, message, timestamp FROM community_replies WHERE post_id = %s ORDER BY timestamp ASC",
-            (post_id,)
-        ).fetchall()
+        if after_id:
+            replies = cur.execute(
+                """SELECT id, username, message, timestamp FROM community_replies
+                   WHERE post_id = %s AND (timestamp, id) > (SELECT timestamp, id FROM community_replies WHERE id = %s)
+                   ORDER BY timestamp ASC, id ASC LIMIT %s""",
+                (post_id, after_id, limit)
+            ).fetchall()
+        else:
+            replies = cur.execute(
+                "SELECT id, username, message, timestamp FROM community_replies WHERE post_id = %s ORDER BY timestamp ASC, id ASC LIMIT %s",
+                (post_id, limit)
+            ).fetchall()
         conn.close()
 
         return jsonify({'replies': [
@@ -13389,170 +13997,140 @@ def save_safety_plan():
         return handle_exception(e, request.endpoint or 'unknown')
 
 # === DATA EXPORT ===
+# (section title, column header, query) - each section is streamed from its own server-side cursor
+EXPORT_CSV_SECTIONS = (
+    ("MOOD_LOGS",
+     ["timestamp", "mood_val", "sleep_val", "meds", "notes", "sentiment", "exercise_mins", "outside_mins", "water_pints"],
+     "SELECT entrestamp, mood_val, sleep_val, meds, COALESCE(notes, ''), sentiment, exercise_mins, outside_mins, water_pints "
+     "FROM mood_logs WHERE username=%s ORDER BY entrestamp DESC"),
+    ("GRATITUDE_LOGS",
+     ["timestamp", "entry"],
+     "SELECT entry_timestamp, entry FROM gratitude_logs WHERE username=%s ORDER BY entry_timestamp DESC"),
+    ("CBT_RECORDS",
+     ["timestamp", "situation", "thought", "evidence"],
+     "SELECT entry_timestamp, situation, thought, evidence FROM cbt_records WHERE username=%s ORDER BY entry_timestamp DESC"),
+    ("CLINICAL_SCALES",
+     ["timestamp", "scale_name", "score", "severity"],
+     "SELECT entry_timestamp, scale_name, score, severity FROM clinical_scales WHERE username=%s ORDER BY entry_timestamp DESC"),
+)
+
 @app.route('/api/export/csv', methods=['GET'])
 def export_csv():
-    """Export user data as CSV"""
+    """Export user data as CSV (streamed section by section)"""
     try:
         username = request.args.get('username')
         if not username:
             return jsonify({'error': 'Username required'}), 400
         
-        import io
-        import csv
-        
-        conn = get_db_connection()
-        cur = get_wrapped_cursor(conn)
-        
-        output = io.StringIO()
-        writer = csv.writer(output)
-        
-        # Profile
-        writer.writerow(["USER PROFILE"])
-        prof = cur.execute("SELECT full_name, dob, conditions FROM users WHERE username=%s", (username,)).fetchone()
-        if prof:
-            writer.writerow(["username", username])
-            writer.writerow(["full_name", prof[0]])
-            writer.writerow(["dob", prof[1]])
-            writer.writerow(["conditions", prof[2]])
-        writer.writerow([])
-        
-        # Mood logs
-        writer.writerow(["MOOD_LOGS"])
-        writer.writerow(["timestamp", "mood_val", "sleep_val", "meds", "notes", "sentiment", "exercise_mins", "outside_mins", "water_pints"])
-        for r in cur.execute("SELECT entrestamp, mood_val, sleep_val, meds, notes, sentiment, exercise_mins, outside_mins, water_pints FROM mood_logs WHERE username=%s ORDER BY entrestamp DESC", (username,)).fetchall():
-            writer.writerow([r[0], r[1], r[2], r[3], r[4] or "", r[5], r[6], r[7], r[8]])
-        writer.writerow([])
-        
-        # Gratitude
-        writer.writerow(["GRATITUDE_LOGS"])
-        writer.writerow(["timestamp", "entry"])
-        for r in cur.execute("SELECT entry_timestamp, entry FROM gratitude_logs WHERE username=%s ORDER BY entry_timestamp DESC", (username,)).fetchall():
-            writer.writerow([r[0], r[1]])
-        writer.writerow([])
-        
-        # CBT
-        writer.writerow(["CBT_RECORDS"])
-        writer.writerow(["timestamp", "situation", "thought", "evidence"])
-        for r in cur.execute("SELECT entry_timestamp, situation, thought, evidence FROM cbt_records WHERE username=%s ORDER BY entry_timestamp DESC", (username,)).fetchall():
-            writer.writerow([r[0], r[1], r[2], r[3]])
-        writer.writerow([])
-        
-        # Clinical Scales
-        writer.writerow(["CLINICAL_SCALES"])
-        writer.writerow(["timestamp", "scale_name", "score", "severity"])
-        for r in cur.execute("SELECT entry_timestamp, scale_name, score, severity FROM clinical_scales WHERE username=%s ORDER BY entry_timestamp DESC", (username,)).fetchall():
-            writer.writerow([r[0], r[1], r[2], r[3]])
-        
-        conn.close()
-        
-        response = make_response(output.getvalue())
-        response.headers["Content-Disposition"] = f"attachment; filename={username}_data.csv"
-        response.headers["Content-Type"] = "text/csv"
-        return response
+        def generate():
+            conn = get_db_connection()
+            cur = get_wrapped_cursor(conn)
+            
+            # Profile
+            profile_rows = [["USER PROFILE"]]
+            prof = cur.execute("SELECT full_name, dob, conditions FROM users WHERE username=%s", (username,)).fetchone()
+            if prof:
+                profile_rows += [["username", username], ["full_name", prof[0]], ["dob", prof[1]], ["conditions", prof[2]]]
+            yield from csv_chunks(profile_rows)
+            
+            for title, header, query in EXPORT_CSV_SECTIONS:
+                yield from csv_chunks([[], [title], header])
+                yield from csv_chunks(iter_rows(conn, query, (username,), name_prefix='csv_export'))
+        
+        return Response(
+            stream_with_context(generate()),
+            mimetype='text/csv',
+            headers={'Content-Disposition': f'attachment; filename={username}_data.csv'}
+        )
     except Exception as e:
         return handle_exception(e, request.endpoint or 'unknown')
 
 @app.route('/api/export/pdf', methods=['GET'])
 def export_pdf():
-    """Export user data as PDF report (patient personal wellness format)"""
+    """
+    Export user data as PDF report (patient personal wellness format).
+
+    Served straight from the artifact cache when the patient's data is
+    unchanged; otherwise queues a background render and returns 202 with a
+    status URL to poll (see report_service.py).
+    """
     try:
-        username = request.args.get('username')
-        if not username:
-            return jsonify({'error': 'Username required'}), 400
-        
-        try:
-            from reportlab.lib.pagesizes import letter
-            from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-            from reportlab.lib.units import inch
-            from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle, PageBreak
-            from reportlab.lib import colors
-            from reportlab.lib.enums import TA_CENTER, TA_LEFT
-        except ImportError:
-            return jsonify({'error': 'PDF library not available. Please install reportlab.'}), 500
-        
-        import io
-        from datetime import datetime
+        authenticated_user = get_authenticated_username()
+        if not authenticated_user:
+            return jsonify({'error': 'Authentication required'}), 401
+
+        username = request.args.get('username') or authenticated_user
+        if username != authenticated_user:
+            return jsonify({'error': 'Can only export your own data'}), 403
         
         conn = get_db_connection()
         cur = get_wrapped_cursor(conn)
         
-        # Create PDF in memory
-        buffer = io.BytesIO()
-        doc = SimpleDocTemplate(buffer, pagesize=letter, topMargin=0.5*inch, bottomMargin=0.5*inch)
-        
-        story = []
-        styles = getSampleStyleSheet()
+        data_version = report_data_version(cur, username)
+        cache_key = report_cache_key(username, REPORT_WELLNESS_PDF, None, None, data_version, authenticated_user)
+        artifact = find_artifact(cur, cache_key, include_content=True)
         
-        # Title
-        title_style = ParagraphStyle(
-            'CustomTitle',
-            parent=styles['Heading1'],
-            fontSize=24,
-            textColor=colors.HexColor('#667eea'),
-            spaceAfter=12,
-            alignment=TA_CENTER
-        )
-        story.append(Paragraph(f"Personal Wellness Report", title_style))
-        story.append(Paragraph(f"<i>{username}</i>", styles['Normal']))
-        story.append(Paragraph(f"Generated: {datetime.now().strftime('%B %d, %Y')}", styles['Normal']))
-        story.append(Spacer(1, 0.3*inch))
+        if artifact and artifact['status'] == 'ready':
+            response = make_response(artifact['content'])
+            response.headers["Content-Disposition"] = f"attachment; filename={artifact['filename']}"
+            response.headers["Content-Type"] = artifact['content_type']
+            response.headers["X-Report-Cache"] = "hit"
+            return response
         
-        # Mood Summary
-        moods = cur.execute(
-            "SELECT entrestamp, mood_val, sleep_val, meds, exercise_mins FROM mood_logs WHERE username = %s ORDER BY entrestamp DESC LIMIT 15",
-            (username,)
-        ).fetchall()
+        job = enqueue_report(cur, cache_key, username, REPORT_WELLNESS_PDF, None, None,
+                             data_version, authenticated_user)
+        conn.commit()
         
-        if moods:
-            story.append(Paragraph("<b>Recent Mood & Wellness Tracking</b>", styles['Heading2']))
-            mood_data = [['Date', 'Mood', 'Sleep (hrs)', 'Exercise (mins)', 'Medications']]
-            for m in moods:
-                date_str = m[0][:10] if m[0] else 'N/A'
-                mood_data.append([
-                    date_str,
-                    f"{m[1]}/10" if m[1] else 'N/A',
-                    f"{m[2]}" if m[2] else 'N/A',
-                    f"{m[4]}" if m[4] else '0',
-                    m[3] if m[3] else 'None'
-                ])
-            
-            table = Table(mood_data, colWidths=[1.2*inch, 0.8*inch, 1*inch, 1.2*inch, 2*inch])
-            table.setStyle(TableStyle([
-                ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#667eea')),
-                ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-                ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-                ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-                ('FONTSIZE', (0, 0), (-1, 0), 10),
-                ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-                ('GRID', (0, 0), (-1, -1), 1, colors.grey)
-            ]))
-            story.append(table)
-            story.append(Spacer(1, 0.2*inch))
+        return jsonify({
+            'success': True,
+            'artifact_id': job['id'],
+            'status': job['status'],
+            'status_url': f"/api/reports/artifacts/{job['id']}"
+        }), 202
+    except Exception as e:
+        return handle_exception(e, request.endpoint or 'unknown')
+
+@app.route('/api/reports/artifacts/<int:artifact_id>', methods=['GET'])
+def get_report_artifact_status(artifact_id):
+    """Poll a queued report render"""
+    try:
+        authenticated_user = get_authenticated_username()
+        if not authenticated_user:
+            return jsonify({'error': 'Authentication required'}), 401
         
-        # Gratitude entries
-        gratitudes = cur.execute(
-            "SELECT entry_timestamp, entry FROM gratitude_logs WHERE username = %s ORDER BY entry_timestamp DESC LIMIT 10",
-            (username,)
-        ).fetchall()
+        conn = get_db_connection()
+        cur = get_wrapped_cursor(conn)
+        artifact = get_artifact(cur, artifact_id)
         
-        if gratitudes:
-            story.append(Paragraph("<b>Gratitude Journal Highlights</b>", styles['Heading2']))
-            for g in gratitudes:
-                date_str = g[0][:10] if g[0] else 'N/A'
-                story.append(Paragraph(f"<i>{date_str}:</i> {g[1]}", styles['Normal']))
-            story.append(Spacer(1, 0.2*inch))
+        if not artifact or artifact['requested_by'] != authenticated_user:
+            return jsonify({'error': 'Report not found'}), 404
         
-        conn.close()
+        if artifact['status'] == 'ready':
+            artifact['download_url'] = f"/api/reports/artifacts/{artifact_id}/download"
+        return jsonify(artifact), 200
+    except Exception as e:
+        return handle_exception(e, request.endpoint or 'unknown')
+
+@app.route('/api/reports/artifacts/<int:artifact_id>/download', methods=['GET'])
+def download_report_artifact(artifact_id):
+    """Download a rendered report"""
+    try:
+        authenticated_user = get_authenticated_username()
+        if not authenticated_user:
+            return jsonify({'error': 'Authentication required'}), 401
         
-        # Build PDF
-        doc.build(story)
+        conn = get_db_connection()
+        cur = get_wrapped_cursor(conn)
+        artifact = get_artifact(cur, artifact_id, include_content=True)
         
-        pdf_data = buffer.getvalue()
-        buffer.close()
+        if not artifact or artifact['requested_by'] != authenticated_user:
+            return jsonify({'error': 'Report not found'}), 404
+        if artifact['status'] != 'ready':
+            return jsonify({'error': 'Report is not ready yet', 'status': artifact['status']}), 409
         
-        response = make_response(pdf_data)
-        response.headers["Content-Disposition"] = f"attachment; filename={username}_wellness_report.pdf"
-        response.headers["Content-Type"] = "application/pdf"
+        response = make_response(artifact['content'])
+        response.headers["Content-Disposition"] = f"attachment; filename={artifact['filename'] or 'report'}"
+        response.headers["Content-Type"] = artifact['content_type'] or 'application/octet-stream'
         return response
     except Exception as e:
         return handle_exception(e, request.endpoint or 'unknown')
@@ -13612,53 +14190,33 @@ def get_insights():
                 conn.close()
                 return jsonify({'error': 'Can only view your own insights'}), 403
 
-        # Build mood log query with date range
-        mood_query = "SELECT mood_val, sleep_val, entrestamp, notes FROM mood_logs WHERE username = %s"
-        params = [username]
-        if from_date:
-            mood_query += " AND DATE(entrestamp) >= date(%s)"
-            params.append(from_date)
-        if to_date:
-            mood_query += " AND DATE(entrestamp) <= date(%s)"
-            params.append(to_date)
-        mood_query += " ORDER BY entrestamp DESC"
-        moods = cur.execute(mood_query, tuple(params)).fetchall()
-
-        # Get chat history in date range
-        chat_query = "SELECT sender, message, timestamp FROM chat_history WHERE session_id = %s"
-        chat_params = [f"{username}_session"]
-        if from_date:
-            chat_query += " AND DATE(timestamp) >= date(%s)"
-            chat_params.append(from_date)
-        if to_date:
-            chat_query += " AND DATE(timestamp) <= date(%s)"
-            chat_params.append(to_date)
-        chat_query += " ORDER BY timestamp DESC"
-        chat_history = cur.execute(chat_query, tuple(chat_params)).fetchall()
+        try:
+            window = parse_date_range(from_date, to_date)
+        except ValueError:
+            conn.close()
+            return jsonify({'error': 'Dates must be YYYY-MM-DD, with to_date on or after from_date'}), 400
 
-        # Get gratitude entries
-        grat_query = "SELECT entry, entry_timestamp FROM gratitude_logs WHERE username = %s"
-        grat_params = [username]
-        if from_date:
-            grat_query += " AND DATE(entry_timestamp) >= date(%s)"
-            grat_params.append(from_date)
-        if to_date:
-            grat_query += " AND DATE(entry_timestamp) <= date(%s)"
-            grat_params.append(to_date)
-        grat_query += " ORDER BY entry_timestamp DESC"
-        gratitudes = cur.execute(grat_query, tuple(grat_params)).fetchall()
-
-        # Get CBT records
-        cbt_query = "SELECT situation, thought, evidence, entry_timestamp FROM cbt_records WHERE username = %s"
-        cbt_params = [username]
-        if from_date:
-            cbt_query += " AND DATE(entry_timestamp) >= date(%s)"
-            cbt_params.append(from_date)
-        if to_date:
-            cbt_query += " AND DATE(entry_timestamp) <= date(%s)"
-            cbt_params.append(to_date)
-        cbt_query += " ORDER BY entry_timestamp DESC"
-        cbt = cur.execute(cbt_query, tuple(cbt_params)).fetchall()
+        # Mood logs in range (all of them: they feed the averages and charts)
+        moods = cur.execute(*range_query(
+            "SELECT mood_val, sleep_val, entrestamp, notes FROM mood_logs WHERE username = %s",
+            [username], 'entrestamp', window
+        )).fetchall()
+
+        # The summary sections only show the newest few rows, so only fetch those
+        chat_history = cur.execute(*range_query(
+            "SELECT sender, message, timestamp FROM chat_history WHERE session_id = %s",
+            [f"{username}_session"], 'timestamp', window, limit=10
+        )).fetchall()
+
+        gratitudes = cur.execute(*range_query(
+            "SELECT entry, entry_timestamp FROM gratitude_logs WHERE username = %s",
+            [username], 'entry_timestamp', window, limit=5
+        )).fetchall()
+
+        cbt = cur.execute(*range_query(
+            "SELECT situation, thought, evidence, entry_timestamp FROM cbt_records WHERE username = %s",
+            [username], 'entry_timestamp', window, limit=5
+        )).fetchall()
 
         # Get safety plan
         safety = cur.execute(
@@ -13908,11 +14466,11 @@ def get_patient_detail(username):
                 (username,)
             ).fetchall()
         
-        # AI Chat history
-        chat_history = cur.execute(
-            "SELECT sender, message, timestamp FROM chat_history WHERE session_id = %s ORDER BY timestamp DESC LIMIT 50",
-            (f"{username}_session",)
-        ).fetchall()
+        # AI Chat history: newest 50, older pages via chat_before_id
+        chat_page = fetch_chat_history_page(
+            cur, 'session_id', f"{username}_session", limit=50,
+            before_id=request.args.get('chat_before_id', type=int)
+        )
         
         # Gratitude entries
         gratitude = cur.execute(
@@ -14034,9 +14592,8 @@ def get_patient_detail(username):
                     'timestamp': m[7]
                 } for m in moods
             ],
-            'chat_history': [
-                {'sender': c[0], 'message': c[1], 'timestamp': c[2]} for c in chat_history
-            ],
+            'chat_history': chat_page['history'][::-1],
+            'chat_history_next_before_id': chat_page['next_before_id'],
             'gratitude_entries': [
                 {'entry': g[0], 'timestamp': g[1]} for g in gratitude
             ],
@@ -14087,6 +14644,46 @@ def get_patient_detail(username):
     except Exception as e:
         return handle_exception(e, request.endpoint or 'unknown')
 
+@app.route('/api/professional/patient/<username>/chat-history', methods=['GET'])
+def get_patient_chat_history(username):
+    """Older pages of a patient's AI chat history for the clinician dashboard
+
+    Pass chat_history_next_before_id from /api/professional/patient/<username>
+    (then next_before_id from here) as before_id. Newest-first, like the
+    patient detail payload.
+    """
+    try:
+        clinician_username = get_authenticated_username()
+        if not clinician_username:
+            return jsonify({'error': 'Authentication required'}), 401
+
+        before_id = request.args.get('before_id', type=int)
+        if not before_id:
+            return jsonify({'error': 'before_id required'}), 400
+
+        conn = get_db_connection()
+        cur = get_wrapped_cursor(conn)
+        clinician = get_user_role_row(cur, clinician_username)
+        if not clinician or clinician[0] != 'clinician':
+            conn.close()
+            return jsonify({'error': 'Clinician role required'}), 403
+
+        is_valid, _ = verify_clinician_patient_relationship(clinician_username, username)
+        if not is_valid:
+            conn.close()
+            return jsonify({'error': 'Unauthorized: Patient not assigned to clinician'}), 403
+
+        page = fetch_chat_history_page(cur, 'session_id', f"{username}_session", limit=50, before_id=before_id)
+        conn.close()
+
+        return jsonify({
+            'chat_history': page['history'][::-1],
+            'has_more': page['has_more'],
+            'next_before_id': page['next_before_id']
+        }), 200
+    except Exception as e:
+        return handle_exception(e, request.endpoint or 'unknown')
+
 @app.route('/api/professional/ai-summary', methods=['POST'])
 def generate_ai_summary():
     """TIER 1.7: Generate AI clinical summary for a patient - clinician identity from session only"""
@@ -14584,65 +15181,55 @@ def export_patient_summary():
             app_logger.warning(f"Access denied: clinician {clinician_username} attempted export for unauthorized patient {patient_username}")
             return jsonify({'error': 'Unauthorized: You do not have access to this patient'}), 403
 
+        # Serve the cached summary if nothing in the patient's record has changed
+        data_version = report_data_version(cur, patient_username)
+        cache_key = report_cache_key(patient_username, REPORT_CLINICAL_SUMMARY, start_date, end_date,
+                                     data_version, clinician_username)
+        cached = find_artifact(cur, cache_key, include_content=True)
+        if cached and cached['status'] == 'ready':
+            conn.close()
+            return jsonify(json.loads(cached['content'])), 200
+
         # Get patient profile
         profile = cur.execute(
             "SELECT full_name, dob, conditions FROM users WHERE username = %s",
             (patient_username,)
         ).fetchone()
         
-        # Build date filters
-        mood_filter = ""
-        mood_params = [patient_username]
-        if start_date:
-            mood_filter += " AND entrestamp >= %s"
-            mood_params.append(start_date)
-        if end_date:
-            mood_filter += " AND entrestamp <= %s"
-            mood_params.append(end_date)
-        
-        # Get moods
-        moods = cur.execute(
-            f"SELECT mood_val, sleep_val, exercise_mins, notes, entrestamp FROM mood_logs WHERE username = %s{mood_filter} ORDER BY entrestamp DESC",
-            tuple(mood_params)
-        ).fetchall()
-        
+        # Dates are inclusive calendar days; filter on a half-open range of the raw columns
+        try:
+            window = parse_date_range(start_date, end_date)
+        except ValueError:
+            conn.close()
+            return jsonify({'error': 'Dates must be YYYY-MM-DD, with end_date on or after start_date'}), 400
+
+        # Mood stats are aggregated in SQL; only the 30 rows the table shows are fetched
+        mood_stats = cur.execute(*range_query(
+            "SELECT AVG(mood_val), AVG(COALESCE(sleep_val, 0)), COUNT(*) FROM mood_logs WHERE username = %s",
+            [patient_username], 'entrestamp', window, order=None
+        )).fetchone()
+        moods = cur.execute(*range_query(
+            "SELECT mood_val, sleep_val, exercise_mins, notes, entrestamp FROM mood_logs WHERE username = %s",
+            [patient_username], 'entrestamp', window, limit=30
+        )).fetchall()
+
         # Get assessments
-        assess_params = [patient_username]
-        assess_filter = ""
-        if start_date:
-            assess_filter += " AND entry_timestamp >= %s"
-            assess_params.append(start_date)
-        if end_date:
-            assess_filter += " AND entry_timestamp <= %s"
-            assess_params.append(end_date)
-        
-        assessments = cur.execute(
-            f"SELECT scale_name, score, severity, entry_timestamp FROM clinical_scales WHERE username = %s{assess_filter} ORDER BY entry_timestamp DESC",
-            tuple(assess_params)
-        ).fetchall()
-        
+        assessments = cur.execute(*range_query(
+            "SELECT scale_name, score, severity, entry_timestamp FROM clinical_scales WHERE username = %s",
+            [patient_username], 'entry_timestamp', window
+        )).fetchall()
+
         # Get clinician notes
         notes = cur.execute(
             "SELECT note_text, is_highlighted, created_at FROM clinician_notes WHERE clinician_username = %s AND patient_username = %s ORDER BY created_at DESC",
             (clinician_username, patient_username)
         ).fetchall()
-        
+
         # Get alerts
-        alert_params = [patient_username]
-        alert_filter = ""
-        if start_date:
-            alert_filter += " AND created_at >= %s"
-            alert_params.append(start_date)
-        if end_date:
-            alert_filter += " AND created_at <= %s"
-            alert_params.append(end_date)
-        
-        alerts = cur.execute(
-            f"SELECT alert_type, details, created_at FROM alerts WHERE username = %s{alert_filter} ORDER BY created_at DESC",
-            tuple(alert_params)
-        ).fetchall()
-        
-        conn.close()
+        alerts = cur.execute(*range_query(
+            "SELECT alert_type, details, created_at FROM alerts WHERE username = %s",
+            [patient_username], 'created_at', window
+        )).fetchall()
         
         # Calculate stats
         period_text = "All Time"
@@ -14653,8 +15240,9 @@ def export_patient_summary():
         elif end_date:
             period_text = f"Until {end_date}"
         
-        avg_mood = sum(m[0] for m in moods) / len(moods) if moods else 0
-        avg_sleep = sum(m[1] or 0 for m in moods) / len(moods) if moods else 0
+        avg_mood = float(mood_stats[0] or 0) if mood_stats else 0
+        avg_sleep = float(mood_stats[1] or 0) if mood_stats else 0
+        mood_count = mood_stats[2] if mood_stats else 0
         
         # Build HTML
         html = f"""<!DOCTYPE html>
@@ -14700,7 +15288,7 @@ def export_patient_summary():
             <div class="stat-label">Average Sleep</div>
         </div>
         <div class="stat">
-            <div class="stat-value">{len(moods)}</div>
+            <div class="stat-value">{mood_count}</div>
             <div class="stat-label">Mood Entries</div>
         </div>
         <div class="stat">
@@ -14719,25 +15307,30 @@ def export_patient_summary():
     {''.join([f'<div class="alert"><strong>{a[0]}:</strong> {a[1]}<br><small>{a[2][:19]}</small></div>' for a in alerts]) if alerts else '<p style="color: #28a745;">✓ No safety alerts in this period</p>'}
     
     <h2>Mood History (Last 30 Entries)</h2>
-    {'<table><tr><th>Date</th><th>Mood</th><th>Sleep</th><th>Exercise</th><th>Notes</th></tr>' + ''.join([f'<tr><td>{m[4][:10]}</td><td>{m[0]}/10</td><td>{m[1] or 0}h</td><td>{m[2] or 0}min</td><td style="max-width:200px;">{(m[3] or "-")[:50]}</td></tr>' for m in moods[:30]]) + '</table>' if moods else '<p>No mood entries in this period</p>'}
+    {'<table><tr><th>Date</th><th>Mood</th><th>Sleep</th><th>Exercise</th><th>Notes</th></tr>' + ''.join([f'<tr><td>{m[4][:10]}</td><td>{m[0]}/10</td><td>{m[1] or 0}h</td><td>{m[2] or 0}min</td><td style="max-width:200px;">{(m[3] or "-")[:50]}</td></tr>' for m in moods]) + '</table>' if moods else '<p>No mood entries in this period</p>'}
     
     <hr style="margin-top: 40px;">
     <p style="text-align: center; color: #999; font-size: 11px;">Confidential - Generated by Healing Space UK for {clinician_username}</p>
 </body>
 </html>"""
         
-        return jsonify({
+        summary = {
             'success': True,
             'html': html,
             'period': period_text,
             'stats': {
                 'avg_mood': round(avg_mood, 1),
                 'avg_sleep': round(avg_sleep, 1),
-                'total_entries': len(moods),
+                'total_entries': mood_count,
                 'alert_count': len(alerts),
                 'assessment_count': len(assessments)
             }
-        }), 200
+        }
+        _cache_report(conn, cur, cache_key, patient_username, REPORT_CLINICAL_SUMMARY, start_date, end_date,
+                      data_version, clinician_username, summary)
+        conn.close()
+        
+        return jsonify(summary), 200
         
     except Exception as e:
         print(f"Export summary error: {e}")
@@ -14797,6 +15390,7 @@ def reset_all_users():
 
         # Delete all users and related data
         cur.execute("DELETE FROM users")
+        principal_cache.notify(cur)
         cur.execute("DELETE FROM patient_approvals")
         cur.execute("DELETE FROM notifications")
         cur.execute("DELETE FROM sessions")
@@ -14808,6 +15402,7 @@ def reset_all_users():
         cur.execute("DELETE FROM safety_plans")
         cur.execute("DELETE FROM ai_memory")
         cur.execute("DELETE FROM community_posts")
+        cur.execute("DELETE FROM community_channel_stats")
         cur.execute("DELETE FROM alerts")
         
         conn.commit()
@@ -16461,6 +17056,17 @@ def get_patient_analytics(username):
 
 # ==================== REPORT GENERATOR ENDPOINTS ====================
 
+def _cache_report(conn, cur, cache_key, username, report_type, range_start, range_end,
+                  data_version, requested_by, payload):
+    """Store a rendered JSON report as a ready artifact. Best effort: a cache write never fails the request."""
+    try:
+        store_artifact(cur, cache_key, username, report_type, range_start, range_end, data_version,
+                       requested_by, json.dumps(payload, default=str).encode(), 'application/json', None)
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        app_logger.warning(f"Report cache write failed for {report_type}/{username}: {e}")
+
 @app.route('/api/reports/generate', methods=['POST'])
 def generate_clinical_report():
     """Generate clinical report for patient"""
@@ -16472,6 +17078,8 @@ def generate_clinical_report():
 
         if not all([username, report_type, clinician]):
             return jsonify({'error': 'Missing required fields'}), 400
+        if report_type not in CLINICAL_REPORT_TYPES:
+            return jsonify({'error': f"report_type must be one of {', '.join(CLINICAL_REPORT_TYPES)}"}), 400
 
         conn = get_db_connection()
         cur = get_wrapped_cursor(conn)
@@ -16496,6 +17104,17 @@ def generate_clinical_report():
             conn.close()
             return jsonify({'error': 'Patient not found'}), 404
         
+        # Reports are dated, so the cache key includes today's date
+        from datetime import date
+        report_day = date.today().isoformat()
+        data_version = report_data_version(cur, username)
+        cache_key = report_cache_key(username, report_type, report_day, report_day, data_version, clinician)
+        cached = find_artifact(cur, cache_key, include_content=True)
+        if cached and cached['status'] == 'ready':
+            conn.close()
+            log_event(clinician, 'clinician', 'report_generated', f'{report_type} for {username} (cached)')
+            return jsonify(json.loads(cached['content'])), 200
+        
         # Decrypt patient data
         full_name = decrypt_text(patient[0]) if patient[0] else username
         dob = decrypt_text(patient[1]) if patient[1] else 'Not provided'
@@ -16530,8 +17149,6 @@ def generate_clinical_report():
             AND entrestamp > CURRENT_TIMESTAMP - INTERVAL '30 days'
         """, (username,)).fetchone()[0]
         
-        conn.close()
-        
         # Generate report content
         from datetime import datetime
         report_date = datetime.now().strftime('%d %B %Y')
@@ -16624,14 +17241,19 @@ FOLLOW-UP RECOMMENDATIONS:
 Mental Health Clinician
 """
         
-        log_event(clinician, 'clinician', 'report_generated', f'{report_type} for {username}')
-        
-        return jsonify({
+        report = {
             'success': True,
             'report_content': report_content,
             'report_type': report_type,
             'patient': username
-        }), 200
+        }
+        _cache_report(conn, cur, cache_key, username, report_type, report_day, report_day,
+                      data_version, clinician, report)
+        conn.close()
+        
+        log_event(clinician, 'clinician', 'report_generated', f'{report_type} for {username}')
+        
+        return jsonify(report), 200
         
     except Exception as e:
         return handle_exception(e, request.endpoint or 'unknown')
@@ -16722,7 +17344,7 @@ def get_risk_score(username):
         cur = get_wrapped_cursor(conn)
 
         # Verify access: must be the patient, their clinician, or a developer
-        role = cur.execute("SELECT role FROM users WHERE username = %s", (requesting_user,)).fetchone()
+        role = get_user_role_row(cur, requesting_user)
         if not role:
             conn.close()
             return jsonify({'error': 'User not found'}), 404
@@ -16770,7 +17392,7 @@ def get_risk_history(username):
         cur = get_wrapped_cursor(conn)
 
         # Verify clinician access
-        role = cur.execute("SELECT role FROM users WHERE username = %s", (requesting_user,)).fetchone()
+        role = get_user_role_row(cur, requesting_user)
         if not role or role[0] not in ('clinician', 'developer'):
             conn.close()
             return jsonify({'error': 'Clinician role required'}), 403
@@ -16833,7 +17455,7 @@ def get_risk_alerts():
         conn = get_db_connection()
         cur = get_wrapped_cursor(conn)
 
-        role = cur.execute("SELECT role FROM users WHERE username = %s", (username,)).fetchone()
+        role = get_user_role_row(cur, username)
         if not role or role[0] not in ('clinician', 'developer'):
             conn.close()
             return jsonify({'error': 'Clinician role required'}), 403
@@ -16915,7 +17537,7 @@ def create_risk_alert():
         conn = get_db_connection()
         cur = get_wrapped_cursor(conn)
 
-        role = cur.execute("SELECT role FROM users WHERE username = %s", (username,)).fetchone()
+        role = get_user_role_row(cur, username)
         if not role or role[0] not in ('clinician', 'developer'):
             conn.close()
             return jsonify({'error': 'Clinician role required'}), 403
@@ -16989,7 +17611,7 @@ def acknowledge_risk_alert(alert_id):
         conn = get_db_connection()
         cur = get_wrapped_cursor(conn)
 
-        role = cur.execute("SELECT role FROM users WHERE username = %s", (username,)).fetchone()
+        role = get_user_role_row(cur, username)
         if not role or role[0] not in ('clinician', 'developer'):
             conn.close()
             return jsonify({'error': 'Clinician role required'}), 403
@@ -17032,7 +17654,7 @@ def resolve_risk_alert(alert_id):
         conn = get_db_connection()
         cur = get_wrapped_cursor(conn)
 
-        role = cur.execute("SELECT role FROM users WHERE username = %s", (username,)).fetchone()
+        role = get_user_role_row(cur, username)
         if not role or role[0] not in ('clinician', 'developer'):
             conn.close()
             return jsonify({'error': 'Clinician role required'}), 403
@@ -17085,7 +17707,7 @@ def get_risk_keywords():
         conn = get_db_connection()
         cur = get_wrapped_cursor(conn)
 
-        role = cur.execute("SELECT role FROM users WHERE username = %s", (username,)).fetchone()
+        role = get_user_role_row(cur, username)
         if not role or role[0] not in ('clinician', 'developer'):
             conn.close()
             return jsonify({'error': 'Clinician role required'}), 403
@@ -17126,7 +17748,7 @@ def add_risk_keyword():
         conn = get_db_connection()
         cur = get_wrapped_cursor(conn)
 
-        role = cur.execute("SELECT role FROM users WHERE username = %s", (username,)).fetchone()
+        role = get_user_role_row(cur, username)
         if not role or role[0] not in ('clinician', 'developer'):
             conn.close()
             return jsonify({'error': 'Clinician role required'}), 403
@@ -17182,7 +17804,7 @@ def get_risk_dashboard():
         conn = get_db_connection()
         cur = get_wrapped_cursor(conn)
 
-        role = cur.execute("SELECT role FROM users WHERE username = %s", (username,)).fetchone()
+        role = get_user_role_row(cur, username)
         if not role or role[0] not in ('clinician', 'developer'):
             conn.close()
             return jsonify({'error': 'Clinician role required'}), 403
@@ -17352,7 +17974,7 @@ def get_predictive_flags(patient_username):
             return jsonify({'error': 'Authentication required'}), 401
         conn = get_db_connection()
         cur = get_wrapped_cursor(conn)
-        role = cur.execute("SELECT role FROM users WHERE username = %s", (username,)).fetchone()
+        role = get_user_role_row(cur, username)
         if not role or role[0] not in ('clinician', 'developer'):
             conn.close()
             return jsonify({'error': 'Clinician role required'}), 403
@@ -17396,7 +18018,7 @@ def dismiss_predictive_flag(flag_id):
             return jsonify({'error': 'Authentication required'}), 401
         conn = get_db_connection()
         cur = get_wrapped_cursor(conn)
-        role = cur.execute("SELECT role FROM users WHERE username = %s", (username,)).fetchone()
+        role = get_user_role_row(cur, username)
         if not role or role[0] not in ('clinician', 'developer'):
             conn.close()
             return jsonify({'error': 'Clinician role required'}), 403
@@ -17434,7 +18056,7 @@ def get_safeguarding_stats():
 
         conn = get_db_connection()
         cur = get_wrapped_cursor(conn)
-        role = cur.execute("SELECT role FROM users WHERE username=%s", (username,)).fetchone()
+        role = get_user_role_row(cur, username)
         if not role or role[0] not in ('clinician', 'developer'):
             conn.close()
             return jsonify({'error': 'Clinician access required'}), 403
@@ -17479,7 +18101,7 @@ def list_safeguarding_concerns():
 
         conn = get_db_connection()
         cur = get_wrapped_cursor(conn)
-        role = cur.execute("SELECT role FROM users WHERE username=%s", (username,)).fetchone()
+        role = get_user_role_row(cur, username)
         if not role or role[0] not in ('clinician', 'developer'):
             conn.close()
             return jsonify({'error': 'Clinician access required'}), 403
@@ -17535,7 +18157,7 @@ def create_safeguarding_concern():
 
         conn = get_db_connection()
         cur = get_wrapped_cursor(conn)
-        role = cur.execute("SELECT role FROM users WHERE username=%s", (username,)).fetchone()
+        role = get_user_role_row(cur, username)
         if not role or role[0] not in ('clinician', 'developer'):
             conn.close()
             return jsonify({'error': 'Clinician access required'}), 403
@@ -17671,7 +18293,7 @@ def get_safeguarding_concern(concern_id):
 
         conn = get_db_connection()
         cur = get_wrapped_cursor(conn)
-        role = cur.execute("SELECT role FROM users WHERE username=%s", (username,)).fetchone()
+        role = get_user_role_row(cur, username)
         if not role or role[0] not in ('clinician', 'developer'):
             conn.close()
             return jsonify({'error': 'Clinician access required'}), 403
@@ -17722,7 +18344,7 @@ def update_safeguarding_concern(concern_id):
 
         conn = get_db_connection()
         cur = get_wrapped_cursor(conn)
-        role = cur.execute("SELECT role FROM users WHERE username=%s", (username,)).fetchone()
+        role = get_user_role_row(cur, username)
         if not role or role[0] not in ('clinician', 'developer'):
             conn.close()
             return jsonify({'error': 'Clinician access required'}), 403
@@ -17783,7 +18405,7 @@ def get_patient_safeguarding(patient_username):
 
         conn = get_db_connection()
         cur = get_wrapped_cursor(conn)
-        role = cur.execute("SELECT role FROM users WHERE username=%s", (username,)).fetchone()
+        role = get_user_role_row(cur, username)
         if not role or role[0] not in ('clinician', 'developer'):
             conn.close()
             return jsonify({'error': 'Clinician access required'}), 403
@@ -17831,7 +18453,7 @@ def get_duty_clinician():
 
         conn = get_db_connection()
         cur = get_wrapped_cursor(conn)
-        role = cur.execute("SELECT role FROM users WHERE username=%s", (username,)).fetchone()
+        role = get_user_role_row(cur, username)
         if not role or role[0] not in ('clinician', 'developer'):
             conn.close()
             return jsonify({'error': 'Clinician access required'}), 403
@@ -17899,7 +18521,7 @@ def set_duty_clinician():
 
         conn = get_db_connection()
         cur = get_wrapped_cursor(conn)
-        role = cur.execute("SELECT role FROM users WHERE username=%s", (username,)).fetchone()
+        role = get_user_role_row(cur, username)
         if not role or role[0] not in ('clinician', 'developer'):
             conn.close()
             return jsonify({'error': 'Clinician access required'}), 403
@@ -17912,7 +18534,7 @@ def set_duty_clinician():
             return jsonify({'error': 'clinician_username and duty_date are required'}), 400
 
         # Verify the clinician exists
-        clin_check = cur.execute("SELECT role FROM users WHERE username=%s", (clinician_username,)).fetchone()
+        clin_check = get_user_role_row(cur, clinician_username)
         if not clin_check or clin_check[0] not in ('clinician', 'developer'):
             conn.close()
             return jsonify({'error': 'Specified user is not a clinician'}), 400
@@ -17960,7 +18582,7 @@ def delete_duty_assignment(duty_id):
 
         conn = get_db_connection()
         cur = get_wrapped_cursor(conn)
-        role = cur.execute("SELECT role FROM users WHERE username=%s", (username,)).fetchone()
+        role = get_user_role_row(cur, username)
         if not role or role[0] not in ('clinician', 'developer'):
             conn.close()
             return jsonify({'error': 'Clinician access required'}), 403
@@ -17994,7 +18616,7 @@ def get_enhanced_safety_plan(username):
 
         # Allow patient to view own plan, or clinician to view their patient's plan
         if auth_user != username:
-            role = cur.execute("SELECT role FROM users WHERE username = %s", (auth_user,)).fetchone()
+            role = get_user_role_row(cur, auth_user)
             if not role or role[0] not in ('clinician', 'developer'):
                 conn.close()
                 return jsonify({'error': 'Unauthorized'}), 403
@@ -18184,7 +18806,7 @@ def get_ai_monitoring_consent(username):
         if auth_user != username:
             conn = get_db_connection()
             cur = get_wrapped_cursor(conn)
-            role = cur.execute("SELECT role FROM users WHERE username = %s", (auth_user,)).fetchone()
+            role = get_user_role_row(cur, auth_user)
             conn.close()
             if not role or role[0] not in ('clinician', 'developer'):
                 return jsonify({'error': 'Unauthorized'}), 403
@@ -18284,7 +18906,7 @@ def get_individual_risk_report(username):
         conn = get_db_connection()
         cur = get_wrapped_cursor(conn)
 
-        role = cur.execute("SELECT role FROM users WHERE username = %s", (auth_user,)).fetchone()
+        role = get_user_role_row(cur, auth_user)
         if not role or role[0] not in ('clinician', 'developer'):
             conn.close()
             return jsonify({'error': 'Clinician role required'}), 403
@@ -18387,7 +19009,7 @@ def get_caseload_report():
         conn = get_db_connection()
         cur = get_wrapped_cursor(conn)
 
-        role = cur.execute("SELECT role FROM users WHERE username = %s", (auth_user,)).fetchone()
+        role = get_user_role_row(cur, auth_user)
         if not role or role[0] not in ('clinician', 'developer'):
             conn.close()
             return jsonify({'error': 'Clinician role required'}), 403
@@ -18539,7 +19161,7 @@ def submit_feedback():
         cur = get_wrapped_cursor(conn)
 
         # Get user role
-        user = cur.execute("SELECT role FROM users WHERE username=%s", (username,)).fetchone()
+        user = get_user_role_row(cur, username)
         role = user[0] if user else 'user'
 
         cur.execute(
@@ -19183,27 +19805,35 @@ def get_conversation(recipient_username):
         limit = int(request.args.get('limit', 50))
         if limit < 1 or limit > 200:
             limit = 50
+
+        # Keyset cursors: before_id pages backwards, after_id fetches deltas
+        before_id = request.args.get('before_id', type=int)
+        after_id = request.args.get('after_id', type=int)
+        if before_id and after_id:
+            return jsonify({'error': 'Use either before_id or after_id, not both'}), 400
         
         try:
             conn = get_db_connection()
             cur = get_wrapped_cursor(conn)
             service = MessageService(conn, cur, username)
             
-            # Get conversation with MessageService
+            # Get conversation with MessageService (marks unread as read in bulk)
             result = service.get_conversation(
                 recipient_username=recipient_username,
-                limit=limit
+                limit=limit,
+                before_id=before_id,
+                after_id=after_id
             )
             
-            # Mark messages as read
-            service.mark_conversation_as_read(recipient_username)
-            
             conn.close()
             
             return jsonify({
                 'messages': result.get('messages', []),
                 'with_user': recipient_username,
-                'participant_count': 2
+                'participant_count': 2,
+                'has_more': result.get('has_more', False),
+                'next_before_id': result.get('next_before_id'),
+                'latest_id': result.get('latest_id')
             }), 200
         
         except ValueError as e:
@@ -19342,7 +19972,7 @@ def get_all_feedback():
         cur = get_wrapped_cursor(conn)
 
         # Check if user is developer
-        user_role = cur.execute('SELECT role FROM users WHERE username=%s', (username,)).fetchone()
+        user_role = get_user_role_row(cur, username)
         if not user_role or user_role[0] != 'developer':
             conn.close()
             return jsonify({'error': 'Only developers can view all feedback'}), 403
@@ -19398,7 +20028,7 @@ def update_feedback_status(feedback_id):
         cur = get_wrapped_cursor(conn)
 
         # Check if user is developer
-        user_role = cur.execute('SELECT role FROM users WHERE username=%s', (username,)).fetchone()
+        user_role = get_user_role_row(cur, username)
         if not user_role or user_role[0] != 'developer':
             conn.close()
             return jsonify({'error': 'Only developers can update feedback'}), 403
@@ -19958,6 +20588,20 @@ def list_group_members(conversation_id):
 
 
 # ============= MESSAGE SCHEDULING (4 ENDPOINTS) =============
+# Delivery is done out of band by message_dispatcher.py (Procfile 'worker').
+
+def _parse_scheduled_for(value):
+    """Parse an ISO-8601 scheduled_for value into a naive local datetime"""
+    if not value or not isinstance(value, str):
+        raise ValueError("scheduled_for must be an ISO-8601 datetime")
+    try:
+        parsed = datetime.fromisoformat(value.strip().replace('Z', '+00:00'))
+    except ValueError:
+        raise ValueError("scheduled_for must be an ISO-8601 datetime")
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone().replace(tzinfo=None)
+    return parsed
+
 
 @app.route('/api/messages/scheduled', methods=['POST'])
 def schedule_message():
@@ -19991,7 +20635,12 @@ def schedule_message():
             cur = get_wrapped_cursor(conn)
             service = MessageService(conn, cur, username)
             
-            result = service.schedule_message(recipient, content, subject, scheduled_for)
+            result = service.schedule_message(
+                recipient_username=recipient,
+                content=content,
+                scheduled_for=_parse_scheduled_for(scheduled_for),
+                subject=subject or None
+            )
             conn.close()
             
             log_event(username, 'messaging', 'message_scheduled', f'Recipient: {recipient}, Scheduled: {scheduled_for}')
@@ -20070,7 +20719,12 @@ def update_scheduled_message(message_id):
             cur = get_wrapped_cursor(conn)
             service = MessageService(conn, cur, username)
             
-            result = service.update_scheduled_message(message_id, scheduled_for, content, subject)
+            result = service.update_scheduled_message(
+                message_id,
+                scheduled_for=_parse_scheduled_for(scheduled_for) if scheduled_for else None,
+                content=content,
+                subject=subject
+            )
             conn.close()
             
             log_event(username, 'messaging', 'scheduled_updated', f'Message ID: {message_id}')
@@ -20246,11 +20900,11 @@ def list_blocked_users():
         return handle_exception(e, 'list_blocked_users')
 
 
-# ============= BROADCAST MESSAGING (2 ENDPOINTS) =============
+# ============= BROADCAST MESSAGING (3 ENDPOINTS) =============
 
 @app.route('/api/admin/messages/broadcast', methods=['POST'])
 def broadcast_message_admin():
-    """Broadcast message to all users (admin only)"""
+    """Broadcast message to all/filtered users (admin or developer only)"""
     try:
         username = get_authenticated_username()
         if not username:
@@ -20262,10 +20916,10 @@ def broadcast_message_admin():
         # Check admin role
         conn = get_db_connection()
         cur = get_wrapped_cursor(conn)
-        user = cur.execute('SELECT role FROM users WHERE username=%s', (username,)).fetchone()
+        user = get_user_role_row(cur, username)
         conn.close()
         
-        if not user or user[0] != 'admin':
+        if not user or user[0] not in ('admin', 'developer'):
             return jsonify({'error': 'Admin role required'}), 403
         
         # Validate CSRF
@@ -20275,6 +20929,7 @@ def broadcast_message_admin():
         data = request.json or {}
         subject = data.get('subject', '').strip()
         content = data.get('content', '').strip()
+        recipient_filter = data.get('type', 'all')
         
         if not subject or not content:
             return jsonify({'error': 'Subject and content are required'}), 400
@@ -20282,20 +20937,26 @@ def broadcast_message_admin():
         try:
             conn = get_db_connection()
             cur = get_wrapped_cursor(conn)
-            service = MessageService(conn, cur, 'SYSTEM')
+            service = MessageService(conn, cur, username)
             
-            result = service.broadcast_message(subject, content, broadcast_type='admin')
+            # Small audiences are fanned out inline; large ones are queued for
+            # message_dispatcher.py and polled via GET .../broadcast/<id>
+            result = service.send_broadcast_message(content, subject=subject,
+                                                    recipient_filter=recipient_filter)
             conn.close()
             
-            log_event(username, 'messaging', 'broadcast_sent', f'Subject: {subject}, Recipients: {result.get("recipient_count")}')
+            log_event(username, 'messaging', 'broadcast_sent', f'Subject: {subject}, Recipients: {result.get("recipients_count")}')
             
             return jsonify({
                 'broadcast_id': result.get('broadcast_id'),
+                'message_id': result.get('message_id'),
                 'subject': subject,
-                'recipient_count': result.get('recipient_count'),
-                'status': 'sent'
-            }), 201
+                'recipients_count': result.get('recipients_count'),
+                'status': result.get('status')
+            }), 202 if result.get('status') == 'queued' else 201
         
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         except Exception as e:
             app_logger.error(f'Error broadcasting: {e}')
             return jsonify({'error': 'Failed to broadcast message'}), 500
@@ -20304,6 +20965,39 @@ def broadcast_message_admin():
         return handle_exception(e, 'broadcast_message_admin')
 
 
+@app.route('/api/admin/messages/broadcast/<int:broadcast_id>', methods=['GET'])
+def get_broadcast_status_admin(broadcast_id):
+    """Fan-out progress of a broadcast (admin or developer only)"""
+    try:
+        username = get_authenticated_username()
+        if not username:
+            return jsonify({'error': 'Authentication required'}), 401
+        
+        if not HAS_MESSAGE_SERVICE:
+            return jsonify({'error': 'Messaging system not available'}), 503
+        
+        conn = get_db_connection()
+        cur = get_wrapped_cursor(conn)
+        user = get_user_role_row(cur, username)
+        
+        if not user or user[0] not in ('admin', 'developer'):
+            conn.close()
+            return jsonify({'error': 'Admin role required'}), 403
+        
+        try:
+            service = MessageService(conn, cur, username)
+            status = service.get_broadcast_status(broadcast_id)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 404
+        finally:
+            conn.close()
+        
+        return jsonify(status), 200
+    
+    except Exception as e:
+        return handle_exception(e, 'get_broadcast_status_admin')
+
+
 @app.route('/api/clinician/messages/broadcast', methods=['POST'])
 def broadcast_message_clinician():
     """Broadcast message to assigned patients (clinician only)"""
@@ -20318,7 +21012,7 @@ def broadcast_message_clinician():
         # Check clinician role
         conn = get_db_connection()
         cur = get_wrapped_cursor(conn)
-        user = cur.execute('SELECT role FROM users WHERE username=%s', (username,)).fetchone()
+        user = get_user_role_row(cur, username)
         conn.close()
         
         if not user or user[0] not in ('clinician', 'therapist'):
@@ -20531,7 +21225,7 @@ def search_message_recipients():
         cur = get_wrapped_cursor(conn)
         
         # Get role of current user to determine who they can message
-        user_role = cur.execute('SELECT role FROM users WHERE username=%s', (username,)).fetchone()
+        user_role = get_user_role_row(cur, username)
         user_role = user_role[0] if user_role else 'user'
         
         # Build search query based on role
@@ -20673,7 +21367,7 @@ def get_message_analytics_admin():
         # Check admin role
         conn = get_db_connection()
         cur = get_wrapped_cursor(conn)
-        user = cur.execute('SELECT role FROM users WHERE username=%s', (username,)).fetchone()
+        user = get_user_role_row(cur, username)
         
         if not user or user[0] != 'admin':
             conn.close()
@@ -20713,7 +21407,7 @@ def get_message_analytics_clinician():
         # Check clinician role
         conn = get_db_connection()
         cur = get_wrapped_cursor(conn)
-        user = cur.execute('SELECT role FROM users WHERE username=%s', (username,)).fetchone()
+        user = get_user_role_row(cur, username)
         
         if not user or user[0] not in ('clinician', 'therapist'):
             conn.close()
@@ -20767,7 +21461,7 @@ def save_test_results():
 
         conn = get_db_connection()
         cur = get_wrapped_cursor(conn)
-        user_role = cur.execute("SELECT role FROM users WHERE username=%s", (username,)).fetchone()
+        user_role = get_user_role_row(cur, username)
 
         if not user_role or user_role[0] != 'developer':
             conn.close()
@@ -20803,7 +21497,7 @@ def run_tests():
 
         conn = get_db_connection()
         cur = get_wrapped_cursor(conn)
-        user_role = cur.execute("SELECT role FROM users WHERE username=%s", (username,)).fetchone()
+        user_role = get_user_role_row(cur, username)
 
         if not user_role or user_role[0] != 'developer':
             conn.close()
@@ -20875,7 +21569,7 @@ def get_test_results():
         conn = get_db_connection()
         cur = get_wrapped_cursor(conn)
         
-        user_role = cur.execute("SELECT role FROM users WHERE username=%s", (username,)).fetchone()
+        user_role = get_user_role_row(cur, username)
         if not user_role or user_role[0] != 'developer':
             conn.close()
             return jsonify({'error': 'Developer role required'}), 403
@@ -20919,7 +21613,7 @@ def run_performance_tests():
         conn = get_db_connection()
         cur = get_wrapped_cursor(conn)
         
-        user_role = cur.execute("SELECT role FROM users WHERE username=%s", (username,)).fetchone()
+        user_role = get_user_role_row(cur, username)
         if not user_role or user_role[0] != 'developer':
             conn.close()
             return jsonify({'error': 'Developer role required'}), 403
@@ -20968,6 +21662,141 @@ def run_performance_tests():
     except Exception as e:
         return handle_exception(e, 'run_performance_tests')
 
+@app.route('/api/developer/monitoring/scheduled-messages', methods=['GET'])
+def get_scheduled_message_metrics():
+    """Delivery-lag and backlog metrics for the scheduled message dispatcher"""
+    try:
+        username = get_authenticated_username()
+        if not username:
+            return jsonify({'error': 'Authentication required'}), 401
+
+        if not HAS_MESSAGE_SERVICE:
+            return jsonify({'error': 'Messaging system not available'}), 503
+
+        conn = get_db_connection()
+        cur = get_wrapped_cursor(conn)
+
+        user_role = get_user_role_row(cur, username)
+        if not user_role or user_role[0] != 'developer':
+            conn.close()
+            return jsonify({'error': 'Developer role required'}), 403
+
+        hours = request.args.get('hours', 24, type=int)
+        if hours < 1 or hours > 720:
+            hours = 24
+
+        stats = get_dispatch_stats(cur, hours=hours)
+        conn.close()
+
+        stats['timestamp'] = datetime.now().isoformat()
+        return jsonify(stats), 200
+
+    except Exception as e:
+        return handle_exception(e, 'get_scheduled_message_metrics')
+
+@app.route('/api/developer/monitoring/email-outbox', methods=['GET'])
+def get_email_outbox_metrics():
+    """Backlog and delivery-latency metrics for the outbound email queue"""
+    try:
+        username = get_authenticated_username()
+        if not username:
+            return jsonify({'error': 'Authentication required'}), 401
+
+        conn = get_db_connection()
+        cur = get_wrapped_cursor(conn)
+
+        user_role = get_user_role_row(cur, username)
+        if not user_role or user_role[0] != 'developer':
+            conn.close()
+            return jsonify({'error': 'Developer role required'}), 403
+
+        hours = request.args.get('hours', 24, type=int)
+        if hours < 1 or hours > 720:
+            hours = 24
+
+        stats = get_outbox_stats(cur, hours=hours)
+        conn.close()
+
+        stats['smtp_configured'] = smtp_configured()
+        stats['timestamp'] = datetime.now().isoformat()
+        return jsonify(stats), 200
+
+    except Exception as e:
+        return handle_exception(e, 'get_email_outbox_metrics')
+
+@app.route('/api/developer/training/jobs', methods=['GET'])
+def get_training_jobs():
+    """Recent AI training jobs with live progress from the training runner"""
+    try:
+        username = get_authenticated_username()
+        if not username:
+            return jsonify({'error': 'Authentication required'}), 401
+
+        conn = get_db_connection()
+        cur = get_wrapped_cursor(conn)
+
+        user_role = get_user_role_row(cur, username)
+        if not user_role or user_role[0] != 'developer':
+            conn.close()
+            return jsonify({'error': 'Developer role required'}), 403
+
+        limit = request.args.get('limit', 20, type=int)
+        if limit < 1 or limit > 100:
+            limit = 20
+
+        jobs = training_jobs.recent_jobs(cur, limit)
+        watermark = cur.execute(
+            "SELECT last_trained_id, pending_rows, trained_at FROM training_watermark WHERE id = 1"
+        ).fetchone()
+        conn.close()
+
+        for job in jobs:
+            for key in ('created_at', 'started_at', 'heartbeat_at', 'finished_at'):
+                if job[key]:
+                    job[key] = job[key].isoformat()
+
+        return jsonify({
+            'jobs': jobs,
+            'watermark': {
+                'last_trained_id': watermark[0],
+                'pending_rows': watermark[1],
+                'trained_at': watermark[2].isoformat() if watermark[2] else None
+            } if watermark else None,
+            'timestamp': datetime.now().isoformat()
+        }), 200
+
+    except Exception as e:
+        return handle_exception(e, 'get_training_jobs')
+
+@app.route('/api/developer/training/jobs/<int:job_id>/cancel', methods=['POST'])
+def cancel_training_job(job_id):
+    """Cancel a queued training job, or ask the runner to stop a running one"""
+    try:
+        username = get_authenticated_username()
+        if not username:
+            return jsonify({'error': 'Authentication required'}), 401
+
+        conn = get_db_connection()
+        cur = get_wrapped_cursor(conn)
+
+        user_role = get_user_role_row(cur, username)
+        if not user_role or user_role[0] != 'developer':
+            conn.close()
+            return jsonify({'error': 'Developer role required'}), 403
+
+        status = training_jobs.cancel_job(cur, job_id)
+        conn.commit()
+        conn.close()
+
+        if status is None:
+            return jsonify({'error': 'Training job not found or already finished'}), 404
+
+        log_event(username, 'developer', 'training_cancelled', f'Training job {job_id} ({status})')
+        return jsonify({'success': True, 'job_id': job_id, 'status': status}), 200
+
+    except Exception as e:
+        return handle_exception(e, 'cancel_training_job')
+
 @app.route('/api/developer/monitoring/status', methods=['GET'])
 def get_monitoring_status():
     """Get system health and monitoring status"""
@@ -20979,7 +21808,7 @@ def get_monitoring_status():
         conn = get_db_connection()
         cur = get_wrapped_cursor(conn)
         
-        user_role = cur.execute("SELECT role FROM users WHERE username=%s", (username,)).fetchone()
+        user_role = get_user_role_row(cur, username)
         if not user_role or user_role[0] != 'developer':
             conn.close()
             return jsonify({'error': 'Developer role required'}), 403
@@ -21033,6 +21862,79 @@ def get_monitoring_status():
     except Exception as e:
         return handle_exception(e, 'get_monitoring_status')
 
+@app.route('/api/developer/metrics/summary', methods=['GET'])
+def get_request_metrics_summary():
+    """Slowest (or busiest) endpoints from the request metrics behind /metrics"""
+    try:
+        username = get_authenticated_username()
+        if not username:
+            return jsonify({'error': 'Authentication required'}), 401
+
+        conn = get_db_connection()
+        cur = get_wrapped_cursor(conn)
+        user_role = get_user_role_row(cur, username)
+        conn.close()
+        if not user_role or user_role[0] != 'developer':
+            return jsonify({'error': 'Developer role required'}), 403
+
+        limit = request.args.get('limit', 20, type=int)
+        if limit < 1 or limit > 200:
+            limit = 20
+
+        snapshot = request_metrics.snapshot()
+        requests_total = sum(s.requests for s in snapshot.series.values())
+        errors_total = sum(s.errors for s in snapshot.series.values())
+
+        return jsonify({
+            'endpoints': summarize(snapshot, sort=request.args.get('sort', 'p95'), limit=limit),
+            'totals': {
+                'requests': requests_total,
+                'errors': errors_total,
+                'in_flight': snapshot.in_flight,
+                'endpoints_seen': len(snapshot.series)
+            },
+            'all_workers': snapshot.aggregated,
+            'timestamp': datetime.now().isoformat()
+        }), 200
+
+    except Exception as e:
+        return handle_exception(e, 'get_request_metrics_summary')
+
+@app.route('/api/developer/sql-profile', methods=['GET'])
+def get_sql_profile_offenders():
+    """Endpoints the SQL profiler flagged for query count or repeated statements (N+1)"""
+    try:
+        username = get_authenticated_username()
+        if not username:
+            return jsonify({'error': 'Authentication required'}), 401
+
+        conn = get_db_connection()
+        cur = get_wrapped_cursor(conn)
+        user_role = get_user_role_row(cur, username)
+        conn.close()
+        if not user_role or user_role[0] != 'developer':
+            return jsonify({'error': 'Developer role required'}), 403
+
+        limit = request.args.get('limit', 20, type=int)
+        if limit < 1 or limit > 200:
+            limit = 20
+
+        offenders = sql_profiler.store.top_offenders(limit)
+        for row in offenders:
+            if row.get('last_seen') is not None:
+                row['last_seen'] = row['last_seen'].isoformat()
+
+        return jsonify({
+            'enabled': sql_profiler.enabled,
+            'query_budget': sql_profiler.query_budget,
+            'repeat_limit': sql_profiler.repeat_limit,
+            'offenders': offenders,
+            'timestamp': datetime.now().isoformat()
+        }), 200
+
+    except Exception as e:
+        return handle_exception(e, 'get_sql_profile_offenders')
+
 @app.route('/api/developer/backups/list', methods=['GET'])
 def list_backups():
     """List available database backups"""
@@ -21044,7 +21946,7 @@ def list_backups():
         conn = get_db_connection()
         cur = get_wrapped_cursor(conn)
         
-        user_role = cur.execute("SELECT role FROM users WHERE username=%s", (username,)).fetchone()
+        user_role = get_user_role_row(cur, username)
         if not user_role or user_role[0] != 'developer':
             conn.close()
             return jsonify({'error': 'Developer role required'}), 403
@@ -21093,7 +21995,7 @@ def generate_test_data():
         conn = get_db_connection()
         cur = get_wrapped_cursor(conn)
         
-        user_role = cur.execute("SELECT role FROM users WHERE username=%s", (username,)).fetchone()
+        user_role = get_user_role_row(cur, username)
         if not user_role or user_role[0] != 'developer':
             conn.close()
             return jsonify({'error': 'Developer role required'}), 403
@@ -21135,7 +22037,7 @@ def generate_test_data():
                 # Add some mood logs
                 for j in range(5):
                     cur.execute("""
-                        INSERT INTO mood_logs (username, mood_val, sleep_val, meds, notes, entry_timestamp)
+                        INSERT INTO mood_logs (username, mood_val, sleep_val, meds, notes, entrestamp)
                         VALUES (%s, %s, %s, %s, %s, %s)
                     """, (patient_username, 5 + (j % 5), 6 + (j % 4), 'Test meds', f'Test mood entry {j}', 
                           datetime.now() - timedelta(days=j)))
@@ -21190,13 +22092,20 @@ def test_database_connection():
         sys.stdout.flush()
         return False
 
-# Initialize pet table
-try:
-    ensure_pet_table()
-except Exception as e:
-    msg = f"⚠️  Pet table initialization failed: {e}"
-    print(msg, flush=True)
-    sys.stdout.flush()
+def check_schema_version():
+    """Warn if the release step has not applied every migration (workers never run DDL)"""
+    conn = None
+    try:
+        conn = get_db_connection()
+        pending = migrations.pending_migrations(conn.cursor())
+        conn.rollback()
+        if pending:
+            print(f"⚠️  {len(pending)} schema migration(s) pending - run: python migrations.py", flush=True)
+    except Exception as e:
+        print(f"⚠️  Schema version check failed: {e}", flush=True)
+    finally:
+        if conn:
+            conn.close()
 
 # Log startup info
 print("=" * 80, flush=True)
@@ -21244,7 +22153,7 @@ def view_developer_logs():
 
         conn = get_db_connection()
         cur = get_wrapped_cursor(conn)
-        user_role = cur.execute("SELECT role FROM users WHERE username=%s", (username,)).fetchone()
+        user_role = get_user_role_row(cur, username)
         conn.close()
 
         if not user_role or user_role[0] != 'developer':
@@ -21323,7 +22232,7 @@ def run_verbose_tests():
 
         conn = get_db_connection()
         cur = get_wrapped_cursor(conn)
-        user_role = cur.execute("SELECT role FROM users WHERE username=%s", (username,)).fetchone()
+        user_role = get_user_role_row(cur, username)
         conn.close()
 
         if not user_role or user_role[0] != 'developer':
@@ -21406,7 +22315,7 @@ def get_developer_diagnostics():
 
         conn = get_db_connection()
         cur = get_wrapped_cursor(conn)
-        user_role = cur.execute("SELECT role FROM users WHERE username=%s", (username,)).fetchone()
+        user_role = get_user_role_row(cur, username)
         if not user_role or user_role[0] != 'developer':
             conn.close()
             return jsonify({'error': 'Developer role required'}), 403
@@ -21643,13 +22552,12 @@ def get_today_wellness_log():
         conn = get_db_connection()
         cur = get_wrapped_cursor(conn)
         
-        row = cur.execute("""
-            SELECT id, mood, mood_descriptor, sleep_quality, energy_level, 
-                   capacity_index, exercise_duration, timestamp
-            FROM wellness_logs
-            WHERE username = %s AND DATE(timestamp) = %s
-            LIMIT 1
-        """, (username, today)).fetchone()
+        row = cur.execute(*range_query(
+            """SELECT id, mood, mood_descriptor, sleep_quality, energy_level,
+                      capacity_index, exercise_duration, timestamp
+               FROM wellness_logs WHERE username = %s""",
+            [username], 'timestamp', day_range(today), order=None, limit=1
+        )).fetchone()
         
         conn.close()
         
@@ -22009,7 +22917,7 @@ def clinician_get_patient_medications(patient_username):
         conn = get_db_connection()
         cur = get_wrapped_cursor(conn)
 
-        role = cur.execute("SELECT role FROM users WHERE username=%s", (clinician_username,)).fetchone()
+        role = get_user_role_row(cur, clinician_username)
         if not role or role[0] not in ('clinician', 'admin'):
             conn.close()
             return jsonify({'error': 'Clinician access required'}), 403
@@ -22450,7 +23358,7 @@ def get_waiting_list():
 
         conn = get_db_connection()
         cur = get_wrapped_cursor(conn)
-        role = cur.execute("SELECT role FROM users WHERE username=%s", (clinician_username,)).fetchone()
+        role = get_user_role_row(cur, clinician_username)
         if not role or role[0] not in ('clinician', 'admin'):
             conn.close()
             return jsonify({'error': 'Clinician access required'}), 403
@@ -22492,7 +23400,7 @@ def add_to_waiting_list():
 
         conn = get_db_connection()
         cur = get_wrapped_cursor(conn)
-        role = cur.execute("SELECT role FROM users WHERE username=%s", (clinician_username,)).fetchone()
+        role = get_user_role_row(cur, clinician_username)
         if not role or role[0] not in ('clinician', 'admin'):
             conn.close()
             return jsonify({'error': 'Clinician access required'}), 403
@@ -22636,7 +23544,7 @@ def _compute_and_store_milestones(username, conn, cur):
 
         # ── Mood streak milestones ──────────────────────────────────────────
         streak_rows = cur.execute(
-            """SELECT DATE(entry_timestamp) as d FROM mood_logs
+            """SELECT DATE(entrestamp) as d FROM mood_logs
                WHERE username=%s AND deleted_at IS NULL
                GROUP BY d ORDER BY d DESC""",
             (username,)
@@ -22766,7 +23674,7 @@ def get_progress_dashboard():
 
         # ── Streak calculation ─────────────────────────────────────────────
         all_dates = cur.execute(
-            """SELECT DISTINCT DATE(entry_timestamp) as d FROM mood_logs
+            """SELECT DISTINCT DATE(entrestamp) as d FROM mood_logs
                WHERE username=%s AND deleted_at IS NULL
                ORDER BY d DESC""",
             (username,)
@@ -23678,40 +24586,34 @@ def generate_clinician_summaries_endpoint():
             FROM patient_approvals WHERE status = 'approved'
         """).fetchall()
 
-        today = date.today()
-        month_start = date(today.year, today.month, 1)
-        if today.month == 12:
-            month_end = date(today.year + 1, 1, 1) - timedelta(days=1)
-        else:
-            month_end = date(today.year, today.month + 1, 1) - timedelta(days=1)
+        month = month_range(date.today())
+        month_start = month.start.date()
+        month_end = (month.end - timedelta(days=1)).date()
 
         summaries_generated = 0
 
         for patient, clinician in approvals:
             try:
                 # Wellness metrics
-                wellness_data = cur.execute("""
-                    SELECT AVG(mood) as avg_mood, COUNT(*) as total,
-                           AVG(sleep_quality) as avg_sleep,
-                           COUNT(DISTINCT DATE(timestamp)) as days_logged
-                    FROM wellness_logs WHERE username = %s
-                    AND timestamp >= %s AND timestamp < %s + INTERVAL '1 day'
-                """, (patient, month_start, month_end)).fetchone()
+                wellness_data = cur.execute(*range_query(
+                    """SELECT AVG(mood) as avg_mood, COUNT(*) as total,
+                              AVG(sleep_quality) as avg_sleep,
+                              COUNT(DISTINCT DATE(timestamp)) as days_logged
+                       FROM wellness_logs WHERE username = %s""",
+                    [patient], 'timestamp', month, order=None
+                )).fetchone()
 
                 # Therapy activity
-                therapy_count = cur.execute("""
-                    SELECT COUNT(*) FROM chat_history
-                    WHERE session_id = %s AND timestamp >= %s
-                    AND timestamp < %s + INTERVAL '1 day'
-                """, (f"{patient}_session", month_start, month_end)).fetchone()[0]
+                therapy_count = cur.execute(*range_query(
+                    "SELECT COUNT(*) FROM chat_history WHERE session_id = %s",
+                    [f"{patient}_session"], 'timestamp', month, order=None
+                )).fetchone()[0]
 
                 # Mood logs
-                mood_data = cur.execute("""
-                    SELECT AVG(mood_val), COUNT(*)
-                    FROM mood_logs WHERE username = %s
-                    AND entrestamp >= %s AND entrestamp < %s + INTERVAL '1 day'
-                    AND deleted_at IS NULL
-                """, (patient, month_start, month_end)).fetchone()
+                mood_data = cur.execute(*range_query(
+                    "SELECT AVG(mood_val), COUNT(*) FROM mood_logs WHERE username = %s AND deleted_at IS NULL",
+                    [patient], 'entrestamp', month, order=None
+                )).fetchone()
 
                 # Active flags
                 flags = cur.execute("""
@@ -23983,6 +24885,7 @@ def clinician_approve_patient():
             "UPDATE users SET clinician_id = %s WHERE username = %s",
             (clinician_username, patient_username)
         )
+        principal_cache.notify(cur, patient_username)
         
         # Create notifications
         cur.execute("""
@@ -24591,16 +25494,17 @@ def get_clinician_patient_mood_logs(patient_username):
         # Parse date parameters (default to 30 days)
         end_date = request.args.get('end_date', date.today().isoformat())
         start_date = request.args.get('start_date', (date.today() - timedelta(days=30)).isoformat())
-        
+        try:
+            window = parse_date_range(start_date, end_date)
+        except ValueError:
+            conn.close()
+            return jsonify({'error': 'Dates must be YYYY-MM-DD, with end_date on or after start_date'}), 400
+
         # Get mood logs
-        logs = cur.execute("""
-            SELECT entrestamp, mood_val, sleep_val, notes
-            FROM mood_logs
-            WHERE username = %s
-            AND entrestamp::date BETWEEN %s::date AND %s::date
-            AND deleted_at IS NULL
-            ORDER BY entrestamp DESC
-        """, (patient_username, start_date, end_date)).fetchall()
+        logs = cur.execute(*range_query(
+            "SELECT entrestamp, mood_val, sleep_val, notes FROM mood_logs WHERE username = %s AND deleted_at IS NULL",
+            [patient_username], 'entrestamp', window
+        )).fetchall()
         
         # Calculate week average
         week_avg = cur.execute("""
@@ -25302,7 +26206,7 @@ def get_wins_stats():
         if target_username != auth_user:
             conn = get_db_connection()
             cur = get_wrapped_cursor(conn)
-            role = cur.execute("SELECT role FROM users WHERE username = %s", (auth_user,)).fetchone()
+            role = get_user_role_row(cur, auth_user)
             if not role or role[0] != 'clinician':
                 conn.close()
                 return jsonify({'error': 'Unauthorized'}), 403
@@ -27429,17 +28333,11 @@ def update_treatment_plan_goal(plan_id, goal_index):
             conn.close()
 
 
-# Run startup checks before first request
-# Note: @app.before_first_request is deprecated in Flask 2.2+
-# Instead, we run this during app initialization below
-@app.before_request
-def before_first_request():
-    """Initialize database and run security checks on first request"""
-    # Only run once per app startup
-    if not hasattr(app, '_tier0_initialized'):
-        startup_security_checks()
-        init_db()
-        app._tier0_initialized = True
+# Startup checks run once per worker at boot rather than inside its first request.
+# Schema changes are applied by the release step (python migrations.py), not here.
+if os.getenv('TESTING') != '1':
+    startup_security_checks()
+    check_schema_version()
 
 
 # Print app summary
@@ -27452,5 +28350,5 @@ if __name__ == '__main__':
     print(f"🌐 Starting on http://0.0.0.0:{port}")
     # Run startup checks
     startup_security_checks()
-    init_db()
+    migrations.migrate()
     app.run(host='0.0.0.0', port=port, debug=DEBUG)
@@ -0,0 +1,98 @@
+"""
+Date-range filters that keep timestamp indexes usable.
+
+Endpoints take inclusive calendar dates (from_date=2026-10-01&to_date=2026-10-19).
+Wrapping the column instead (DATE(entrestamp) <= date(%s), or
+entrestamp::date BETWEEN ...) stops PostgreSQL from using an index on the
+column. Comparing the raw column with `<=` against a date has a different
+problem: the whole end day is excluded after midnight. Both are replaced
+with a half-open range on the raw column:
+
+    entrestamp >= '2026-10-01' AND entrestamp < '2026-10-20'
+
+    window = parse_date_range(from_date, to_date)       # ValueError -> 400
+    sql, params = range_query(
+        "SELECT entry, entry_timestamp FROM gratitude_logs WHERE username = %s", [username],
+        'entry_timestamp', window, limit=5)
+    rows = cur.execute(sql, params).fetchall()
+"""
+
+from datetime import date, datetime, timedelta
+from typing import List, NamedTuple, Optional, Sequence, Tuple, Union
+
+DateLike = Union[str, date, datetime, None]
+
+
+class DateRange(NamedTuple):
+    """Half-open [start, end); either side may be open (None)"""
+    start: Optional[datetime] = None
+    end: Optional[datetime] = None
+
+
+def _day(value: DateLike) -> Optional[datetime]:
+    if value is None or value == '':
+        return None
+    if isinstance(value, datetime):
+        value = value.date()
+    elif not isinstance(value, date):
+        value = date.fromisoformat(str(value).strip()[:10])
+    return datetime(value.year, value.month, value.day)
+
+
+def parse_date_range(from_date: DateLike = None, to_date: DateLike = None) -> DateRange:
+    """Inclusive calendar dates (YYYY-MM-DD strings or dates) -> half-open DateRange
+
+    Raises ValueError for unparseable dates or an end before the start.
+    """
+    start = _day(from_date)
+    end = _day(to_date)
+    if end is not None:
+        end += timedelta(days=1)
+    if start is not None and end is not None and end <= start:
+        raise ValueError("to_date must not be before from_date")
+    return DateRange(start, end)
+
+
+def day_range(day: DateLike) -> DateRange:
+    """The single calendar day containing `day`"""
+    return parse_date_range(day, day)
+
+
+def month_range(day: DateLike) -> DateRange:
+    """The calendar month containing `day`"""
+    start = _day(day).replace(day=1)
+    end = start.replace(year=start.year + 1, month=1) if start.month == 12 else start.replace(month=start.month + 1)
+    return DateRange(start, end)
+
+
+def range_filter(column: str, window: DateRange) -> Tuple[str, List[datetime]]:
+    """' AND column >= %s AND column < %s' (open sides omitted) and its params
+
+    `column` is interpolated, so it must be a trusted identifier.
+    """
+    sql, params = '', []
+    if window.start is not None:
+        sql += f" AND {column} >= %s"
+        params.append(window.start)
+    if window.end is not None:
+        sql += f" AND {column} < %s"
+        params.append(window.end)
+    return sql, params
+
+
+def range_query(select_sql: str, params: Sequence, column: str, window: DateRange,
+                order: Optional[str] = 'DESC', limit: Optional[int] = None) -> Tuple[str, tuple]:
+    """Append the range filter, ORDER BY column and an optional LIMIT to a SELECT ... WHERE
+
+    Summary sections that only show the newest N rows should pass limit=N
+    rather than slicing the fetched list, so the index scan stops early.
+    """
+    where, range_params = range_filter(column, window)
+    sql = select_sql + where
+    if order:
+        sql += f" ORDER BY {column} {order}"
+    all_params = [*params, *range_params]
+    if limit is not None:
+        sql += " LIMIT %s"
+        all_params.append(int(limit))
+    return sql, tuple(all_params)
@@ -0,0 +1,494 @@
+#!/usr/bin/env python3
+"""
+Email Outbox - queued outbound email with a pooled SMTP sender.
+
+Request handlers (password reset, 2FA codes, risk alerts, appointment
+reminders) call enqueue_email(), which writes one email_outbox row and
+NOTIFYs the sender. They no longer open an SMTP connection, STARTTLS and
+log in inside the request.
+
+The sender worker claims pending rows in priority order (crisis alerts
+first, reminders last) with FOR UPDATE SKIP LOCKED and sends them over one
+long-lived authenticated SMTP session per worker. Transient failures are
+retried with exponential backoff. Rows have their body cleared once they
+are sent or permanently failed, so reset links, 2FA codes and alert/PHI
+content do not linger in the table, and the worker purges sent/failed rows
+older than EMAIL_OUTBOX_RETENTION_DAYS (default 30).
+
+Run as a long-lived worker (Procfile: `mailer: python email_outbox.py`):
+    python email_outbox.py                 # LISTEN + poll every 5 seconds
+    python email_outbox.py --once          # drain the outbox and exit (cron)
+
+For local testing point it at an SMTP sink without TLS/auth:
+    SMTP_SERVER=localhost SMTP_PORT=1025 SMTP_STARTTLS=0 SMTP_AUTH=0 python email_outbox.py
+"""
+
+import argparse
+import logging
+import os
+import select
+import smtplib
+import sys
+import time
+from datetime import datetime
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from typing import Any, Dict, List, Optional
+
+import psycopg2
+
+logger = logging.getLogger('email_outbox')
+
+# Lower value = sent first
+PRIORITY_CRISIS = 0        # critical/high risk and safeguarding alerts
+PRIORITY_SECURITY = 1      # 2FA codes, password resets (user is waiting)
+PRIORITY_ALERT = 2         # other clinician alerts
+PRIORITY_REMINDER = 5      # appointment reminders
+
+NOTIFY_CHANNEL = 'email_outbox'
+
+# Failures of the SMTP session itself (as opposed to one message being rejected).
+# Socket errors (non-SMTPException OSErrors) are also session failures.
+SESSION_ERRORS = (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError,
+                  smtplib.SMTPAuthenticationError)
+
+
+# ==================== CONFIG ====================
+
+def smtp_config() -> Dict[str, Any]:
+    """SMTP settings from env. GMAIL_* vars are accepted as credential fallbacks."""
+    user = os.getenv('SMTP_USER') or os.getenv('GMAIL_ADDRESS')
+    return {
+        'host': os.getenv('SMTP_SERVER', 'smtp.gmail.com'),
+        'port': int(os.getenv('SMTP_PORT', '587')),
+        'user': user,
+        'password': os.getenv('SMTP_PASSWORD') or os.getenv('GMAIL_APP_PASSWORD'),
+        'from_email': os.getenv('FROM_EMAIL', user),
+        'starttls': os.getenv('SMTP_STARTTLS', '1').lower() not in ('0', 'false', 'no'),
+        'auth': os.getenv('SMTP_AUTH', '1').lower() not in ('0', 'false', 'no'),
+    }
+
+
+def smtp_configured() -> bool:
+    """True if the sender worker will be able to deliver (credentials or no-auth relay)."""
+    config = smtp_config()
+    if not config['auth']:
+        return bool(config['from_email'])
+    return bool(config['user'] and config['password'])
+
+
+# ==================== ENQUEUE ====================
+
+def enqueue_email(cur, to_email: str, subject: str, html_body: str,
+                  category: str = 'general', priority: int = PRIORITY_ALERT,
+                  from_name: str = 'Healing Space UK') -> int:
+    """
+    Add an email to the outbox. Caller commits; the NOTIFY is delivered to
+    the sender worker on commit. Returns the outbox row id.
+    """
+    if not to_email:
+        raise ValueError("Recipient email required")
+
+    cur.execute("""
+        INSERT INTO email_outbox (category, priority, to_email, subject, html_body, from_name)
+        VALUES (%s, %s, %s, %s, %s, %s)
+        RETURNING id
+    """, (category, priority, to_email, subject, html_body, from_name))
+    outbox_id = cur.fetchone()[0]
+    cur.execute(f"NOTIFY {NOTIFY_CHANNEL}")
+    return outbox_id
+
+
+# ==================== SMTP SESSION ====================
+
+class SMTPSession:
+    """
+    A reusable authenticated SMTP connection. Connects lazily, checks the
+    connection with NOOP after it has been idle, reconnects once on a dropped
+    connection and recycles after max_messages (providers cap per-session sends).
+    """
+
+    def __init__(self, config: Dict[str, Any] = None, max_messages: int = 100,
+                 idle_check_seconds: float = 30.0, smtp_factory=smtplib.SMTP):
+        self.config = config or smtp_config()
+        self.max_messages = max_messages
+        self.idle_check_seconds = idle_check_seconds
+        self.smtp_factory = smtp_factory
+        self.server = None
+        self.sent_on_session = 0
+        self.connections_opened = 0
+        self.last_used = 0.0
+
+    def _connect(self):
+        server = self.smtp_factory(self.config['host'], self.config['port'], timeout=30)
+        try:
+            if self.config['starttls']:
+                server.starttls()
+            if self.config['auth'] and self.config['user']:
+                server.login(self.config['user'], self.config['password'])
+        except Exception:
+            server.close()
+            raise
+        self.server = server
+        self.sent_on_session = 0
+        self.connections_opened += 1
+
+    def _ensure_connected(self):
+        if self.server is not None and time.monotonic() - self.last_used > self.idle_check_seconds:
+            try:
+                if self.server.noop()[0] != 250:
+                    self.close()
+            except (smtplib.SMTPException, OSError):
+                self.server = None
+        if self.server is None:
+            self._connect()
+
+    def send(self, msg) -> None:
+        self._ensure_connected()
+        try:
+            self.server.send_message(msg)
+        except smtplib.SMTPServerDisconnected:
+            self.close()
+            self._connect()
+            self.server.send_message(msg)
+        self.sent_on_session += 1
+        self.last_used = time.monotonic()
+        if self.sent_on_session >= self.max_messages:
+            self.close()
+
+    def close(self):
+        if self.server is None:
+            return
+        try:
+            self.server.quit()
+        except (smtplib.SMTPException, OSError):
+            self.server.close()
+        self.server = None
+
+
+# ==================== SENDER WORKER ====================
+
+class EmailOutboxWorker:
+    """Claims pending outbox rows in priority order and sends them in batches."""
+
+    DEFAULT_BATCH_SIZE = 25
+    DEFAULT_POLL_INTERVAL = 5.0
+    MAX_ATTEMPTS = 6
+    BACKOFF_BASE_SECONDS = 30
+    BACKOFF_MAX_SECONDS = 3600
+    LATENCY_SAMPLE_SIZE = 1000
+    PURGE_INTERVAL_SECONDS = 3600
+
+    def __init__(self, conn, session: SMTPSession = None, batch_size: int = None, connect=None):
+        self.conn = conn
+        self.session = session or SMTPSession()
+        self.batch_size = batch_size or self.DEFAULT_BATCH_SIZE
+        self.connect = connect  # optional factory used to reconnect after a dropped connection
+        self.sent_total = 0
+        self.failed_total = 0
+        self.last_run_at = None
+        self._last_purge = 0.0
+        self._recent_latencies: List[float] = []
+
+    def _backoff_seconds(self, attempts: int) -> float:
+        return float(min(self.BACKOFF_MAX_SECONDS, self.BACKOFF_BASE_SECONDS * (2 ** attempts)))
+
+    def _build_message(self, to_email, subject, html_body, from_name):
+        msg = MIMEMultipart('alternative')
+        msg['Subject'] = subject
+        msg['From'] = f"{from_name} <{self.session.config['from_email']}>"
+        msg['To'] = to_email
+        msg.attach(MIMEText(html_body or '', 'html'))
+        return msg
+
+    def send_batch(self) -> Dict[str, int]:
+        """Send up to batch_size due emails in one transaction. Returns sent/retry/failed counts."""
+        cur = self.conn.cursor()
+        sent_ids, latencies = [], []
+        retry_ids, retry_errors, retry_statuses, retry_delays = [], [], [], []
+        try:
+            cur.execute("""
+                SELECT id, to_email, subject, html_body, from_name, attempts
+                FROM email_outbox
+                WHERE status = 'pending' AND next_attempt_at <= CURRENT_TIMESTAMP
+                ORDER BY priority, next_attempt_at, id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            """, (self.batch_size,))
+            rows = cur.fetchall()
+
+            if not rows:
+                self.conn.commit()
+                return {'sent': 0, 'retry': 0, 'failed': 0}
+
+            for outbox_id, to_email, subject, html_body, from_name, attempts in rows:
+                try:
+                    self.session.send(self._build_message(to_email, subject, html_body, from_name))
+                    sent_ids.append(outbox_id)
+                except smtplib.SMTPRecipientsRefused as e:
+                    # Permanent: retrying a refused address will not help
+                    retry_ids.append(outbox_id)
+                    retry_errors.append(str(e)[:500])
+                    retry_statuses.append('failed')
+                    retry_delays.append(0.0)
+                except (smtplib.SMTPException, OSError) as e:
+                    exhausted = attempts + 1 >= self.MAX_ATTEMPTS
+                    retry_ids.append(outbox_id)
+                    retry_errors.append(str(e)[:500])
+                    retry_statuses.append('failed' if exhausted else 'pending')
+                    retry_delays.append(self._backoff_seconds(attempts))
+                    if isinstance(e, SESSION_ERRORS) or not isinstance(e, smtplib.SMTPException):
+                        # Connection-level failure: leave the rest of the batch
+                        # pending for the next pass instead of reconnecting per row
+                        self.session.close()
+                        break
+
+            if sent_ids:
+                cur.execute("""
+                    UPDATE email_outbox
+                    SET status = 'sent', sent_at = CURRENT_TIMESTAMP, attempts = attempts + 1,
+                        html_body = NULL, last_error = NULL
+                    WHERE id = ANY(%s)
+                    RETURNING EXTRACT(EPOCH FROM (sent_at - created_at))
+                """, (sent_ids,))
+                latencies = [float(r[0]) for r in cur.fetchall() if r[0] is not None]
+
+            if retry_ids:
+                cur.execute("""
+                    UPDATE email_outbox o
+                    SET attempts = o.attempts + 1, last_error = u.error, status = u.status,
+                        next_attempt_at = CURRENT_TIMESTAMP + make_interval(secs => u.delay),
+                        html_body = CASE WHEN u.status = 'failed' THEN NULL ELSE o.html_body END
+                    FROM unnest(%s::int[], %s::text[], %s::text[], %s::float8[])
+                         AS u(id, error, status, delay)
+                    WHERE o.id = u.id
+                """, (retry_ids, retry_errors, retry_statuses, retry_delays))
+
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            cur.close()
+
+        failed = retry_statuses.count('failed')
+        self._record(len(sent_ids), failed, latencies)
+        return {'sent': len(sent_ids), 'retry': len(retry_ids) - failed, 'failed': failed}
+
+    def run_pending(self, max_batches: int = 50) -> int:
+        """Drain due emails batch by batch. Returns number sent."""
+        sent = 0
+        for _ in range(max_batches):
+            result = self.send_batch()
+            sent += result['sent']
+            if sum(result.values()) < self.batch_size:
+                break
+        self.last_run_at = datetime.now()
+        return sent
+
+    def purge_if_due(self) -> Optional[int]:
+        """Run purge_outbox at most once per PURGE_INTERVAL_SECONDS. Returns rows deleted, if run."""
+        if self._last_purge and time.monotonic() - self._last_purge < self.PURGE_INTERVAL_SECONDS:
+            return None
+        cur = self.conn.cursor()
+        try:
+            deleted = purge_outbox(cur)
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            cur.close()
+        self._last_purge = time.monotonic()
+        if deleted:
+            logger.info(f"Purged {deleted} sent/failed outbox row(s)")
+        return deleted
+
+    def run_forever(self, poll_interval: float = None):
+        """Send as NOTIFYs arrive (or every poll_interval seconds) until interrupted."""
+        interval = poll_interval or self.DEFAULT_POLL_INTERVAL
+        logger.info(f"Email outbox worker started (batch={self.batch_size}, interval={interval}s)")
+        listening = False
+        while True:
+            try:
+                if self.conn.closed and self.connect:
+                    self.conn = self.connect()
+                    listening = False
+                if not listening:
+                    cur = self.conn.cursor()
+                    cur.execute(f"LISTEN {NOTIFY_CHANNEL}")
+                    cur.close()
+                    self.conn.commit()
+                    listening = True
+                self.run_pending()
+                self.purge_if_due()
+                # Idle: close the SMTP session rather than hold it open between bursts
+                self.session.close()
+                if select.select([self.conn], [], [], interval) != ([], [], []):
+                    self.conn.poll()
+                    self.conn.notifies.clear()
+            except psycopg2.Error as e:
+                logger.error(f"Outbox pass failed: {e}")
+                listening = False
+                time.sleep(interval)
+
+    # ==================== METRICS ====================
+
+    def _record(self, sent: int, failed: int, latencies: List[float]) -> None:
+        self.sent_total += sent
+        self.failed_total += failed
+        self._recent_latencies = (self._recent_latencies + latencies)[-self.LATENCY_SAMPLE_SIZE:]
+        if latencies:
+            logger.info(
+                f"Sent {sent} email(s), {failed} failed; "
+                f"latency max={max(latencies):.2f}s avg={sum(latencies) / len(latencies):.2f}s"
+            )
+
+    def stats(self) -> Dict[str, Any]:
+        """In-process delivery-latency summary for this worker."""
+        latencies = sorted(self._recent_latencies)
+
+        def pct(p):
+            if not latencies:
+                return None
+            return round(latencies[min(len(latencies) - 1, int(p * len(latencies)))], 3)
+
+        return {
+            'sent_total': self.sent_total,
+            'failed_total': self.failed_total,
+            'smtp_connections_opened': self.session.connections_opened,
+            'last_run_at': self.last_run_at.isoformat() if self.last_run_at else None,
+            'latency_p50_seconds': pct(0.50),
+            'latency_p95_seconds': pct(0.95),
+            'latency_max_seconds': round(latencies[-1], 3) if latencies else None
+        }
+
+
+def retention_days() -> int:
+    try:
+        return max(1, int(os.getenv('EMAIL_OUTBOX_RETENTION_DAYS', '30')))
+    except ValueError:
+        return 30
+
+
+def purge_outbox(cur, days: int = None) -> int:
+    """
+    Delete sent/failed rows older than `days` (EMAIL_OUTBOX_RETENTION_DAYS)
+    and clear any body still held by a failed row. Caller commits. Returns
+    the number of rows deleted.
+    """
+    days = days or retention_days()
+    cur.execute("""
+        UPDATE email_outbox SET html_body = NULL
+        WHERE status = 'failed' AND html_body IS NOT NULL
+    """)
+    cur.execute("""
+        DELETE FROM email_outbox
+        WHERE status IN ('sent', 'failed')
+        AND created_at < CURRENT_TIMESTAMP - make_interval(days => %s)
+    """, (days,))
+    return max(cur.rowcount or 0, 0)
+
+
+def get_outbox_stats(cur, hours: int = 24) -> Dict[str, Any]:
+    """
+    Cluster-wide outbox metrics: pending backlog per priority and delivery
+    latency (created -> sent) per category over the last `hours`.
+    """
+    cur.execute("""
+        SELECT priority, COUNT(*), EXTRACT(EPOCH FROM (CURRENT_TIMESTAMP - MIN(created_at)))
+        FROM email_outbox
+        WHERE status = 'pending'
+        GROUP BY priority
+        ORDER BY priority
+    """)
+    pending = [{
+        'priority': r[0],
+        'count': r[1],
+        'oldest_seconds': round(float(r[2]), 3) if r[2] is not None else None
+    } for r in cur.fetchall()]
+
+    cur.execute("""
+        SELECT category, COUNT(*) FILTER (WHERE status = 'sent'),
+               COUNT(*) FILTER (WHERE status = 'failed'),
+               percentile_cont(0.5) WITHIN GROUP (ORDER BY EXTRACT(EPOCH FROM (sent_at - created_at))),
+               percentile_cont(0.95) WITHIN GROUP (ORDER BY EXTRACT(EPOCH FROM (sent_at - created_at))),
+               MAX(EXTRACT(EPOCH FROM (sent_at - created_at)))
+        FROM email_outbox
+        WHERE status IN ('sent', 'failed')
+        AND created_at >= CURRENT_TIMESTAMP - make_interval(hours => %s)
+        GROUP BY category
+        ORDER BY category
+    """, (hours,))
+
+    def secs(v):
+        return round(float(v), 3) if v is not None else None
+
+    categories = [{
+        'category': r[0],
+        'sent_count': r[1] or 0,
+        'failed_count': r[2] or 0,
+        'latency_p50_seconds': secs(r[3]),
+        'latency_p95_seconds': secs(r[4]),
+        'latency_max_seconds': secs(r[5])
+    } for r in cur.fetchall()]
+
+    return {
+        'window_hours': hours,
+        'pending_count': sum(p['count'] for p in pending),
+        'pending_by_priority': pending,
+        'categories': categories
+    }
+
+
+def get_db_connection():
+    """Open a dedicated PostgreSQL connection for the worker (fail closed)."""
+    database_url = os.getenv('DATABASE_URL')
+    if database_url:
+        return psycopg2.connect(database_url)
+
+    host = os.getenv('DB_HOST')
+    name = os.getenv('DB_NAME')
+    user = os.getenv('DB_USER')
+    password = os.getenv('DB_PASSWORD')
+    if not all([host, name, user, password]):
+        raise RuntimeError(
+            "CRITICAL: Database credentials incomplete. "
+            "Required: DATABASE_URL or (DB_HOST, DB_NAME, DB_USER, DB_PASSWORD)"
+        )
+    return psycopg2.connect(host=host, port=int(os.getenv('DB_PORT', '5432')),
+                            database=name, user=user, password=password)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Send queued outbound email')
+    parser.add_argument('--once', action='store_true', help='drain the outbox and exit')
+    parser.add_argument('--interval', type=float, default=EmailOutboxWorker.DEFAULT_POLL_INTERVAL,
+                        help='max seconds between polls when no NOTIFY arrives')
+    parser.add_argument('--batch-size', type=int, default=EmailOutboxWorker.DEFAULT_BATCH_SIZE)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    if not smtp_configured():
+        logger.error("SMTP not configured: set SMTP_USER/SMTP_PASSWORD (or SMTP_AUTH=0 and FROM_EMAIL)")
+        return 1
+
+    worker = EmailOutboxWorker(get_db_connection(), batch_size=args.batch_size, connect=get_db_connection)
+    try:
+        if args.once:
+            sent = worker.run_pending()
+            worker.purge_if_due()
+            print(f"Sent {sent} email(s)")
+        else:
+            worker.run_forever(args.interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        worker.session.close()
+        worker.conn.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
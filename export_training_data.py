@@ -3,8 +3,9 @@
 DEPRECATED: Automated Training Data Export Script
 
 This script is for reference only and is not currently used.
-Training data export is handled by the TrainingDataManager class
-and integrated into the Flask API.
+Bulk exports for research partners are produced by research_export.py
+(partitioned Parquet, incremental); per-user training data export is
+handled by the TrainingDataManager class via the Flask API.
 
 Original usage:
     python3 export_training_data.py
@@ -13,7 +14,7 @@ Note: Uses legacy SQLite code - not updated for PostgreSQL migration.
 """
 
 import sys
-print("ERROR: This script is deprecated. Use TrainingDataManager directly via the Flask API.")
+print("ERROR: This script is deprecated. Use research_export.py for bulk exports.")
 sys.exit(1)
 
 # === Legacy SQLite code below - DO NOT USE ===
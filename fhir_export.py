@@ -1,86 +1,166 @@
+#!/usr/bin/env python3
 """
-DEPRECATED: FHIR Export Module
+FHIR Export - single-patient bundles and bulk ($export-style) NDJSON jobs.
 
-This module is for reference only and not actively used.
-FHIR export functionality is integrated into the main Flask API.
+Single patient: export_patient_fhir() builds a signed FHIR Bundle for
+GET /api/export/fhir.
 
-Note: Uses legacy SQLite code - not updated for PostgreSQL migration.
-"""
+Bulk: POST /api/export/fhir/bulk queues a fhir_export_jobs row for a
+clinician's caseload or an explicit cohort. The export worker reads each
+resource type through WITH HOLD server-side cursors, decrypts profile
+fields a chunk at a time, and writes NDJSON parts (one resource per line,
+grouped by resource type) to fhir_export_parts. Each part is committed
+together with the job's checkpoint, so a crashed or restarted worker
+resumes from the last committed part without duplicating output. When all
+stages are done the job gets a Bulk Data style manifest signed with
+HMAC-SHA256.
 
-import sys
-raise ImportError("This module is deprecated. FHIR functionality moved to Flask API.")
+Run as a long-lived worker (Procfile: `fhir: python fhir_export.py`):
+    python fhir_export.py              # LISTEN + poll every 10 seconds
+    python fhir_export.py --once       # run queued exports and exit (cron)
+"""
 
-# === Legacy SQLite code below - DO NOT USE ===
-import sqlite3
+import argparse
+import hashlib
+import hmac
 import json
+import logging
 import os
-import hmac
-import hashlib
+import select
+import sys
+import time
 from datetime import datetime, timezone
-from cryptography.fernet import Fernet
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import psycopg2
+
 from secrets_manager import SecretsManager
-from typing import Tuple, List
+from streaming_export import iter_row_chunks
 
+logger = logging.getLogger('fhir_export')
 
-# Determine debug mode locally
 DEBUG = os.environ.get('DEBUG', '').lower() in ('1', 'true', 'yes')
-secrets = SecretsManager(debug=DEBUG)
-
-# Local decrypt helper using same ENCRYPTION_KEY sourcing as main
-# SECURITY: Encryption key MUST be provided via environment variable or secrets manager.
-# File-based key storage is NOT supported for security reasons.
-_enc = secrets.get_secret("ENCRYPTION_KEY") or os.environ.get("ENCRYPTION_KEY")
-if _enc:
-    ENCRYPTION_KEY = _enc.encode() if isinstance(_enc, str) else _enc
-    try:
-        _cipher = Fernet(ENCRYPTION_KEY)
-    except Exception as e:
-        raise ValueError(f"Invalid ENCRYPTION_KEY format in fhir_export. Must be a valid Fernet key. Error: {e}")
-else:
-    # Do not raise at import time; allow the app to run without FHIR signing available.
-    ENCRYPTION_KEY = None
-    _cipher = None
-    if DEBUG:
-        # For local debug runs, generate a temporary key so signing can proceed if needed.
-        import warnings
-        warnings.warn(
-            'ENCRYPTION_KEY not set in fhir_export; generating temporary key for DEBUG mode. '
-            'FHIR signatures will NOT be verifiable after restart! '
-            'Set ENCRYPTION_KEY env var for persistent signing.'
-        )
-        ENCRYPTION_KEY = Fernet.generate_key()
+_secrets_manager = SecretsManager(debug=DEBUG)
+
+_enc = _secrets_manager.get_secret("ENCRYPTION_KEY") or os.environ.get("ENCRYPTION_KEY")
+ENCRYPTION_KEY = (_enc.encode() if isinstance(_enc, str) else _enc) if _enc else None
+
+NOTIFY_CHANNEL = 'fhir_export_jobs'
+FHIR_NDJSON_CONTENT_TYPE = 'application/fhir+ndjson'
+CONDITIONS_EXTENSION_URL = 'http://example.org/fhir/StructureDefinition/conditions'
+
+
+# ==================== CRYPTO ====================
+
+_cipher = None
+
+
+def _get_cipher():
+    """Fernet built once per process (decrypt_text in api.py rebuilds it per value)."""
+    global _cipher
+    if _cipher is None and ENCRYPTION_KEY:
+        from cryptography.fernet import Fernet
         _cipher = Fernet(ENCRYPTION_KEY)
-    else:
-        # In production, log the issue but don't crash at import
-        print("WARNING: ENCRYPTION_KEY not set. FHIR export signing will fail in production.")
-
-def _decrypt(v):
-    if not v: return ""
-    if _cipher is None:
-        # If no cipher available, assume data is plaintext or already decrypted
-        return v
-    try:
-        return _cipher.decrypt(v.encode()).decode()
-    except Exception:
-        return v
+    return _cipher
 
 
-def _sign_bundle(bundle_json: str) -> str:
-    # HMAC-SHA256 over bundle JSON using ENCRYPTION_KEY
-    key = ENCRYPTION_KEY
-    if not key:
-        # Try to fetch at runtime from secrets manager or environment (tests may set env later)
-        _enc = secrets.get_secret("ENCRYPTION_KEY") or os.environ.get("ENCRYPTION_KEY")
-        if _enc:
-            key = _enc.encode() if isinstance(_enc, str) else _enc
+def decrypt_values(values: List[Optional[str]]) -> List[str]:
+    """Decrypt a batch of profile fields; values that are not ciphertext pass through."""
+    cipher = _get_cipher()
+    out = []
+    for value in values:
+        if not value:
+            out.append("")
+        elif cipher is None:
+            out.append(value)
+        else:
+            try:
+                out.append(cipher.decrypt(value.encode()).decode())
+            except Exception:
+                out.append(value)  # legacy plaintext
+    return out
+
+
+def _signing_key() -> bytes:
+    key = os.environ.get('FHIR_SIGNING_KEY') or ENCRYPTION_KEY
     if not key:
-        raise RuntimeError('ENCRYPTION_KEY is required to sign FHIR bundles in production')
-    sig = hmac.new(key, bundle_json.encode(), hashlib.sha256).hexdigest()
-    signed = {
-        "signedBundle": json.loads(bundle_json),
-        "signature": {"algorithm": "hmac-sha256", "value": sig, "generatedAt": datetime.now(timezone.utc).isoformat()}
+        raise RuntimeError('ENCRYPTION_KEY (or FHIR_SIGNING_KEY) is required to sign FHIR exports')
+    return key.encode() if isinstance(key, str) else key
+
+
+def sign_payload(payload: Dict[str, Any]) -> Dict[str, str]:
+    """HMAC-SHA256 over the canonical (sorted, compact) JSON encoding of payload."""
+    canonical = json.dumps(payload, sort_keys=True, separators=(',', ':'), default=str).encode()
+    return {
+        'algorithm': 'hmac-sha256',
+        'value': hmac.new(_signing_key(), canonical, hashlib.sha256).hexdigest(),
+        'generatedAt': datetime.now(timezone.utc).isoformat(),
+    }
+
+
+def verify_signature(payload: Dict[str, Any], signature: Dict[str, str]) -> bool:
+    canonical = json.dumps(payload, sort_keys=True, separators=(',', ':'), default=str).encode()
+    expected = hmac.new(_signing_key(), canonical, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature.get('value', ''))
+
+
+# ==================== RESOURCES ====================
+
+def _iso(value) -> Optional[str]:
+    if value is None:
+        return None
+    return value.isoformat() if hasattr(value, 'isoformat') else str(value)
+
+
+def patient_resource(username: str, full_name: str, dob: str, conditions: str) -> Dict[str, Any]:
+    return {
+        "resourceType": "Patient",
+        "id": username,
+        "name": [{"text": full_name or username}],
+        "birthDate": dob or None,
+        "extension": [{"url": CONDITIONS_EXTENSION_URL, "valueString": conditions}] if conditions else []
+    }
+
+
+def scale_observation(row_id, username, scale_name, score, severity, timestamp) -> Dict[str, Any]:
+    return {
+        "resourceType": "Observation",
+        "id": f"scale-{row_id}",
+        "status": "final",
+        "subject": {"reference": f"Patient/{username}"},
+        "code": {"text": scale_name},
+        "valueQuantity": {"value": score},
+        "interpretation": [{"text": severity}] if severity else [],
+        "effectiveDateTime": _iso(timestamp)
+    }
+
+
+def mood_observation(row_id, username, mood_val, sleep_val, meds, notes, timestamp) -> Dict[str, Any]:
+    return {
+        "resourceType": "Observation",
+        "id": f"mood-{row_id}",
+        "status": "final",
+        "subject": {"reference": f"Patient/{username}"},
+        "code": {"text": "Mood Log"},
+        "component": [
+            {"code": {"text": "mood_val"}, "valueQuantity": {"value": mood_val}},
+            {"code": {"text": "sleep_val"}, "valueQuantity": {"value": sleep_val}},
+            {"code": {"text": "meds"}, "valueString": meds or ""},
+        ],
+        "note": [{"text": notes}] if notes else [],
+        "effectiveDateTime": _iso(timestamp)
+    }
+
+
+def provenance_resource(username: str, signer: Optional[str], recorded: str) -> Dict[str, Any]:
+    return {
+        "resourceType": "Provenance",
+        "id": f"export-{username}",
+        "recorded": recorded,
+        "target": [{"reference": f"Patient/{username}"}],
+        "agent": [{"type": {"text": "author"}, "who": {"reference": f"Practitioner/{signer or 'system'}"}}],
+        "entity": [{"role": "source", "what": {"reference": f"Patient/{username}"}}]
     }
-    return json.dumps(signed, indent=2, default=str)
 
 
 def validate_fhir_bundle(bundle_obj: dict) -> Tuple[bool, List[str]]:
@@ -91,7 +171,6 @@ def validate_fhir_bundle(bundle_obj: dict) -> Tuple[bool, List[str]]:
         errors.append("resourceType must be 'Bundle'")
     if 'entry' not in bundle_obj or not isinstance(bundle_obj['entry'], list) or len(bundle_obj['entry']) == 0:
         errors.append('Bundle must have at least one entry')
-    # Check for Patient resource
     patient_found = False
     for e in bundle_obj.get('entry', []):
         r = e.get('resource', {})
@@ -99,121 +178,396 @@ def validate_fhir_bundle(bundle_obj: dict) -> Tuple[bool, List[str]]:
             patient_found = True
             if not r.get('id'):
                 errors.append('Patient.id is required')
-            # name text or family/given advisable
             if not r.get('name') or not isinstance(r.get('name'), list) or len(r.get('name')) == 0:
                 errors.append('Patient.name is required')
+        elif r.get('resourceType') == 'Observation' and not r.get('effectiveDateTime'):
+            errors.append('Observation missing effectiveDateTime')
     if not patient_found:
         errors.append('No Patient resource found')
-
-    # Basic check for Observations having effectiveDateTime
-    for e in bundle_obj.get('entry', []):
-        r = e.get('resource', {})
-        if r.get('resourceType') == 'Observation':
-            if not r.get('effectiveDateTime'):
-                errors.append('Observation missing effectiveDateTime')
-
     return (len(errors) == 0), errors
 
 
-def export_patient_fhir(username: str, signer: str = None, add_provenance: bool = True, sign_bundle: bool = True) -> str:
-    conn = sqlite3.connect("therapist_app.db")
-    cur = conn.cursor()
+# ==================== SINGLE PATIENT ====================
 
-    # Patient profile
-    p = cur.execute("SELECT full_name, dob, conditions FROM users WHERE username=%s", (username,)).fetchone()
-    if p:
-        full_name = _decrypt(p[0])
-        dob = _decrypt(p[1])
-        conditions = _decrypt(p[2])
+def export_patient_fhir(username: str, signer: str = None, add_provenance: bool = True,
+                        sign_bundle: bool = True, connect: Optional[Callable] = None) -> str:
+    """
+    FHIR Bundle (JSON string) for one patient, optionally HMAC-signed.
+    connect supplies a connection owned by the caller (e.g. the API's request-scoped
+    pooled connection); without it a dedicated connection is opened and closed.
+    """
+    own_conn = None
+    if connect is not None:
+        cur = connect().cursor()
     else:
-        full_name = username
-        dob = None
-        conditions = None
-
-    # Clinical scales
-    scales = cur.execute("SELECT scale_name, score, severity, entry_timestamp FROM clinical_scales WHERE username=%s ORDER BY entry_timestamp DESC", (username,)).fetchall()
-
-    # Mood logs - schema may vary between 'entry_timestamp' and 'entrestamp'
+        own_conn = get_db_connection()
+        cur = own_conn.cursor()
     try:
-        moods = cur.execute("SELECT mood_val, sleep_val, meds, notes, entry_timestamp FROM mood_logs WHERE username=%s ORDER BY entry_timestamp DESC LIMIT 50", (username,)).fetchall()
-        timestamp_col = 'entry_timestamp'
-    except sqlite3.OperationalError:
-        moods = cur.execute("SELECT mood_val, sleep_val, meds, notes, entrestamp FROM mood_logs WHERE username=%s ORDER BY entrestamp DESC LIMIT 50", (username,)).fetchall()
-        timestamp_col = 'entrestamp'
-
-    conn.close()
-
-    bundle = {
-        "resourceType": "Bundle",
-        "type": "collection",
-        "timestamp": datetime.now(timezone.utc).isoformat(),
-        "entry": []
-    }
+        cur.execute("SELECT full_name, dob, conditions FROM users WHERE username = %s", (username,))
+        profile = cur.fetchone()
+        full_name, dob, conditions = decrypt_values(list(profile)) if profile else (username, None, None)
 
-    patient = {
-        "resource": {
-            "resourceType": "Patient",
-            "id": username,
-            "name": [{"text": full_name}],
-            "birthDate": dob if dob else None,
-            "extension": [{"url": "http://example.org/fhir/StructureDefinition/conditions", "valueString": conditions}] if conditions else []
-        }
-    }
-    bundle['entry'].append(patient)
-
-    # Add clinical scales as Observations
-    for s in scales:
-        obs = {
-            "resource": {
-                "resourceType": "Observation",
-                "status": "final",
-                "code": {"text": s[0]},
-                "valueQuantity": {"value": s[1]},
-                "interpretation": [{"text": s[2]}],
-                "effectiveDateTime": s[3]
-            }
-        }
-        bundle['entry'].append(obs)
-
-    # Add mood logs
-    for m in moods:
-        obs = {
-            "resource": {
-                "resourceType": "Observation",
-                "status": "final",
-                "code": {"text": "Mood Log"},
-                "component": [
-                    {"code": {"text": "mood_val"}, "valueQuantity": {"value": m[0]}},
-                    {"code": {"text": "sleep_val"}, "valueQuantity": {"value": m[1]}},
-                    {"code": {"text": "meds"}, "valueString": m[2] or ""},
-                ],
-                "note": [{"text": m[3] or ""}],
-                "effectiveDateTime": m[4]
-            }
-        }
-        bundle['entry'].append(obs)
+        cur.execute(
+            "SELECT id, username, scale_name, score, severity, entry_timestamp FROM clinical_scales "
+            "WHERE username = %s ORDER BY entry_timestamp DESC", (username,))
+        scales = cur.fetchall()
+        cur.execute(
+            "SELECT id, username, mood_val, sleep_val, meds, notes, entrestamp FROM mood_logs "
+            "WHERE username = %s ORDER BY entrestamp DESC LIMIT 50", (username,))
+        moods = cur.fetchall()
+    finally:
+        if own_conn is not None:
+            own_conn.close()
 
-    # Add Provenance entry describing the export
+    recorded = datetime.now(timezone.utc).isoformat()
+    entries = [patient_resource(username, full_name, dob, conditions)]
+    entries += [scale_observation(*s) for s in scales]
+    entries += [mood_observation(*m) for m in moods]
     if add_provenance:
-        prov = {
-            "resource": {
-                "resourceType": "Provenance",
-                "recorded": datetime.now(timezone.utc).isoformat(),
-                "agent": [{"type": {"text": "author"}, "who": {"reference": f"Practitioner/{signer or 'system'}"}}],
-                "entity": [{"role": "source", "what": {"reference": f"Patient/{username}"}}]
-            }
-        }
-        bundle['entry'].append(prov)
+        entries.append(provenance_resource(username, signer, recorded))
 
-    bundle_json = json.dumps(bundle, indent=2, default=str)
-
-    # Validate bundle
+    bundle = {"resourceType": "Bundle", "type": "collection", "timestamp": recorded,
+              "entry": [{"resource": r} for r in entries]}
     valid, errors = validate_fhir_bundle(bundle)
     if not valid:
-        # still return a bundle but include validation problems under a top-level 'validation' key
-        wrapped = {"bundle": json.loads(bundle_json), "validation": {"ok": False, "errors": errors}}
-        bundle_json = json.dumps(wrapped, indent=2, default=str)
+        bundle = {"bundle": bundle, "validation": {"ok": False, "errors": errors}}
 
     if sign_bundle:
-        return _sign_bundle(bundle_json)
-    return bundle_json
+        return json.dumps({"signedBundle": bundle, "signature": sign_payload(bundle)}, default=str)
+    return json.dumps(bundle, default=str)
+
+
+# ==================== BULK EXPORT ====================
+
+def _patient_batch(rows, job) -> List[Tuple[Any, Dict[str, Any]]]:
+    # One decrypt pass per chunk, column by column
+    names = decrypt_values([r[1] for r in rows])
+    dobs = decrypt_values([r[2] for r in rows])
+    conditions = decrypt_values([r[3] for r in rows])
+    return [(r[0], patient_resource(r[0], n, d, c)) for r, n, d, c in zip(rows, names, dobs, conditions)]
+
+
+def _scale_batch(rows, job):
+    return [(r[0], scale_observation(*r)) for r in rows]
+
+
+def _mood_batch(rows, job):
+    return [(r[0], mood_observation(*r)) for r in rows]
+
+
+def _provenance_batch(rows, job):
+    return [(r[0], provenance_resource(r[0], job['requested_by'], job['transaction_time'])) for r in rows]
+
+
+# (resource type, keyset query over the job's patient list, batch builder).
+# Every query takes (usernames, last_key) and orders by the key it resumes from.
+BULK_STAGES: List[Tuple[str, str, Callable]] = [
+    ('Patient',
+     "SELECT username, full_name, dob, conditions FROM users "
+     "WHERE username = ANY(%s) AND username > COALESCE(%s::text, '') ORDER BY username",
+     _patient_batch),
+    ('Observation',
+     "SELECT id, username, scale_name, score, severity, entry_timestamp FROM clinical_scales "
+     "WHERE username = ANY(%s) AND id > COALESCE(%s::int, 0) ORDER BY id",
+     _scale_batch),
+    ('Observation',
+     "SELECT id, username, mood_val, sleep_val, meds, notes, entrestamp FROM mood_logs "
+     "WHERE username = ANY(%s) AND id > COALESCE(%s::int, 0) ORDER BY id",
+     _mood_batch),
+    ('Provenance',
+     "SELECT username FROM users "
+     "WHERE username = ANY(%s) AND username > COALESCE(%s::text, '') ORDER BY username",
+     _provenance_batch),
+]
+
+
+def new_progress() -> Dict[str, Any]:
+    return {'stage': 0, 'last_key': None, 'part_no': 0, 'counts': {}}
+
+
+def enqueue_bulk_export(cur, requested_by: str, scope: str, usernames: List[str]) -> int:
+    """Queue a bulk export for a fixed patient list. Returns the job id."""
+    cur.execute("""
+        INSERT INTO fhir_export_jobs (requested_by, scope, patient_usernames, progress)
+        VALUES (%s, %s, %s, %s)
+        RETURNING id
+    """, (requested_by, scope, list(usernames), json.dumps(new_progress())))
+    job_id = cur.fetchone()[0]
+    cur.execute(f"NOTIFY {NOTIFY_CHANNEL}")
+    return job_id
+
+
+def get_bulk_export(cur, job_id: int) -> Optional[Dict[str, Any]]:
+    cur.execute("""
+        SELECT id, requested_by, scope, status, progress, manifest, signature, error,
+               created_at, completed_at, array_length(patient_usernames, 1)
+        FROM fhir_export_jobs WHERE id = %s
+    """, (job_id,))
+    row = cur.fetchone()
+    if not row:
+        return None
+
+    def load(v):
+        return json.loads(v) if isinstance(v, str) else v
+
+    return {
+        'id': row[0],
+        'requested_by': row[1],
+        'scope': row[2],
+        'status': row[3],
+        'progress': load(row[4]) or new_progress(),
+        'manifest': load(row[5]),
+        'signature': load(row[6]),
+        'error': row[7],
+        'created_at': _iso(row[8]),
+        'completed_at': _iso(row[9]),
+        'patient_count': row[10] or 0,
+    }
+
+
+class FhirBulkExportWorker:
+    """Runs queued bulk exports stage by stage, checkpointing after every part."""
+
+    DEFAULT_POLL_INTERVAL = 10.0
+    FETCH_SIZE = 1000          # rows per server-side cursor round trip (and decrypt batch)
+    PART_SIZE = 10000          # resources per NDJSON part
+    STALE_AFTER_SECONDS = 600  # running jobs without a heartbeat this long are resumed
+    MAX_ATTEMPTS = 5
+
+    def __init__(self, conn, connect: Optional[Callable] = None, base_url: str = '/api/export/fhir/bulk'):
+        self.conn = conn
+        self.connect = connect
+        self.base_url = base_url
+        self.completed_total = 0
+
+    def claim_job(self) -> Optional[Dict[str, Any]]:
+        """Take the oldest queued (or abandoned) job."""
+        cur = self.conn.cursor()
+        try:
+            cur.execute("""
+                UPDATE fhir_export_jobs
+                SET status = 'running', attempts = attempts + 1, heartbeat_at = CURRENT_TIMESTAMP,
+                    started_at = COALESCE(started_at, CURRENT_TIMESTAMP)
+                WHERE id = (
+                    SELECT id FROM fhir_export_jobs
+                    WHERE status = 'queued'
+                    OR (status = 'running' AND heartbeat_at < CURRENT_TIMESTAMP - make_interval(secs => %s))
+                    ORDER BY created_at, id
+                    LIMIT 1
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING id, requested_by, patient_usernames, progress, attempts, created_at
+            """, (self.STALE_AFTER_SECONDS,))
+            row = cur.fetchone()
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            cur.close()
+        if not row:
+            return None
+        progress = row[3]
+        if isinstance(progress, str):
+            progress = json.loads(progress)
+        return {'id': row[0], 'requested_by': row[1], 'usernames': list(row[2] or []),
+                'progress': progress or new_progress(), 'attempts': row[4],
+                'transaction_time': _iso(row[5])}
+
+    def _write_part(self, job, resource_type: str, lines: List[str], last_key) -> None:
+        """Persist one NDJSON part and the checkpoint that follows it, atomically."""
+        body = ('\n'.join(lines) + '\n').encode()
+        progress = job['progress']
+        progress['part_no'] += 1
+        progress['last_key'] = last_key
+        progress['counts'][resource_type] = progress['counts'].get(resource_type, 0) + len(lines)
+
+        cur = self.conn.cursor()
+        try:
+            cur.execute("""
+                INSERT INTO fhir_export_parts (job_id, part_no, resource_type, resource_count, sha256, content)
+                VALUES (%s, %s, %s, %s, %s, %s)
+            """, (job['id'], progress['part_no'], resource_type, len(lines),
+                  hashlib.sha256(body).hexdigest(), psycopg2.Binary(body)))
+            cur.execute("""
+                UPDATE fhir_export_jobs SET progress = %s, heartbeat_at = CURRENT_TIMESTAMP WHERE id = %s
+            """, (json.dumps(progress), job['id']))
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            cur.close()
+
+    def _advance_stage(self, job, stage_index: int) -> None:
+        job['progress']['stage'] = stage_index + 1
+        job['progress']['last_key'] = None
+        cur = self.conn.cursor()
+        try:
+            cur.execute("UPDATE fhir_export_jobs SET progress = %s, heartbeat_at = CURRENT_TIMESTAMP WHERE id = %s",
+                        (json.dumps(job['progress']), job['id']))
+            self.conn.commit()
+        finally:
+            cur.close()
+
+    def run_job(self, job) -> Dict[str, Any]:
+        """Run (or resume) every remaining stage, then sign and store the manifest."""
+        progress = job['progress']
+        for stage_index in range(progress['stage'], len(BULK_STAGES)):
+            resource_type, query, build = BULK_STAGES[stage_index]
+            lines, last_key = [], progress['last_key']
+            chunks = iter_row_chunks(self.conn, query, (job['usernames'], progress['last_key']),
+                                     chunk_size=self.FETCH_SIZE, name_prefix='fhir_bulk', withhold=True)
+            try:
+                for rows in chunks:
+                    for key, resource in build(rows, job):
+                        lines.append(json.dumps(resource, default=str, separators=(',', ':')))
+                        last_key = key
+                        if len(lines) >= self.PART_SIZE:
+                            self._write_part(job, resource_type, lines, last_key)
+                            lines = []
+            finally:
+                chunks.close()
+            if lines:
+                self._write_part(job, resource_type, lines, last_key)
+            self._advance_stage(job, stage_index)
+
+        return self._complete(job)
+
+    def _complete(self, job) -> Dict[str, Any]:
+        cur = self.conn.cursor()
+        try:
+            cur.execute("""
+                SELECT part_no, resource_type, resource_count, sha256
+                FROM fhir_export_parts WHERE job_id = %s ORDER BY part_no
+            """, (job['id'],))
+            parts = cur.fetchall()
+            manifest = {
+                'transactionTime': job['transaction_time'],
+                'request': f"{self.base_url} (job {job['id']})",
+                'requiresAccessToken': True,
+                'output': [{
+                    'type': resource_type,
+                    'url': f"{self.base_url}/{job['id']}/parts/{part_no}",
+                    'count': count,
+                    'sha256': digest,
+                } for part_no, resource_type, count, digest in parts],
+                'error': [],
+            }
+            signature = sign_payload(manifest)
+            cur.execute("""
+                UPDATE fhir_export_jobs
+                SET status = 'completed', manifest = %s, signature = %s, error = NULL,
+                    completed_at = CURRENT_TIMESTAMP
+                WHERE id = %s
+            """, (json.dumps(manifest), json.dumps(signature), job['id']))
+            cur.execute(
+                "INSERT INTO notifications (recipient_username, message, notification_type) VALUES (%s, %s, %s)",
+                (job['requested_by'], f"FHIR bulk export #{job['id']} is ready", 'fhir_export_ready')
+            )
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            cur.close()
+        self.completed_total += 1
+        return manifest
+
+    def _fail(self, job, error: Exception) -> None:
+        """Requeue (the checkpoint is kept, so the retry resumes) or give up after MAX_ATTEMPTS."""
+        status = 'queued' if job['attempts'] < self.MAX_ATTEMPTS else 'failed'
+        try:
+            self.conn.rollback()
+            cur = self.conn.cursor()
+            cur.execute("UPDATE fhir_export_jobs SET status = %s, error = %s WHERE id = %s",
+                        (status, str(error)[:500], job['id']))
+            cur.close()
+            self.conn.commit()
+        except psycopg2.Error as e:
+            logger.error(f"Could not record failure for FHIR export {job['id']}: {e}")
+
+    def run_pending(self, max_jobs: int = 10) -> int:
+        """Run queued exports one at a time. Returns number completed."""
+        completed = 0
+        for _ in range(max_jobs):
+            job = self.claim_job()
+            if not job:
+                break
+            try:
+                self.run_job(job)
+                completed += 1
+            except Exception as e:
+                logger.error(f"FHIR export {job['id']} failed: {e}")
+                self._fail(job, e)
+        return completed
+
+    def run_forever(self, poll_interval: float = None):
+        interval = poll_interval or self.DEFAULT_POLL_INTERVAL
+        logger.info(f"FHIR bulk export worker started (interval={interval}s)")
+        listening = False
+        while True:
+            try:
+                if self.conn.closed and self.connect:
+                    self.conn = self.connect()
+                    listening = False
+                if not listening:
+                    cur = self.conn.cursor()
+                    cur.execute(f"LISTEN {NOTIFY_CHANNEL}")
+                    cur.close()
+                    self.conn.commit()
+                    listening = True
+                self.run_pending()
+                if select.select([self.conn], [], [], interval) != ([], [], []):
+                    self.conn.poll()
+                    self.conn.notifies.clear()
+            except psycopg2.Error as e:
+                logger.error(f"FHIR export pass failed: {e}")
+                listening = False
+                time.sleep(interval)
+
+
+def get_db_connection():
+    """Open a dedicated PostgreSQL connection for the worker (fail closed)."""
+    database_url = os.getenv('DATABASE_URL')
+    if database_url:
+        return psycopg2.connect(database_url)
+
+    host = os.getenv('DB_HOST')
+    name = os.getenv('DB_NAME')
+    user = os.getenv('DB_USER')
+    password = os.getenv('DB_PASSWORD')
+    if not all([host, name, user, password]):
+        raise RuntimeError(
+            "CRITICAL: Database credentials incomplete. "
+            "Required: DATABASE_URL or (DB_HOST, DB_NAME, DB_USER, DB_PASSWORD)"
+        )
+    return psycopg2.connect(host=host, port=int(os.getenv('DB_PORT', '5432')),
+                            database=name, user=user, password=password)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Run queued FHIR bulk exports')
+    parser.add_argument('--once', action='store_true', help='run queued exports and exit')
+    parser.add_argument('--interval', type=float, default=FhirBulkExportWorker.DEFAULT_POLL_INTERVAL,
+                        help='max seconds between polls when no NOTIFY arrives')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    worker = FhirBulkExportWorker(get_db_connection(), connect=get_db_connection)
+    try:
+        if args.once:
+            completed = worker.run_pending()
+            print(f"Completed {completed} export(s)")
+        else:
+            worker.run_forever(args.interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        worker.conn.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
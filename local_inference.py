@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+"""
+Local Inference - serves the locally trained therapy model to the web tier.
+
+BackgroundAITrainer.generate_response loads the whole model into whichever
+process calls it and generates one reply at a time. This module runs the
+model once per host in its own process instead:
+
+    python local_inference.py --port 8081 --threads 4
+
+and the web workers reach it through LocalTherapistAI, which has the same
+interface as api.TherapistAI (set AI_PROVIDER=local to swap it in).
+
+- The latest trained model (training_metrics.json) is loaded once at start.
+- Concurrent requests are micro-batched: the first request waits up to
+  max_wait seconds for others, then the batch is left-padded and decoded
+  with a single generate() call.
+- Each conversation's KV cache is kept (LRU, bounded by the total number of
+  cached tokens, CONVERSATION_CACHE_TOKENS). A request that arrives alone
+  and whose prompt extends its conversation's cached tokens only runs the
+  new tokens through the model. Batched requests are generated from scratch;
+  their padded caches are not kept.
+
+Prompts use the training format (see ai_trainer.build_context_windows):
+"Patient: ..."/"Therapist: ..." turns separated by EOS.
+"""
+
+import argparse
+import hashlib
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+try:
+    import torch
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+    HAS_TRANSFORMERS = True
+except ImportError:
+    HAS_TRANSFORMERS = False
+
+LOCAL_INFERENCE_URL = os.getenv('LOCAL_INFERENCE_URL', 'http://127.0.0.1:8081')
+LOCAL_INFERENCE_TIMEOUT = float(os.getenv('LOCAL_INFERENCE_TIMEOUT', '30'))
+
+MAX_BATCH_SIZE = 8
+MAX_BATCH_WAIT_SECONDS = 0.02
+MAX_NEW_TOKENS = 96
+MAX_CONTEXT_TOKENS = 512
+HISTORY_TURNS = 10
+# About 70 KB of KV cache per token for DialoGPT-small, so ~300 MB by default
+CONVERSATION_CACHE_TOKENS = int(os.getenv('CONVERSATION_CACHE_TOKENS', '4096'))
+MIN_CACHE_REUSE_TOKENS = 16
+
+TURN_PREFIXES = {'user': 'Patient: ', 'ai': 'Therapist: '}
+
+CRISIS_FOOTER = (
+    "\n\nIf you're in distress or feel unsafe right now, please reach out to the Samaritans on "
+    "**116 123** (free, 24/7), text **SHOUT to 85258**, or call **999** in an emergency."
+)
+
+
+class MicroBatcher:
+    """
+    Collects concurrent submissions into batches for handler(items) -> results.
+
+    The worker thread takes the first waiting item, gathers more for up to
+    max_wait seconds (or until max_batch_size), and resolves every caller's
+    future from one handler call. A handler exception fails the whole batch.
+    """
+
+    def __init__(self, handler, max_batch_size=MAX_BATCH_SIZE, max_wait=MAX_BATCH_WAIT_SECONDS):
+        self.handler = handler
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.batch_sizes = deque(maxlen=100)  # recent batches, for /health
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, item, timeout=None):
+        """Queue item and block until its result is ready."""
+        self._ensure_worker()
+        future = Future()
+        self._queue.put((item, future))
+        return future.result(timeout)
+
+    def _ensure_worker(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, daemon=True, name='inference-batcher')
+                self._thread.start()
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            self.batch_sizes.append(len(batch))
+            try:
+                results = self.handler([item for item, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+
+
+class ConversationCache:
+    """
+    LRU of conversation_id -> (token ids covered, KV cache), bounded by the
+    total number of cached tokens (KV memory grows with tokens, not entries).
+
+    take() removes the entry, so the caller can crop and extend the KV cache
+    in place and put() the result back without copying it.
+    """
+
+    def __init__(self, max_tokens=CONVERSATION_CACHE_TOKENS):
+        self.max_tokens = max_tokens
+        self.tokens = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, conversation_id):
+        with self._lock:
+            entry = self._entries.pop(conversation_id, None)
+            if entry is not None:
+                self.tokens -= len(entry[0])
+            return entry
+
+    def put(self, conversation_id, tokens, past):
+        with self._lock:
+            old = self._entries.pop(conversation_id, None)
+            if old is not None:
+                self.tokens -= len(old[0])
+            if len(tokens) > self.max_tokens:
+                return
+            self._entries[conversation_id] = (tokens, past)
+            self.tokens += len(tokens)
+            while self.tokens > self.max_tokens:
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self.tokens -= len(evicted)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def common_prefix_length(a, b):
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+def build_prompt_ids(tokenizer, turns, message, max_tokens=MAX_CONTEXT_TOKENS - MAX_NEW_TOKENS):
+    """Token ids for the conversation so far plus the therapist prefix, trimmed from the left."""
+    eos = tokenizer.eos_token_id
+    texts = [f"{TURN_PREFIXES.get(role, TURN_PREFIXES['user'])}{text}" for role, text in turns]
+    texts.append(f"{TURN_PREFIXES['user']}{message}")
+    ids = []
+    for encoded in tokenizer(texts, add_special_tokens=False)['input_ids']:
+        ids.extend(encoded)
+        ids.append(eos)
+    ids.extend(tokenizer([TURN_PREFIXES['ai'].rstrip()], add_special_tokens=False)['input_ids'][0])
+    return ids[-max_tokens:]
+
+
+def clean_reply(text):
+    """Drop any turn the model started writing for the patient."""
+    return text.split(TURN_PREFIXES['user'].strip())[0].strip()
+
+
+class LocalModelEngine:
+    """Holds the model and generates replies for batches of requests."""
+
+    def __init__(self, model_path=None, threads=None, cache_tokens=CONVERSATION_CACHE_TOKENS,
+                 max_new_tokens=MAX_NEW_TOKENS):
+        if not HAS_TRANSFORMERS:
+            raise RuntimeError(
+                "Transformers library required. Install with:\n"
+                "pip install -r requirements-training.txt"
+            )
+        from ai_trainer import MODEL_NAME, latest_model_path
+
+        if threads:
+            torch.set_num_threads(threads)
+        self.model_path = model_path or latest_model_path() or MODEL_NAME
+        self.tokenizer = AutoTokenizer.from_pretrained(self.model_path)
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.tokenizer.padding_side = 'left'
+        self.model = AutoModelForCausalLM.from_pretrained(self.model_path)
+        self.model.eval()
+        self.max_new_tokens = max_new_tokens
+        self.conversations = ConversationCache(cache_tokens)
+        print(f"🤖 Local model loaded: {self.model_path}")
+
+    def _generation_kwargs(self, max_new_tokens):
+        return dict(max_new_tokens=max_new_tokens, do_sample=True, temperature=0.8, top_p=0.9,
+                    pad_token_id=self.tokenizer.pad_token_id, eos_token_id=self.tokenizer.eos_token_id)
+
+    def _max_new_tokens(self, request):
+        """The client's max_new_tokens, capped at the server's own limit"""
+        try:
+            requested = int(request.get('max_new_tokens') or 0)
+        except (TypeError, ValueError):
+            requested = 0
+        return min(requested, self.max_new_tokens) if requested > 0 else self.max_new_tokens
+
+    def generate_batch(self, requests):
+        """requests: [{'conversation_id', 'turns', 'message', 'max_new_tokens'}] -> [reply dict]"""
+        prompts = [build_prompt_ids(self.tokenizer, r['turns'], r['message']) for r in requests]
+        if len(requests) == 1:
+            return [self._generate_one(requests[0], prompts[0])]
+
+        max_new_tokens = max(self._max_new_tokens(r) for r in requests)
+        padded = self.tokenizer.pad({'input_ids': prompts}, return_tensors='pt')
+        with torch.inference_mode():
+            output = self.model.generate(**padded, **self._generation_kwargs(max_new_tokens))
+        width = padded['input_ids'].shape[1]
+        return [{'response': clean_reply(self.tokenizer.decode(row[width:], skip_special_tokens=True)),
+                 'cached_tokens': 0, 'batch_size': len(requests)} for row in output]
+
+    def _generate_one(self, request, prompt):
+        """Generate alone, continuing from the conversation's KV cache when the prompt extends it."""
+        conversation_id = request.get('conversation_id')
+        kwargs, reused = {}, 0
+        entry = self.conversations.take(conversation_id) if conversation_id else None
+        if entry is not None:
+            tokens, past = entry
+            reused = common_prefix_length(tokens, prompt)
+            # At least one prompt token must still go through the model
+            reused = min(reused, len(prompt) - 1)
+            if reused >= MIN_CACHE_REUSE_TOKENS:
+                # Taken out of the cache, so it can be cropped and extended in place
+                past.crop(reused)
+                kwargs['past_key_values'] = past
+            else:
+                reused = 0
+
+        input_ids = torch.tensor([prompt])
+        with torch.inference_mode():
+            output = self.model.generate(
+                input_ids, attention_mask=torch.ones_like(input_ids), return_dict_in_generate=True,
+                **self._generation_kwargs(self._max_new_tokens(request)), **kwargs)
+
+        sequence = output.sequences[0].tolist()
+        past = output.past_key_values
+        if conversation_id and hasattr(past, 'crop'):
+            self.conversations.put(conversation_id, sequence[:past.get_seq_length()], past)
+        return {'response': clean_reply(self.tokenizer.decode(sequence[len(prompt):], skip_special_tokens=True)),
+                'cached_tokens': reused, 'batch_size': 1}
+
+
+def create_app(engine, batcher=None):
+    """Flask app exposing POST /generate and GET /health."""
+    from flask import Flask, jsonify, request
+
+    app = Flask(__name__)
+    batcher = batcher or MicroBatcher(engine.generate_batch)
+
+    @app.route('/generate', methods=['POST'])
+    def generate():
+        data = request.get_json(silent=True) or {}
+        message = data.get('message')
+        if not message:
+            return jsonify({'error': 'message required'}), 400
+        turns = [(str(t[0]), str(t[1])) for t in data.get('turns', []) if isinstance(t, (list, tuple)) and len(t) >= 2]
+        item = {'conversation_id': data.get('conversation_id'), 'turns': turns[-HISTORY_TURNS:],
+                'message': str(message), 'max_new_tokens': data.get('max_new_tokens')}
+        try:
+            return jsonify(batcher.submit(item, timeout=LOCAL_INFERENCE_TIMEOUT)), 200
+        except Exception as e:
+            print(f"❌ Local generation failed: {e}")
+            return jsonify({'error': 'generation failed'}), 500
+
+    @app.route('/health', methods=['GET'])
+    def health():
+        sizes = batcher.batch_sizes
+        return jsonify({
+            'model_path': engine.model_path,
+            'conversations_cached': len(engine.conversations),
+            'cached_tokens': engine.conversations.tokens,
+            'avg_batch_size': round(sum(sizes) / len(sizes), 2) if sizes else None
+        }), 200
+
+    return app
+
+
+class LocalTherapistAI:
+    """
+    Drop-in for api.TherapistAI backed by the local inference server.
+
+    The small local model is not prompted with memory/wellness context; it
+    sees the recent dialogue only. Crisis resources are appended
+    deterministically for high/critical risk rather than left to the model.
+    """
+
+    def __init__(self, username, base_url=None, timeout=None):
+        self.username = username
+        self.base_url = (base_url or LOCAL_INFERENCE_URL).rstrip('/')
+        self.timeout = timeout or LOCAL_INFERENCE_TIMEOUT
+        # The server only needs a stable key per conversation, not the username
+        self.conversation_id = hashlib.sha256(f"conversation:{username}".encode()).hexdigest()[:32]
+
+    def get_response(self, user_message, history=None, wellness_data=None, memory_context=None,
+                     risk_context=None, suggestions=None):
+        import requests
+
+        turns = []
+        for item in (history or [])[-HISTORY_TURNS:]:
+            if isinstance(item, (list, tuple)) and len(item) >= 2:
+                turns.append(('user' if str(item[0]).lower() == 'user' else 'ai', str(item[1])))
+
+        response = requests.post(
+            f"{self.base_url}/generate",
+            json={'conversation_id': self.conversation_id, 'turns': turns, 'message': user_message},
+            timeout=self.timeout
+        )
+        if response.status_code != 200:
+            raise RuntimeError(f"Local inference error: {response.status_code}")
+
+        reply = response.json().get('response') or (
+            "I'm here with you. Could you tell me a little more about how you're feeling right now?"
+        )
+        if risk_context in ('high', 'critical'):
+            reply += CRISIS_FOOTER
+        return reply
+
+    def get_insight(self, text):
+        """Get AI insight on provided text"""
+        return self.get_response(text)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve the locally trained therapy model')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--model', help='model directory (default: latest trained model)')
+    parser.add_argument('--threads', type=int, default=int(os.getenv('INFERENCE_THREADS', '0')) or None,
+                        help='torch CPU threads (default: INFERENCE_THREADS or torch default)')
+    parser.add_argument('--max-batch', type=int, default=MAX_BATCH_SIZE)
+    parser.add_argument('--max-wait-ms', type=float, default=MAX_BATCH_WAIT_SECONDS * 1000)
+    args = parser.parse_args(argv)
+
+    engine = LocalModelEngine(args.model, threads=args.threads)
+    batcher = MicroBatcher(engine.generate_batch, args.max_batch, args.max_wait_ms / 1000.0)
+    create_app(engine, batcher).run(host=args.host, port=args.port, threaded=True)
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+"""
+Scheduled Message Dispatcher - delivers messages created by
+MessageService.schedule_message once their scheduled_for time arrives.
+
+Each pass claims a batch of due rows with FOR UPDATE SKIP LOCKED, flips them
+to 'sent', creates in-app notifications for the whole batch with set-based
+inserts and commits. Several dispatchers (one per node, or one per gunicorn
+host) can run at once: SKIP LOCKED guarantees a message is only ever claimed
+by one of them.
+
+The same loop also fans out large broadcasts queued by
+MessageService.send_broadcast_message (broadcast_jobs rows). Each job is
+guarded by a session-level advisory lock (also taken by the inline fan-out in
+send_broadcast_message) and resumes from its last committed chunk, so a
+crashed worker's job is picked up by the next pass and a failed one is
+retried up to MessageService.BROADCAST_MAX_ATTEMPTS times.
+
+Run as a long-lived worker (Procfile: `worker: python message_dispatcher.py`):
+    python message_dispatcher.py                 # poll every 5 seconds
+    python message_dispatcher.py --interval 2    # poll every 2 seconds
+    python message_dispatcher.py --once          # drain due messages and exit (cron)
+"""
+
+import argparse
+import logging
+import os
+import sys
+import time
+from datetime import datetime
+from typing import Any, Dict, List
+
+import psycopg2
+
+from message_service import MessageService
+
+logger = logging.getLogger('message_dispatcher')
+
+
+class ScheduledMessageDispatcher:
+    """Claims due scheduled messages in batches and delivers them."""
+
+    DEFAULT_BATCH_SIZE = 200
+    DEFAULT_POLL_INTERVAL = 5.0
+    LAG_SAMPLE_SIZE = 1000  # recent deliveries kept for in-process lag percentiles
+    BROADCAST_CHUNKS_PER_PASS = 20   # bound one pass so scheduled messages are not starved
+
+    def __init__(self, conn, batch_size: int = None, connect=None):
+        self.conn = conn
+        self.connect = connect  # optional factory used to reconnect after a dropped connection
+        self.batch_size = batch_size or self.DEFAULT_BATCH_SIZE
+        self.delivered_total = 0
+        self.batches_total = 0
+        self.last_run_at = None
+        self.broadcast_recipients_total = 0
+        self._recent_lags: List[float] = []
+
+    # ==================== DISPATCH ====================
+
+    def dispatch_batch(self) -> List[Dict[str, Any]]:
+        """
+        Deliver up to batch_size due messages in a single transaction.
+
+        Returns the delivered rows: {message_id, conversation_id, sender,
+        recipient, lag_seconds}.
+        """
+        cur = self.conn.cursor()
+        try:
+            # Claim + transition in one statement. The partial index
+            # idx_messages_scheduled_due keeps the scan to due rows only.
+            cur.execute("""
+                WITH due AS (
+                    SELECT id FROM messages
+                    WHERE delivery_status = 'scheduled'
+                    AND scheduled_for <= CURRENT_TIMESTAMP
+                    ORDER BY scheduled_for
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                UPDATE messages m
+                SET delivery_status = 'sent', sent_at = CURRENT_TIMESTAMP,
+                    updated_at = CURRENT_TIMESTAMP
+                FROM due
+                WHERE m.id = due.id
+                RETURNING m.id, m.conversation_id, m.sender_username, m.recipient_username,
+                          m.subject, EXTRACT(EPOCH FROM (m.sent_at - m.scheduled_for))
+            """, (self.batch_size,))
+            rows = cur.fetchall()
+
+            if not rows:
+                self.conn.commit()
+                return []
+
+            message_ids = [r[0] for r in rows]
+            recipients = [r[3] for r in rows]
+            notices = [
+                f"New message from {r[2]}: {r[4]}" if r[4] else f"New message from {r[2]}"
+                for r in rows
+            ]
+            conversation_ids = sorted({r[1] for r in rows if r[1] is not None})
+
+            # Bulk notifications: one INSERT per table for the whole batch
+            cur.execute("""
+                INSERT INTO message_notifications (message_id, recipient_username, notification_type, sent_at)
+                SELECT u.message_id, u.recipient_username, 'in_app', CURRENT_TIMESTAMP
+                FROM unnest(%s::int[], %s::text[]) AS u(message_id, recipient_username)
+                WHERE u.recipient_username IS NOT NULL
+                ON CONFLICT (message_id, recipient_username, notification_type) DO NOTHING
+            """, (message_ids, recipients))
+            cur.execute("""
+                INSERT INTO notifications (recipient_username, message, notification_type)
+                SELECT u.recipient_username, u.message, 'message'
+                FROM unnest(%s::text[], %s::text[]) AS u(recipient_username, message)
+                WHERE u.recipient_username IS NOT NULL
+            """, (recipients, notices))
+
+            if conversation_ids:
+                cur.execute("""
+                    UPDATE conversations SET last_message_at = CURRENT_TIMESTAMP
+                    WHERE id = ANY(%s)
+                """, (conversation_ids,))
+
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            cur.close()
+
+        delivered = [{
+            'message_id': r[0],
+            'conversation_id': r[1],
+            'sender': r[2],
+            'recipient': r[3],
+            'lag_seconds': float(r[5]) if r[5] is not None else 0.0
+        } for r in rows]
+        self._record(delivered)
+        return delivered
+
+    def run_pending(self, max_batches: int = 50) -> int:
+        """Drain due messages batch by batch. Returns number delivered."""
+        delivered = 0
+        for _ in range(max_batches):
+            batch = self.dispatch_batch()
+            delivered += len(batch)
+            if len(batch) < self.batch_size:
+                break
+        self.last_run_at = datetime.now()
+        return delivered
+
+    def dispatch_broadcasts(self) -> int:
+        """
+        Advance open broadcast fan-out jobs, and retry failed ones until
+        they reach MessageService.BROADCAST_MAX_ATTEMPTS. Returns number of
+        recipients fanned out in this pass.
+        """
+        cur = self.conn.cursor()
+        try:
+            cur.execute("""
+                SELECT id, sender_username, processed_recipients FROM broadcast_jobs
+                WHERE status IN ('pending', 'running')
+                   OR (status = 'failed' AND attempts < %s)
+                ORDER BY id
+            """, (MessageService.BROADCAST_MAX_ATTEMPTS,))
+            jobs = cur.fetchall()
+            self.conn.commit()
+
+            processed = 0
+            for job_id, sender, before in jobs:
+                service = MessageService(self.conn, cur, sender)
+                try:
+                    status = service.run_locked_broadcast_fan_out(job_id, max_chunks=self.BROADCAST_CHUNKS_PER_PASS)
+                except Exception as e:
+                    # Recorded on the job (status 'failed', attempts + 1); move on to the next one
+                    logger.error(f"Broadcast {job_id} failed: {e}")
+                    continue
+                if status is None:
+                    continue  # another worker owns this job
+                processed += status['processed_recipients'] - (before or 0)
+                logger.info(
+                    f"Broadcast {job_id}: {status['processed_recipients']}/"
+                    f"{status['total_recipients']} recipients ({status['status']})"
+                )
+        finally:
+            cur.close()
+
+        self.broadcast_recipients_total += processed
+        return processed
+
+    def run_forever(self, poll_interval: float = None):
+        """Poll for due messages until interrupted."""
+        interval = poll_interval or self.DEFAULT_POLL_INTERVAL
+        logger.info(f"Scheduled message dispatcher started (batch={self.batch_size}, interval={interval}s)")
+        while True:
+            try:
+                if self.conn.closed and self.connect:
+                    self.conn = self.connect()
+                self.run_pending()
+                self.dispatch_broadcasts()
+            except Exception as e:
+                logger.exception(f"Dispatch pass failed: {e}")
+                try:
+                    self.conn.rollback()
+                except Exception:
+                    pass
+            time.sleep(interval)
+
+    # ==================== METRICS ====================
+
+    def _record(self, delivered: List[Dict[str, Any]]) -> None:
+        self.batches_total += 1
+        self.delivered_total += len(delivered)
+        lags = [d['lag_seconds'] for d in delivered]
+        self._recent_lags = (self._recent_lags + lags)[-self.LAG_SAMPLE_SIZE:]
+        logger.info(
+            f"Delivered {len(delivered)} scheduled message(s); "
+            f"lag max={max(lags):.2f}s avg={sum(lags) / len(lags):.2f}s"
+        )
+
+    def stats(self) -> Dict[str, Any]:
+        """In-process delivery-lag summary for this dispatcher."""
+        lags = sorted(self._recent_lags)
+
+        def pct(p):
+            if not lags:
+                return None
+            return round(lags[min(len(lags) - 1, int(p * len(lags)))], 3)
+
+        return {
+            'delivered_total': self.delivered_total,
+            'batches_total': self.batches_total,
+            'broadcast_recipients_total': self.broadcast_recipients_total,
+            'last_run_at': self.last_run_at.isoformat() if self.last_run_at else None,
+            'lag_p50_seconds': pct(0.50),
+            'lag_p95_seconds': pct(0.95),
+            'lag_max_seconds': round(lags[-1], 3) if lags else None
+        }
+
+
+def get_dispatch_stats(cur, hours: int = 24) -> Dict[str, Any]:
+    """
+    Cluster-wide delivery-lag metrics read from the messages table, so they
+    cover every dispatcher instance: backlog of overdue messages and lag
+    percentiles for deliveries in the last `hours`.
+    """
+    cur.execute("""
+        SELECT COUNT(*),
+               EXTRACT(EPOCH FROM (CURRENT_TIMESTAMP - MIN(scheduled_for)))
+        FROM messages
+        WHERE delivery_status = 'scheduled' AND scheduled_for <= CURRENT_TIMESTAMP
+    """)
+    backlog = cur.fetchone() or (0, None)
+
+    cur.execute("""
+        SELECT COUNT(*),
+               percentile_cont(0.5) WITHIN GROUP (ORDER BY EXTRACT(EPOCH FROM (sent_at - scheduled_for))),
+               percentile_cont(0.95) WITHIN GROUP (ORDER BY EXTRACT(EPOCH FROM (sent_at - scheduled_for))),
+               MAX(EXTRACT(EPOCH FROM (sent_at - scheduled_for)))
+        FROM messages
+        WHERE scheduled_for IS NOT NULL AND delivery_status = 'sent'
+        AND sent_at >= CURRENT_TIMESTAMP - make_interval(hours => %s)
+    """, (hours,))
+    delivered = cur.fetchone() or (0, None, None, None)
+
+    def secs(v):
+        return round(float(v), 3) if v is not None else None
+
+    return {
+        'overdue_count': backlog[0] or 0,
+        'oldest_overdue_seconds': secs(backlog[1]),
+        'window_hours': hours,
+        'delivered_count': delivered[0] or 0,
+        'lag_p50_seconds': secs(delivered[1]),
+        'lag_p95_seconds': secs(delivered[2]),
+        'lag_max_seconds': secs(delivered[3])
+    }
+
+
+def get_db_connection():
+    """Open a dedicated PostgreSQL connection for the worker (fail closed)."""
+    database_url = os.getenv('DATABASE_URL')
+    if database_url:
+        return psycopg2.connect(database_url)
+
+    host = os.getenv('DB_HOST')
+    name = os.getenv('DB_NAME')
+    user = os.getenv('DB_USER')
+    password = os.getenv('DB_PASSWORD')
+    if not all([host, name, user, password]):
+        raise RuntimeError(
+            "CRITICAL: Database credentials incomplete. "
+            "Required: DATABASE_URL or (DB_HOST, DB_NAME, DB_USER, DB_PASSWORD)"
+        )
+    return psycopg2.connect(host=host, port=int(os.getenv('DB_PORT', '5432')),
+                            database=name, user=user, password=password)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Deliver scheduled messages')
+    parser.add_argument('--once', action='store_true', help='drain due messages and exit')
+    parser.add_argument('--interval', type=float, default=ScheduledMessageDispatcher.DEFAULT_POLL_INTERVAL,
+                        help='seconds between polls')
+    parser.add_argument('--batch-size', type=int, default=ScheduledMessageDispatcher.DEFAULT_BATCH_SIZE)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    dispatcher = ScheduledMessageDispatcher(get_db_connection(), batch_size=args.batch_size,
+                                            connect=get_db_connection)
+    try:
+        if args.once:
+            delivered = dispatcher.run_pending()
+            fanned_out = dispatcher.dispatch_broadcasts()
+            print(f"Delivered {delivered} scheduled message(s), {fanned_out} broadcast recipient(s)")
+        else:
+            dispatcher.run_forever(args.interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        dispatcher.conn.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -19,7 +19,7 @@ class MessageService:
     
     # Constants
     MESSAGE_TYPES = ['direct', 'group', 'system', 'broadcast']
-    DELIVERY_STATUSES = ['draft', 'scheduled', 'sent', 'delivered', 'failed']
+    DELIVERY_STATUSES = ['draft', 'scheduled', 'sent', 'delivered', 'failed', 'cancelled']
     CONVERSATION_TYPES = ['direct', 'group', 'thread']
     RECEIPT_TYPES = ['delivered', 'read', 'typing']
     NOTIFICATION_TYPES = ['in_app', 'email', 'push', 'digest']
@@ -28,6 +28,19 @@ class MessageService:
     MAX_SUBJECT_LENGTH = 255
     MAX_TEMPLATE_NAME_LENGTH = 255
     MAX_SEARCH_QUERY_LENGTH = 200
+
+    # Broadcast fan-out: audience filters are fixed SQL fragments (never user input)
+    BROADCAST_ROLES = ('developer', 'admin')
+    BROADCAST_AUDIENCES = {
+        'all': "role != 'developer'",
+        'patients': "role = 'user'",
+        'clinicians': "role = 'clinician'",
+        'admin': "role = 'admin'",
+    }
+    BROADCAST_CHUNK_SIZE = 1000     # recipients per INSERT ... SELECT
+    BROADCAST_INLINE_LIMIT = 2000   # larger audiences are fanned out by the worker
+    BROADCAST_LOCK_NAMESPACE = 7301  # pg_try_advisory_lock(namespace, job_id)
+    BROADCAST_MAX_ATTEMPTS = 5      # failed jobs are retried by the worker until this many failures
     
     def __init__(self, conn, cur, username: str = None):
         """Initialize service with database connection and authenticated user"""
@@ -215,39 +228,49 @@ class MessageService:
                               recipient_filter: str = None) -> Dict[str, Any]:
         """
         Broadcast message from developer/admin to all/filtered users.
-        recipient_filter: 'all', 'patients', 'clinicians', or username list
+        recipient_filter: 'all', 'patients', 'clinicians' or 'admin'
+
+        Participants and notifications are fanned out with set-based
+        INSERT ... SELECT in chunks tracked by a broadcast_jobs row. Small
+        audiences are fanned out before returning; larger ones are queued
+        for message_dispatcher.py and can be polled via get_broadcast_status.
         """
         if not self.username:
             raise ValueError("Authentication required")
+
+        if not content:
+            raise ValueError("Content required")
+
+        if len(content) > self.MAX_MESSAGE_LENGTH:
+            raise ValueError(f"Message exceeds {self.MAX_MESSAGE_LENGTH} characters")
         
-        # Verify sender is developer
+        # Verify sender is developer/admin
         sender_role = self.cur.execute(
             "SELECT role FROM users WHERE username=%s",
             (self.username,)
         ).fetchone()
         
-        if not sender_role or sender_role[0] != 'developer':
-            raise ValueError("Only developers can broadcast")
+        if not sender_role or sender_role[0] not in self.BROADCAST_ROLES:
+            raise ValueError("Only developers or admins can broadcast")
         
-        # Get recipient list based on filter
-        if recipient_filter == 'patients':
-            self.cur.execute("SELECT username FROM users WHERE role='user'")
-        elif recipient_filter == 'clinicians':
-            self.cur.execute("SELECT username FROM users WHERE role='clinician'")
-        else:  # 'all'
-            self.cur.execute("SELECT username FROM users WHERE role != 'developer'")
+        audience = recipient_filter if recipient_filter in self.BROADCAST_AUDIENCES else 'all'
         
-        recipients = [row[0] for row in self.cur.fetchall()]
+        # Count recipients without pulling usernames into Python
+        self.cur.execute(
+            f"SELECT COUNT(*) FROM users WHERE {self.BROADCAST_AUDIENCES[audience]}"
+        )
+        recipients_count = self.cur.fetchone()[0]
         
-        if not recipients:
+        if not recipients_count:
             return {'message_id': None, 'recipients_count': 0, 'status': 'no_recipients'}
         
-        # Create broadcast conversation
-        conversation_id = self._get_or_create_conversation(
-            type='group',
-            subject=subject or 'System Broadcast',
-            participants=recipients
-        )
+        # Create broadcast conversation (participants added by fan-out)
+        self.cur.execute("""
+            INSERT INTO conversations (type, subject, created_by, participant_count)
+            VALUES ('group', %s, %s, %s)
+            RETURNING id
+        """, (subject or 'System Broadcast', self.username, recipients_count))
+        conversation_id = self.cur.fetchone()[0]
         
         # Insert broadcast message
         self.cur.execute("""
@@ -261,19 +284,163 @@ class MessageService:
         result = self.cur.fetchone()
         message_id, sent_at = result[0], result[1]
         
-        # Create notifications
-        for recipient in recipients:
-            self._create_notification(message_id, recipient, 'in_app')
+        # Progress record for the fan-out
+        self.cur.execute("""
+            INSERT INTO broadcast_jobs (
+                message_id, conversation_id, sender_username, recipient_filter,
+                status, total_recipients
+            ) VALUES (%s, %s, %s, %s, 'pending', %s)
+            RETURNING id
+        """, (message_id, conversation_id, self.username, audience, recipients_count))
+        broadcast_id = self.cur.fetchone()[0]
         
         self.conn.commit()
         
+        job = None
+        if recipients_count <= self.BROADCAST_INLINE_LIMIT:
+            # The dispatcher can see the committed job too; whoever gets the lock fans it out
+            job = self.run_locked_broadcast_fan_out(broadcast_id)
+        if job is None:
+            status = 'queued'
+        else:
+            status = 'sent' if job['status'] == 'completed' else job['status']
+        
         return {
             'message_id': message_id,
             'conversation_id': conversation_id,
-            'recipients_count': len(recipients),
-            'status': 'sent',
+            'broadcast_id': broadcast_id,
+            'recipients_count': recipients_count,
+            'status': status,
             'sent_at': sent_at.isoformat() if sent_at else None
         }
+
+    def run_locked_broadcast_fan_out(self, broadcast_id: int, max_chunks: int = None) -> Optional[Dict[str, Any]]:
+        """
+        run_broadcast_fan_out under the job's session advisory lock. Returns
+        None without doing anything if another worker holds the lock.
+        """
+        self.cur.execute("SELECT pg_try_advisory_lock(%s, %s)", (self.BROADCAST_LOCK_NAMESPACE, broadcast_id))
+        row = self.cur.fetchone()
+        if not row or not row[0]:
+            self.conn.commit()
+            return None
+        try:
+            return self.run_broadcast_fan_out(broadcast_id, max_chunks=max_chunks)
+        finally:
+            # A failed fan-out can leave the transaction aborted; the unlock
+            # would fail with it and leak the lock for the whole session
+            self.conn.rollback()
+            self.cur.execute("SELECT pg_advisory_unlock(%s, %s)", (self.BROADCAST_LOCK_NAMESPACE, broadcast_id))
+            self.conn.commit()
+
+    def run_broadcast_fan_out(self, broadcast_id: int, max_chunks: int = None) -> Dict[str, Any]:
+        """
+        Add participants and notifications for a broadcast, one chunk of
+        BROADCAST_CHUNK_SIZE recipients per statement/commit. Resumes from
+        the last committed username, so an interrupted job can be re-run.
+        Callers other than run_locked_broadcast_fan_out must hold the job's
+        advisory lock.
+        """
+        self.cur.execute("""
+            SELECT message_id, conversation_id, recipient_filter, last_username, status
+            FROM broadcast_jobs WHERE id = %s
+        """, (broadcast_id,))
+        job = self.cur.fetchone()
+        if not job:
+            raise ValueError("Broadcast not found")
+        
+        message_id, conversation_id, audience, last_username, status = job
+        if status == 'completed':
+            return self.get_broadcast_status(broadcast_id)
+        
+        audience_sql = self.BROADCAST_AUDIENCES.get(audience, self.BROADCAST_AUDIENCES['all'])
+        
+        self.cur.execute("""
+            UPDATE broadcast_jobs
+            SET status = 'running', started_at = COALESCE(started_at, CURRENT_TIMESTAMP)
+            WHERE id = %s
+        """, (broadcast_id,))
+        self.conn.commit()
+        
+        chunks = 0
+        try:
+            while max_chunks is None or chunks < max_chunks:
+                self.cur.execute(f"""
+                    WITH batch AS (
+                        SELECT username FROM users
+                        WHERE {audience_sql} AND username > %s
+                        ORDER BY username
+                        LIMIT %s
+                    ), participants AS (
+                        INSERT INTO conversation_participants (conversation_id, username)
+                        SELECT %s, username FROM batch
+                        ON CONFLICT (conversation_id, username) DO NOTHING
+                    ), notified AS (
+                        INSERT INTO message_notifications (message_id, recipient_username, notification_type, sent_at)
+                        SELECT %s, username, 'in_app', CURRENT_TIMESTAMP FROM batch
+                        ON CONFLICT (message_id, recipient_username, notification_type) DO NOTHING
+                    )
+                    SELECT COUNT(*), MAX(username) FROM batch
+                """, (last_username or '', self.BROADCAST_CHUNK_SIZE, conversation_id, message_id))
+                count, chunk_last = self.cur.fetchone()
+                chunks += 1
+                
+                if count:
+                    last_username = chunk_last
+                    self.cur.execute("""
+                        UPDATE broadcast_jobs
+                        SET processed_recipients = processed_recipients + %s, last_username = %s
+                        WHERE id = %s
+                    """, (count, last_username, broadcast_id))
+                
+                if count < self.BROADCAST_CHUNK_SIZE:
+                    self.cur.execute("""
+                        UPDATE broadcast_jobs
+                        SET status = 'completed', completed_at = CURRENT_TIMESTAMP
+                        WHERE id = %s
+                    """, (broadcast_id,))
+                    self.conn.commit()
+                    break
+                
+                self.conn.commit()
+        except Exception as e:
+            self.conn.rollback()
+            self.cur.execute("""
+                UPDATE broadcast_jobs SET status = 'failed', error = %s, attempts = attempts + 1 WHERE id = %s
+            """, (str(e)[:500], broadcast_id))
+            self.conn.commit()
+            raise
+        
+        return self.get_broadcast_status(broadcast_id)
+
+    def get_broadcast_status(self, broadcast_id: int) -> Dict[str, Any]:
+        """Progress of a broadcast fan-out (for the admin messaging page)"""
+        self.cur.execute("""
+            SELECT id, message_id, sender_username, recipient_filter, status,
+                   total_recipients, processed_recipients, created_at, started_at,
+                   completed_at, error
+            FROM broadcast_jobs WHERE id = %s
+        """, (broadcast_id,))
+        row = self.cur.fetchone()
+        if not row:
+            raise ValueError("Broadcast not found")
+        
+        total = row[5] or 0
+        processed = row[6] or 0
+        return {
+            'broadcast_id': row[0],
+            'message_id': row[1],
+            'sender': row[2],
+            'recipient_filter': row[3],
+            'status': row[4],
+            'total_recipients': total,
+            'processed_recipients': processed,
+            'progress': round(processed / total, 4) if total else 1.0,
+            'created_at': row[7].isoformat() if row[7] else None,
+            'started_at': row[8].isoformat() if row[8] else None,
+            'completed_at': row[9].isoformat() if row[9] else None,
+            'error': row[10]
+        }
     
     # ==================== MESSAGE RETRIEVAL ====================
     
@@ -378,7 +545,8 @@ class MessageService:
             'total_pages': (total + limit - 1) // limit
         }
     
-    def get_conversation(self, recipient_username: str, limit: int = 50) -> Dict[str, Any]:
+    def get_conversation(self, recipient_username: str, limit: int = 50,
+                         before_id: int = None, after_id: int = None) -> Dict[str, Any]:
         """Get conversation with a specific user (by username)"""
         if not self.username:
             raise ValueError("Authentication required")
@@ -405,13 +573,17 @@ class MessageService:
             return {
                 'messages': [],
                 'with_user': recipient_username,
-                'participant_count': 2
+                'participant_count': 2,
+                'has_more': False,
+                'next_before_id': None,
+                'latest_id': after_id
             }
 
         conversation_id = conv_result[0]
 
         # Get messages using get_conversation_thread
-        thread = self.get_conversation_thread(conversation_id, limit)
+        thread = self.get_conversation_thread(conversation_id, limit,
+                                              before_id=before_id, after_id=after_id)
 
         # Add with_user field for frontend
         thread['with_user'] = recipient_username
@@ -419,8 +591,26 @@ class MessageService:
 
         return thread
 
-    def get_conversation_thread(self, conversation_id: int, limit: int = 50) -> Dict[str, Any]:
-        """Get full conversation thread"""
+    def get_conversation_thread(self, conversation_id: int, limit: int = 50,
+                                before_id: int = None, after_id: int = None) -> Dict[str, Any]:
+        """
+        Get a page of a conversation thread, newest page first.
+
+        Pages are keyed on (sent_at, id) so they stay stable while new
+        messages arrive:
+          - no cursor: the newest `limit` messages
+          - before_id: the `limit` messages immediately older than before_id
+          - after_id: every message newer than after_id (delta refresh),
+            capped at `limit`
+
+        Messages are always returned oldest-first for rendering. Loading the
+        newest page or a delta marks every unread, visible message addressed
+        to the user in this conversation as read with a single UPDATE
+        (scheduled and draft messages stay unread until delivered).
+
+        Returns: {conversation_id, messages, message_count, has_more,
+                  next_before_id, latest_id, marked_read}
+        """
         if not self.username:
             raise ValueError("Authentication required")
 
@@ -436,24 +626,40 @@ class MessageService:
         if not access:
             raise ValueError("Access denied")
 
-        # Get messages
-        self.cur.execute("""
+        # Scheduled/draft rows are not part of the visible thread until sent
+        base_sql = """
             SELECT id, sender_username, recipient_username, subject, content,
                    is_read, read_at, sent_at, message_type
             FROM messages
             WHERE conversation_id = %s AND deleted_at IS NULL
-            ORDER BY sent_at ASC LIMIT %s
-        """, (conversation_id, limit))
+            AND COALESCE(delivery_status, 'sent') NOT IN ('scheduled', 'draft', 'cancelled')
+        """
 
-        messages = []
-        for row in self.cur.fetchall():
-            # Mark as read if recipient
-            if row[2] == self.username and not row[5]:
-                self.cur.execute("""
-                    UPDATE messages SET is_read = 1, read_at = CURRENT_TIMESTAMP
-                    WHERE id = %s
-                """, (row[0],))
+        # Fetch one extra row to learn whether another page exists
+        if after_id:
+            self.cur.execute(base_sql + """
+                AND (sent_at, id) > (SELECT sent_at, id FROM messages WHERE id = %s)
+                ORDER BY sent_at ASC, id ASC LIMIT %s
+            """, (conversation_id, after_id, limit + 1))
+            rows = self.cur.fetchall()
+            has_more = len(rows) > limit
+            rows = rows[:limit]
+        else:
+            if before_id:
+                self.cur.execute(base_sql + """
+                    AND (sent_at, id) < (SELECT sent_at, id FROM messages WHERE id = %s)
+                    ORDER BY sent_at DESC, id DESC LIMIT %s
+                """, (conversation_id, before_id, limit + 1))
+            else:
+                self.cur.execute(base_sql + """
+                    ORDER BY sent_at DESC, id DESC LIMIT %s
+                """, (conversation_id, limit + 1))
+            rows = self.cur.fetchall()
+            has_more = len(rows) > limit
+            rows = list(reversed(rows[:limit]))
 
+        messages = []
+        for row in rows:
             messages.append({
                 'id': row[0],
                 'sender': row[1],
@@ -466,12 +672,35 @@ class MessageService:
                 'message_type': row[8]
             })
 
+        # Bulk read receipt: one set-based update instead of one per row.
+        # Older pages were already covered when the newest page was read.
+        marked_read = 0
+        if not before_id:
+            self.cur.execute("""
+                UPDATE messages SET is_read = 1, read_at = CURRENT_TIMESTAMP
+                WHERE conversation_id = %s AND recipient_username = %s
+                AND is_read = 0 AND deleted_at IS NULL
+                AND COALESCE(delivery_status, 'sent') NOT IN ('scheduled', 'draft', 'cancelled')
+            """, (conversation_id, self.username))
+            marked_read = max(getattr(self.cur, 'rowcount', 0) or 0, 0)
+
         self.conn.commit()
 
+        if after_id:
+            next_before_id = None
+            latest_id = messages[-1]['id'] if messages else after_id
+        else:
+            next_before_id = messages[0]['id'] if (messages and has_more) else None
+            latest_id = messages[-1]['id'] if messages else None
+
         return {
             'conversation_id': conversation_id,
             'messages': messages,
-            'message_count': len(messages)
+            'message_count': len(messages),
+            'has_more': has_more,
+            'next_before_id': next_before_id,
+            'latest_id': latest_id,
+            'marked_read': marked_read
         }
     
     def get_sent_messages(self, limit: int = 100) -> List[Dict[str, Any]]:
@@ -768,15 +997,76 @@ class MessageService:
         
         messages = []
         for row in self.cur.fetchall():
+            content = self._decrypt(row[3]) or ''
             messages.append({
                 'message_id': row[0],
                 'recipient': row[1],
                 'subject': row[2],
-                'preview': row[3][:100] + '...' if len(row[3]) > 100 else row[3],
+                'preview': content[:100] + '...' if len(content) > 100 else content,
                 'scheduled_for': row[4].isoformat() if row[4] else None
             })
         
         return messages
+
+    def update_scheduled_message(self, message_id: int, scheduled_for: datetime = None,
+                                 content: str = None, subject: str = None) -> Dict[str, Any]:
+        """
+        Edit a message that has not been dispatched yet.
+        The delivery_status guard means a row already claimed by the
+        dispatcher (message_dispatcher.py) is never modified.
+        """
+        if not self.username:
+            raise ValueError("Authentication required")
+
+        if scheduled_for is not None and scheduled_for <= self.now:
+            raise ValueError("Scheduled time must be in the future")
+
+        if content is not None:
+            if not content:
+                raise ValueError("Content cannot be empty")
+            if len(content) > self.MAX_MESSAGE_LENGTH:
+                raise ValueError(f"Message exceeds {self.MAX_MESSAGE_LENGTH} characters")
+
+        self.cur.execute("""
+            UPDATE messages
+            SET scheduled_for = COALESCE(%s, scheduled_for),
+                content = COALESCE(%s, content),
+                subject = COALESCE(%s, subject),
+                updated_at = CURRENT_TIMESTAMP
+            WHERE id = %s AND sender_username = %s AND delivery_status = 'scheduled'
+            RETURNING updated_at
+        """, (scheduled_for, self._encrypt(content) if content is not None else None,
+              subject, message_id, self.username))
+
+        result = self.cur.fetchone()
+        if not result:
+            raise ValueError("Scheduled message not found or already sent")
+
+        self.conn.commit()
+
+        return {
+            'message_id': message_id,
+            'updated_at': result[0].isoformat() if result[0] else None
+        }
+
+    def cancel_scheduled_message(self, message_id: int) -> Dict[str, Any]:
+        """Cancel a message that has not been dispatched yet"""
+        if not self.username:
+            raise ValueError("Authentication required")
+
+        self.cur.execute("""
+            UPDATE messages
+            SET delivery_status = 'cancelled', updated_at = CURRENT_TIMESTAMP
+            WHERE id = %s AND sender_username = %s AND delivery_status = 'scheduled'
+            RETURNING id
+        """, (message_id, self.username))
+
+        if not self.cur.fetchone():
+            raise ValueError("Scheduled message not found or already sent")
+
+        self.conn.commit()
+
+        return {'message_id': message_id, 'status': 'cancelled'}
     
     # ==================== USER BLOCKING ====================
     
@@ -918,6 +1208,7 @@ class MessageService:
         self.cur.execute("""
             INSERT INTO message_notifications (message_id, recipient_username, notification_type, sent_at)
             VALUES (%s, %s, %s, CURRENT_TIMESTAMP)
+            ON CONFLICT (message_id, recipient_username, notification_type) DO NOTHING
         """, (message_id, recipient_username, notification_type))
     
     def mark_conversation_as_read(self, other_username: str) -> None:
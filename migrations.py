@@ -0,0 +1,426 @@
+#!/usr/bin/env python3
+"""
+Schema Migrations - versioned schema changes applied once, as a release step.
+
+Workers used to run init_db() (plus the CBT and pet schema helpers) from a
+before_request hook, so every worker start did ~1,600 lines of DDL inside
+the first user request it served. Now each change is a numbered migration,
+the versions applied are recorded in schema_version, and the deploy runs
+this script before new workers start:
+
+    python migrations.py            # apply pending migrations
+    python migrations.py --status   # list applied / pending
+
+Migration 1 is the historical init_db() schema, which is idempotent and so
+safe to record against an existing database. New schema changes are added
+here as the next version, not to init_db().
+
+A migration receives the runner's connection. It may commit itself (the
+baseline does), but normally it does not, and its DDL commits atomically
+with its schema_version row. Migrations registered with
+transactional=False run in autocommit mode, for CREATE INDEX CONCURRENTLY
+on live tables.
+"""
+
+import argparse
+import os
+import sys
+from typing import Callable, NamedTuple
+
+import psycopg2
+
+# pg_advisory_lock key: concurrent release steps apply migrations one at a time
+MIGRATION_LOCK_ID = 20260044
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    apply: Callable
+    transactional: bool = True
+
+
+MIGRATIONS = []  # in version order
+
+
+def migration(version, name, transactional=True):
+    def register(fn):
+        if MIGRATIONS and version <= MIGRATIONS[-1].version:
+            raise ValueError(f"Migration {version} registered out of order")
+        MIGRATIONS.append(Migration(version, name, fn, transactional))
+        return fn
+    return register
+
+
+def get_db_connection():
+    """Dedicated connection: the runner holds a session-level advisory lock"""
+    database_url = os.getenv('DATABASE_URL')
+    if database_url:
+        return psycopg2.connect(database_url)
+    return psycopg2.connect(host=os.getenv('DB_HOST'), port=int(os.getenv('DB_PORT', '5432')),
+                            database=os.getenv('DB_NAME'), user=os.getenv('DB_USER'),
+                            password=os.getenv('DB_PASSWORD'))
+
+
+def applied_versions(cur):
+    """Versions recorded in schema_version (none if the table does not exist yet)"""
+    cur.execute("SELECT to_regclass('schema_version') IS NOT NULL")
+    if not cur.fetchone()[0]:
+        return set()
+    cur.execute("SELECT version FROM schema_version")
+    return {row[0] for row in cur.fetchall()}
+
+
+def pending_migrations(cur):
+    applied = applied_versions(cur)
+    return [m for m in MIGRATIONS if m.version not in applied]
+
+
+def migrate(conn=None, log=print):
+    """Apply every pending migration in order; returns the versions applied"""
+    own_conn = conn is None
+    conn = conn or get_db_connection()
+    cur = conn.cursor()
+    applied = []
+    try:
+        cur.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_ID,))
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        conn.commit()
+
+        # Read under the lock: another release step may have just applied some
+        for m in pending_migrations(cur):
+            log(f"Applying migration {m.version}: {m.name}")
+            conn.commit()
+            try:
+                conn.autocommit = not m.transactional
+                try:
+                    m.apply(conn)
+                finally:
+                    conn.autocommit = False
+                cur.execute("INSERT INTO schema_version (version, name) VALUES (%s, %s)", (m.version, m.name))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            applied.append(m.version)
+        return applied
+    finally:
+        try:
+            cur.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_ID,))
+            conn.commit()
+        except Exception:
+            pass
+        if own_conn:
+            conn.close()
+
+
+def create_index_concurrently(cur, name, definition, unique=False):
+    """CREATE [UNIQUE] INDEX CONCURRENTLY, rebuilding an INVALID index left by an interrupted run"""
+    cur.execute("""
+        SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE c.relname = %s
+    """, (name,))
+    row = cur.fetchone()
+    if row and row[0]:
+        return
+    if row:
+        cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+    cur.execute(f"CREATE {'UNIQUE ' if unique else ''}INDEX CONCURRENTLY IF NOT EXISTS {name} ON {definition}")
+
+
+# ==================== MIGRATIONS ====================
+
+@migration(1, 'baseline schema (init_db, CBT tools, pet)')
+def baseline(conn):
+    import api
+    if not api.init_db():
+        raise RuntimeError("init_db failed; see the migration notes above")
+    if 'init_cbt_tools_schema' in vars(api):
+        api.init_cbt_tools_schema()
+    api.ensure_pet_table()
+
+
+@migration(2, 'safeguarding concerns and duty clinician rota')
+def safeguarding_tables(conn):
+    # Previously sat after init_db()'s return statement and never ran
+    cur = conn.cursor()
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS safeguarding_concerns (
+            id                        SERIAL PRIMARY KEY,
+            patient_username          TEXT NOT NULL,
+            recording_clinician       TEXT NOT NULL,
+            duty_clinician_username   TEXT,
+            concern_category          TEXT NOT NULL,
+            statutory_framework       TEXT,
+            disclosure_method         TEXT NOT NULL DEFAULT 'clinician_observed',
+            disclosure_date           DATE NOT NULL DEFAULT CURRENT_DATE,
+            description               TEXT NOT NULL,
+            immediate_risk            BOOLEAN NOT NULL DEFAULT FALSE,
+            immediate_action_taken    TEXT,
+            patient_under_18          BOOLEAN DEFAULT FALSE,
+            gillick_competent         BOOLEAN,
+            capacity_assessed         BOOLEAN DEFAULT FALSE,
+            capacity_assessment_notes TEXT,
+            referral_required         BOOLEAN DEFAULT FALSE,
+            referral_agency           TEXT,
+            referral_made_at          TIMESTAMP,
+            referral_reference        TEXT,
+            referral_notes            TEXT,
+            supervisor_consulted      BOOLEAN DEFAULT FALSE,
+            supervisor_username       TEXT,
+            supervisor_notes          TEXT,
+            status                    TEXT NOT NULL DEFAULT 'open',
+            closed_at                 TIMESTAMP,
+            closed_by                 TEXT,
+            closure_notes             TEXT,
+            created_at                TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at                TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            CONSTRAINT valid_sg_status CHECK (status IN ('open','referred','monitoring','closed'))
+        )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_sg_patient ON safeguarding_concerns(patient_username)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_sg_clinician ON safeguarding_concerns(recording_clinician)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_sg_status ON safeguarding_concerns(status)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_sg_immediate ON safeguarding_concerns(immediate_risk) WHERE immediate_risk = TRUE")
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS duty_clinician (
+            id                  SERIAL PRIMARY KEY,
+            clinician_username  TEXT NOT NULL,
+            duty_date           DATE NOT NULL,
+            duty_start          TIME NOT NULL DEFAULT '08:00',
+            duty_end            TIME NOT NULL DEFAULT '18:00',
+            is_out_of_hours     BOOLEAN DEFAULT FALSE,
+            contact_phone       TEXT,
+            notes               TEXT,
+            created_by          TEXT,
+            created_at          TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(duty_date, is_out_of_hours)
+        )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_duty_date ON duty_clinician(duty_date)")
+
+
+# Composite indexes matching the hot queries' filter + sort columns
+# (tests/backend/test_query_plans.py EXPLAINs each query against them)
+HOT_QUERY_INDEXES = [
+    ('idx_mood_logs_user_time', 'mood_logs (username, entrestamp DESC)'),
+    ('idx_clinical_scales_user_scale_time', 'clinical_scales (username, scale_name, entry_timestamp DESC)'),
+    ('idx_chat_history_chat_session_time', 'chat_history (chat_session_id, timestamp)'),
+    ('idx_chat_history_session_time', 'chat_history (session_id, timestamp)'),
+    ('idx_risk_alerts_patient_ack', 'risk_alerts (patient_username, acknowledged)'),
+    ('idx_risk_assessments_patient_time', 'risk_assessments (patient_username, assessed_at DESC)'),
+]
+
+# Single-column indexes that are now a prefix of a composite above
+SUPERSEDED_INDEXES = [
+    'idx_mood_logs_username',
+    'idx_clinical_scales_username',
+    'idx_risk_alerts_patient',
+    'idx_risk_patient',
+]
+
+
+@migration(3, 'composite indexes for hot queries', transactional=False)
+def hot_query_indexes(conn):
+    cur = conn.cursor()
+
+    # Queries use mood_logs.entrestamp (production was renamed by fix_production_database.py),
+    # but fresh databases were still created with entry_timestamp
+    cur.execute("""
+        SELECT column_name FROM information_schema.columns
+        WHERE table_name = 'mood_logs' AND column_name IN ('entrestamp', 'entry_timestamp')
+    """)
+    columns = {row[0] for row in cur.fetchall()}
+    if columns == {'entry_timestamp'}:
+        cur.execute("ALTER TABLE mood_logs RENAME COLUMN entry_timestamp TO entrestamp")
+    elif columns == {'entrestamp', 'entry_timestamp'}:
+        cur.execute("UPDATE mood_logs SET entrestamp = entry_timestamp WHERE entrestamp IS NULL")
+
+    for name, definition in HOT_QUERY_INDEXES:
+        create_index_concurrently(cur, name, definition)
+    for name in SUPERSEDED_INDEXES:
+        cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+
+
+@migration(4, 'monthly partitions for append-only tables')
+def partition_append_only_tables(conn):
+    import partitions
+    cur = conn.cursor()
+    for table, policy in partitions.PARTITIONED_TABLES.items():
+        partitions.partition_table(cur, table, policy)
+
+
+@migration(5, 'chat_history surrogate id for keyset pagination')
+def chat_history_ids(conn):
+    import partitions
+    cur = conn.cursor()
+    cur.execute("CREATE SEQUENCE IF NOT EXISTS chat_history_id_seq AS BIGINT")
+    cur.execute("ALTER TABLE chat_history ADD COLUMN IF NOT EXISTS id BIGINT")
+
+    # Number existing rows in timestamp order, so id order is chronological order
+    cur.execute("""
+        UPDATE chat_history h SET id = n.base + n.rn
+        FROM (
+            SELECT tableoid, ctid, row_number() OVER (ORDER BY timestamp, ctid) AS rn,
+                   (SELECT COALESCE(MAX(id), 0) FROM chat_history) AS base
+            FROM chat_history WHERE id IS NULL
+        ) n
+        WHERE h.tableoid = n.tableoid AND h.ctid = n.ctid
+    """)
+    cur.execute("SELECT setval('chat_history_id_seq', (SELECT COALESCE(MAX(id), 0) + 1 FROM chat_history), false)")
+    cur.execute("ALTER TABLE chat_history ALTER COLUMN id SET DEFAULT nextval('chat_history_id_seq')")
+    cur.execute("ALTER TABLE chat_history ALTER COLUMN id SET NOT NULL")
+    cur.execute("ALTER SEQUENCE chat_history_id_seq OWNED BY chat_history.id")
+
+    # A partitioned table's primary key must include the partition column
+    if partitions.is_partitioned(cur, 'chat_history'):
+        cur.execute('ALTER TABLE chat_history ADD PRIMARY KEY (id, "timestamp")')
+    else:
+        cur.execute("ALTER TABLE chat_history ADD PRIMARY KEY (id)")
+
+    # Per-session history pages and deltas walk these; they replace the timestamp ordering
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_chat_history_chat_session_id ON chat_history (chat_session_id, id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_chat_history_session_id ON chat_history (session_id, id)")
+    cur.execute("DROP INDEX IF EXISTS idx_chat_history_chat_session_time")
+
+
+# Per-user timestamp indexes for the date-range filters (date_range.py) used by
+# insights, clinical summary exports and reports
+DATE_RANGE_INDEXES = [
+    ('idx_gratitude_logs_user_time', 'gratitude_logs (username, entry_timestamp DESC)'),
+    ('idx_cbt_records_user_time', 'cbt_records (username, entry_timestamp DESC)'),
+    ('idx_alerts_user_time', 'alerts (username, created_at DESC)'),
+]
+
+
+@migration(6, 'per-user timestamp indexes for date-range filters', transactional=False)
+def date_range_indexes(conn):
+    cur = conn.cursor()
+    for name, definition in DATE_RANGE_INDEXES:
+        create_index_concurrently(cur, name, definition)
+    cur.execute("DROP INDEX CONCURRENTLY IF EXISTS idx_alerts_username")
+
+
+@migration(7, 'request metrics shared by web workers')
+def request_metrics_tables(conn):
+    # UNLOGGED like rate_limits: cheap to update, and losing them in a crash
+    # only resets the counters, which Prometheus handles
+    cur = conn.cursor()
+    cur.execute("""
+        CREATE UNLOGGED TABLE IF NOT EXISTS request_metrics (
+            endpoint        TEXT NOT NULL,
+            method          TEXT NOT NULL,
+            requests        BIGINT NOT NULL DEFAULT 0,
+            errors          BIGINT NOT NULL DEFAULT 0,
+            duration_sum    DOUBLE PRECISION NOT NULL DEFAULT 0,
+            response_bytes  BIGINT NOT NULL DEFAULT 0,
+            buckets         BIGINT[] NOT NULL,
+            updated_at      TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (endpoint, method)
+        )
+    """)
+    cur.execute("""
+        CREATE UNLOGGED TABLE IF NOT EXISTS request_metrics_workers (
+            worker      TEXT PRIMARY KEY,
+            in_flight   INTEGER NOT NULL DEFAULT 0,
+            updated_at  TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+
+
+@migration(8, 'SQL profiler offenders')
+def sql_profile_offenders_table(conn):
+    # One row per endpoint, upserted by PostgresProfileStore when a profiled
+    # request breaks the query budget or repeats a statement (sql_profiler.py)
+    conn.cursor().execute("""
+        CREATE UNLOGGED TABLE IF NOT EXISTS sql_profile_offenders (
+            endpoint             TEXT NOT NULL,
+            method               TEXT NOT NULL,
+            flagged_requests     BIGINT NOT NULL DEFAULT 0,
+            n_plus_one_requests  BIGINT NOT NULL DEFAULT 0,
+            max_queries          INTEGER NOT NULL DEFAULT 0,
+            last_queries         INTEGER NOT NULL DEFAULT 0,
+            max_repeats          INTEGER NOT NULL DEFAULT 0,
+            repeated_sql         TEXT,
+            max_sql_ms           DOUBLE PRECISION NOT NULL DEFAULT 0,
+            last_seen            TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (endpoint, method)
+        )
+    """)
+
+
+@migration(9, 'broadcast retries and one notification per recipient', transactional=False)
+def broadcast_fan_out_dedupe(conn):
+    cur = conn.cursor()
+    cur.execute("ALTER TABLE broadcast_jobs ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 0")
+
+    # Concurrent fan-outs of the same broadcast could notify a recipient twice
+    cur.execute("""
+        DELETE FROM message_notifications a
+        USING message_notifications b
+        WHERE a.message_id = b.message_id
+          AND a.recipient_username = b.recipient_username
+          AND a.notification_type IS NOT DISTINCT FROM b.notification_type
+          AND a.id > b.id
+    """)
+    create_index_concurrently(cur, 'uq_message_notifications_recipient',
+                              'message_notifications (message_id, recipient_username, notification_type)',
+                              unique=True)
+    # Leading column of the unique index
+    cur.execute("DROP INDEX CONCURRENTLY IF EXISTS idx_message_notifications_message")
+
+
+@migration(10, 'research export participants per dataset')
+def research_export_participants_table(conn):
+    # Who each research dataset has been exported for (research_export.py):
+    # new consents are backfilled, withdrawals removed from published parts
+    conn.cursor().execute("""
+        CREATE TABLE IF NOT EXISTS research_export_participants (
+            dataset          VARCHAR(50) NOT NULL,
+            participant_id   TEXT NOT NULL,
+            first_exported_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (dataset, participant_id)
+        )
+    """)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Apply Healing Space schema migrations')
+    parser.add_argument('--status', action='store_true', help='list applied and pending migrations')
+    args = parser.parse_args(argv)
+
+    if args.status:
+        conn = get_db_connection()
+        try:
+            applied = applied_versions(conn.cursor())
+        finally:
+            conn.close()
+        for m in MIGRATIONS:
+            print(f"{m.version:>4}  {'applied' if m.version in applied else 'PENDING':<8} {m.name}")
+        return 0
+
+    try:
+        applied = migrate()
+    except Exception as e:
+        print(f"Migration failed: {e}")
+        return 1
+    print(f"Applied {len(applied)} migration(s)" if applied else "Schema is up to date")
+
+    # Each release also tops up monthly partitions (the partitions worker does it daily)
+    import partitions
+    conn = get_db_connection()
+    try:
+        partitions.maintain(conn)
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
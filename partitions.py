@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+"""
+Partitions - monthly range partitioning and retention for append-only tables.
+
+chat_history, ai_activity_log, ai_memory_events, audit_logs and
+notifications only ever grow. The app reads them by recent time window
+(the last 24 hours, 7 days or 30 days). Migration 4 turns each one into
+a table partitioned by month on its timestamp column:
+
+  - <table>_legacy     every row from before the month of the migration
+                       (the original table, attached without rewriting it)
+  - <table>_pYYYY_MM   one partition per month, made PREMAKE_MONTHS ahead
+  - <table>_default    a safety net so inserts never fail if maintenance
+                       falls behind; its rows move into the month's
+                       partition once that partition is created
+
+Window queries then touch only the partitions that overlap the window.
+Retention detaches whole partitions once their month is older than the
+table's retention. Clinical and audit records are moved to the `archive`
+schema, never dropped. Operational logs are dropped.
+
+Retention can be configured per table with <TABLE>_RETENTION_MONTHS
+(0 = keep everything in the live table).
+
+    python partitions.py                # create upcoming partitions, apply retention
+    python partitions.py --dry-run      # show what retention would do
+    python partitions.py --every 86400  # run as a daily worker
+"""
+
+import argparse
+import os
+import re
+import sys
+import time
+from datetime import date, datetime
+from typing import NamedTuple, Optional
+
+import psycopg2
+
+PREMAKE_MONTHS = 3
+ARCHIVE_SCHEMA = 'archive'
+
+
+class PartitionPolicy(NamedTuple):
+    column: str
+    retention_months: int   # months kept in the live table (0 = forever)
+    clinical: bool          # clinical/audit record: archive, never drop
+
+
+def _retention(table, default):
+    return int(os.getenv(f'{table.upper()}_RETENTION_MONTHS', default))
+
+
+PARTITIONED_TABLES = {
+    # Therapy transcripts and the audit trail are records: moved out of the live
+    # table after two years, but kept (archive schema)
+    'chat_history': PartitionPolicy('timestamp', _retention('chat_history', 24), clinical=True),
+    'audit_logs': PartitionPolicy('timestamp', _retention('audit_logs', 24), clinical=True),
+    # AI memory is derived from the transcripts and regenerated from them
+    'ai_memory_events': PartitionPolicy('event_timestamp', _retention('ai_memory_events', 24), clinical=False),
+    'ai_activity_log': PartitionPolicy('activity_timestamp', _retention('ai_activity_log', 13), clinical=False),
+    'notifications': PartitionPolicy('created_at', _retention('notifications', 6), clinical=False),
+}
+
+
+def get_db_connection():
+    database_url = os.getenv('DATABASE_URL')
+    if database_url:
+        return psycopg2.connect(database_url)
+    return psycopg2.connect(host=os.getenv('DB_HOST'), port=int(os.getenv('DB_PORT', '5432')),
+                            database=os.getenv('DB_NAME'), user=os.getenv('DB_USER'),
+                            password=os.getenv('DB_PASSWORD'))
+
+
+# ==================== MONTHS ====================
+
+def month_start(d) -> date:
+    return date(d.year, d.month, 1)
+
+
+def add_months(d: date, months: int) -> date:
+    index = d.year * 12 + d.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(table, month: date) -> str:
+    return f"{table}_p{month.year:04d}_{month.month:02d}"
+
+
+_UPPER_BOUND = re.compile(r"TO \('([^']+)'\)")
+
+
+def upper_bound(bound_expr) -> Optional[datetime]:
+    """Upper bound of a range partition from pg_get_expr(relpartbound) (None for DEFAULT)"""
+    match = _UPPER_BOUND.search(bound_expr or '')
+    return datetime.fromisoformat(match.group(1)) if match else None
+
+
+# ==================== CATALOG ====================
+
+def is_partitioned(cur, table) -> bool:
+    cur.execute("""
+        SELECT c.relkind = 'p' FROM pg_class c
+        WHERE c.relname = %s AND c.relnamespace = 'public'::regnamespace
+    """, (table,))
+    row = cur.fetchone()
+    return bool(row and row[0])
+
+
+def list_partitions(cur, table):
+    """[(partition name, upper bound or None)] for table's attached partitions"""
+    cur.execute("""
+        SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        JOIN pg_class p ON p.oid = i.inhparent
+        WHERE p.relname = %s AND p.relnamespace = 'public'::regnamespace
+        ORDER BY c.relname
+    """, (table,))
+    return [(name, upper_bound(bound)) for name, bound in cur.fetchall()]
+
+
+# ==================== CONVERSION (migration 4) ====================
+
+def partition_table(cur, table, policy: PartitionPolicy, today=None):
+    """
+    Swap an ordinary table for a monthly-partitioned one with the same name.
+
+    The original becomes <table>_legacy, covering everything before this
+    month. A CHECK constraint is validated first, so attaching it does not
+    rescan it under an exclusive lock. Rows from this month move into
+    this month's partition.
+    """
+    if is_partitioned(cur, table):
+        return False
+    column = policy.column
+    legacy = f"{table}_legacy"
+    this_month = month_start(today or date.today())
+
+    # Index and foreign-key definitions to recreate on the partitioned parent
+    cur.execute("""
+        SELECT i.relname, pg_get_indexdef(i.oid), x.indisunique
+        FROM pg_index x JOIN pg_class i ON i.oid = x.indexrelid
+        WHERE x.indrelid = %s::regclass
+    """, (table,))
+    indexes = cur.fetchall()
+    cur.execute("""
+        SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint
+        WHERE conrelid = %s::regclass AND contype = 'f'
+    """, (table,))
+    foreign_keys = cur.fetchall()
+    cur.execute("""
+        SELECT a.attname FROM pg_index x
+        JOIN pg_attribute a ON a.attrelid = x.indrelid AND a.attnum = ANY(x.indkey)
+        WHERE x.indrelid = %s::regclass AND x.indisprimary
+    """, (table,))
+    primary_key = [row[0] for row in cur.fetchall()]
+
+    cur.execute(f'ALTER TABLE {table} RENAME TO {legacy}')
+    for name, _, _ in indexes:
+        cur.execute(f'ALTER INDEX {name} RENAME TO {name}_legacy')
+
+    # The partition key must be NOT NULL; rows that never had a time sort first
+    cur.execute(f'UPDATE {legacy} SET "{column}" = %s WHERE "{column}" IS NULL', (datetime(1970, 1, 1),))
+    cur.execute(f"""
+        ALTER TABLE {legacy} ADD CONSTRAINT {legacy}_bound
+        CHECK ("{column}" IS NOT NULL AND "{column}" < %s) NOT VALID
+    """, (this_month,))
+
+    cur.execute(f"""
+        CREATE TABLE {table} (LIKE {legacy} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)
+        PARTITION BY RANGE ("{column}")
+    """)
+    cur.execute(f'ALTER TABLE {table} DROP CONSTRAINT {legacy}_bound')
+    cur.execute(f'ALTER TABLE {table} ALTER COLUMN "{column}" SET NOT NULL')
+    if primary_key:
+        # Sequences belonged to the legacy table; keep them when it is archived or dropped
+        for pk_column in primary_key:
+            cur.execute("SELECT pg_get_serial_sequence(%s, %s)", (legacy, pk_column))
+            sequence = cur.fetchone()[0]
+            if sequence:
+                cur.execute(f'ALTER SEQUENCE {sequence} OWNED BY {table}."{pk_column}"')
+
+    # This month's rows (and any dated in the future) move out; the rest stay in place
+    cur.execute(f"""
+        CREATE TABLE {partition_name(table, this_month)} PARTITION OF {table}
+        FOR VALUES FROM (%s) TO (%s)
+    """, (this_month, add_months(this_month, 1)))
+    cur.execute(f'CREATE TABLE {table}_default PARTITION OF {table} DEFAULT')
+    cur.execute(f"""
+        WITH moved AS (DELETE FROM {legacy} WHERE "{column}" >= %s RETURNING *)
+        INSERT INTO {table} SELECT * FROM moved
+    """, (this_month,))
+    cur.execute(f'ALTER TABLE {legacy} VALIDATE CONSTRAINT {legacy}_bound')
+    cur.execute(f'ALTER TABLE {legacy} ALTER COLUMN "{column}" SET NOT NULL')
+    cur.execute(f"ALTER TABLE {table} ATTACH PARTITION {legacy} FOR VALUES FROM (MINVALUE) TO (%s)", (this_month,))
+
+    # Parent indexes adopt the legacy table's equivalents instead of rebuilding them
+    if primary_key:
+        key = ', '.join(f'"{c}"' for c in primary_key if c != column) + f', "{column}"'
+        cur.execute(f'ALTER TABLE {table} ADD PRIMARY KEY ({key})')
+    for name, definition, unique in indexes:
+        if unique:
+            continue  # unique indexes must include the partition key; the primary key is rebuilt above
+        cur.execute(definition)  # captured before the rename, so it names the new parent
+    for name, definition in foreign_keys:
+        cur.execute(f'ALTER TABLE {table} ADD CONSTRAINT {name} {definition}')
+
+    ensure_partitions(cur, table, today=today)
+    return True
+
+
+# ==================== MAINTENANCE ====================
+
+def ensure_partitions(cur, table, today=None, ahead=PREMAKE_MONTHS):
+    """Create this month's and the next `ahead` months' partitions; returns those created"""
+    policy = PARTITIONED_TABLES[table]
+    column = policy.column
+    existing = {name for name, _ in list_partitions(cur, table)}
+    created = []
+    this_month = month_start(today or date.today())
+    for offset in range(ahead + 1):
+        month = add_months(this_month, offset)
+        name = partition_name(table, month)
+        if name in existing:
+            continue
+        bounds = (month, add_months(month, 1))
+        # Rows that landed in the default partition for this month must move first,
+        # or the attach fails
+        cur.execute(f'CREATE TABLE {name} (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)')
+        cur.execute(f"""
+            WITH moved AS (
+                DELETE FROM {table}_default WHERE "{column}" >= %s AND "{column}" < %s RETURNING *
+            )
+            INSERT INTO {name} SELECT * FROM moved
+        """, bounds)
+        cur.execute(f'ALTER TABLE {table} ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s)', bounds)
+        created.append(name)
+    return created
+
+
+def apply_retention(cur, table, today=None, dry_run=False):
+    """Detach partitions older than the retention window; archive or drop them"""
+    policy = PARTITIONED_TABLES[table]
+    if not policy.retention_months:
+        return []
+    cutoff = datetime.combine(add_months(month_start(today or date.today()), -policy.retention_months),
+                              datetime.min.time())
+    actions = []
+    for name, upper in list_partitions(cur, table):
+        if upper is None or upper > cutoff:
+            continue
+        action = 'archive' if policy.clinical else 'drop'
+        actions.append((name, action))
+        if dry_run:
+            continue
+        cur.execute(f'ALTER TABLE {table} DETACH PARTITION {name}')
+        if policy.clinical:
+            cur.execute(f'CREATE SCHEMA IF NOT EXISTS {ARCHIVE_SCHEMA}')
+            cur.execute(f'ALTER TABLE {name} SET SCHEMA {ARCHIVE_SCHEMA}')
+        else:
+            cur.execute(f'DROP TABLE {name}')
+    return actions
+
+
+def maintain(conn, today=None, dry_run=False, log=print):
+    """Top up partitions and apply retention for every partitioned table"""
+    summary = {}
+    for table in PARTITIONED_TABLES:
+        cur = conn.cursor()
+        try:
+            if not is_partitioned(cur, table):
+                conn.rollback()
+                continue
+            created = [] if dry_run else ensure_partitions(cur, table, today=today)
+            retired = apply_retention(cur, table, today=today, dry_run=dry_run)
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            log(f"Partition maintenance failed for {table}: {e}")
+            continue
+        summary[table] = {'created': created, 'retired': retired}
+        for name in created:
+            log(f"{table}: created {name}")
+        for name, action in retired:
+            log(f"{table}: {'would ' if dry_run else ''}{action} {name}")
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Create upcoming partitions and apply retention')
+    parser.add_argument('--dry-run', action='store_true', help='report retention actions without applying them')
+    parser.add_argument('--every', type=float, default=0, help='repeat every N seconds')
+    args = parser.parse_args(argv)
+
+    while True:
+        conn = get_db_connection()
+        try:
+            maintain(conn, dry_run=args.dry_run)
+        finally:
+            conn.close()
+        if not args.every:
+            return 0
+        time.sleep(args.every)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,109 @@
+"""
+Principal Cache - per-worker cache of who a session user is.
+
+get_authenticated_username() used to re-read the user's row on every
+request. The principal (role, clinician assignment) changes rarely, so each
+worker keeps it for a short TTL. Writes that change it - account deletion,
+password changes, clinician assignment - call notify() in the same
+transaction; every worker LISTENs and evicts the entry once the change
+commits. The TTL bounds staleness if a notification is missed.
+"""
+
+import os
+import select
+import threading
+import time
+from typing import NamedTuple, Optional
+
+import psycopg2
+
+PRINCIPAL_CHANNEL = 'principal_invalidate'
+PRINCIPAL_CACHE_TTL = int(os.getenv('PRINCIPAL_CACHE_TTL', '30'))
+PRINCIPAL_CACHE_MAX = 20000
+
+# notify() payload that evicts every entry
+ALL_PRINCIPALS = '*'
+
+
+class Principal(NamedTuple):
+    username: str
+    role: str
+    clinician_id: Optional[str]
+
+
+def _listen_connection():
+    """Dedicated connection for LISTEN (the request pool's connections are borrowed)."""
+    database_url = os.getenv('DATABASE_URL')
+    if database_url:
+        return psycopg2.connect(database_url)
+    return psycopg2.connect(host=os.getenv('DB_HOST'), port=int(os.getenv('DB_PORT', '5432')),
+                            database=os.getenv('DB_NAME'), user=os.getenv('DB_USER'),
+                            password=os.getenv('DB_PASSWORD'))
+
+
+class PrincipalCache:
+
+    def __init__(self, ttl=PRINCIPAL_CACHE_TTL, listen=True):
+        self.ttl = ttl
+        self.listen = listen
+        self._entries = {}  # username -> (Principal, expires_at)
+        self._lock = threading.Lock()
+        self.generation = 0  # bumped on every invalidation
+        self._listener_pid = None
+
+    def get(self, username) -> Optional[Principal]:
+        self._ensure_listener()
+        cached = self._entries.get(username)
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
+        return None
+
+    def put(self, principal: Principal, generation=None):
+        with self._lock:
+            # An invalidation that landed mid-query means the row we read may be stale
+            if generation is not None and generation != self.generation:
+                return
+            if len(self._entries) >= PRINCIPAL_CACHE_MAX:
+                self._entries.clear()
+            self._entries[principal.username] = (principal, time.monotonic() + self.ttl)
+
+    def invalidate(self, username=None):
+        """Drop one cached principal (or all of them if username is None)"""
+        with self._lock:
+            self.generation += 1
+            if username is None or username == ALL_PRINCIPALS:
+                self._entries.clear()
+            else:
+                self._entries.pop(username, None)
+
+    def notify(self, cur, username=ALL_PRINCIPALS):
+        """Evict username here now and, once the caller commits, in every worker"""
+        self.invalidate(username)
+        cur.execute('SELECT pg_notify(%s, %s)', (PRINCIPAL_CHANNEL, username))
+
+    def _ensure_listener(self):
+        """Start this worker's invalidation listener (once per process, after fork)"""
+        if not self.listen or self._listener_pid == os.getpid():
+            return
+        if not (os.getenv('DATABASE_URL') or os.getenv('DB_HOST')):
+            return
+        self._listener_pid = os.getpid()
+        threading.Thread(target=self._listen_for_changes, name='principal-listener', daemon=True).start()
+
+    def _listen_for_changes(self, poll_interval=30):
+        """Evict principals as workers NOTIFY changes; reconnect on failure"""
+        while True:
+            try:
+                conn = _listen_connection()
+                conn.autocommit = True
+                conn.cursor().execute(f'LISTEN {PRINCIPAL_CHANNEL}')
+                # Changes made while we were not listening were missed
+                self.invalidate()
+                while True:
+                    if select.select([conn], [], [], poll_interval) != ([], [], []):
+                        conn.poll()
+                        while conn.notifies:
+                            self.invalidate(conn.notifies.pop(0).payload)
+            except Exception as e:
+                print(f"Principal listener error: {e}")
+                time.sleep(poll_interval)
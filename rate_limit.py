@@ -0,0 +1,301 @@
+"""
+Rate Limiting - generic cell-rate (GCRA) limiter.
+
+A limit of max_requests per window is enforced by storing one number per
+key: the theoretical arrival time (TAT) of the next request if the client
+sent at exactly the sustained rate. A request is allowed when it does not
+arrive more than `window` ahead of schedule, which permits a burst of
+max_requests and then one request every window / max_requests seconds.
+Checking is O(1) and the same call returns how long to wait.
+
+An entry is worthless once its TAT has passed, and a TAT is never more than
+`window` in the future. Each limit type therefore keeps two generations of
+entries and drops the older one every `window` seconds, so memory tracks the
+keys seen in the last two windows rather than every request ever made, with
+no sweep to schedule.
+
+GCRALimiter keeps that state per process, so N gunicorn workers would each
+grant the full limit. SharedGCRALimiter keeps the TATs in PostgreSQL instead
+(an UNLOGGED table updated by rate_limit_acquire(), created in init_db) and
+batches its writes: high-volume limits lease several slots per round-trip
+and spend them locally for a second, and a denied key is answered locally
+until its retry time, so a client hammering a limit costs no writes.
+
+Benchmark (constant memory under churn):
+    python rate_limit.py --keys 1000000
+"""
+
+import argparse
+import math
+import os
+import threading
+import time
+from typing import Dict, NamedTuple, Tuple
+
+import psycopg2
+
+# Leased slots not spent within this many seconds are forfeited
+LEASE_SECONDS = 1.0
+# A limit leases max_requests // LEASE_DIVISOR slots per round-trip (login etc. lease one)
+LEASE_DIVISOR = 10
+# Rows whose TAT has passed carry no state; delete them this often
+SWEEP_INTERVAL_SECONDS = 300
+
+
+class RateLimitDecision(NamedTuple):
+    allowed: bool
+    retry_after: float  # seconds until a request would be allowed (0 when allowed)
+
+
+def gcra_acquire(tat, now, interval, window, want=1):
+    """
+    Take up to `want` slots from a key whose TAT is `tat` (None if unseen).
+
+    Returns (granted, new_tat, retry_after). rate_limit_acquire() in init_db
+    is the SQL twin of this function.
+    """
+    base = now if tat is None else max(tat, now)
+    available = math.floor((now + window - base) / interval + 1e-9)
+    granted = min(want, available)
+    if granted < 1:
+        return 0, tat, base + interval - window - now
+    return granted, base + granted * interval, 0.0
+
+
+class _LimitState:
+    """TATs for one limit type, in two generations rotated every window."""
+
+    __slots__ = ('window', 'current', 'previous', 'rotated_at')
+
+    def __init__(self, window, now):
+        self.window = window
+        self.current = {}
+        self.previous = {}
+        self.rotated_at = now
+
+    def rotate(self, now):
+        elapsed = now - self.rotated_at
+        if elapsed < self.window:
+            return
+        # Everything in previous was written over a window ago and has expired;
+        # after two idle windows so has everything in current.
+        self.previous = self.current if elapsed < 2 * self.window else {}
+        self.current = {}
+        self.rotated_at = now
+
+    def get(self, key):
+        tat = self.current.get(key)
+        if tat is None:
+            tat = self.previous.get(key)
+        return tat
+
+    def set(self, key, tat):
+        self.current[key] = tat
+        self.previous.pop(key, None)
+
+    def __len__(self):
+        return len(self.current) + len(self.previous)
+
+
+class GCRALimiter:
+    """
+    In-process GCRA limiter.
+
+    limits maps limit type -> (max_requests, window_seconds); unknown types
+    use limits['default'].
+    """
+
+    def __init__(self, limits: Dict[str, Tuple[int, float]], clock=time.monotonic):
+        self.limits = limits
+        self.clock = clock
+        self._states = {}
+        self.lock = threading.Lock()
+
+    def _state(self, limit_type, window, now):
+        state = self._states.get(limit_type)
+        if state is None:
+            state = self._states[limit_type] = _LimitState(window, now)
+        else:
+            state.rotate(now)
+        return state
+
+    def check(self, key: str, limit_type: str = 'default') -> RateLimitDecision:
+        """Count one request against key and say whether it is allowed."""
+        max_requests, window = self.limits.get(limit_type, self.limits['default'])
+        interval = window / max_requests
+
+        with self.lock:
+            now = self.clock()
+            state = self._state(limit_type, window, now)
+            granted, tat, retry_after = gcra_acquire(state.get(key), now, interval, window)
+            if not granted:
+                return RateLimitDecision(False, retry_after)
+            state.set(key, tat)
+            return RateLimitDecision(True, 0.0)
+
+    def reset(self, key: str, limit_type: str = 'default'):
+        with self.lock:
+            state = self._states.get(limit_type)
+            if state is not None:
+                state.current.pop(key, None)
+                state.previous.pop(key, None)
+
+    def __len__(self):
+        return sum(len(state) for state in self._states.values())
+
+
+def _store_connection():
+    """Dedicated autocommit connection: limiter rows must not wait on the request's transaction"""
+    database_url = os.getenv('DATABASE_URL')
+    if database_url:
+        conn = psycopg2.connect(database_url)
+    else:
+        conn = psycopg2.connect(host=os.getenv('DB_HOST'), port=int(os.getenv('DB_PORT', '5432')),
+                                database=os.getenv('DB_NAME'), user=os.getenv('DB_USER'),
+                                password=os.getenv('DB_PASSWORD'))
+    conn.autocommit = True
+    return conn
+
+
+class PostgresLimitStore:
+    """TATs shared by every worker and node, in the rate_limits table"""
+
+    def __init__(self, connect=_store_connection):
+        self.connect = connect
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _cursor(self):
+        # Connections are not fork-safe; each worker opens its own
+        if self._conn is None or self._conn.closed or self._pid != os.getpid():
+            self._conn = self.connect()
+            self._pid = os.getpid()
+        return self._conn.cursor()
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            try:
+                cur = self._cursor()
+                cur.execute(sql, params)
+                return cur.fetchone() if cur.description else None
+            except Exception:
+                self._conn = None
+                raise
+
+    def acquire(self, limit_type, key, interval, window, want):
+        """Atomically take up to `want` slots; returns (granted, retry_after)"""
+        granted, retry_after = self._execute(
+            'SELECT granted, retry_after FROM rate_limit_acquire(%s, %s, %s, %s, %s)',
+            (limit_type, key, interval, window, want))
+        return granted, retry_after
+
+    def reset(self, limit_type, key):
+        self._execute('DELETE FROM rate_limits WHERE limit_type = %s AND key = %s', (limit_type, key))
+
+    def sweep(self):
+        self._execute('DELETE FROM rate_limits WHERE tat < EXTRACT(EPOCH FROM clock_timestamp())')
+
+
+class SharedGCRALimiter(GCRALimiter):
+    """
+    GCRA limiter whose state lives in a shared store (PostgresLimitStore).
+
+    Locally it only remembers leases (slots already taken from the store)
+    and denials (when the store said to retry), both in the same rotating
+    generations as GCRALimiter. If the store is unreachable, checks fall back
+    to per-process limiting rather than failing the request.
+    """
+
+    def __init__(self, limits, store, clock=time.monotonic, lease_seconds=LEASE_SECONDS,
+                 lease_divisor=LEASE_DIVISOR, sweep_interval=SWEEP_INTERVAL_SECONDS):
+        super().__init__(limits, clock)
+        self.store = store
+        self.lease_seconds = lease_seconds
+        self.lease_divisor = lease_divisor
+        self.sweep_interval = sweep_interval
+        self.fallback = GCRALimiter(limits, clock)
+        self.store_calls = 0
+        self._swept_at = None
+
+    def check(self, key: str, limit_type: str = 'default') -> RateLimitDecision:
+        max_requests, window = self.limits.get(limit_type, self.limits['default'])
+        interval = window / max_requests
+
+        with self.lock:
+            now = self.clock()
+            state = self._state(limit_type, window, now)
+            local = state.get(key)  # (leased slots left, lease expiry, denied until)
+            if local is not None:
+                leased, lease_expires, denied_until = local
+                if now < denied_until:
+                    return RateLimitDecision(False, denied_until - now)
+                if leased and now < lease_expires:
+                    state.set(key, (leased - 1, lease_expires, 0.0))
+                    return RateLimitDecision(True, 0.0)
+            sweep = self._swept_at is None or now - self._swept_at >= self.sweep_interval
+            if sweep:
+                self._swept_at = now
+
+        want = max(1, max_requests // self.lease_divisor)
+        try:
+            self.store_calls += 1
+            granted, retry_after = self.store.acquire(limit_type, key, interval, window, want)
+            if sweep:
+                self.store.sweep()
+        except Exception as e:
+            print(f"Shared rate limiter unavailable, limiting per process: {e}")
+            return self.fallback.check(key, limit_type)
+
+        with self.lock:
+            state = self._state(limit_type, window, now)
+            if not granted:
+                state.set(key, (0, 0.0, now + retry_after))
+                return RateLimitDecision(False, retry_after)
+            state.set(key, (granted - 1, now + self.lease_seconds, 0.0))
+            return RateLimitDecision(True, 0.0)
+
+    def reset(self, key: str, limit_type: str = 'default'):
+        super().reset(key, limit_type)
+        self.fallback.reset(key, limit_type)
+        self.store.reset(limit_type, key)
+
+
+def _benchmark(keys, per_window):
+    """Feed `keys` distinct clients through a 60s limit, `per_window` new clients per window."""
+    import tracemalloc
+
+    now = [0.0]
+    limiter = GCRALimiter({'default': (60, 60)}, clock=lambda: now[0])
+    step = 60.0 / per_window
+
+    tracemalloc.start()
+    samples = []
+    started = time.perf_counter()
+    for i in range(keys):
+        now[0] = i * step
+        limiter.check(f"ip:10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}:{i}")
+        if i and i % (keys // 10) == 0:
+            samples.append((i, len(limiter), tracemalloc.get_traced_memory()[0]))
+    elapsed = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return samples, peak, elapsed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='GCRA limiter memory benchmark')
+    parser.add_argument('--keys', type=int, default=1_000_000, help='distinct keys to feed through')
+    parser.add_argument('--per-window', type=int, default=10_000, help='new keys per 60s window')
+    args = parser.parse_args(argv)
+
+    samples, peak, elapsed = _benchmark(args.keys, args.per_window)
+    print(f"{args.keys:,} keys in {elapsed:.2f}s ({args.keys / elapsed:,.0f} checks/s)")
+    for i, live, current in samples:
+        print(f"  after {i:>9,} keys: {live:>7,} live entries, {current / 1024:>8,.0f} KiB")
+    print(f"peak traced memory: {peak / 1024:,.0f} KiB")
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
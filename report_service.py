@@ -0,0 +1,488 @@
+#!/usr/bin/env python3
+"""
+Report Service - cached report artifacts with background PDF rendering.
+
+Every report is stored as a report_artifacts row keyed by
+(patient, report type, date range, requester, data version). The data
+version is a cheap fingerprint of the patient's clinical tables, so a
+request for a report whose underlying data has not changed is served from
+the stored artifact without re-querying or re-rendering anything.
+
+PDF reports are rendered off the request path: the API enqueues an
+artifact row and NOTIFYs the render worker, which gathers the data,
+builds the PDF in a process pool (reportlab is CPU-bound and holds the
+GIL), stores the bytes, and tells the requester it is ready (in-app
+notification + NOTIFY report_ready). Clients poll
+GET /api/reports/artifacts/<id> until status is 'ready'.
+
+Run as a long-lived worker (Procfile: `reports: python report_service.py`):
+    python report_service.py                 # LISTEN + poll every 5 seconds
+    python report_service.py --once          # render queued reports and exit (cron)
+    python report_service.py --workers 4     # size of the render process pool
+"""
+
+import argparse
+import hashlib
+import logging
+import os
+import select
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional
+
+import psycopg2
+
+logger = logging.getLogger('report_service')
+
+REPORT_WELLNESS_PDF = 'wellness_pdf'
+REPORT_CLINICAL_SUMMARY = 'clinical_summary'
+CLINICAL_REPORT_TYPES = ('gp_referral', 'progress', 'discharge')
+
+# Bump when a renderer's output changes so previously cached artifacts are not reused
+RENDER_VERSION = 1
+
+NOTIFY_CHANNEL = 'report_jobs'
+READY_CHANNEL = 'report_ready'
+ARTIFACT_RETENTION_DAYS = 7
+
+
+# ==================== CACHE KEYS ====================
+
+def report_data_version(cur, username: str) -> str:
+    """
+    Fingerprint of everything a patient report can show, in one query.
+
+    Row counts catch deletions and MAX(id) catches inserts; the profile
+    columns are hashed directly. Changes here mean a cached artifact is stale.
+    """
+    cur.execute("""
+        SELECT md5(concat_ws('|',
+            (SELECT concat_ws(':', COUNT(*), MAX(id)) FROM mood_logs WHERE username = %s),
+            (SELECT concat_ws(':', COUNT(*), MAX(id)) FROM gratitude_logs WHERE username = %s),
+            (SELECT concat_ws(':', COUNT(*), MAX(id)) FROM cbt_records WHERE username = %s),
+            (SELECT concat_ws(':', COUNT(*), MAX(id)) FROM clinical_scales WHERE username = %s),
+            (SELECT concat_ws(':', COUNT(*), MAX(id)) FROM alerts WHERE username = %s),
+            (SELECT concat_ws(':', COUNT(*), MAX(id)) FROM clinician_notes WHERE patient_username = %s),
+            (SELECT md5(concat_ws('|', full_name, dob, conditions)) FROM users WHERE username = %s)
+        ))
+    """, (username,) * 7)
+    row = cur.fetchone()
+    return row[0] if row and row[0] else ''
+
+
+def report_cache_key(username: str, report_type: str, range_start: Optional[str], range_end: Optional[str],
+                     data_version: str, requested_by: str = '') -> str:
+    parts = [str(RENDER_VERSION), username, report_type, range_start or '', range_end or '',
+             requested_by or '', data_version]
+    return hashlib.sha256('\x1f'.join(parts).encode()).hexdigest()
+
+
+# ==================== ARTIFACT STORE ====================
+
+_ARTIFACT_COLUMNS = ("id, patient_username, report_type, status, content_type, filename, "
+                     "requested_by, error, created_at, completed_at")
+
+
+def _artifact_dict(row, content=None) -> Dict[str, Any]:
+    artifact = {
+        'id': row[0],
+        'patient_username': row[1],
+        'report_type': row[2],
+        'status': row[3],
+        'content_type': row[4],
+        'filename': row[5],
+        'requested_by': row[6],
+        'error': row[7],
+        'created_at': row[8].isoformat() if hasattr(row[8], 'isoformat') else row[8],
+        'completed_at': row[9].isoformat() if hasattr(row[9], 'isoformat') else row[9],
+    }
+    if content is not None:
+        artifact['content'] = bytes(content)
+    return artifact
+
+
+def find_artifact(cur, cache_key: str, include_content: bool = False) -> Optional[Dict[str, Any]]:
+    """Artifact for a cache key in any status, or None."""
+    content_col = ', content' if include_content else ''
+    cur.execute(f"SELECT {_ARTIFACT_COLUMNS}{content_col} FROM report_artifacts WHERE cache_key = %s",
+                (cache_key,))
+    row = cur.fetchone()
+    if not row:
+        return None
+    return _artifact_dict(row, row[10] if include_content and row[10] is not None else None)
+
+
+def get_artifact(cur, artifact_id: int, include_content: bool = False) -> Optional[Dict[str, Any]]:
+    content_col = ', content' if include_content else ''
+    cur.execute(f"SELECT {_ARTIFACT_COLUMNS}{content_col} FROM report_artifacts WHERE id = %s",
+                (artifact_id,))
+    row = cur.fetchone()
+    if not row:
+        return None
+    return _artifact_dict(row, row[10] if include_content and row[10] is not None else None)
+
+
+def store_artifact(cur, cache_key: str, username: str, report_type: str, range_start, range_end,
+                   data_version: str, requested_by: str, content: bytes, content_type: str,
+                   filename: str) -> int:
+    """Save an artifact rendered inline (cheap text/HTML reports) as ready."""
+    cur.execute("""
+        INSERT INTO report_artifacts
+            (cache_key, patient_username, report_type, range_start, range_end, data_version,
+             requested_by, status, content, content_type, filename, completed_at)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, 'ready', %s, %s, %s, CURRENT_TIMESTAMP)
+        ON CONFLICT (cache_key) DO UPDATE
+        SET status = 'ready', content = EXCLUDED.content, content_type = EXCLUDED.content_type,
+            filename = EXCLUDED.filename, error = NULL, completed_at = CURRENT_TIMESTAMP
+        RETURNING id
+    """, (cache_key, username, report_type, range_start, range_end, data_version, requested_by,
+          psycopg2.Binary(content), content_type, filename))
+    artifact_id = cur.fetchone()[0]
+    _delete_superseded(cur, artifact_id)
+    return artifact_id
+
+
+def enqueue_report(cur, cache_key: str, username: str, report_type: str, range_start, range_end,
+                   data_version: str, requested_by: str) -> Dict[str, Any]:
+    """
+    Queue a background render unless one already exists for this key.
+    A previously failed render is re-queued. Returns {'id', 'status'}.
+    """
+    cur.execute("""
+        INSERT INTO report_artifacts
+            (cache_key, patient_username, report_type, range_start, range_end, data_version, requested_by)
+        VALUES (%s, %s, %s, %s, %s, %s, %s)
+        ON CONFLICT (cache_key) DO UPDATE
+        SET status = CASE WHEN report_artifacts.status = 'failed' THEN 'queued' ELSE report_artifacts.status END,
+            error = CASE WHEN report_artifacts.status = 'failed' THEN NULL ELSE report_artifacts.error END
+        RETURNING id, status
+    """, (cache_key, username, report_type, range_start, range_end, data_version, requested_by))
+    artifact_id, status = cur.fetchone()
+    if status == 'queued':
+        cur.execute(f"NOTIFY {NOTIFY_CHANNEL}")
+    return {'id': artifact_id, 'status': status}
+
+
+def _delete_superseded(cur, artifact_id: int) -> None:
+    """Drop older versions of the same report once a newer one is ready."""
+    cur.execute("""
+        DELETE FROM report_artifacts old
+        USING report_artifacts cur
+        WHERE cur.id = %s AND old.id <> cur.id
+        AND old.patient_username = cur.patient_username
+        AND old.report_type = cur.report_type
+        AND old.requested_by = cur.requested_by
+        AND old.range_start IS NOT DISTINCT FROM cur.range_start
+        AND old.range_end IS NOT DISTINCT FROM cur.range_end
+        AND old.status IN ('ready', 'failed')
+    """, (artifact_id,))
+
+
+# ==================== RENDERERS ====================
+
+def collect_wellness_data(cur, username: str) -> Dict[str, Any]:
+    """Rows for the patient wellness PDF, as plain picklable values."""
+    cur.execute(
+        "SELECT entrestamp, mood_val, sleep_val, meds, exercise_mins FROM mood_logs "
+        "WHERE username = %s ORDER BY entrestamp DESC LIMIT 15",
+        (username,)
+    )
+    moods = [(str(m[0])[:10] if m[0] else 'N/A', m[1], m[2], m[3], m[4]) for m in cur.fetchall()]
+    cur.execute(
+        "SELECT entry_timestamp, entry FROM gratitude_logs "
+        "WHERE username = %s ORDER BY entry_timestamp DESC LIMIT 10",
+        (username,)
+    )
+    gratitudes = [(str(g[0])[:10] if g[0] else 'N/A', g[1]) for g in cur.fetchall()]
+    return {'username': username, 'generated_at': datetime.now().strftime('%B %d, %Y'),
+            'moods': moods, 'gratitudes': gratitudes}
+
+
+def render_wellness_pdf(data: Dict[str, Any]) -> bytes:
+    """Build the patient wellness PDF (runs in the render process pool)."""
+    import io
+    from reportlab.lib import colors
+    from reportlab.lib.enums import TA_CENTER
+    from reportlab.lib.pagesizes import letter
+    from reportlab.lib.styles import ParagraphStyle, getSampleStyleSheet
+    from reportlab.lib.units import inch
+    from reportlab.platypus import Paragraph, SimpleDocTemplate, Spacer, Table, TableStyle
+
+    buffer = io.BytesIO()
+    doc = SimpleDocTemplate(buffer, pagesize=letter, topMargin=0.5*inch, bottomMargin=0.5*inch)
+    styles = getSampleStyleSheet()
+    story = []
+
+    title_style = ParagraphStyle(
+        'CustomTitle',
+        parent=styles['Heading1'],
+        fontSize=24,
+        textColor=colors.HexColor('#667eea'),
+        spaceAfter=12,
+        alignment=TA_CENTER
+    )
+    story.append(Paragraph("Personal Wellness Report", title_style))
+    story.append(Paragraph(f"<i>{data['username']}</i>", styles['Normal']))
+    story.append(Paragraph(f"Generated: {data['generated_at']}", styles['Normal']))
+    story.append(Spacer(1, 0.3*inch))
+
+    if data['moods']:
+        story.append(Paragraph("<b>Recent Mood & Wellness Tracking</b>", styles['Heading2']))
+        mood_data = [['Date', 'Mood', 'Sleep (hrs)', 'Exercise (mins)', 'Medications']]
+        for date_str, mood, sleep, meds, exercise in data['moods']:
+            mood_data.append([
+                date_str,
+                f"{mood}/10" if mood else 'N/A',
+                f"{sleep}" if sleep else 'N/A',
+                f"{exercise}" if exercise else '0',
+                meds if meds else 'None'
+            ])
+
+        table = Table(mood_data, colWidths=[1.2*inch, 0.8*inch, 1*inch, 1.2*inch, 2*inch])
+        table.setStyle(TableStyle([
+            ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#667eea')),
+            ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+            ('FONTSIZE', (0, 0), (-1, 0), 10),
+            ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
+            ('GRID', (0, 0), (-1, -1), 1, colors.grey)
+        ]))
+        story.append(table)
+        story.append(Spacer(1, 0.2*inch))
+
+    if data['gratitudes']:
+        story.append(Paragraph("<b>Gratitude Journal Highlights</b>", styles['Heading2']))
+        for date_str, entry in data['gratitudes']:
+            story.append(Paragraph(f"<i>{date_str}:</i> {entry}", styles['Normal']))
+        story.append(Spacer(1, 0.2*inch))
+
+    doc.build(story)
+    return buffer.getvalue()
+
+
+# report_type -> (collect(cur, username) on the worker connection, render(data) in the pool,
+#                 content type, filename template)
+BACKGROUND_RENDERERS: Dict[str, tuple] = {
+    REPORT_WELLNESS_PDF: (collect_wellness_data, render_wellness_pdf,
+                          'application/pdf', '{username}_wellness_report.pdf'),
+}
+
+
+# ==================== WORKER ====================
+
+class ReportWorker:
+    """Claims queued artifacts and renders them in a process pool."""
+
+    DEFAULT_BATCH_SIZE = 8
+    DEFAULT_POLL_INTERVAL = 5.0
+    RENDER_TIMEOUT_SECONDS = 300   # 'rendering' rows older than this belonged to a dead worker
+    MAX_ATTEMPTS = 3
+
+    def __init__(self, conn, pool: Optional[ProcessPoolExecutor] = None, batch_size: int = None,
+                 connect: Optional[Callable] = None):
+        self.conn = conn
+        self.pool = pool  # None renders in-process (tests, --workers 0)
+        self.batch_size = batch_size or self.DEFAULT_BATCH_SIZE
+        self.connect = connect
+        self.rendered_total = 0
+        self.failed_total = 0
+        self.last_run_at = None
+
+    def claim_batch(self) -> List[tuple]:
+        """Mark up to batch_size queued (or abandoned) artifacts as rendering."""
+        cur = self.conn.cursor()
+        try:
+            cur.execute("""
+                UPDATE report_artifacts
+                SET status = 'rendering', attempts = attempts + 1, started_at = CURRENT_TIMESTAMP
+                WHERE id IN (
+                    SELECT id FROM report_artifacts
+                    WHERE status = 'queued'
+                    OR (status = 'rendering' AND started_at < CURRENT_TIMESTAMP - make_interval(secs => %s))
+                    ORDER BY created_at, id
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING id, patient_username, report_type, requested_by, attempts
+            """, (self.RENDER_TIMEOUT_SECONDS, self.batch_size))
+            claimed = cur.fetchall()
+            self.conn.commit()
+            return claimed
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            cur.close()
+
+    def render_batch(self) -> Dict[str, int]:
+        """Render one claimed batch. Returns ready/failed counts."""
+        claimed = self.claim_batch()
+        if not claimed:
+            return {'ready': 0, 'failed': 0}
+
+        cur = self.conn.cursor()
+        pending = []
+        for artifact_id, username, report_type, requested_by, attempts in claimed:
+            renderer = BACKGROUND_RENDERERS.get(report_type)
+            try:
+                if not renderer:
+                    raise ValueError(f"No background renderer for report type '{report_type}'")
+                collect, render, content_type, filename = renderer
+                data = collect(cur, username)
+                job = self.pool.submit(render, data) if self.pool else render(data)
+                pending.append((artifact_id, username, requested_by, attempts, job, content_type,
+                                filename.format(username=username)))
+            except Exception as e:
+                pending.append((artifact_id, username, requested_by, attempts, e, None, None))
+
+        ready = failed = 0
+        try:
+            for artifact_id, username, requested_by, attempts, job, content_type, filename in pending:
+                try:
+                    if isinstance(job, Exception):
+                        raise job
+                    content = job.result() if hasattr(job, 'result') else job
+                except Exception as e:
+                    logger.error(f"Report {artifact_id} render failed: {e}")
+                    cur.execute("""
+                        UPDATE report_artifacts SET status = %s, error = %s WHERE id = %s
+                    """, ('queued' if attempts < self.MAX_ATTEMPTS else 'failed', str(e)[:500], artifact_id))
+                    failed += 1
+                    continue
+
+                cur.execute("""
+                    UPDATE report_artifacts
+                    SET status = 'ready', content = %s, content_type = %s, filename = %s,
+                        error = NULL, completed_at = CURRENT_TIMESTAMP
+                    WHERE id = %s
+                """, (psycopg2.Binary(content), content_type, filename, artifact_id))
+                _delete_superseded(cur, artifact_id)
+                cur.execute(
+                    "INSERT INTO notifications (recipient_username, message, notification_type) VALUES (%s, %s, %s)",
+                    (requested_by, f"Your report for {username} is ready to download", 'report_ready')
+                )
+                cur.execute(f"NOTIFY {READY_CHANNEL}, %s", (str(artifact_id),))
+                ready += 1
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            cur.close()
+
+        self.rendered_total += ready
+        self.failed_total += failed
+        return {'ready': ready, 'failed': failed}
+
+    def purge_expired(self) -> int:
+        """Delete artifacts older than the retention window."""
+        cur = self.conn.cursor()
+        try:
+            cur.execute("""
+                DELETE FROM report_artifacts
+                WHERE status IN ('ready', 'failed')
+                AND created_at < CURRENT_TIMESTAMP - make_interval(days => %s)
+            """, (ARTIFACT_RETENTION_DAYS,))
+            deleted = cur.rowcount
+            self.conn.commit()
+            return deleted
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            cur.close()
+
+    def run_pending(self, max_batches: int = 50) -> int:
+        """Render queued reports batch by batch. Returns number rendered."""
+        rendered = 0
+        for _ in range(max_batches):
+            result = self.render_batch()
+            rendered += result['ready']
+            if sum(result.values()) < self.batch_size:
+                break
+        self.last_run_at = datetime.now()
+        return rendered
+
+    def run_forever(self, poll_interval: float = None):
+        """Render as NOTIFYs arrive (or every poll_interval seconds) until interrupted."""
+        interval = poll_interval or self.DEFAULT_POLL_INTERVAL
+        logger.info(f"Report worker started (batch={self.batch_size}, interval={interval}s)")
+        listening = False
+        last_purge = 0.0
+        while True:
+            try:
+                if self.conn.closed and self.connect:
+                    self.conn = self.connect()
+                    listening = False
+                if not listening:
+                    cur = self.conn.cursor()
+                    cur.execute(f"LISTEN {NOTIFY_CHANNEL}")
+                    cur.close()
+                    self.conn.commit()
+                    listening = True
+                self.run_pending()
+                if time.monotonic() - last_purge > 3600:
+                    self.purge_expired()
+                    last_purge = time.monotonic()
+                if select.select([self.conn], [], [], interval) != ([], [], []):
+                    self.conn.poll()
+                    self.conn.notifies.clear()
+            except psycopg2.Error as e:
+                logger.error(f"Report pass failed: {e}")
+                listening = False
+                time.sleep(interval)
+
+
+def get_db_connection():
+    """Open a dedicated PostgreSQL connection for the worker (fail closed)."""
+    database_url = os.getenv('DATABASE_URL')
+    if database_url:
+        return psycopg2.connect(database_url)
+
+    host = os.getenv('DB_HOST')
+    name = os.getenv('DB_NAME')
+    user = os.getenv('DB_USER')
+    password = os.getenv('DB_PASSWORD')
+    if not all([host, name, user, password]):
+        raise RuntimeError(
+            "CRITICAL: Database credentials incomplete. "
+            "Required: DATABASE_URL or (DB_HOST, DB_NAME, DB_USER, DB_PASSWORD)"
+        )
+    return psycopg2.connect(host=host, port=int(os.getenv('DB_PORT', '5432')),
+                            database=name, user=user, password=password)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Render queued report artifacts')
+    parser.add_argument('--once', action='store_true', help='render queued reports and exit')
+    parser.add_argument('--interval', type=float, default=ReportWorker.DEFAULT_POLL_INTERVAL,
+                        help='max seconds between polls when no NOTIFY arrives')
+    parser.add_argument('--batch-size', type=int, default=ReportWorker.DEFAULT_BATCH_SIZE)
+    parser.add_argument('--workers', type=int, default=int(os.getenv('REPORT_RENDER_WORKERS', '2')),
+                        help='render processes (0 renders in the worker process)')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    pool = ProcessPoolExecutor(max_workers=args.workers) if args.workers > 0 else None
+    worker = ReportWorker(get_db_connection(), pool=pool, batch_size=args.batch_size, connect=get_db_connection)
+    try:
+        if args.once:
+            rendered = worker.run_pending()
+            print(f"Rendered {rendered} report(s)")
+        else:
+            worker.run_forever(args.interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if pool:
+            pool.shutdown()
+        worker.conn.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,325 @@
+"""
+Request Metrics - per-endpoint latency and throughput, in Prometheus format.
+
+Every request is recorded in-process against its route template
+(/api/professional/patient/<username>, not the concrete URL, so the number
+of series is bounded by the number of routes): request and 5xx counts, a
+latency histogram, response bytes, and an in-flight gauge. Recording is a
+dict lookup and a few additions under a lock.
+
+Each gunicorn worker only sees its own requests, so RequestMetrics adds its
+counters into a shared store (PostgresMetricsStore: UNLOGGED tables created
+by migration 7) at most every FLUSH_INTERVAL_SECONDS, piggybacked on a
+request like the rate limiter's sweep. The store keeps running totals, so
+counters stay monotonic across worker restarts. /metrics then reads the
+totals from the store and reports every worker's requests, whichever
+worker serves the scrape. Without a store (tests, METRICS_BACKEND=memory)
+or if it is unreachable, /metrics falls back to this worker's own totals.
+
+Streamed responses are timed until the response object is returned and
+have no known size, so they add to the request count but not to the bytes.
+"""
+
+import bisect
+import os
+import threading
+import time
+import uuid
+from typing import Dict, NamedTuple, Optional, Tuple
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+# Histogram upper bounds in seconds (a final +Inf bucket is implied)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Each worker adds its counters to the shared store this often (while serving requests)
+FLUSH_INTERVAL_SECONDS = 10
+# Workers that have not flushed for this long are left out of the in-flight gauge
+IN_FLIGHT_STALE_SECONDS = 60
+
+METRIC_PREFIX = 'healing_space_http'
+
+SeriesKey = Tuple[str, str]  # (route template, method)
+
+
+class EndpointStats:
+    """Counters for one (endpoint, method) series"""
+
+    __slots__ = ('requests', 'errors', 'duration_sum', 'response_bytes', 'buckets')
+
+    def __init__(self, requests=0, errors=0, duration_sum=0.0, response_bytes=0, buckets=None):
+        self.requests = requests
+        self.errors = errors
+        self.duration_sum = duration_sum
+        self.response_bytes = response_bytes
+        # Per-bucket (not cumulative) counts; the last entry is the +Inf overflow
+        self.buckets = list(buckets) if buckets is not None else [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def observe(self, duration, status, size):
+        self.requests += 1
+        if status >= 500:
+            self.errors += 1
+        self.duration_sum += duration
+        self.response_bytes += size
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, duration)] += 1
+
+    def add(self, other: 'EndpointStats'):
+        self.requests += other.requests
+        self.errors += other.errors
+        self.duration_sum += other.duration_sum
+        self.response_bytes += other.response_bytes
+        self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+
+    def quantile(self, q) -> Optional[float]:
+        """Estimate a latency quantile (seconds) by interpolating within its bucket"""
+        if not self.requests:
+            return None
+        rank = q * self.requests
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            if seen + count >= rank and count:
+                if i == len(LATENCY_BUCKETS):
+                    return LATENCY_BUCKETS[-1]  # in +Inf: the best bound we have
+                lower = LATENCY_BUCKETS[i - 1] if i else 0.0
+                return lower + (LATENCY_BUCKETS[i] - lower) * (rank - seen) / count
+            seen += count
+        return LATENCY_BUCKETS[-1]
+
+
+class MetricsSnapshot(NamedTuple):
+    series: Dict[SeriesKey, EndpointStats]
+    in_flight: int
+    aggregated: bool  # True when read from the shared store (every worker)
+
+
+class RequestMetrics:
+    """In-process request recorder that periodically adds its counters to a shared store"""
+
+    def __init__(self, store=None, clock=time.monotonic, flush_interval=FLUSH_INTERVAL_SECONDS):
+        self.store = store
+        self.clock = clock
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.totals: Dict[SeriesKey, EndpointStats] = {}   # this worker, since start
+        self.pending: Dict[SeriesKey, EndpointStats] = {}  # not yet added to the store
+        self._flushed_at = clock()
+        self._worker = None
+        self._pid = None
+
+    @property
+    def worker(self):
+        # Workers fork from the master after import; name each by its own pid
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._worker = f"{os.uname().nodename}:{self._pid}:{uuid.uuid4().hex[:8]}"
+        return self._worker
+
+    def request_started(self):
+        with self.lock:
+            self.in_flight += 1
+
+    def request_finished(self, endpoint, method, status, duration, size=0):
+        key = (endpoint, method)
+        with self.lock:
+            self.in_flight = max(0, self.in_flight - 1)
+            for table in (self.totals, self.pending):
+                stats = table.get(key)
+                if stats is None:
+                    stats = table[key] = EndpointStats()
+                stats.observe(duration, status, size)
+            due = self.store is not None and self.clock() - self._flushed_at >= self.flush_interval
+        if due:
+            self.flush()
+
+    def flush(self) -> bool:
+        """Add pending counters to the store; on failure they are kept for the next flush"""
+        if self.store is None:
+            return False
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            in_flight = self.in_flight
+            self._flushed_at = self.clock()
+        try:
+            self.store.add(self.worker, pending, in_flight)
+            return True
+        except Exception as e:
+            print(f"Request metrics store unavailable, keeping counters locally: {e}")
+            with self.lock:
+                for key, stats in pending.items():
+                    merged = self.pending.setdefault(key, EndpointStats())
+                    merged.add(stats)
+            return False
+
+    def snapshot(self) -> MetricsSnapshot:
+        """Every worker's totals from the store, or this worker's if there is none"""
+        if self.store is not None and self.flush():
+            try:
+                series, in_flight = self.store.load(IN_FLIGHT_STALE_SECONDS)
+                return MetricsSnapshot(series, in_flight, True)
+            except Exception as e:
+                print(f"Request metrics store unavailable, reporting this worker only: {e}")
+        with self.lock:
+            series = {key: EndpointStats(s.requests, s.errors, s.duration_sum, s.response_bytes, s.buckets)
+                      for key, s in self.totals.items()}
+            return MetricsSnapshot(series, self.in_flight, False)
+
+
+def _store_connection():
+    database_url = os.getenv('DATABASE_URL')
+    if database_url:
+        conn = psycopg2.connect(database_url)
+    else:
+        conn = psycopg2.connect(host=os.getenv('DB_HOST'), port=int(os.getenv('DB_PORT', '5432')),
+                                database=os.getenv('DB_NAME'), user=os.getenv('DB_USER'),
+                                password=os.getenv('DB_PASSWORD'))
+    conn.autocommit = True
+    return conn
+
+
+class PostgresMetricsStore:
+    """Running totals shared by every worker, in request_metrics / request_metrics_workers"""
+
+    def __init__(self, connect=_store_connection):
+        self.connect = connect
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _cursor(self):
+        # Connections are not fork-safe; each worker opens its own
+        if self._conn is None or self._conn.closed or self._pid != os.getpid():
+            self._conn = self.connect()
+            self._pid = os.getpid()
+        return self._conn.cursor()
+
+    def add(self, worker, deltas: Dict[SeriesKey, EndpointStats], in_flight):
+        with self._lock:
+            try:
+                cur = self._cursor()
+                if deltas:
+                    # Sorted so concurrent workers lock rows in the same order
+                    execute_values(cur, """
+                        INSERT INTO request_metrics
+                            (endpoint, method, requests, errors, duration_sum, response_bytes, buckets)
+                        VALUES %s
+                        ON CONFLICT (endpoint, method) DO UPDATE SET
+                            requests = request_metrics.requests + EXCLUDED.requests,
+                            errors = request_metrics.errors + EXCLUDED.errors,
+                            duration_sum = request_metrics.duration_sum + EXCLUDED.duration_sum,
+                            response_bytes = request_metrics.response_bytes + EXCLUDED.response_bytes,
+                            buckets = ARRAY(
+                                SELECT COALESCE(a, 0) + COALESCE(b, 0)
+                                FROM unnest(request_metrics.buckets, EXCLUDED.buckets) WITH ORDINALITY AS t(a, b, i)
+                                ORDER BY i
+                            ),
+                            updated_at = CURRENT_TIMESTAMP
+                    """, [(endpoint, method, s.requests, s.errors, s.duration_sum, s.response_bytes, s.buckets)
+                          for (endpoint, method), s in sorted(deltas.items())],
+                        template="(%s, %s, %s, %s, %s, %s, %s::BIGINT[])")
+                cur.execute("""
+                    INSERT INTO request_metrics_workers (worker, in_flight, updated_at)
+                    VALUES (%s, %s, CURRENT_TIMESTAMP)
+                    ON CONFLICT (worker) DO UPDATE SET in_flight = EXCLUDED.in_flight, updated_at = CURRENT_TIMESTAMP
+                """, (worker, in_flight))
+            except Exception:
+                self._conn = None
+                raise
+
+    def load(self, stale_seconds=IN_FLIGHT_STALE_SECONDS):
+        with self._lock:
+            try:
+                cur = self._cursor()
+                cur.execute("""
+                    SELECT endpoint, method, requests, errors, duration_sum, response_bytes, buckets
+                    FROM request_metrics
+                """)
+                series = {(r[0], r[1]): EndpointStats(r[2], r[3], r[4], r[5], r[6]) for r in cur.fetchall()}
+                cur.execute("DELETE FROM request_metrics_workers WHERE updated_at < CURRENT_TIMESTAMP - INTERVAL '1 day'")
+                cur.execute("""
+                    SELECT COALESCE(SUM(in_flight), 0) FROM request_metrics_workers
+                    WHERE updated_at >= CURRENT_TIMESTAMP - make_interval(secs => %s)
+                """, (stale_seconds,))
+                return series, int(cur.fetchone()[0])
+            except Exception:
+                self._conn = None
+                raise
+
+
+# ==================== EXPOSITION ====================
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render_prometheus(snapshot: MetricsSnapshot) -> str:
+    """Prometheus text exposition format (version 0.0.4)"""
+    p = METRIC_PREFIX
+    lines = []
+
+    def family(name, kind, help_text, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        lines.extend(samples)
+
+    keys = sorted(snapshot.series)
+
+    def labels(key, **extra):
+        pairs = [('endpoint', key[0]), ('method', key[1]), *extra.items()]
+        return '{' + ','.join(f'{k}="{_label(v)}"' for k, v in pairs) + '}'
+
+    family(f"{p}_requests_total", 'counter', 'Requests served, by route template and method.',
+           [f"{p}_requests_total{labels(k)} {snapshot.series[k].requests}" for k in keys])
+    family(f"{p}_request_errors_total", 'counter', 'Requests answered with a 5xx status.',
+           [f"{p}_request_errors_total{labels(k)} {snapshot.series[k].errors}" for k in keys])
+
+    histogram = []
+    for k in keys:
+        s = snapshot.series[k]
+        cumulative = 0
+        for bound, count in zip((*LATENCY_BUCKETS, '+Inf'), s.buckets):
+            cumulative += count
+            le = bound if bound == '+Inf' else _number(float(bound))
+            histogram.append(f"{p}_request_duration_seconds_bucket{labels(k, le=le)} {cumulative}")
+        histogram.append(f"{p}_request_duration_seconds_sum{labels(k)} {_number(float(s.duration_sum))}")
+        histogram.append(f"{p}_request_duration_seconds_count{labels(k)} {s.requests}")
+    family(f"{p}_request_duration_seconds", 'histogram', 'Time to produce the response.', histogram)
+
+    sizes = []
+    for k in keys:
+        sizes.append(f"{p}_response_size_bytes_sum{labels(k)} {snapshot.series[k].response_bytes}")
+        sizes.append(f"{p}_response_size_bytes_count{labels(k)} {snapshot.series[k].requests}")
+    family(f"{p}_response_size_bytes", 'summary', 'Response body size (streamed bodies count as 0).', sizes)
+
+    family(f"{p}_requests_in_flight", 'gauge', 'Requests being served right now.',
+           [f"{p}_requests_in_flight {snapshot.in_flight}"])
+    family(f"{p}_metrics_aggregated", 'gauge', '1 if these metrics cover every worker, 0 if only the scraped one.',
+           [f"{p}_metrics_aggregated {int(snapshot.aggregated)}"])
+    return '\n'.join(lines) + '\n'
+
+
+def summarize(snapshot: MetricsSnapshot, sort='p95', limit=20):
+    """Per-endpoint rows for the developer dashboard, slowest (or busiest) first"""
+    rows = []
+    for (endpoint, method), s in snapshot.series.items():
+        if not s.requests:
+            continue
+        p50, p95 = s.quantile(0.5), s.quantile(0.95)
+        rows.append({
+            'endpoint': endpoint,
+            'method': method,
+            'requests': s.requests,
+            'errors': s.errors,
+            'error_rate': round(s.errors / s.requests, 4),
+            'avg_ms': round(s.duration_sum / s.requests * 1000, 1),
+            'p50_ms': round(p50 * 1000, 1),
+            'p95_ms': round(p95 * 1000, 1),
+            'avg_bytes': round(s.response_bytes / s.requests),
+        })
+    order = {'p95': 'p95_ms', 'requests': 'requests', 'errors': 'errors', 'avg': 'avg_ms'}.get(sort, 'p95_ms')
+    rows.sort(key=lambda r: (r[order], r['requests']), reverse=True)
+    return rows[:limit]
@@ -0,0 +1,378 @@
+#!/usr/bin/env python3
+"""
+Research Export - partitioned Parquet datasets for research partners.
+
+Replaces the per-user, row-at-a-time TrainingDataManager.export_* path for
+university trial partners. Each dataset is written as
+
+    <output>/<dataset>/year=YYYY/month=MM/part-<from_id>.parquet
+
+and only covers patients with active training consent (data_consent).
+Participants are identified by TrainingDataManager.anonymize_username - the
+same hash stored in data_consent - and free-text columns are scrubbed with
+PII_PATTERNS a whole Arrow column at a time rather than message by message.
+
+Exports are incremental: research_export_watermarks records the last row id
+written per dataset, so a scheduled run only appends rows newer than the
+previous one. Part files are named after the watermark they start from, so
+re-running after a crash rewrites the same files instead of duplicating rows.
+
+research_export_participants records who each dataset has been exported
+for. A patient who consents after earlier runs is backfilled from id 0 up
+to the watermark in a separate part-<watermark>-backfill-<digest> file; a
+patient who withdraws is removed from every part file already written
+(files are rewritten, or deleted once empty) before the next rows go out.
+
+    python research_export.py --output /srv/research          # append new rows
+    python research_export.py --output /srv/research --datasets mood wellness
+    python research_export.py --output /tmp/fresh --full       # rebuild from scratch
+
+Requires pyarrow (requirements-training.txt).
+"""
+
+import argparse
+import glob
+import hashlib
+import logging
+import os
+import sys
+from typing import Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+import psycopg2
+
+from streaming_export import EXPORT_CHUNK_SIZE, iter_row_chunks
+from training_data_manager import PII_PATTERNS, TrainingDataManager
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+    HAS_ARROW = True
+except ImportError:
+    HAS_ARROW = False
+
+logger = logging.getLogger('research_export')
+
+OUTCOME_SCALES = ('PHQ-9', 'GAD-7', 'CORE-10', 'WEMWBS')
+
+
+class ResearchDataset(NamedTuple):
+    """
+    One exported dataset.
+
+    query must select (id, username, timestamp, *columns) for
+    username = ANY(%s) AND id > %s, ordered by id.
+    """
+    name: str
+    query: str
+    columns: Tuple[Tuple[str, str], ...]
+    text_columns: Tuple[str, ...] = ()
+
+
+DATASETS: Dict[str, ResearchDataset] = {d.name: d for d in (
+    ResearchDataset(
+        'mood',
+        "SELECT id, username, entrestamp::timestamp, mood_val, sleep_val, meds, notes FROM mood_logs "
+        "WHERE username = ANY(%s) AND id > %s AND deleted_at IS NULL ORDER BY id",
+        (('mood', 'int32'), ('sleep', 'int32'), ('medication', 'string'), ('notes', 'string')),
+        text_columns=('medication', 'notes'),
+    ),
+    ResearchDataset(
+        'wellness',
+        "SELECT id, username, timestamp, mood, sleep_quality, energy_level, capacity_index, "
+        "exercise_duration, outdoor_time_minutes, social_contact, medication_taken, homework_completed, "
+        "time_of_day_category, emotional_narrative FROM wellness_logs "
+        "WHERE username = ANY(%s) AND id > %s ORDER BY id",
+        (('mood', 'int32'), ('sleep_quality', 'int32'), ('energy_level', 'int32'),
+         ('capacity_index', 'int32'), ('exercise_minutes', 'int32'), ('outdoor_minutes', 'int32'),
+         ('social_contact', 'string'), ('medication_taken', 'bool'), ('homework_completed', 'bool'),
+         ('time_of_day', 'string'), ('emotional_narrative', 'string')),
+        text_columns=('social_contact', 'emotional_narrative'),
+    ),
+    ResearchDataset(
+        'clinical_scales',
+        "SELECT id, username, entry_timestamp, scale_name, score, severity FROM clinical_scales "
+        "WHERE username = ANY(%s) AND id > %s ORDER BY id",
+        (('scale', 'string'), ('score', 'int32'), ('severity', 'string')),
+    ),
+    # Outcome measures: validated scales with change from each participant's
+    # first administration. The window runs over full history so appended
+    # rows still carry the right baseline.
+    ResearchDataset(
+        'outcomes',
+        "SELECT * FROM (SELECT id, username, entry_timestamp, scale_name, score, "
+        "score - FIRST_VALUE(score) OVER w, "
+        "EXTRACT(DAY FROM entry_timestamp - FIRST_VALUE(entry_timestamp) OVER w)::int, "
+        "ROW_NUMBER() OVER w "
+        "FROM clinical_scales WHERE username = ANY(%s) "
+        f"AND scale_name IN ({', '.join(repr(s) for s in OUTCOME_SCALES)}) "
+        "WINDOW w AS (PARTITION BY username, scale_name ORDER BY entry_timestamp, id)) scored "
+        "WHERE id > %s ORDER BY id",
+        (('scale', 'string'), ('score', 'int32'), ('change_from_baseline', 'int32'),
+         ('days_since_baseline', 'int32'), ('administration', 'int32')),
+    ),
+    # Engagement: in-app activity only. session_id and app_state are
+    # dropped since session ids embed the username.
+    ResearchDataset(
+        'engagement',
+        "SELECT id, username, activity_timestamp, activity_type, activity_detail FROM ai_activity_log "
+        "WHERE username = ANY(%s) AND id > %s ORDER BY id",
+        (('activity_type', 'string'), ('activity_detail', 'string')),
+        text_columns=('activity_detail',),
+    ),
+)}
+
+
+def _require_arrow():
+    if not HAS_ARROW:
+        raise RuntimeError("pyarrow is required for research exports: pip install -r requirements-training.txt")
+
+
+def dataset_schema(dataset: ResearchDataset) -> 'pa.Schema':
+    _require_arrow()
+    types = {'int32': pa.int32(), 'string': pa.string(), 'bool': pa.bool_()}
+    fields = [pa.field('participant_id', pa.string()), pa.field('recorded_at', pa.timestamp('us'))]
+    fields += [pa.field(name, types[kind]) for name, kind in dataset.columns]
+    return pa.schema(fields)
+
+
+def scrub_pii_array(values: 'pa.Array') -> 'pa.Array':
+    """Vectorized TrainingDataManager.strip_pii over a string column."""
+    _require_arrow()
+    for pattern, replacement, flags in PII_PATTERNS:
+        if flags:
+            pattern = '(?i)' + pattern
+        values = pc.replace_substring_regex(values, pattern=pattern, replacement=replacement)
+    return values
+
+
+def consented_participants(cur, manager: Optional[TrainingDataManager] = None) -> Dict[str, str]:
+    """Map username -> anonymized participant id for every patient with active consent."""
+    manager = manager or TrainingDataManager()
+    cur.execute("SELECT user_hash FROM data_consent WHERE consent_given = 1 AND consent_withdrawn = 0")
+    consented = {row[0] for row in cur.fetchall()}
+    if not consented:
+        return {}
+
+    cur.execute("SELECT username FROM users WHERE role = 'user'")
+    participants = {}
+    for (username,) in cur.fetchall():
+        user_hash = manager.anonymize_username(username)
+        if user_hash in consented:
+            participants[username] = user_hash
+    return participants
+
+
+class ResearchExporter:
+    """Writes incremental Parquet datasets and advances their watermarks."""
+
+    def __init__(self, conn, output_dir: str, manager: Optional[TrainingDataManager] = None,
+                 chunk_size: int = EXPORT_CHUNK_SIZE):
+        _require_arrow()
+        self.conn = conn
+        self.output_dir = output_dir
+        self.manager = manager or TrainingDataManager()
+        self.chunk_size = chunk_size
+
+    def get_watermark(self, name: str) -> int:
+        cur = self.conn.cursor()
+        cur.execute("SELECT last_id FROM research_export_watermarks WHERE dataset = %s", (name,))
+        row = cur.fetchone()
+        return int(row[0]) if row else 0
+
+    def _save_watermark(self, name: str, last_id: int, rows: int, full: bool):
+        cur = self.conn.cursor()
+        cur.execute("""
+            INSERT INTO research_export_watermarks (dataset, last_id, rows_exported, last_run_rows, exported_at)
+            VALUES (%s, %s, %s, %s, CURRENT_TIMESTAMP)
+            ON CONFLICT (dataset) DO UPDATE SET
+                last_id = EXCLUDED.last_id,
+                rows_exported = CASE WHEN %s THEN EXCLUDED.rows_exported
+                                     ELSE research_export_watermarks.rows_exported + EXCLUDED.rows_exported END,
+                last_run_rows = EXCLUDED.last_run_rows,
+                exported_at = EXCLUDED.exported_at
+        """, (name, last_id, rows, rows, full))
+
+    def _to_batch(self, rows: List[tuple], dataset: ResearchDataset, schema: 'pa.Schema',
+                  usernames: 'pa.Array', participant_ids: 'pa.Array') -> 'pa.RecordBatch':
+        columns = list(zip(*rows))
+        arrays = [pc.take(participant_ids, pc.index_in(pa.array(columns[1], pa.string()), value_set=usernames))]
+        for field, values in zip(list(schema)[1:], columns[2:]):
+            array = pa.array(values, type=field.type)
+            if field.name in dataset.text_columns:
+                array = scrub_pii_array(array)
+            arrays.append(array)
+        return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+    def exported_participants(self, name: str) -> set:
+        cur = self.conn.cursor()
+        cur.execute("SELECT participant_id FROM research_export_participants WHERE dataset = %s", (name,))
+        return {row[0] for row in cur.fetchall()}
+
+    def _save_participants(self, name: str, added: Iterable[str], removed: Iterable[str], full: bool):
+        cur = self.conn.cursor()
+        if full:
+            cur.execute("DELETE FROM research_export_participants WHERE dataset = %s", (name,))
+        elif removed:
+            cur.execute("DELETE FROM research_export_participants WHERE dataset = %s AND participant_id = ANY(%s)",
+                        (name, sorted(removed)))
+        if added:
+            cur.execute("""
+                INSERT INTO research_export_participants (dataset, participant_id)
+                SELECT %s, unnest(%s::text[])
+                ON CONFLICT (dataset, participant_id) DO NOTHING
+            """, (name, sorted(added)))
+
+    def export_dataset(self, dataset: ResearchDataset, participants: Dict[str, str],
+                       full: bool = False) -> Dict[str, int]:
+        """
+        Append rows newer than the dataset's watermark, backfill newly
+        consented participants and remove withdrawn ones from existing parts.
+        Returns {'rows', 'last_id', 'backfilled', 'withdrawn'}.
+        """
+        from_id = 0 if full else self.get_watermark(dataset.name)
+        exported = set() if full else self.exported_participants(dataset.name)
+        current = set(participants.values())
+        withdrawn = exported - current
+        added = {u: pid for u, pid in participants.items() if pid not in exported}
+
+        removed_rows = self._remove_participants(dataset, withdrawn) if withdrawn else 0
+
+        backfilled = 0
+        if added and from_id:
+            digest = hashlib.sha256(','.join(sorted(added.values())).encode()).hexdigest()[:12]
+            backfilled, _ = self._write_rows(dataset, added, 0, f'part-{from_id:012d}-backfill-{digest}',
+                                             upto=from_id)
+
+        total, last_id = 0, from_id
+        if participants:
+            total, last_id = self._write_rows(dataset, participants, from_id, f'part-{from_id:012d}')
+
+        self._save_watermark(dataset.name, last_id, total + backfilled, full)
+        self._save_participants(dataset.name, added.values(), withdrawn, full)
+        self.conn.commit()
+        logger.info("Exported %d %s row(s), backfilled %d for %d new participant(s), removed %d for %d "
+                    "withdrawn, watermark %d -> %d", total, dataset.name, backfilled, len(added),
+                    removed_rows, len(withdrawn), from_id, last_id)
+        return {'rows': total, 'last_id': last_id, 'backfilled': backfilled, 'withdrawn': len(withdrawn)}
+
+    def _write_rows(self, dataset: ResearchDataset, participants: Dict[str, str], from_id: int,
+                    part_name: str, upto: Optional[int] = None) -> Tuple[int, int]:
+        """Write rows with id > from_id (and <= upto) into part_name files. Returns (rows, last_id)."""
+        schema = dataset_schema(dataset)
+        names = list(participants)
+        usernames = pa.array(names, pa.string())
+        participant_ids = pa.array([participants[n] for n in names], pa.string())
+
+        writers = {}
+        total, last_id = 0, from_id
+        chunks = iter_row_chunks(self.conn, dataset.query, (names, from_id),
+                                 chunk_size=self.chunk_size, name_prefix='research_export')
+        try:
+            for rows in chunks:
+                done = upto is not None and rows[-1][0] > upto
+                if done:
+                    rows = [r for r in rows if r[0] <= upto]
+                if rows:
+                    batch = self._to_batch(rows, dataset, schema, usernames, participant_ids)
+                    self._write_partitions(dataset, batch, part_name, writers)
+                    total += len(rows)
+                    last_id = rows[-1][0]
+                if done:
+                    break
+        except Exception:
+            for writer, tmp_path, _ in writers.values():
+                writer.close()
+                os.remove(tmp_path)
+            raise
+        finally:
+            chunks.close()
+
+        # Publish the files before the watermark moves past them
+        for writer, tmp_path, final_path in writers.values():
+            writer.close()
+            os.replace(tmp_path, final_path)
+        return total, last_id
+
+    def _remove_participants(self, dataset: ResearchDataset, participant_ids: Iterable[str]) -> int:
+        """Rewrite every published part without the given participants. Returns rows removed."""
+        value_set = pa.array(sorted(participant_ids), pa.string())
+        removed = 0
+        for path in glob.glob(os.path.join(self.output_dir, dataset.name, '**', '*.parquet'), recursive=True):
+            table = pq.ParquetFile(path).read()
+            keep = pc.invert(pc.is_in(table.column('participant_id'), value_set=value_set))
+            kept = table.filter(keep)
+            if kept.num_rows == table.num_rows:
+                continue
+            removed += table.num_rows - kept.num_rows
+            if kept.num_rows:
+                pq.write_table(kept, path + '.tmp', compression='zstd')
+                os.replace(path + '.tmp', path)
+            else:
+                os.remove(path)
+        return removed
+
+    def _write_partitions(self, dataset: ResearchDataset, batch: 'pa.RecordBatch', part_name: str, writers: dict):
+        keys = pc.fill_null(pc.strftime(batch.column(1), format='year=%Y/month=%m'), 'year=unknown/month=unknown')
+        for key in pc.unique(keys).to_pylist():
+            if key not in writers:
+                directory = os.path.join(self.output_dir, dataset.name, *key.split('/'))
+                os.makedirs(directory, exist_ok=True)
+                final_path = os.path.join(directory, f'{part_name}.parquet')
+                tmp_path = final_path + '.tmp'
+                writers[key] = (pq.ParquetWriter(tmp_path, batch.schema, compression='zstd'), tmp_path, final_path)
+            writers[key][0].write_batch(batch.filter(pc.equal(keys, key)))
+
+    def run(self, names: Optional[Iterable[str]] = None, full: bool = False) -> Dict[str, Dict[str, int]]:
+        """Export the named datasets (default: all) for currently consented patients."""
+        participants = consented_participants(self.conn.cursor(), self.manager)
+        results = {}
+        for name in (names or DATASETS):
+            results[name] = self.export_dataset(DATASETS[name], participants, full=full)
+        return results
+
+
+def get_db_connection():
+    """Open a dedicated PostgreSQL connection for the export (fail closed)."""
+    database_url = os.getenv('DATABASE_URL')
+    if database_url:
+        return psycopg2.connect(database_url)
+
+    host = os.getenv('DB_HOST')
+    name = os.getenv('DB_NAME')
+    user = os.getenv('DB_USER')
+    password = os.getenv('DB_PASSWORD')
+    if not all([host, name, user, password]):
+        raise RuntimeError(
+            "CRITICAL: Database credentials incomplete. "
+            "Required: DATABASE_URL or (DB_HOST, DB_NAME, DB_USER, DB_PASSWORD)"
+        )
+    return psycopg2.connect(host=host, port=int(os.getenv('DB_PORT', '5432')),
+                            database=name, user=user, password=password)
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Export anonymized research datasets as Parquet')
+    parser.add_argument('--output', required=True, help='dataset root directory')
+    parser.add_argument('--datasets', nargs='+', choices=sorted(DATASETS), help='datasets to export (default: all)')
+    parser.add_argument('--full', action='store_true', help='ignore watermarks and export all history')
+    parser.add_argument('--chunk-size', type=int, default=EXPORT_CHUNK_SIZE)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    conn = get_db_connection()
+    try:
+        exporter = ResearchExporter(conn, args.output, chunk_size=args.chunk_size)
+        results = exporter.run(args.datasets, full=args.full)
+    finally:
+        conn.close()
+
+    for name, result in results.items():
+        print(f"{name}: {result['rows']} row(s), {result['backfilled']} backfilled, "
+              f"{result['withdrawn']} withdrawn, watermark {result['last_id']}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,325 @@
+"""
+SQL Profiler - per-request statement recording with N+1 detection.
+
+When enabled (SQL_PROFILER=1), each request gets a QueryProfile. The pooled
+connections create ProfilingCursor cursors, which record every statement
+into the current request's profile: normalized SQL (literals and IN lists
+folded, so `WHERE post_id = 17` and `= 18` are the same statement),
+duration and row count. That covers endpoints that use conn.cursor()
+directly as well as PostgreSQLCursorWrapper, which records through
+profile_execute() when it wraps a cursor from elsewhere.
+
+At the end of the request the profile is checked against two limits:
+
+  - SQL_QUERY_BUDGET: more statements than this in one request
+  - SQL_REPEAT_LIMIT: the same normalized statement run more than this many
+    times, which is the signature of a query inside a loop (N+1)
+
+A request over either limit is logged as one compact line and recorded in
+sql_profile_offenders (migration 8), which the developer dashboard reads.
+With the profiler disabled, the cursor's only extra cost is one ContextVar
+lookup per execute.
+"""
+
+import contextvars
+import os
+import re
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List, NamedTuple, Optional
+
+import psycopg2
+import psycopg2.extensions
+
+DEFAULT_QUERY_BUDGET = 25
+DEFAULT_REPEAT_LIMIT = 5
+MAX_STATEMENT_LENGTH = 500
+
+_current_profile = contextvars.ContextVar('sql_profile', default=None)
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?\b")
+_IN_LIST = re.compile(r"\bIN\s*\(\s*(?:\?|%s)(?:\s*,\s*(?:\?|%s))*\s*\)", re.IGNORECASE)
+_VALUES_LIST = re.compile(r"\bVALUES\s*(\([^()]*\))(?:\s*,\s*\([^()]*\))+", re.IGNORECASE)
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_sql(sql) -> str:
+    """Fold literals, IN lists and multi-row VALUES so repeated statements compare equal"""
+    if isinstance(sql, bytes):
+        sql = sql.decode('utf-8', 'replace')
+    sql = _WHITESPACE.sub(' ', str(sql)).strip()
+    sql = _STRING.sub('?', sql)
+    sql = _NUMBER.sub('?', sql)
+    sql = _IN_LIST.sub('IN (...)', sql)
+    sql = _VALUES_LIST.sub(r'VALUES \1, ...', sql)
+    return sql[:MAX_STATEMENT_LENGTH]
+
+
+class StatementStats:
+    __slots__ = ('count', 'seconds', 'rows')
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.rows = 0
+
+
+class QueryProfile:
+    """Statements executed during one request, grouped by normalized SQL"""
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+        self.statements: Dict[str, StatementStats] = {}
+        self.lock = threading.Lock()
+
+    def record(self, sql, seconds, rowcount):
+        key = normalize_sql(sql)
+        with self.lock:
+            stats = self.statements.get(key)
+            if stats is None:
+                stats = self.statements[key] = StatementStats()
+            stats.count += 1
+            stats.seconds += seconds
+            stats.rows += max(rowcount or 0, 0)
+            self.queries += 1
+            self.seconds += seconds
+
+    def most_repeated(self):
+        """(normalized sql, StatementStats) of the statement run most often, or None"""
+        if not self.statements:
+            return None
+        return max(self.statements.items(), key=lambda item: (item[1].count, item[1].seconds))
+
+
+class ProfileReport(NamedTuple):
+    endpoint: str
+    method: str
+    queries: int
+    sql_ms: float
+    request_ms: float
+    repeated_sql: Optional[str]
+    repeats: int
+    over_budget: bool
+    n_plus_one: bool
+
+    def summary(self) -> str:
+        flags = ', '.join(f for f, on in (('over budget', self.over_budget), ('N+1', self.n_plus_one)) if on)
+        line = (f"SQL profile {self.method} {self.endpoint}: {self.queries} queries, "
+                f"{self.sql_ms:.0f}ms SQL of {self.request_ms:.0f}ms [{flags}]")
+        if self.n_plus_one:
+            line += f"; {self.repeats}x {self.repeated_sql[:160]}"
+        return line
+
+
+class ProfilingCursorMixin:
+    """Records execute/executemany into the active QueryProfile, if any"""
+
+    def execute(self, query, vars=None):
+        profile = _current_profile.get()
+        if profile is None:
+            return super().execute(query, vars)
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            profile.record(_statement_text(query, self), time.perf_counter() - started, self.rowcount)
+
+    def executemany(self, query, vars_list):
+        profile = _current_profile.get()
+        if profile is None:
+            return super().executemany(query, vars_list)
+        started = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            profile.record(_statement_text(query, self), time.perf_counter() - started, self.rowcount)
+
+
+class ProfilingCursor(ProfilingCursorMixin, psycopg2.extensions.cursor):
+    """cursor_factory for the pooled connections"""
+
+
+def profile_execute(cursor, query, params=None):
+    """cursor.execute() recorded into the active profile, for cursors without the mixin"""
+    profile = _current_profile.get()
+    if profile is None or isinstance(cursor, ProfilingCursorMixin):
+        return cursor.execute(query, params)
+    started = time.perf_counter()
+    try:
+        return cursor.execute(query, params)
+    finally:
+        profile.record(_statement_text(query, cursor), time.perf_counter() - started,
+                       getattr(cursor, 'rowcount', -1))
+
+
+def _statement_text(query, cursor):
+    if isinstance(query, (str, bytes)):
+        return query
+    try:
+        return query.as_string(cursor)  # psycopg2.sql.Composed
+    except Exception:
+        return repr(query)
+
+
+def _env_int(name, default):
+    try:
+        return int(os.getenv(name, default))
+    except ValueError:
+        return default
+
+
+class SQLProfiler:
+    """Starts and judges per-request profiles; flagged requests go to the store"""
+
+    def __init__(self, enabled=None, query_budget=None, repeat_limit=None, store=None, log=print):
+        if enabled is None:
+            enabled = os.getenv('SQL_PROFILER', '').lower() in ('1', 'true', 'yes', 'on')
+        self.enabled = enabled
+        if query_budget is None:
+            query_budget = _env_int('SQL_QUERY_BUDGET', DEFAULT_QUERY_BUDGET)
+        if repeat_limit is None:
+            repeat_limit = _env_int('SQL_REPEAT_LIMIT', DEFAULT_REPEAT_LIMIT)
+        self.query_budget = query_budget
+        self.repeat_limit = repeat_limit
+        self.store = store if store is not None else MemoryProfileStore()
+        self.log = log
+
+    def begin(self):
+        """Start profiling the current context; returns a token for end()"""
+        if not self.enabled:
+            return None
+        return _current_profile.set(QueryProfile())
+
+    def end(self, token, endpoint, method, request_seconds) -> Optional[ProfileReport]:
+        """Stop profiling; returns the report if the request broke a limit"""
+        if token is None:
+            return None
+        profile = _current_profile.get()
+        _current_profile.reset(token)
+        if profile is None:
+            return None
+
+        repeated = profile.most_repeated()
+        repeated_sql, repeats = (repeated[0], repeated[1].count) if repeated else (None, 0)
+        report = ProfileReport(
+            endpoint=endpoint,
+            method=method,
+            queries=profile.queries,
+            sql_ms=round(profile.seconds * 1000, 1),
+            request_ms=round(request_seconds * 1000, 1),
+            repeated_sql=repeated_sql,
+            repeats=repeats,
+            over_budget=profile.queries > self.query_budget,
+            n_plus_one=repeats > self.repeat_limit,
+        )
+        if not (report.over_budget or report.n_plus_one):
+            return None
+
+        self.log(report.summary())
+        try:
+            self.store.record(report)
+        except Exception as e:
+            self.log(f"SQL profile store unavailable: {e}")
+        return report
+
+
+class MemoryProfileStore:
+    """Per-process offenders, for TESTING and the memory backend"""
+
+    def __init__(self):
+        self.rows: Dict[tuple, dict] = {}
+        self._lock = threading.Lock()
+
+    def record(self, report: ProfileReport):
+        with self._lock:
+            row = self.rows.setdefault((report.endpoint, report.method), {
+                'endpoint': report.endpoint, 'method': report.method, 'flagged_requests': 0,
+                'n_plus_one_requests': 0, 'max_queries': 0, 'last_queries': 0, 'max_repeats': 0,
+                'repeated_sql': None, 'max_sql_ms': 0.0, 'last_seen': None,
+            })
+            row['flagged_requests'] += 1
+            row['n_plus_one_requests'] += int(report.n_plus_one)
+            row['max_queries'] = max(row['max_queries'], report.queries)
+            row['last_queries'] = report.queries
+            if report.repeats >= row['max_repeats']:
+                row['max_repeats'], row['repeated_sql'] = report.repeats, report.repeated_sql
+            row['max_sql_ms'] = max(row['max_sql_ms'], report.sql_ms)
+            row['last_seen'] = datetime.now()
+
+    def top_offenders(self, limit=20) -> List[dict]:
+        with self._lock:
+            rows = sorted(self.rows.values(), key=lambda r: (r['max_repeats'], r['max_queries']), reverse=True)
+            return [dict(row) for row in rows[:limit]]
+
+
+def _store_connection():
+    database_url = os.getenv('DATABASE_URL')
+    if database_url:
+        conn = psycopg2.connect(database_url)
+    else:
+        conn = psycopg2.connect(host=os.getenv('DB_HOST'), port=int(os.getenv('DB_PORT', '5432')),
+                                database=os.getenv('DB_NAME'), user=os.getenv('DB_USER'),
+                                password=os.getenv('DB_PASSWORD'))
+    conn.autocommit = True
+    return conn
+
+
+class PostgresProfileStore:
+    """Flagged endpoints from every worker, in sql_profile_offenders"""
+
+    def __init__(self, connect=_store_connection):
+        self.connect = connect
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _cursor(self):
+        # Connections are not fork-safe; each worker opens its own
+        if self._conn is None or self._conn.closed or self._pid != os.getpid():
+            self._conn = self.connect()
+            self._pid = os.getpid()
+        return self._conn.cursor()
+
+    def record(self, report: ProfileReport):
+        with self._lock:
+            try:
+                self._cursor().execute("""
+                    INSERT INTO sql_profile_offenders
+                        (endpoint, method, flagged_requests, n_plus_one_requests, max_queries, last_queries,
+                         max_repeats, repeated_sql, max_sql_ms, last_seen)
+                    VALUES (%s, %s, 1, %s, %s, %s, %s, %s, %s, CURRENT_TIMESTAMP)
+                    ON CONFLICT (endpoint, method) DO UPDATE SET
+                        flagged_requests = sql_profile_offenders.flagged_requests + 1,
+                        n_plus_one_requests = sql_profile_offenders.n_plus_one_requests + EXCLUDED.n_plus_one_requests,
+                        max_queries = GREATEST(sql_profile_offenders.max_queries, EXCLUDED.max_queries),
+                        last_queries = EXCLUDED.last_queries,
+                        repeated_sql = CASE WHEN EXCLUDED.max_repeats >= sql_profile_offenders.max_repeats
+                                            THEN EXCLUDED.repeated_sql ELSE sql_profile_offenders.repeated_sql END,
+                        max_repeats = GREATEST(sql_profile_offenders.max_repeats, EXCLUDED.max_repeats),
+                        max_sql_ms = GREATEST(sql_profile_offenders.max_sql_ms, EXCLUDED.max_sql_ms),
+                        last_seen = CURRENT_TIMESTAMP
+                """, (report.endpoint, report.method, int(report.n_plus_one), report.queries, report.queries,
+                      report.repeats, report.repeated_sql, report.sql_ms))
+            except Exception:
+                self._conn = None
+                raise
+
+    def top_offenders(self, limit=20) -> List[dict]:
+        with self._lock:
+            try:
+                cur = self._cursor()
+                cur.execute("""
+                    SELECT endpoint, method, flagged_requests, n_plus_one_requests, max_queries, last_queries,
+                           max_repeats, repeated_sql, max_sql_ms, last_seen
+                    FROM sql_profile_offenders
+                    ORDER BY max_repeats DESC, max_queries DESC
+                    LIMIT %s
+                """, (limit,))
+                columns = [d[0] for d in cur.description]
+                return [dict(zip(columns, row)) for row in cur.fetchall()]
+            except Exception:
+                self._conn = None
+                raise
@@ -0,0 +1,118 @@
+"""
+Streaming export helpers.
+
+Exports iterate a named (server-side) PostgreSQL cursor in fixed-size
+chunks and encode rows incrementally, so memory stays flat no matter how
+many years of mood logs or chat history a user has. Pair with Flask's
+stream_with_context so the request-scoped pooled connection stays open
+until the last chunk has been sent:
+
+    def generate():
+        conn = get_db_connection()
+        rows = iter_rows(conn, "SELECT ... WHERE username=%s", (username,))
+        yield from csv_chunks(rows, header=['timestamp', 'mood'])
+
+    return Response(stream_with_context(generate()), mimetype='text/csv')
+"""
+
+import csv
+import io
+import json
+import secrets
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence
+
+EXPORT_CHUNK_SIZE = 2000    # rows fetched per round trip from the server-side cursor
+ROWS_PER_WRITE = 500        # rows encoded per yielded chunk
+
+
+def iter_row_chunks(conn, query: str, params: Sequence = (), chunk_size: int = EXPORT_CHUNK_SIZE,
+                    name_prefix: str = 'export', withhold: bool = False) -> Iterator[List[tuple]]:
+    """
+    Yield lists of up to chunk_size rows from a named server-side cursor.
+
+    Only one chunk is held client-side at once. The cursor is closed when the
+    iterator is exhausted or closed (e.g. the client disconnects mid-download).
+    withhold=True declares the cursor WITH HOLD so it survives commits made
+    between chunks (checkpointing background jobs).
+    """
+    name = f"{name_prefix}_{secrets.token_hex(6)}"
+    cur = conn.cursor(name=name, withhold=True) if withhold else conn.cursor(name=name)
+    cur.itersize = chunk_size
+    try:
+        cur.execute(query, params)
+        while True:
+            rows = cur.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        cur.close()
+
+
+def iter_rows(conn, query: str, params: Sequence = (), chunk_size: int = EXPORT_CHUNK_SIZE,
+              name_prefix: str = 'export') -> Iterator[tuple]:
+    """Yield rows one at a time from a named server-side cursor (see iter_row_chunks)."""
+    for rows in iter_row_chunks(conn, query, params, chunk_size, name_prefix):
+        yield from rows
+
+
+def _default(value: Any):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    return str(value)
+
+
+def csv_chunks(rows: Iterable[Sequence], header: Optional[Sequence[str]] = None,
+               rows_per_write: int = ROWS_PER_WRITE) -> Iterator[str]:
+    """Encode rows as CSV, yielding one string per rows_per_write rows."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    pending = 0
+
+    if header:
+        writer.writerow(header)
+        pending += 1
+
+    for row in rows:
+        writer.writerow(row)
+        pending += 1
+        if pending >= rows_per_write:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            pending = 0
+
+    if pending:
+        yield buffer.getvalue()
+
+
+def ndjson_chunks(records: Iterable[Dict[str, Any]], rows_per_write: int = ROWS_PER_WRITE) -> Iterator[str]:
+    """Encode dicts as newline-delimited JSON."""
+    lines = []
+    for record in records:
+        lines.append(json.dumps(record, default=_default))
+        if len(lines) >= rows_per_write:
+            yield '\n'.join(lines) + '\n'
+            lines = []
+    if lines:
+        yield '\n'.join(lines) + '\n'
+
+
+def json_array_chunks(records: Iterable[Dict[str, Any]], rows_per_write: int = ROWS_PER_WRITE) -> Iterator[str]:
+    """Encode dicts as a single JSON array without materialising it."""
+    yield '['
+    first = True
+    lines = []
+    for record in records:
+        lines.append(('' if first else ',') + '\n  ' + json.dumps(record, default=_default))
+        first = False
+        if len(lines) >= rows_per_write:
+            yield ''.join(lines)
+            lines = []
+    if lines:
+        yield ''.join(lines)
+    yield '\n]\n' if not first else ']\n'
@@ -0,0 +1,222 @@
+"""
+Tests for the streaming training dataset builder (ai_trainer.py).
+
+Covers:
+  - Sessions streamed from training_chats via a server-side cursor
+  - Each turn tokenized once; contexts built by token slicing
+  - Tokenized shards cached on disk and reused
+  - Turn-ending EOS tokens kept in the loss; only padding masked
+  - A CPU-only training step with a tiny model (skipped without transformers)
+"""
+
+import json
+
+import pytest
+
+import ai_trainer
+from ai_trainer import build_context_windows, build_tokenized_shards, iter_sessions
+
+
+class WordTokenizer:
+    """Whitespace tokenizer that records how often each text is encoded."""
+
+    eos_token_id = 0
+    name_or_path = 'word-tokenizer'
+
+    def __init__(self):
+        self.vocab = {}
+        self.encoded = []
+
+    def __len__(self):
+        return 1000  # fixed, like a real vocabulary
+
+    def __call__(self, texts, add_special_tokens=True):
+        self.encoded.extend(texts)
+        return {'input_ids': [[self.vocab.setdefault(w, len(self.vocab) + 1) for w in t.split()] for t in texts]}
+
+
+class ChatCursor:
+    def __init__(self, rows, conn):
+        self.rows = rows
+        self.conn = conn
+
+    def execute(self, query, params=None):
+        self.conn.queries.append((query, params))
+        return self
+
+    def fetchmany(self, size):
+        self.conn.fetch_sizes.append(size)
+        batch, self.rows = self.rows[:size], self.rows[size:]
+        return batch
+
+    def close(self):
+        pass
+
+
+class ChatConnection:
+    def __init__(self, rows):
+        self.rows = rows
+        self.queries = []
+        self.fetch_sizes = []
+
+    def cursor(self, name=None):
+        assert name, 'training data must stream from a named cursor'
+        return ChatCursor(list(self.rows), self)
+
+
+def _conversation(session, turns, start_id=1):
+    rows = []
+    for i in range(turns):
+        role = 'user' if i % 2 == 0 else 'ai'
+        rows.append((start_id + i, session, role, f'{role}{i} says words number {i}'))
+    return rows
+
+
+class TestIterSessions:
+
+    def test_groups_across_fetch_batches(self):
+        rows = _conversation('s1', 5) + _conversation('s2', 3, start_id=6)
+        conn = ChatConnection(rows)
+
+        sessions = list(iter_sessions(conn, 0, 8, batch_size=2))
+
+        assert [(s, len(turns)) for s, turns in sessions] == [('s1', 5), ('s2', 3)]
+        assert conn.queries[0][1] == (0, 8, 8)
+        assert set(conn.fetch_sizes) == {2}
+
+
+class TestContextWindows:
+
+    def test_each_turn_tokenized_once(self):
+        tokenizer = WordTokenizer()
+        sessions = [('s1', [(i, role, text) for i, _, role, text in _conversation('s1', 40)])]
+
+        examples = list(build_context_windows(sessions, tokenizer, max_length=64))
+
+        assert len(tokenizer.encoded) == 40
+        assert len(examples) == 20  # one per therapist reply
+        assert all(len(ids) <= 64 for ids in examples)
+
+    def test_context_is_latest_history_then_reply(self):
+        tokenizer = WordTokenizer()
+        turns = [(1, 'user', 'hello there'), (2, 'ai', 'hi friend'), (3, 'user', 'bad day'), (4, 'ai', 'tell me')]
+
+        examples = list(build_context_windows([('s', turns)], tokenizer, max_length=9))
+        decode = {v: k for k, v in tokenizer.vocab.items()}
+        decode[0] = '<eos>'
+
+        assert [decode[t] for t in examples[0]] == ['Patient:', 'hello', 'there', '<eos>', 'Therapist:', 'hi', 'friend', '<eos>']
+        # 9 tokens: the oldest turn is sliced off to fit
+        assert [decode[t] for t in examples[1]] == ['there', '<eos>', 'Therapist:', 'hi', 'friend', '<eos>',
+                                                    'Patient:', 'bad', 'day', '<eos>', 'Therapist:', 'tell', 'me',
+                                                    '<eos>'][-9:]
+
+    def test_only_replies_after_watermark(self):
+        tokenizer = WordTokenizer()
+        turns = [(i, role, text) for i, _, role, text in _conversation('s1', 6)]
+
+        examples = list(build_context_windows([('s1', turns)], tokenizer, max_length=128, from_id=4))
+
+        assert len(examples) == 1  # only turn 6; turns 2 and 4 were trained last time
+        assert len(examples[0]) > 20  # but it still sees the earlier turns as context
+
+    def test_opening_reply_without_context_skipped(self):
+        tokenizer = WordTokenizer()
+        assert list(build_context_windows([('s', [(1, 'ai', 'welcome back')])], tokenizer)) == []
+
+
+class TestShardCache:
+
+    @pytest.fixture(autouse=True)
+    def arrow(self):
+        pytest.importorskip('pyarrow')
+
+    def test_builds_shards_and_manifest(self, tmp_path):
+        conn = ChatConnection(_conversation('s1', 10) + _conversation('s2', 10, start_id=11))
+
+        manifest = build_tokenized_shards(conn, WordTokenizer(), 0, 20, max_length=32,
+                                          cache_dir=str(tmp_path), shard_size=4)
+
+        assert manifest['examples'] == 10
+        assert manifest['sessions'] == 2
+        assert len(manifest['shards']) == 3
+        import pyarrow as pa
+        with pa.OSFile(manifest['shards'][0], 'rb') as source:
+            table = pa.ipc.open_stream(source).read_all()
+        assert table.column_names == ['input_ids', 'length']
+        assert table['length'].to_pylist() == [len(ids) for ids in table['input_ids'].to_pylist()]
+
+    def test_cached_build_skips_database(self, tmp_path):
+        tokenizer = WordTokenizer()
+        first = build_tokenized_shards(ChatConnection(_conversation('s1', 6)), tokenizer, 0, 6,
+                                       cache_dir=str(tmp_path))
+        conn = ChatConnection(_conversation('s1', 6))
+
+        again = build_tokenized_shards(conn, tokenizer, 0, 6, cache_dir=str(tmp_path))
+
+        assert again == first
+        assert conn.queries == []
+
+    def test_interrupted_build_redone(self, tmp_path):
+        tokenizer = WordTokenizer()
+        manifest = build_tokenized_shards(ChatConnection(_conversation('s1', 6)), tokenizer, 0, 6,
+                                          cache_dir=str(tmp_path))
+        (tmp_path / manifest['key'] / 'manifest.json').unlink()
+        conn = ChatConnection(_conversation('s1', 6))
+
+        rebuilt = build_tokenized_shards(conn, tokenizer, 0, 6, cache_dir=str(tmp_path))
+
+        assert conn.queries
+        assert json.loads((tmp_path / manifest['key'] / 'manifest.json').read_text()) == rebuilt
+
+
+class TestCollator:
+
+    def test_eos_kept_in_loss_padding_masked(self):
+        pytest.importorskip('torch')
+        if not ai_trainer.HAS_TRANSFORMERS:
+            pytest.skip('needs transformers')
+
+        batch = ai_trainer.CausalLMCollator(pad_token_id=0)([{'input_ids': [5, 6, 0, 7, 0]},
+                                                             {'input_ids': [8, 0]}])
+
+        assert batch['input_ids'].tolist() == [[5, 6, 0, 7, 0], [8, 0, 0, 0, 0]]
+        assert batch['attention_mask'].tolist() == [[1, 1, 1, 1, 1], [1, 1, 0, 0, 0]]
+        assert batch['labels'].tolist() == [[5, 6, 0, 7, 0], [8, 0, -100, -100, -100]]
+
+
+class TestTinyModelTraining:
+
+    def test_cpu_training_step(self, tmp_path):
+        pytest.importorskip('torch')
+        pytest.importorskip('transformers')
+        pytest.importorskip('datasets')
+        from tokenizers import Tokenizer, models, pre_tokenizers
+        from transformers import (GPT2Config, GPT2LMHeadModel, PreTrainedTokenizerFast, Trainer,
+                                  TrainingArguments)
+
+        rows = _conversation('s1', 12) + _conversation('s2', 8, start_id=13)
+        words = sorted({w for *_, text in rows for w in text.split()} | {'Patient:', 'Therapist:'})
+        vocab = {'<eos>': 0, '<unk>': 1, **{w: i + 2 for i, w in enumerate(words)}}
+        core = Tokenizer(models.WordLevel(vocab, unk_token='<unk>'))
+        core.pre_tokenizer = pre_tokenizers.WhitespaceSplit()
+        tokenizer = PreTrainedTokenizerFast(tokenizer_object=core, eos_token='<eos>', pad_token='<eos>',
+                                            unk_token='<unk>')
+
+        manifest = build_tokenized_shards(ChatConnection(rows), tokenizer, 0, 20, max_length=32,
+                                          cache_dir=str(tmp_path / 'cache'))
+        dataset = ai_trainer.load_shards(manifest)
+        model = GPT2LMHeadModel(GPT2Config(vocab_size=len(vocab), n_positions=32, n_embd=16, n_layer=1, n_head=2))
+
+        trainer = Trainer(
+            model=model,
+            args=TrainingArguments(output_dir=str(tmp_path / 'out'), max_steps=2, per_device_train_batch_size=4,
+                                   report_to='none', use_cpu=True, group_by_length=True,
+                                   length_column_name='length'),
+            train_dataset=dataset,
+            data_collator=ai_trainer.CausalLMCollator(tokenizer.pad_token_id),
+        )
+        result = trainer.train()
+
+        assert len(dataset) == 10
+        assert result.training_loss > 0
@@ -600,7 +600,7 @@ class TestSessionManagement:
     def test_authenticated_user_returned_from_session(self, client):
         """get_authenticated_username returns username when session is valid and user exists in DB."""
         mock_get_db, mock_get_cursor, conn, cursor = make_mock_db({
-            "SELECT role FROM users WHERE username": ("user",),
+            "SELECT role, clinician_id FROM users WHERE username": ("user", None),
         })
 
         with client.session_transaction() as sess:
@@ -679,7 +679,7 @@ class TestXUsernameBypassLogging:
     def test_x_username_with_valid_session_no_log(self, mock_log, client):
         """X-Username header WITH valid session should not log bypass attempt."""
         mock_get_db, mock_get_cursor, conn, cursor = make_mock_db({
-            "SELECT role FROM users WHERE username": ("user",),
+            "SELECT role, clinician_id FROM users WHERE username": ("user", None),
         })
 
         with client.application.test_request_context(
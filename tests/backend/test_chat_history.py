@@ -0,0 +1,203 @@
+"""
+Tests for chat_history ids and keyset pagination (migration 5).
+
+Covers:
+  - fetch_chat_history_page: newest page, before_id pages, after_id deltas
+  - GET /api/therapy/history cursors and limits
+  - GET /api/professional/patient/<username>/chat-history older pages
+  - POST /api/therapy/chat returns the new message ids
+  - Migration 5 backfills ids in timestamp order and keys the table
+"""
+
+from datetime import datetime
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+import api
+import migrations
+from tests.backend.test_message_dispatcher import RecordingConnection, RecordingCursor
+
+NOW = datetime(2026, 10, 19, 9, 30)
+
+
+def _rows(*ids):
+    return [(i, 'user' if i % 2 else 'ai', f'message {i}', NOW) for i in ids]
+
+
+def _last_query(cursor):
+    return ' '.join(cursor.executed[-1][0].split()), cursor.executed[-1][1]
+
+
+class TestFetchChatHistoryPage:
+
+    def test_newest_page_returned_oldest_first(self):
+        cursor = RecordingCursor(_rows(9, 8, 7))
+
+        page = api.fetch_chat_history_page(cursor, 'chat_session_id', 3, limit=2)
+
+        sql, params = _last_query(cursor)
+        assert 'WHERE chat_session_id = %s ORDER BY id DESC LIMIT %s' in sql
+        assert params == (3, 3)
+        assert [m['id'] for m in page['history']] == [8, 9]
+        assert page['has_more'] is True
+        assert page['next_before_id'] == 8
+        assert page['latest_id'] == 9
+
+    def test_before_id_pages_backwards(self):
+        cursor = RecordingCursor(_rows(7, 6))
+
+        page = api.fetch_chat_history_page(cursor, 'session_id', 'p_session', limit=2, before_id=8)
+
+        sql, params = _last_query(cursor)
+        assert 'session_id = %s AND id < %s ORDER BY id DESC' in sql
+        assert params == ('p_session', 8, 3)
+        assert [m['id'] for m in page['history']] == [6, 7]
+        assert page['has_more'] is False
+        assert page['next_before_id'] is None
+
+    def test_after_id_returns_only_newer(self):
+        cursor = RecordingCursor(_rows(10, 11))
+
+        page = api.fetch_chat_history_page(cursor, 'chat_session_id', 3, after_id=9)
+
+        sql, params = _last_query(cursor)
+        assert 'id > %s ORDER BY id ASC' in sql
+        assert params[1] == 9
+        assert [m['id'] for m in page['history']] == [10, 11]
+        assert page['latest_id'] == 11
+
+    def test_empty_delta_keeps_cursor(self):
+        page = api.fetch_chat_history_page(RecordingCursor([]), 'chat_session_id', 3, after_id=9)
+
+        assert page['history'] == []
+        assert page['latest_id'] == 9
+
+    def test_rejects_unknown_column(self):
+        with pytest.raises(ValueError):
+            api.fetch_chat_history_page(RecordingCursor([]), 'sender', 'x')
+
+
+class TestHistoryEndpoint:
+
+    def test_active_session_page(self, auth_patient, mock_db):
+        client, _ = auth_patient
+        _, cursor = mock_db({
+            'SELECT id FROM chat_sessions': (4,),
+            'FROM chat_history': _rows(12, 11),
+        })
+
+        resp = client.get('/api/therapy/history?before_id=13&limit=5')
+        data = resp.get_json()
+
+        assert resp.status_code == 200
+        assert [m['id'] for m in data['history']] == [11, 12]
+        assert data['has_more'] is False
+        assert cursor._last_params == (4, 13, 6)
+
+    def test_limit_is_capped(self, auth_patient, mock_db):
+        client, _ = auth_patient
+        _, cursor = mock_db({'SELECT id FROM chat_sessions': (4,), 'FROM chat_history': []})
+
+        client.get('/api/therapy/history?limit=100000')
+
+        assert cursor._last_params[-1] == api.CHAT_HISTORY_MAX_PAGE_SIZE + 1
+
+    def test_both_cursors_rejected(self, auth_patient, mock_db):
+        client, _ = auth_patient
+        mock_db({})
+
+        resp = client.get('/api/therapy/history?before_id=5&after_id=2')
+
+        assert resp.status_code == 400
+
+
+class TestClinicianHistoryEndpoint:
+
+    def test_older_page_newest_first(self, auth_clinician, mock_db):
+        client, _ = auth_clinician
+        _, cursor = mock_db({'SELECT role FROM users': ('clinician',), 'FROM chat_history': _rows(40, 39)})
+
+        with patch.object(api, 'verify_clinician_patient_relationship', return_value=(True, None)):
+            resp = client.get('/api/professional/patient/test_patient/chat-history?before_id=41')
+        data = resp.get_json()
+
+        assert resp.status_code == 200
+        assert [m['id'] for m in data['chat_history']] == [40, 39]
+        assert data['has_more'] is False
+        assert cursor._last_params == ('test_patient_session', 41, 51)
+
+    def test_before_id_required(self, auth_clinician, mock_db):
+        client, _ = auth_clinician
+        mock_db({'SELECT role FROM users': ('clinician',)})
+
+        resp = client.get('/api/professional/patient/test_patient/chat-history')
+
+        assert resp.status_code == 400
+
+    def test_unassigned_patient_forbidden(self, auth_clinician, mock_db):
+        client, _ = auth_clinician
+        mock_db({'SELECT role FROM users': ('clinician',)})
+
+        with patch.object(api, 'verify_clinician_patient_relationship', return_value=(False, 'Not assigned')):
+            resp = client.get('/api/professional/patient/other_patient/chat-history?before_id=41')
+
+        assert resp.status_code == 403
+
+
+class TestChatWritePath:
+
+    def test_chat_returns_message_ids(self, auth_patient, mock_db):
+        client, _ = auth_patient
+        mock_db({
+            'SELECT id FROM chat_sessions': (4,),
+            'INSERT INTO chat_history': (42,),
+            'SELECT sender, message FROM chat_history': [],
+            'SELECT keyword, category, severity_weight FROM risk_keywords': [],
+        })
+        ai = MagicMock()
+        ai.get_response.return_value = 'Tell me more.'
+
+        with patch.object(api, 'TherapistAI', return_value=ai), \
+             patch.object(api, 'get_user_ai_memory', return_value=None), \
+             patch.object(api, 'log_therapy_interaction_to_memory'), \
+             patch.object(api, 'mark_daily_task_complete'), \
+             patch.object(api.training_manager, 'check_user_consent', return_value=False), \
+             patch.object(api, 'log_event'):
+            resp = client.post('/api/therapy/chat', json={'message': 'I feel anxious today'})
+
+        data = resp.get_json()
+        assert resp.status_code == 200
+        assert data['user_message_id'] == data['ai_message_id'] == 42
+        assert data['chat_session_id'] == 4
+
+
+class TestChatHistoryIdsMigration:
+
+    def _statements(self, partitioned):
+        class Cursor(RecordingCursor):
+            def fetchone(self):
+                return (partitioned,)
+
+        cursor = Cursor()
+        migrations.chat_history_ids(RecordingConnection(cursor))
+        return [' '.join(sql.split()) for sql, _ in cursor.executed]
+
+    def test_backfills_in_timestamp_order(self):
+        statements = self._statements(partitioned=True)
+
+        backfill = next(s for s in statements if s.startswith('UPDATE chat_history'))
+        assert 'row_number() OVER (ORDER BY timestamp, ctid)' in backfill
+        assert statements.index(backfill) < statements.index(
+            "ALTER TABLE chat_history ALTER COLUMN id SET NOT NULL")
+
+    def test_partitioned_key_includes_timestamp(self):
+        assert 'ALTER TABLE chat_history ADD PRIMARY KEY (id, "timestamp")' in self._statements(True)
+        assert 'ALTER TABLE chat_history ADD PRIMARY KEY (id)' in self._statements(False)
+
+    def test_session_indexes_keyed_on_id(self):
+        statements = self._statements(partitioned=True)
+
+        assert any('ON chat_history (chat_session_id, id)' in s for s in statements)
+        assert any('ON chat_history (session_id, id)' in s for s in statements)
+        assert 'DROP INDEX IF EXISTS idx_chat_history_chat_session_time' in statements
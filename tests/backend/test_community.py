@@ -45,22 +45,68 @@ class TestGetCommunityPosts:
         p1, p2, mock_conn, mock_cursor = _mock_db()
 
         now = datetime.now().isoformat()
-        # First fetchall returns posts
         mock_cursor.fetchall.side_effect = [
-            [(1, 'user1', 'Hello world', 5, now, 'general', 0)],  # posts
-            [('like', 3), ('heart', 2)],  # reactions for post 1
-            [],   # user_reactions
-            [(10, 'user2', 'Nice post!', now)],  # replies for post 1
+            [(1, 'user1', 'Hello world', 5, now, 'general', 0, {'like': 3, 'heart': 2}, 1)],  # posts page
+            [(1, 'heart')],  # user_reactions for the page
+            [(1, 10, 'user2', 'Nice post!', now)],  # reply previews for the page
         ]
         mock_cursor.fetchone.return_value = None
 
         with p1, p2:
-            resp = client.get('/api/community/posts')
+            resp = client.get('/api/community/posts?username=test_patient')
 
         assert resp.status_code == 200
         data = resp.get_json()
         assert 'posts' in data
         assert 'categories' in data
+        post = data['posts'][0]
+        assert post['reactions'] == {'like': 3, 'heart': 2}
+        assert post['user_reactions'] == ['heart']
+        assert post['replies'][0]['id'] == 10
+        assert post['reply_count'] == 1
+        assert data['has_more'] is False
+
+    def test_get_posts_constant_query_count(self, client):
+        """Query count must not grow with the number of posts on the page."""
+        p1, p2, mock_conn, mock_cursor = _mock_db()
+
+        now = datetime.now()
+        posts = [(i, 'user1', f'Post {i}', 0, now, 'general', 0, {}, 0) for i in range(1, 21)]
+        mock_cursor.fetchall.side_effect = [posts, [], []]
+
+        with p1, p2:
+            resp = client.get('/api/community/posts?username=test_patient')
+
+        assert resp.status_code == 200
+        assert len(resp.get_json()['posts']) == 20
+        assert mock_cursor.execute.call_count == 3
+
+    def test_get_posts_cursor_pagination(self, client):
+        """An extra row means another page; its cursor is passed back as `before`."""
+        p1, p2, mock_conn, mock_cursor = _mock_db()
+
+        now = datetime(2026, 1, 1, 12, 0, 0)
+        posts = [(i, 'user1', f'Post {i}', 0, now, 'general', 0, {}, 0) for i in (9, 8, 7)]
+        mock_cursor.fetchall.side_effect = [posts, []]
+
+        with p1, p2:
+            resp = client.get('/api/community/posts?limit=2')
+            data = resp.get_json()
+            assert [p['id'] for p in data['posts']] == [9, 8]
+            assert data['has_more'] is True
+
+            mock_cursor.fetchall.side_effect = [[], []]
+            resp = client.get(f"/api/community/posts?limit=2&before={data['next_cursor']}")
+
+        assert resp.status_code == 200
+        query, params = mock_cursor.execute.call_args_list[-1][0]
+        assert '(is_pinned, entry_timestamp, id) < (%s, %s, %s)' in query
+        assert params == (0, now, 8, 3)
+
+    def test_get_posts_invalid_cursor(self, client):
+        """A malformed cursor is a client error."""
+        resp = client.get('/api/community/posts?before=garbage')
+        assert resp.status_code == 400
 
     def test_get_posts_with_category_filter(self, client):
         """Should filter posts by category when provided."""
@@ -110,6 +156,28 @@ class TestGetCommunityChannels:
         assert 'channels' in data
         assert len(data['channels']) == 14  # 14 valid categories
 
+    def test_channels_two_queries_with_unread(self, client):
+        """Stats + one grouped unread query, regardless of channel count."""
+        p1, p2, mock_conn, mock_cursor = _mock_db()
+
+        latest = datetime(2026, 1, 2, 9, 0)
+        mock_cursor.fetchall.side_effect = [
+            [('anxiety', 12, latest), ('grief', 30, latest), ('sleep', 0, None)],  # channel stats
+            [('anxiety', 3)],  # unread for channels the user has opened
+        ]
+
+        with p1, p2:
+            resp = client.get('/api/community/channels?username=test_patient')
+
+        assert resp.status_code == 200
+        channels = {c['id']: c for c in resp.get_json()['channels']}
+        assert mock_cursor.execute.call_count == 2
+        assert channels['anxiety']['post_count'] == 12
+        assert channels['anxiety']['unread_count'] == 3
+        assert channels['grief']['unread_count'] == 10  # never opened: capped at 10
+        assert channels['sleep']['unread_count'] == 0
+        assert channels['trauma']['post_count'] == 0
+
 
 # ==================== POST /api/community/post ====================
 
@@ -129,6 +197,8 @@ class TestCreateCommunityPost:
         assert resp.status_code == 201
         data = resp.get_json()
         assert data['success'] is True
+        queries = [c[0][0] for c in mock_cursor.execute.call_args_list]
+        assert any('INSERT INTO community_channel_stats' in q for q in queries)
 
     def test_create_post_missing_username(self, client):
         """Should return 400 when username is missing."""
@@ -192,6 +262,8 @@ class TestCreateReply:
         data = resp.get_json()
         assert data['success'] is True
         assert data['reply_id'] == 42
+        queries = [c[0][0] for c in mock_cursor.execute.call_args_list]
+        assert any('reply_count = reply_count + 1' in q for q in queries)
 
     def test_reply_missing_message(self, client):
         """Should return 400 when message is missing."""
@@ -258,8 +330,8 @@ class TestReactToPost:
     def test_react_success(self, client):
         """Should add a reaction and return updated counts."""
         p1, p2, mock_conn, mock_cursor = _mock_db()
-        mock_cursor.fetchone.return_value = None  # no existing reaction
-        mock_cursor.fetchall.return_value = [('heart', 1)]  # reaction counts
+        mock_cursor.fetchall.return_value = []  # DELETE ... RETURNING: no existing reaction
+        mock_cursor.fetchone.return_value = ({'heart': 1}, 1)  # counters after increment
 
         with p1, p2:
             resp = client.post('/api/community/post/1/react',
@@ -270,12 +342,17 @@ class TestReactToPost:
         data = resp.get_json()
         assert data['success'] is True
         assert data['action'] == 'added'
+        assert data['reactions'] == {'heart': 1}
+        assert data['total'] == 1
+        # counters adjusted in place, no GROUP BY recount
+        queries = [c[0][0] for c in mock_cursor.execute.call_args_list]
+        assert not any('GROUP BY' in q for q in queries)
 
     def test_react_toggle_off(self, client):
         """Should remove an existing reaction (toggle off)."""
         p1, p2, mock_conn, mock_cursor = _mock_db()
-        mock_cursor.fetchone.return_value = (1,)  # existing reaction found
-        mock_cursor.fetchall.return_value = []  # no reactions left
+        mock_cursor.fetchall.return_value = [(7,)]  # DELETE ... RETURNING: existing reaction removed
+        mock_cursor.fetchone.return_value = ({'heart': 0}, 0)  # counters after decrement
 
         with p1, p2:
             resp = client.post('/api/community/post/1/react',
@@ -285,6 +362,7 @@ class TestReactToPost:
         assert resp.status_code == 200
         data = resp.get_json()
         assert data['action'] == 'removed'
+        assert data['reactions'] == {}
 
     def test_react_invalid_type(self, client):
         """Should return 400 for invalid reaction type."""
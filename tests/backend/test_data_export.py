@@ -2,15 +2,19 @@
 Tests for Chat Export and Data Export endpoints.
 
 Covers:
-  - POST /api/therapy/export (chat history export in txt/json/csv)
+  - POST /api/therapy/export (chat history export in txt/json/ndjson/csv)
+  - GET /api/export/csv
+  - Streaming from server-side cursors with a constant memory ceiling
 """
 
 import json
+import tracemalloc
 import pytest
 from unittest.mock import patch, MagicMock
 from datetime import datetime
 
 import api
+from streaming_export import EXPORT_CHUNK_SIZE
 from tests.conftest import make_mock_db
 
 
@@ -116,3 +120,157 @@ class TestChatExport:
         })
 
         assert resp.status_code == 200
+
+    def test_export_uses_half_open_range(self, client, mock_db):
+        """Date filter is a plain parameterised range (no SQLite datetime())."""
+        conn, cursor = mock_db([])
+
+        resp = client.post('/api/therapy/export', json={
+            'username': 'test_patient',
+            'from_date': '2026-01-01',
+            'to_date': '2026-02-28',
+            'format': 'csv',
+        })
+        resp.get_data()
+
+        assert 'datetime(' not in cursor._last_query
+        assert 'timestamp >= %s AND timestamp < %s' in cursor._last_query
+        assert cursor._last_params[1:] == (datetime(2026, 1, 1), datetime(2026, 3, 1))
+
+    def test_export_invalid_date(self, client, mock_db):
+        """Malformed dates return 400 before anything is streamed."""
+        resp = client.post('/api/therapy/export', json={
+            'username': 'test_patient',
+            'from_date': '01/01/2026',
+            'to_date': '2026-02-28',
+        })
+        assert resp.status_code == 400
+
+    def test_export_ndjson(self, client, mock_db):
+        """NDJSON export emits one JSON object per line."""
+        mock_db([('user', 'Hello', '2026-01-02T10:00:00'), ('ai', 'Hi', '2026-01-02T10:00:05')])
+
+        resp = client.post('/api/therapy/export', json={
+            'username': 'test_patient',
+            'from_date': '2026-01-01',
+            'to_date': '2026-02-28',
+            'format': 'ndjson',
+        })
+        lines = resp.get_data(as_text=True).splitlines()
+
+        assert 'ndjson' in resp.content_type
+        assert [json.loads(line)['sender'] for line in lines] == ['user', 'ai']
+
+    def test_export_json_is_valid_array(self, client, mock_db):
+        """Chunked JSON output still parses as one array."""
+        mock_db([('user', f'msg {i}', '2026-01-02T10:00:00') for i in range(1200)])
+
+        resp = client.post('/api/therapy/export', json={
+            'username': 'test_patient',
+            'from_date': '2026-01-01',
+            'to_date': '2026-02-28',
+            'format': 'json',
+        })
+        data = json.loads(resp.get_data(as_text=True))
+
+        assert len(data) == 1200
+        assert data[-1]['message'] == 'msg 1199'
+
+
+# ==================== CSV DATA EXPORT (GET /api/export/csv) ====================
+
+class TestCsvExport:
+    """Tests for GET /api/export/csv"""
+
+    def test_missing_username(self, client, mock_db):
+        resp = client.get('/api/export/csv')
+        assert resp.status_code == 400
+
+    def test_sections_streamed(self, client, mock_db):
+        mock_db({
+            'FROM users': [('Test Patient', '1990-01-01', 'anxiety')],
+            'FROM mood_logs': [('2026-01-02', 6, 7, 'none', 'ok', 'positive', 30, 60, 4)],
+        })
+
+        resp = client.get('/api/export/csv?username=test_patient')
+        body = resp.get_data(as_text=True)
+
+        assert resp.status_code == 200
+        assert 'csv' in resp.content_type
+        assert 'test_patient_data.csv' in resp.headers['Content-Disposition']
+        for section in ('USER PROFILE', 'MOOD_LOGS', 'GRATITUDE_LOGS', 'CBT_RECORDS', 'CLINICAL_SCALES'):
+            assert section in body
+        assert 'full_name,Test Patient' in body
+
+
+# ==================== STREAMING MEMORY CEILING ====================
+
+class SyntheticHistoryCursor:
+    """Named-cursor stand-in that generates chat rows on demand."""
+
+    ROW = ('user', 'synthetic message with enough padding to look like a real reply', '2020-01-01T09:30:00')
+
+    def __init__(self, total):
+        self.total = total
+        self.served = 0
+        self.fetch_sizes = set()
+        self.closed = False
+
+    def execute(self, query, params=None):
+        return self
+
+    def fetchmany(self, size):
+        self.fetch_sizes.add(size)
+        count = min(size, self.total - self.served)
+        self.served += count
+        return [self.ROW] * count
+
+    def close(self):
+        self.closed = True
+
+
+class SyntheticConnection:
+    def __init__(self, total):
+        self.named_cursors = []
+        self.total = total
+
+    def cursor(self, name=None):
+        assert name, 'exports must use a named server-side cursor'
+        cur = SyntheticHistoryCursor(self.total)
+        self.named_cursors.append(cur)
+        return cur
+
+
+class TestStreamingMemory:
+
+    def test_million_row_export_constant_memory(self, client):
+        """A million-row history streams with a flat memory ceiling."""
+        total = 1_000_000
+        conn = SyntheticConnection(total)
+
+        with patch('api.get_db_connection', return_value=conn):
+            resp = client.post('/api/therapy/export', json={
+                'username': 'test_patient',
+                'from_date': '2020-01-01',
+                'to_date': '2026-12-31',
+                'format': 'csv',
+            })
+            assert resp.status_code == 200
+
+            tracemalloc.start()
+            try:
+                total_bytes = 0
+                for chunk in resp.response:
+                    total_bytes += len(chunk)
+                _, peak = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+                resp.close()
+
+        cursor = conn.named_cursors[0]
+        assert cursor.served == total
+        assert cursor.closed
+        assert cursor.fetch_sizes == {EXPORT_CHUNK_SIZE}
+        # The full export is ~90MB; only a chunk or two may ever be resident
+        assert total_bytes > 50 * 1024 * 1024
+        assert peak < 5 * 1024 * 1024
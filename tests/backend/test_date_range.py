@@ -0,0 +1,103 @@
+"""
+Tests for sargable date-range filters (date_range.py) and their adoption.
+
+Covers:
+  - Inclusive calendar dates become half-open [start, end + 1 day) ranges
+  - range_query emits raw-column comparisons, ORDER BY and LIMIT
+  - /api/insights filters without DATE() and pushes the summary LIMITs into SQL
+  - Index usage is checked in test_query_plans.py (needs PostgreSQL)
+"""
+
+from datetime import date, datetime
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+import api
+from date_range import DateRange, day_range, month_range, parse_date_range, range_filter, range_query
+
+
+class TestParseDateRange:
+
+    def test_end_day_is_included(self):
+        window = parse_date_range('2026-10-01', '2026-10-19')
+        assert window == DateRange(datetime(2026, 10, 1), datetime(2026, 10, 20))
+
+    def test_open_sides(self):
+        assert parse_date_range(None, '2026-10-19') == DateRange(None, datetime(2026, 10, 20))
+        assert parse_date_range('', None) == DateRange(None, None)
+
+    def test_accepts_dates_and_timestamps(self):
+        assert parse_date_range(date(2026, 10, 1), '2026-10-01T18:30:00').end == datetime(2026, 10, 2)
+
+    @pytest.mark.parametrize('from_date,to_date', [('2026-13-01', None), ('yesterday', None),
+                                                   ('2026-10-19', '2026-10-18')])
+    def test_invalid(self, from_date, to_date):
+        with pytest.raises(ValueError):
+            parse_date_range(from_date, to_date)
+
+    def test_day_and_month(self):
+        assert day_range(date(2026, 10, 19)) == DateRange(datetime(2026, 10, 19), datetime(2026, 10, 20))
+        assert month_range('2026-12-05') == DateRange(datetime(2026, 12, 1), datetime(2027, 1, 1))
+
+
+class TestRangeQuery:
+
+    def test_half_open_filter_on_raw_column(self):
+        sql, params = range_filter('entrestamp', parse_date_range('2026-10-01', '2026-10-19'))
+
+        assert sql == ' AND entrestamp >= %s AND entrestamp < %s'
+        assert params == [datetime(2026, 10, 1), datetime(2026, 10, 20)]
+
+    def test_order_and_limit(self):
+        sql, params = range_query("SELECT entry FROM gratitude_logs WHERE username = %s", ['u'],
+                                  'entry_timestamp', parse_date_range('2026-10-01'), limit=5)
+
+        assert sql == ("SELECT entry FROM gratitude_logs WHERE username = %s"
+                       " AND entry_timestamp >= %s ORDER BY entry_timestamp DESC LIMIT %s")
+        assert params == ('u', datetime(2026, 10, 1), 5)
+
+    def test_unbounded_aggregate(self):
+        sql, params = range_query("SELECT COUNT(*) FROM alerts WHERE username = %s", ['u'],
+                                  'created_at', DateRange(), order=None)
+
+        assert sql == "SELECT COUNT(*) FROM alerts WHERE username = %s"
+        assert params == ('u',)
+
+
+class TestInsights:
+
+    def _get(self, client, mock_db, query):
+        _, cursor = mock_db({})
+        executed = []
+        original = cursor.execute
+
+        def record(sql, params=None):
+            executed.append((' '.join(sql.split()), params))
+            return original(sql, params)
+
+        cursor.execute = record
+        ai = MagicMock()
+        ai.get_response.return_value = 'Steady week.'
+        with patch.object(api, 'TherapistAI', return_value=ai):
+            resp = client.get(f'/api/insights?username=test_patient&prompt=summary{query}')
+        return resp, executed
+
+    def test_filters_are_sargable_with_limits(self, auth_patient, mock_db):
+        client, _ = auth_patient
+
+        resp, executed = self._get(client, mock_db, '&from_date=2026-10-01&to_date=2026-10-19')
+
+        assert resp.status_code == 200
+        assert not any('DATE(' in sql for sql, _ in executed)
+        chat = next((sql, params) for sql, params in executed if 'FROM chat_history' in sql)
+        assert chat[0].endswith('timestamp >= %s AND timestamp < %s ORDER BY timestamp DESC LIMIT %s')
+        assert chat[1][1:] == (datetime(2026, 10, 1), datetime(2026, 10, 20), 10)
+        assert any('FROM gratitude_logs' in sql and params[-1] == 5 for sql, params in executed)
+
+    def test_invalid_dates_rejected(self, auth_patient, mock_db):
+        client, _ = auth_patient
+
+        resp, _ = self._get(client, mock_db, '&from_date=2026-10-19&to_date=2026-10-01')
+
+        assert resp.status_code == 400
@@ -0,0 +1,226 @@
+"""
+Tests for the outbound email queue (email_outbox.py).
+
+Covers:
+  - SMTP session reuse against a local SMTP sink
+  - Priority-ordered claiming with FOR UPDATE SKIP LOCKED
+  - Retry/backoff and permanent failures
+  - Risk alerts queued at crisis priority
+  - GET /api/developer/monitoring/email-outbox
+"""
+
+import smtplib
+import socketserver
+import threading
+
+import pytest
+from unittest.mock import patch
+
+import api
+from email_outbox import (EmailOutboxWorker, SMTPSession, enqueue_email, purge_outbox,
+                          PRIORITY_CRISIS, PRIORITY_ALERT)
+from tests.backend.test_message_dispatcher import RecordingCursor, RecordingConnection
+
+
+# ==================== LOCAL SMTP SINK ====================
+
+class _SinkHandler(socketserver.StreamRequestHandler):
+    """Just enough SMTP to accept messages (no TLS, no auth)."""
+
+    def handle(self):
+        self.server.connections += 1
+        self.wfile.write(b'220 sink ready\r\n')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode().strip().upper()
+            if command.startswith(('EHLO', 'HELO')):
+                self.wfile.write(b'250 sink\r\n')
+            elif command == 'DATA':
+                self.wfile.write(b'354 end with .\r\n')
+                while self.rfile.readline() not in (b'.\r\n', b''):
+                    pass
+                self.server.messages += 1
+                self.wfile.write(b'250 queued\r\n')
+            elif command == 'QUIT':
+                self.wfile.write(b'221 bye\r\n')
+                return
+            else:  # MAIL, RCPT, NOOP, RSET
+                self.wfile.write(b'250 ok\r\n')
+
+
+@pytest.fixture
+def smtp_sink():
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), _SinkHandler)
+    server.daemon_threads = True
+    server.connections = 0
+    server.messages = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _sink_config(sink):
+    return {
+        'host': '127.0.0.1', 'port': sink.server_address[1], 'user': None, 'password': None,
+        'from_email': 'noreply@test.com', 'starttls': False, 'auth': False,
+    }
+
+
+def _pending(n, attempts=0):
+    return [(i, f'user{i}@test.com', f'Subject {i}', '<p>hi</p>', 'Healing Space UK', attempts)
+            for i in range(1, n + 1)]
+
+
+# ==================== TESTS ====================
+
+class TestSMTPSession:
+
+    def test_session_reused_across_messages(self, smtp_sink):
+        session = SMTPSession(_sink_config(smtp_sink))
+        worker = EmailOutboxWorker(RecordingConnection(RecordingCursor()), session=session)
+
+        for i in range(5):
+            session.send(worker._build_message(f'user{i}@test.com', 'Hi', '<p>hi</p>', 'Healing Space UK'))
+        session.close()
+
+        assert smtp_sink.messages == 5
+        assert smtp_sink.connections == 1
+        assert session.connections_opened == 1
+
+    def test_session_recycled_after_max_messages(self, smtp_sink):
+        session = SMTPSession(_sink_config(smtp_sink), max_messages=2)
+        worker = EmailOutboxWorker(RecordingConnection(RecordingCursor()), session=session)
+
+        for i in range(5):
+            session.send(worker._build_message('a@test.com', 'Hi', '<p>hi</p>', 'Healing Space UK'))
+        session.close()
+
+        assert smtp_sink.messages == 5
+        assert session.connections_opened == 3
+
+
+class TestSendBatch:
+
+    def test_batch_sent_over_one_connection(self, smtp_sink):
+        cursor = RecordingCursor(_pending(10))
+        conn = RecordingConnection(cursor)
+        worker = EmailOutboxWorker(conn, session=SMTPSession(_sink_config(smtp_sink)), batch_size=25)
+
+        result = worker.send_batch()
+        worker.session.close()
+
+        assert result == {'sent': 10, 'retry': 0, 'failed': 0}
+        assert smtp_sink.connections == 1
+        claim_sql, claim_params = cursor.executed[0]
+        assert 'ORDER BY priority' in claim_sql
+        assert 'FOR UPDATE SKIP LOCKED' in claim_sql
+        assert claim_params == (25,)
+        sent_updates = [(q, p) for q, p in cursor.executed if "status = 'sent'" in q]
+        assert len(sent_updates) == 1
+        assert 'html_body = NULL' in sent_updates[0][0]
+        assert conn.commits == 1
+
+    def test_rejected_message_retried_with_backoff(self):
+        cursor = RecordingCursor(_pending(2, attempts=2))
+        session = SMTPSession({'from_email': 'noreply@test.com'})
+        worker = EmailOutboxWorker(RecordingConnection(cursor), session=session)
+
+        error = smtplib.SMTPDataError(451, b'try later')
+        with patch.object(session, 'send', side_effect=[error, None]):
+            result = worker.send_batch()
+
+        assert result == {'sent': 1, 'retry': 1, 'failed': 0}
+        retry_sql, retry_params = [(q, p) for q, p in cursor.executed if 'unnest' in q][0]
+        ids, errors, statuses, delays = retry_params
+        assert ids == [1]
+        assert statuses == ['pending']
+        assert delays == [worker.BACKOFF_BASE_SECONDS * 4]
+
+    def test_connection_failure_defers_rest_of_batch(self):
+        cursor = RecordingCursor(_pending(3))
+        session = SMTPSession({'from_email': 'noreply@test.com'})
+        worker = EmailOutboxWorker(RecordingConnection(cursor), session=session)
+
+        with patch.object(session, 'send', side_effect=ConnectionRefusedError()) as send:
+            result = worker.send_batch()
+
+        assert send.call_count == 1
+        assert result == {'sent': 0, 'retry': 1, 'failed': 0}
+
+    def test_attempts_exhausted_marks_failed(self):
+        cursor = RecordingCursor(_pending(1, attempts=EmailOutboxWorker.MAX_ATTEMPTS - 1))
+        session = SMTPSession({'from_email': 'noreply@test.com'})
+        worker = EmailOutboxWorker(RecordingConnection(cursor), session=session)
+
+        with patch.object(session, 'send', side_effect=smtplib.SMTPDataError(451, b'busy')):
+            result = worker.send_batch()
+
+        assert result == {'sent': 0, 'retry': 0, 'failed': 1}
+        retry_sql, (_, _, statuses, _) = [(q, p) for q, p in cursor.executed if 'unnest' in q][0]
+        assert statuses == ['failed']
+        assert "html_body = CASE WHEN u.status = 'failed' THEN NULL" in retry_sql
+
+
+class TestRetention:
+
+    def test_purge_deletes_old_rows_and_clears_failed_bodies(self):
+        cursor = RecordingCursor()
+        cursor.rowcount = 7
+
+        assert purge_outbox(cursor, days=14) == 7
+        clear_sql, delete_sql = [q for q, _ in cursor.executed]
+        assert "SET html_body = NULL" in clear_sql and "status = 'failed'" in clear_sql
+        assert "status IN ('sent', 'failed')" in delete_sql
+        assert cursor.executed[1][1] == (14,)
+
+    def test_worker_purges_at_most_hourly(self):
+        conn = RecordingConnection(RecordingCursor())
+        worker = EmailOutboxWorker(conn, session=SMTPSession({'from_email': 'noreply@test.com'}))
+
+        assert worker.purge_if_due() is not None
+        assert worker.purge_if_due() is None
+        assert conn.commits == 1
+
+
+class TestEnqueue:
+
+    def test_enqueue_notifies_worker(self):
+        cursor = RecordingCursor([(42,)])
+        assert enqueue_email(cursor, 'c@test.com', 'Alert', '<p>x</p>', priority=PRIORITY_CRISIS) == 42
+        assert cursor.executed[-1][0] == 'NOTIFY email_outbox'
+
+    def test_enqueue_requires_recipient(self):
+        with pytest.raises(ValueError):
+            enqueue_email(RecordingCursor(), '', 'Alert', '<p>x</p>')
+
+    @pytest.mark.parametrize('severity,priority', [('critical', PRIORITY_CRISIS), ('moderate', PRIORITY_ALERT)])
+    def test_risk_alert_priority(self, severity, priority):
+        with patch.object(api, 'queue_email', return_value=True) as queued:
+            assert api.send_risk_alert_email('c@test.com', 'pat', 'clin', severity, 'chat', 'details')
+
+        args = queued.call_args[0]
+        assert args[3] == 'risk_alert'
+        assert args[4] == priority
+
+
+class TestOutboxMetrics:
+
+    def test_metrics_endpoint(self, auth_developer, mock_db):
+        mock_db({
+            'SELECT role FROM users': [('developer',)],
+            "WHERE status = 'pending'": [(0, 1, 2.5), (5, 30, 600.0)],
+            'percentile_cont': [('risk_alert', 12, 0, 0.8, 2.1, 3.0)],
+        })
+        client, _ = auth_developer
+
+        resp = client.get('/api/developer/monitoring/email-outbox')
+        data = resp.get_json()
+
+        assert resp.status_code == 200
+        assert data['pending_count'] == 31
+        assert data['pending_by_priority'][0]['priority'] == 0
+        assert data['categories'][0]['latency_p95_seconds'] == 2.1
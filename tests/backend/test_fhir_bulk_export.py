@@ -0,0 +1,260 @@
+"""
+Tests for bulk FHIR export (fhir_export.py).
+
+Covers:
+  - NDJSON parts per resource type with checkpoint per part
+  - Resuming a job from its checkpoint
+  - Batch decryption of profile fields
+  - Signed manifest
+  - POST /api/export/fhir/bulk (clinician caseloads, patient-only cohorts, audited admin override) and status polling
+"""
+
+import json
+
+import pytest
+from cryptography.fernet import Fernet
+from unittest.mock import patch
+
+import fhir_export
+from fhir_export import FhirBulkExportWorker, sign_payload, verify_signature
+from tests.backend.test_message_dispatcher import RecordingCursor
+
+
+TEST_KEY = Fernet.generate_key()
+
+
+class StageCursor:
+    """Named cursor stand-in: serves rows for whichever stage query it is given."""
+
+    def __init__(self, conn, withhold):
+        self.conn = conn
+        self.withhold = withhold
+        self.rows = []
+
+    def execute(self, query, params=None):
+        self.conn.stage_queries.append((query, params))
+        for marker, rows in self.conn.stage_rows.items():
+            if marker in query:
+                self.rows = list(rows)
+        return self
+
+    def fetchmany(self, size):
+        batch, self.rows = self.rows[:size], self.rows[size:]
+        return batch
+
+    def close(self):
+        pass
+
+
+class ExportConnection:
+    def __init__(self, stage_rows, cursor=None):
+        self.stage_rows = stage_rows
+        self.stage_queries = []
+        self.plain = cursor or RecordingCursor()
+        self.withhold_flags = []
+        self.commits = 0
+        self.closed = False
+
+    def cursor(self, name=None, withhold=False):
+        if name:
+            self.withhold_flags.append(withhold)
+            return StageCursor(self, withhold)
+        return self.plain
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        pass
+
+
+def _job(progress=None, usernames=('alice', 'bob')):
+    return {'id': 3, 'requested_by': 'dr_smith', 'usernames': list(usernames),
+            'progress': progress or fhir_export.new_progress(), 'attempts': 1,
+            'transaction_time': '2026-10-19T09:00:00'}
+
+
+@pytest.fixture(autouse=True)
+def signing_key():
+    with patch.object(fhir_export, 'ENCRYPTION_KEY', TEST_KEY), patch.object(fhir_export, '_cipher', None):
+        yield
+
+
+def _stage_rows():
+    cipher = Fernet(TEST_KEY)
+    enc = lambda v: cipher.encrypt(v.encode()).decode()
+    return {
+        'FROM users WHERE username = ANY(%s) AND username > COALESCE(%s::text, \'\') ORDER BY username': [],
+        'SELECT username, full_name': [('alice', enc('Alice A'), enc('1990-01-01'), enc('anxiety')),
+                                        ('bob', enc('Bob B'), '', None)],
+        'FROM clinical_scales': [(i, 'alice', 'PHQ-9', 10, 'moderate', '2026-10-01') for i in range(1, 6)],
+        'FROM mood_logs': [(i, 'bob', 6, 7, None, None, '2026-10-02') for i in range(1, 4)],
+        'SELECT username FROM users': [('alice',), ('bob',)],
+    }
+
+
+def _parts(conn):
+    return [p for q, p in conn.plain.executed if 'INSERT INTO fhir_export_parts' in q]
+
+
+class TestBulkWorker:
+
+    def test_writes_ndjson_parts_per_resource_type(self):
+        conn = ExportConnection(_stage_rows())
+        worker = FhirBulkExportWorker(conn)
+        worker.PART_SIZE = 4
+
+        worker.run_job(_job())
+
+        parts = _parts(conn)
+        # Patient(2) | Observation scales 4+1 | Observation moods 3 | Provenance(2)
+        assert [(p[2], p[3]) for p in parts] == [('Patient', 2), ('Observation', 4), ('Observation', 1),
+                                                 ('Observation', 3), ('Provenance', 2)]
+        assert [p[1] for p in parts] == [1, 2, 3, 4, 5]
+        assert all(conn.withhold_flags)
+
+        patients = [json.loads(line) for line in parts[0][5].adapted.decode().splitlines()]
+        assert patients[0]['name'][0]['text'] == 'Alice A'
+        assert patients[0]['birthDate'] == '1990-01-01'
+        assert patients[1]['extension'] == []
+
+    def test_checkpoint_committed_with_each_part(self):
+        conn = ExportConnection(_stage_rows())
+        worker = FhirBulkExportWorker(conn)
+        worker.PART_SIZE = 4
+
+        worker.run_job(_job())
+
+        checkpoints = [json.loads(p[0]) for q, p in conn.plain.executed
+                       if q.strip().startswith('UPDATE fhir_export_jobs SET progress')]
+        second_part = [c for c in checkpoints if c['part_no'] == 2][0]
+        assert second_part['part_no'] == 2
+        assert second_part['last_key'] == 4
+        assert second_part['counts'] == {'Patient': 2, 'Observation': 4}
+
+    def test_resume_skips_finished_stages(self):
+        conn = ExportConnection(_stage_rows())
+        worker = FhirBulkExportWorker(conn)
+        progress = {'stage': 2, 'last_key': 1, 'part_no': 7, 'counts': {'Patient': 2, 'Observation': 5}}
+
+        worker.run_job(_job(progress=progress))
+
+        queried = [q for q, _ in conn.stage_queries]
+        assert not any('FROM clinical_scales' in q for q in queried)
+        assert conn.stage_queries[0][1] == (['alice', 'bob'], 1)
+        parts = _parts(conn)
+        assert [p[1] for p in parts] == [8, 9]
+
+    def test_manifest_is_signed(self):
+        cursor = RecordingCursor([(1, 'Patient', 2, 'a' * 64), (2, 'Observation', 8, 'b' * 64)])
+        conn = ExportConnection({}, cursor=cursor)
+        worker = FhirBulkExportWorker(conn)
+
+        manifest = worker._complete(_job())
+
+        assert manifest['output'][1] == {'type': 'Observation', 'url': '/api/export/fhir/bulk/3/parts/2',
+                                         'count': 8, 'sha256': 'b' * 64}
+        stored = [p for q, p in cursor.executed if "status = 'completed'" in q][0]
+        assert verify_signature(json.loads(stored[0]), json.loads(stored[1]))
+
+    def test_tampered_manifest_fails_verification(self):
+        manifest = {'output': [{'type': 'Patient', 'count': 2}]}
+        signature = sign_payload(manifest)
+        manifest['output'][0]['count'] = 3
+        assert not verify_signature(manifest, signature)
+
+
+class TestBulkEndpoints:
+
+    def test_requires_clinician(self, auth_patient, mock_db):
+        mock_db({'SELECT role FROM users': [('user',)]})
+        client, _ = auth_patient
+        assert client.post('/api/export/fhir/bulk', json={'scope': 'caseload'}).status_code == 403
+
+    def test_caseload_export_queued(self, auth_clinician, mock_db):
+        conn, cursor = mock_db({
+            'SELECT role FROM users': [('clinician',)],
+            'SELECT patient_username FROM patient_approvals': [('alice',), ('bob',)],
+            'INSERT INTO fhir_export_jobs': [(12,)],
+        })
+        client, _ = auth_clinician
+
+        with patch('api.log_event'):
+            resp = client.post('/api/export/fhir/bulk', json={'scope': 'caseload'})
+
+        assert resp.status_code == 202
+        assert resp.headers['Content-Location'] == '/api/export/fhir/bulk/12'
+        assert resp.get_json()['patient_count'] == 2
+
+    def test_cohort_outside_caseload_rejected(self, auth_clinician, mock_db):
+        mock_db({
+            'SELECT role FROM users': [('clinician',)],
+            "FROM users WHERE role = 'user'": [('alice',), ('mallory',)],
+            'SELECT patient_username FROM patient_approvals': [('alice',)],
+        })
+        client, _ = auth_clinician
+
+        resp = client.post('/api/export/fhir/bulk', json={'scope': 'cohort', 'usernames': ['alice', 'mallory']})
+        assert resp.status_code == 403
+
+    def test_cohort_must_be_patients(self, auth_clinician, mock_db):
+        mock_db({
+            'SELECT role FROM users': [('clinician',)],
+            "FROM users WHERE role = 'user'": [('alice',)],
+            'SELECT patient_username FROM patient_approvals': [('alice',), ('dr_jones',)],
+        })
+        client, _ = auth_clinician
+
+        resp = client.post('/api/export/fhir/bulk', json={'scope': 'cohort', 'usernames': ['alice', 'dr_jones']})
+        assert resp.status_code == 400
+
+    def test_developer_cannot_export(self, auth_developer, mock_db):
+        mock_db({'SELECT role FROM users': [('developer',)]})
+        client, _ = auth_developer
+
+        resp = client.post('/api/export/fhir/bulk', json={'scope': 'cohort', 'usernames': ['alice']})
+        assert resp.status_code == 403
+
+    def test_admin_requires_override_reason(self, client, mock_db):
+        mock_db({'SELECT role FROM users': [('admin',)]})
+
+        with patch('api.get_authenticated_username', return_value='root'), \
+             patch('api.validate_csrf_token', return_value=True):
+            resp = client.post('/api/export/fhir/bulk', json={'scope': 'cohort', 'usernames': ['alice']})
+        assert resp.status_code == 403
+
+    def test_admin_override_audited(self, client, mock_db):
+        mock_db({
+            'SELECT role FROM users': [('admin',)],
+            "FROM users WHERE role = 'user'": [('alice',), ('bob',)],
+            'INSERT INTO fhir_export_jobs': [(14,)],
+        })
+
+        with patch('api.get_authenticated_username', return_value='root'), \
+             patch('api.validate_csrf_token', return_value=True), \
+             patch('api.log_event') as log_event:
+            resp = client.post('/api/export/fhir/bulk', json={
+                'scope': 'cohort', 'usernames': ['alice', 'bob'], 'override_reason': 'Subject access request #88'})
+
+        assert resp.status_code == 202
+        override = [c.args for c in log_event.call_args_list if c.args[2] == 'fhir_bulk_export_override']
+        assert override == [('root', 'admin', 'fhir_bulk_export_override',
+                             'Admin export of 2 patients (job 14): Subject access request #88')]
+
+    def test_status_in_progress(self, auth_clinician, mock_db):
+        progress = {'stage': 1, 'last_key': 40, 'part_no': 3, 'counts': {'Patient': 2}}
+        mock_db({'FROM fhir_export_jobs WHERE id': [(12, 'test_clinician', 'caseload', 'running', progress,
+                                                     None, None, None, None, None, 2)]})
+        client, _ = auth_clinician
+
+        resp = client.get('/api/export/fhir/bulk/12')
+
+        assert resp.status_code == 202
+        assert resp.headers['X-Progress'] == 'stage 2 of 4'
+        assert resp.get_json()['parts_written'] == 3
+
+    def test_status_hidden_from_other_users(self, auth_clinician, mock_db):
+        mock_db({'FROM fhir_export_jobs WHERE id': [(12, 'someone_else', 'caseload', 'completed', {},
+                                                     {}, {}, None, None, None, 2)]})
+        client, _ = auth_clinician
+        assert client.get('/api/export/fhir/bulk/12').status_code == 404
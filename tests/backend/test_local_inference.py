@@ -0,0 +1,250 @@
+"""
+Tests for the local-model inference server (local_inference.py).
+
+Covers:
+  - Concurrent requests micro-batched into one handler call
+  - Per-conversation cache LRU (bounded by cached tokens) and prompt construction in the training format
+  - The /generate and /health endpoints
+  - Client max_new_tokens capped at the server limit
+  - LocalTherapistAI as a drop-in for TherapistAI
+  - KV-cache reuse across turns with a tiny model (skipped without transformers)
+"""
+
+import threading
+import time
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from local_inference import (CRISIS_FOOTER, MAX_NEW_TOKENS, ConversationCache, LocalModelEngine,
+                             LocalTherapistAI, MicroBatcher, build_prompt_ids, clean_reply, create_app)
+from tests.backend.test_ai_trainer_dataset import WordTokenizer
+
+
+class TestMicroBatcher:
+
+    def test_concurrent_requests_share_a_batch(self):
+        calls = []
+
+        def handler(items):
+            calls.append(list(items))
+            time.sleep(0.01)
+            return [item * 2 for item in items]
+
+        batcher = MicroBatcher(handler, max_batch_size=8, max_wait=0.2)
+        results = {}
+        start = threading.Barrier(5)
+
+        def submit(n):
+            start.wait()
+            results[n] = batcher.submit(n, timeout=5)
+
+        threads = [threading.Thread(target=submit, args=(n,)) for n in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert results == {n: n * 2 for n in range(5)}
+        assert len(calls) < 5
+        assert max(batcher.batch_sizes) > 1
+
+    def test_batch_capped(self):
+        batcher = MicroBatcher(lambda items: items, max_batch_size=2, max_wait=0.2)
+        for n in range(5):
+            batcher._queue.put((n, MagicMock()))
+
+        assert len(batcher._next_batch()) == 2
+
+    def test_handler_error_fails_callers(self):
+        def handler(items):
+            raise RuntimeError('model crashed')
+
+        batcher = MicroBatcher(handler, max_wait=0)
+
+        with pytest.raises(RuntimeError, match='model crashed'):
+            batcher.submit('hello', timeout=5)
+
+    def test_batch_sizes_bounded(self):
+        batcher = MicroBatcher(lambda items: items, max_wait=0)
+        for n in range(150):
+            batcher.submit(n, timeout=5)
+
+        assert len(batcher.batch_sizes) == 100
+
+
+class TestConversationCache:
+
+    def test_least_recently_used_evicted_by_tokens(self):
+        cache = ConversationCache(max_tokens=5)
+        cache.put('a', [1, 2], 'kv-a')
+        cache.put('b', [3, 4], 'kv-b')
+        cache.put('a', *cache.take('a'))
+        cache.put('c', [5, 6], 'kv-c')
+
+        assert cache.take('b') is None
+        assert cache.take('a') == ([1, 2], 'kv-a')
+        assert len(cache) == 1 and cache.tokens == 2
+
+    def test_take_removes_entry(self):
+        cache = ConversationCache(max_tokens=10)
+        cache.put('a', [1, 2, 3], 'kv-a')
+
+        assert cache.take('a') == ([1, 2, 3], 'kv-a')
+        assert cache.take('a') is None
+        assert cache.tokens == 0
+
+    def test_oversized_entry_not_kept(self):
+        cache = ConversationCache(max_tokens=2)
+        cache.put('a', [1], 'kv-a')
+        cache.put('a', [1, 2, 3], 'kv-a2')
+
+        assert len(cache) == 0 and cache.tokens == 0
+
+
+class TestPrompt:
+
+    def test_training_format(self):
+        tokenizer = WordTokenizer()
+        ids = build_prompt_ids(tokenizer, [('user', 'hello'), ('ai', 'hi there')], 'bad day')
+        decode = {v: k for k, v in tokenizer.vocab.items()}
+        decode[0] = '<eos>'
+
+        assert [decode[t] for t in ids] == ['Patient:', 'hello', '<eos>', 'Therapist:', 'hi', 'there', '<eos>',
+                                            'Patient:', 'bad', 'day', '<eos>', 'Therapist:']
+
+    def test_trimmed_from_the_left(self):
+        ids = build_prompt_ids(WordTokenizer(), [('user', 'word ' * 50)], 'latest', max_tokens=10)
+        assert len(ids) == 10
+
+    def test_reply_stops_at_patient_turn(self):
+        assert clean_reply(' That sounds hard. Patient: yes it is') == 'That sounds hard.'
+
+
+class TestGenerationLength:
+
+    def _engine(self):
+        engine = object.__new__(LocalModelEngine)
+        engine.max_new_tokens = MAX_NEW_TOKENS
+        return engine
+
+    def test_client_value_capped(self):
+        engine = self._engine()
+
+        assert engine._max_new_tokens({'max_new_tokens': 32}) == 32
+        assert engine._max_new_tokens({'max_new_tokens': 100000}) == MAX_NEW_TOKENS
+
+    def test_invalid_value_uses_default(self):
+        engine = self._engine()
+
+        for value in (None, 0, -5, 'lots', [1]):
+            assert engine._max_new_tokens({'max_new_tokens': value}) == MAX_NEW_TOKENS
+
+
+class FakeEngine:
+    model_path = 'trained_models/model_test'
+    conversations = ConversationCache()
+
+    def generate_batch(self, requests):
+        return [{'response': f"echo {r['message']}", 'cached_tokens': 0, 'batch_size': len(requests)}
+                for r in requests]
+
+
+class TestServer:
+
+    @pytest.fixture
+    def server(self):
+        app = create_app(FakeEngine())
+        app.config['TESTING'] = True
+        return app.test_client()
+
+    def test_generate(self, server):
+        resp = server.post('/generate', json={'conversation_id': 'c1', 'turns': [['user', 'hi'], ['ai', 'hello']],
+                                              'message': 'tired'})
+
+        assert resp.status_code == 200
+        assert resp.get_json()['response'] == 'echo tired'
+
+    def test_message_required(self, server):
+        assert server.post('/generate', json={'turns': []}).status_code == 400
+
+    def test_health(self, server):
+        server.post('/generate', json={'message': 'hi'})
+        data = server.get('/health').get_json()
+
+        assert data['model_path'] == 'trained_models/model_test'
+        assert data['avg_batch_size'] == 1
+
+
+class TestLocalTherapistAI:
+
+    def _post(self, reply='I hear you.'):
+        response = MagicMock(status_code=200)
+        response.json.return_value = {'response': reply}
+        return patch('requests.post', return_value=response)
+
+    def test_same_interface_as_groq_client(self):
+        ai = LocalTherapistAI('alice', base_url='http://inference:8081/')
+
+        with self._post() as post:
+            reply = ai.get_response('rough week', history=[('user', 'hi'), ('assistant', 'hello')],
+                                    wellness_data={'mood': 2}, memory_context={}, risk_context='none')
+
+        assert reply == 'I hear you.'
+        url, = post.call_args.args
+        body = post.call_args.kwargs['json']
+        assert url == 'http://inference:8081/generate'
+        assert body['turns'] == [('user', 'hi'), ('ai', 'hello')]
+        assert 'alice' not in body['conversation_id']
+
+    def test_crisis_resources_appended(self):
+        with self._post():
+            reply = LocalTherapistAI('alice').get_response('help', risk_context='critical')
+        assert reply.endswith(CRISIS_FOOTER)
+
+    def test_server_error_raises(self):
+        with patch('requests.post', return_value=MagicMock(status_code=503)):
+            with pytest.raises(RuntimeError):
+                LocalTherapistAI('alice').get_insight('text')
+
+
+class TestTinyModelCache:
+
+    def test_second_turn_reuses_kv_cache(self):
+        torch = pytest.importorskip('torch')
+        pytest.importorskip('transformers')
+        from tokenizers import Tokenizer, models, pre_tokenizers
+        from transformers import GPT2Config, GPT2LMHeadModel, PreTrainedTokenizerFast
+        import local_inference
+
+        words = ['Patient:', 'Therapist:', 'hello', 'there', 'i', 'feel', 'low', 'today', 'tell', 'me', 'more']
+        vocab = {'<eos>': 0, '<unk>': 1, **{w: i + 2 for i, w in enumerate(words)}}
+        core = Tokenizer(models.WordLevel(vocab, unk_token='<unk>'))
+        core.pre_tokenizer = pre_tokenizers.WhitespaceSplit()
+        tokenizer = PreTrainedTokenizerFast(tokenizer_object=core, eos_token='<eos>', pad_token='<eos>',
+                                            unk_token='<unk>', padding_side='left')
+        torch.manual_seed(0)
+
+        engine = object.__new__(local_inference.LocalModelEngine)
+        engine.tokenizer = tokenizer
+        engine.model = GPT2LMHeadModel(GPT2Config(vocab_size=len(vocab), n_positions=128, n_embd=16,
+                                                  n_layer=1, n_head=2)).eval()
+        engine.max_new_tokens = 4
+        engine.conversations = ConversationCache()
+
+        first = engine.generate_batch([{'conversation_id': 'c', 'turns': [('user', 'hello there ' * 5)],
+                                        'message': 'i feel low'}])[0]
+        reply = first['response']
+        second = engine.generate_batch([{'conversation_id': 'c',
+                                         'turns': [('user', 'hello there ' * 5), ('user', 'i feel low'),
+                                                   ('ai', reply)],
+                                         'message': 'today'}])[0]
+        batched = engine.generate_batch([{'conversation_id': 'x', 'turns': [], 'message': 'hello'},
+                                         {'conversation_id': 'y', 'turns': [], 'message': 'i feel low today'}])
+
+        assert first['cached_tokens'] == 0
+        assert second['cached_tokens'] >= local_inference.MIN_CACHE_REUSE_TOKENS
+        tokens, past = engine.conversations.take('c')
+        assert len(tokens) == past.get_seq_length()
+        assert engine.conversations.tokens == 0
+        assert [r['batch_size'] for r in batched] == [2, 2]
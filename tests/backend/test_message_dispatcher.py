@@ -0,0 +1,215 @@
+"""
+Tests for the scheduled message dispatcher (message_dispatcher.py).
+
+Covers:
+  - Claiming due messages with FOR UPDATE SKIP LOCKED
+  - Bulk notification inserts (one statement per table per batch)
+  - Background broadcast fan-out guarded by advisory locks
+  - Delivery-lag metrics
+  - GET /api/developer/monitoring/scheduled-messages
+"""
+
+import psycopg2
+import pytest
+from unittest.mock import patch
+
+import api
+from message_dispatcher import ScheduledMessageDispatcher
+from message_service import MessageService
+from tests.conftest import MockCursor, MockConnection
+
+
+class RecordingCursor(MockCursor):
+    """MockCursor that keeps every executed statement."""
+
+    def __init__(self, results=None):
+        super().__init__(results)
+        self.executed = []
+
+    def execute(self, query, params=None):
+        self.executed.append((query, params))
+        return super().execute(query, params)
+
+
+class RecordingConnection(MockConnection):
+    def __init__(self, cursor):
+        super().__init__(cursor)
+        self.commits = 0
+        self.rollbacks = 0
+        self.closed = False
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+def _claimed(n, lag=1.5):
+    return [(i, 10 + (i % 2), 'test_clinician', 'test_patient', None, lag) for i in range(1, n + 1)]
+
+
+class TestDispatchBatch:
+
+    def test_claims_with_skip_locked(self):
+        cursor = RecordingCursor(_claimed(3))
+        dispatcher = ScheduledMessageDispatcher(RecordingConnection(cursor), batch_size=10)
+
+        delivered = dispatcher.dispatch_batch()
+
+        assert len(delivered) == 3
+        claim_sql, claim_params = cursor.executed[0]
+        assert 'FOR UPDATE SKIP LOCKED' in claim_sql
+        assert "delivery_status = 'sent'" in claim_sql
+        assert claim_params == (10,)
+
+    def test_notifications_inserted_in_bulk(self):
+        cursor = RecordingCursor(_claimed(50))
+        conn = RecordingConnection(cursor)
+        dispatcher = ScheduledMessageDispatcher(conn, batch_size=100)
+
+        dispatcher.dispatch_batch()
+
+        inserts = [q for q, _ in cursor.executed if q.strip().startswith('INSERT')]
+        assert len(inserts) == 2  # message_notifications + notifications, regardless of batch size
+        conv_updates = [p for q, p in cursor.executed if 'UPDATE conversations' in q]
+        assert conv_updates == [([10, 11],)]
+        assert conn.commits == 1
+
+    def test_empty_batch_does_no_writes(self):
+        cursor = RecordingCursor([])
+        dispatcher = ScheduledMessageDispatcher(RecordingConnection(cursor))
+
+        assert dispatcher.dispatch_batch() == []
+        assert len(cursor.executed) == 1
+
+    def test_run_pending_stops_on_short_batch(self):
+        dispatcher = ScheduledMessageDispatcher(RecordingConnection(RecordingCursor()), batch_size=2)
+        batches = [[{'lag_seconds': 0.1}] * 2, [{'lag_seconds': 0.1}]]
+        with patch.object(dispatcher, 'dispatch_batch', side_effect=batches) as mocked:
+            assert dispatcher.run_pending() == 3
+        assert mocked.call_count == 2
+
+    def test_failure_rolls_back(self):
+        cursor = RecordingCursor(_claimed(1))
+        conn = RecordingConnection(cursor)
+        original = cursor.execute
+
+        def failing_execute(query, params=None):
+            if 'INSERT INTO notifications' in query:
+                raise RuntimeError('boom')
+            return original(query, params)
+
+        cursor.execute = failing_execute
+        dispatcher = ScheduledMessageDispatcher(conn)
+
+        with pytest.raises(RuntimeError):
+            dispatcher.dispatch_batch()
+        assert conn.rollbacks == 1
+        assert conn.commits == 0
+
+
+class TestDispatchBroadcasts:
+
+    def test_skips_job_locked_by_another_worker(self):
+        cursor = RecordingCursor([(5, 'test_developer', 0)])
+        original = cursor.execute
+
+        def execute(query, params=None):
+            original(query, params)
+            if 'pg_try_advisory_lock' in query:
+                cursor._results, cursor._result_index = [(False,)], 0
+            return cursor
+
+        cursor.execute = execute
+        dispatcher = ScheduledMessageDispatcher(RecordingConnection(cursor))
+
+        with patch('message_dispatcher.MessageService.run_broadcast_fan_out') as fan_out:
+            assert dispatcher.dispatch_broadcasts() == 0
+        fan_out.assert_not_called()
+
+    def test_advances_and_unlocks_job(self):
+        cursor = RecordingCursor([(5, 'test_developer', 1000)])
+        dispatcher = ScheduledMessageDispatcher(RecordingConnection(cursor))
+        progress = {'processed_recipients': 3000, 'total_recipients': 5000, 'status': 'running'}
+
+        with patch.object(cursor, 'fetchone', return_value=(True,)), \
+             patch('message_dispatcher.MessageService.run_broadcast_fan_out', return_value=progress) as fan_out:
+            assert dispatcher.dispatch_broadcasts() == 2000
+
+        fan_out.assert_called_once_with(5, max_chunks=dispatcher.BROADCAST_CHUNKS_PER_PASS)
+        assert any('pg_advisory_unlock' in q for q, _ in cursor.executed)
+
+    def test_failed_jobs_are_retried_until_capped(self):
+        cursor = RecordingCursor([])
+        ScheduledMessageDispatcher(RecordingConnection(cursor)).dispatch_broadcasts()
+
+        query, params = cursor.executed[0]
+        assert "status = 'failed' AND attempts < %s" in query
+        assert params == (MessageService.BROADCAST_MAX_ATTEMPTS,)
+
+    def test_rolls_back_before_unlock_after_failure(self):
+        cursor = RecordingCursor([(5, 'test_developer', 0)])
+        conn = RecordingConnection(cursor)
+        dispatcher = ScheduledMessageDispatcher(conn)
+        events = []
+        original_execute = cursor.execute
+        conn.rollback = lambda: events.append('rollback')
+
+        def execute(query, params=None):
+            if 'pg_advisory_unlock' in query:
+                events.append('unlock')
+            return original_execute(query, params)
+
+        cursor.execute = execute
+        with patch.object(cursor, 'fetchone', return_value=(True,)), \
+             patch('message_dispatcher.MessageService.run_broadcast_fan_out', side_effect=psycopg2.OperationalError('boom')):
+            assert dispatcher.dispatch_broadcasts() == 0
+
+        assert events == ['rollback', 'unlock']
+
+    def test_run_forever_survives_unexpected_errors(self):
+        dispatcher = ScheduledMessageDispatcher(RecordingConnection(RecordingCursor()))
+
+        with patch.object(dispatcher, 'run_pending', side_effect=[ValueError('bad row'), 0]) as run_pending, \
+             patch.object(dispatcher, 'dispatch_broadcasts', return_value=0), \
+             patch('message_dispatcher.time.sleep', side_effect=[None, KeyboardInterrupt]):
+            with pytest.raises(KeyboardInterrupt):
+                dispatcher.run_forever(poll_interval=0.01)
+
+        assert run_pending.call_count == 2
+
+
+class TestDispatchMetrics:
+
+    def test_lag_stats(self):
+        dispatcher = ScheduledMessageDispatcher(RecordingConnection(RecordingCursor()))
+        dispatcher._record([{'lag_seconds': v} for v in (0.5, 1.0, 2.0, 4.0)])
+
+        stats = dispatcher.stats()
+        assert stats['delivered_total'] == 4
+        assert stats['lag_max_seconds'] == 4.0
+        assert stats['lag_p50_seconds'] == 2.0
+
+    def test_metrics_endpoint_requires_developer(self, auth_patient, mock_db):
+        mock_db({'SELECT role FROM users': [('user',)]})
+        client, _ = auth_patient
+
+        resp = client.get('/api/developer/monitoring/scheduled-messages')
+        assert resp.status_code == 403
+
+    def test_metrics_endpoint(self, auth_developer, mock_db):
+        mock_db({
+            'SELECT role FROM users': [('developer',)],
+            "WHERE delivery_status = 'scheduled'": [(2, 7.5)],
+            'percentile_cont': [(40, 1.2, 3.4, 6.0)],
+        })
+        client, _ = auth_developer
+
+        resp = client.get('/api/developer/monitoring/scheduled-messages')
+        data = resp.get_json()
+
+        assert resp.status_code == 200
+        assert data['overdue_count'] == 2
+        assert data['delivered_count'] == 40
+        assert data['lag_p95_seconds'] == 3.4
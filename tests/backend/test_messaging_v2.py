@@ -155,3 +155,199 @@ class TestInbox:
         """Unauthenticated request returns 401."""
         resp = unauth_client.get('/api/messages/inbox')
         assert resp.status_code == 401
+
+
+# ==================== CONVERSATION THREAD (keyset paging) ====================
+
+class TestConversationThreadPaging:
+    """Tests for GET /api/messages/conversation/<username> keyset paging"""
+
+    @staticmethod
+    def _rows(ids, recipient='test_patient', is_read=0):
+        return [(i, 'test_clinician', recipient, None, f'msg {i}', is_read, None,
+                 datetime(2026, 1, 1, 12, 0, i), 'direct') for i in ids]
+
+    def test_newest_page_returned_in_chronological_order(self, auth_patient, mock_db):
+        """First page is the newest messages, rendered oldest-first, with a cursor."""
+        conn, cursor = mock_db({
+            'SELECT c.id FROM conversations': [(7,)],
+            'SELECT 1 FROM conversation_participants': [(1,)],
+            'SELECT id, sender_username': self._rows([5, 4, 3]),  # limit=2 -> one extra row
+        })
+        client, _ = auth_patient
+
+        resp = client.get('/api/messages/conversation/test_clinician?limit=2')
+        data = resp.get_json()
+
+        assert resp.status_code == 200
+        assert [m['id'] for m in data['messages']] == [4, 5]
+        assert data['has_more'] is True
+        assert data['next_before_id'] == 4
+        assert data['latest_id'] == 5
+
+    def test_read_receipts_use_single_update(self, auth_patient, mock_db):
+        """Unread messages are marked read with one set-based UPDATE."""
+        conn, cursor = mock_db({
+            'SELECT c.id FROM conversations': [(7,)],
+            'SELECT 1 FROM conversation_participants': [(1,)],
+            'SELECT id, sender_username': self._rows([3, 2, 1]),
+        })
+        executed = []
+        original_execute = cursor.execute
+
+        def recording_execute(query, params=None):
+            executed.append(query)
+            return original_execute(query, params)
+
+        cursor.execute = recording_execute
+        client, _ = auth_patient
+
+        resp = client.get('/api/messages/conversation/test_clinician')
+
+        assert resp.status_code == 200
+        updates = [q for q in executed if 'UPDATE messages' in q]
+        assert len(updates) == 1
+        assert 'WHERE conversation_id' in updates[0]
+        # Scheduled/draft messages are hidden from the thread, so they must stay unread
+        assert "NOT IN ('scheduled', 'draft', 'cancelled')" in updates[0]
+
+    def test_after_id_returns_delta(self, auth_patient, mock_db):
+        """after_id returns only newer messages and advances latest_id."""
+        conn, cursor = mock_db({
+            'SELECT c.id FROM conversations': [(7,)],
+            'SELECT 1 FROM conversation_participants': [(1,)],
+            'SELECT id, sender_username': self._rows([11, 12]),
+        })
+        client, _ = auth_patient
+
+        resp = client.get('/api/messages/conversation/test_clinician?after_id=10')
+        data = resp.get_json()
+
+        assert resp.status_code == 200
+        assert [m['id'] for m in data['messages']] == [11, 12]
+        assert data['latest_id'] == 12
+
+    def test_before_and_after_together_rejected(self, auth_patient, mock_db):
+        """Both cursors at once is a client error."""
+        mock_db({})
+        client, _ = auth_patient
+
+        resp = client.get('/api/messages/conversation/test_clinician?before_id=5&after_id=2')
+        assert resp.status_code == 400
+
+
+# ==================== BROADCAST FAN-OUT ====================
+
+class TestBroadcastFanOut:
+    """Tests for POST /api/admin/messages/broadcast and its progress record"""
+
+    @staticmethod
+    def _broadcast_db(mock_db, total, chunk):
+        conn, cursor = mock_db({
+            'WITH batch AS': [chunk],
+            'SELECT role FROM users': [('developer',)],
+            'SELECT COUNT(*) FROM users': [(total,)],
+            'INSERT INTO conversations': [(20,)],
+            'INSERT INTO messages': [(100, datetime(2026, 1, 1, 12, 0))],
+            'INSERT INTO broadcast_jobs': [(5,)],
+            'pg_try_advisory_lock': [(True,)],
+            'SELECT message_id, conversation_id': [(100, 20, 'patients', None, 'pending')],
+            'SELECT id, message_id, sender_username': [
+                (5, 100, 'test_developer', 'patients', 'completed', total, chunk[0],
+                 None, None, None, None)],
+        })
+        executed = []
+        original_execute = cursor.execute
+
+        def recording_execute(query, params=None):
+            executed.append((query, params))
+            return original_execute(query, params)
+
+        cursor.execute = recording_execute
+        return executed
+
+    def test_small_audience_fanned_out_set_based(self, auth_developer, mock_db):
+        """Participants + notifications go in one INSERT ... SELECT per chunk, not per recipient."""
+        executed = self._broadcast_db(mock_db, total=3, chunk=(3, 'zoe'))
+        client, _ = auth_developer
+
+        with patch.object(api, 'log_event'):
+            resp = client.post('/api/admin/messages/broadcast', json={
+                'type': 'patients', 'subject': 'Maintenance', 'content': 'Back at 9am',
+            })
+
+        data = resp.get_json()
+        assert resp.status_code == 201
+        assert data['status'] == 'sent'
+        assert data['recipients_count'] == 3
+        assert data['broadcast_id'] == 5
+
+        fan_out = [q for q, _ in executed if 'WITH batch AS' in q]
+        assert len(fan_out) == 1
+        assert "role = 'user'" in fan_out[0]
+        assert 'INSERT INTO conversation_participants' in fan_out[0]
+        assert 'INSERT INTO message_notifications' in fan_out[0]
+        assert 'ON CONFLICT (message_id, recipient_username, notification_type) DO NOTHING' in fan_out[0]
+        assert not [q for q, _ in executed if 'INSERT INTO notifications' in q]
+        locked = [i for i, (q, _) in enumerate(executed) if 'advisory' in q]
+        assert len(locked) == 2 and locked[0] < executed.index(next(e for e in executed if 'WITH batch AS' in e[0])) < locked[1]
+
+    def test_inline_fan_out_skipped_while_dispatcher_holds_lock(self, auth_developer, mock_db):
+        """A job the dispatcher already claimed is reported as queued, not fanned out twice."""
+        conn, cursor = mock_db({
+            'SELECT role FROM users': [('developer',)],
+            'SELECT COUNT(*) FROM users': [(3,)],
+            'INSERT INTO conversations': [(20,)],
+            'INSERT INTO messages': [(100, datetime(2026, 1, 1, 12, 0))],
+            'INSERT INTO broadcast_jobs': [(5,)],
+            'pg_try_advisory_lock': [(False,)],
+        })
+        client, _ = auth_developer
+
+        with patch.object(api, 'log_event'), \
+             patch.object(api.MessageService, 'run_broadcast_fan_out') as fan_out:
+            resp = client.post('/api/admin/messages/broadcast', json={
+                'type': 'patients', 'subject': 'Maintenance', 'content': 'Back at 9am',
+            })
+
+        assert resp.get_json()['status'] == 'queued'
+        fan_out.assert_not_called()
+
+    def test_large_audience_is_queued(self, auth_developer, mock_db):
+        """Audiences over the inline limit are left for the background worker."""
+        total = api.MessageService.BROADCAST_INLINE_LIMIT + 1
+        executed = self._broadcast_db(mock_db, total=total, chunk=(0, None))
+        client, _ = auth_developer
+
+        with patch.object(api, 'log_event'):
+            resp = client.post('/api/admin/messages/broadcast', json={
+                'type': 'all', 'subject': 'Update', 'content': 'New features',
+            })
+
+        data = resp.get_json()
+        assert resp.status_code == 202
+        assert data['status'] == 'queued'
+        assert data['recipients_count'] == total
+        assert not [q for q, _ in executed if 'WITH batch AS' in q]
+
+    def test_broadcast_requires_admin(self, auth_patient, mock_db):
+        mock_db({'SELECT role FROM users': [('user',)]})
+        client, _ = auth_patient
+
+        resp = client.post('/api/admin/messages/broadcast', json={
+            'type': 'all', 'subject': 'x', 'content': 'y',
+        })
+        assert resp.status_code == 403
+
+    def test_broadcast_status(self, auth_developer, mock_db):
+        """Progress record can be polled by the admin messaging page."""
+        self._broadcast_db(mock_db, total=4000, chunk=(1000, 'm'))
+        client, _ = auth_developer
+
+        resp = client.get('/api/admin/messages/broadcast/5')
+        data = resp.get_json()
+
+        assert resp.status_code == 200
+        assert data['total_recipients'] == 4000
+        assert data['processed_recipients'] == 1000
+        assert data['progress'] == 0.25
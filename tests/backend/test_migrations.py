@@ -0,0 +1,202 @@
+"""
+Tests for the versioned migration runner (migrations.py).
+
+Covers:
+  - Only pending migrations applied, in order, each recorded in schema_version
+  - Runs under an advisory lock; a failure rolls back and stops the run
+  - Worker boot and requests no longer run init_db
+  - Hot-query index migration (plans are checked in test_query_plans.py)
+"""
+
+from unittest.mock import patch
+
+import pytest
+
+import api
+import migrations
+from tests.backend.test_message_dispatcher import RecordingConnection, RecordingCursor
+
+
+class SchemaCursor(RecordingCursor):
+    """Answers the runner's schema_version queries from a set of applied versions"""
+
+    def __init__(self, applied=None):
+        super().__init__()
+        self.applied = applied
+
+    def execute(self, query, params=None):
+        self.executed.append((query, params))
+        if 'to_regclass' in query:
+            self._rows = [(self.applied is not None,)]
+        elif query.startswith('SELECT version FROM schema_version'):
+            self._rows = [(v,) for v in sorted(self.applied or ())]
+        return self
+
+    def fetchone(self):
+        return self._rows.pop(0)
+
+    def fetchall(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+
+def _registry(*versions, fail=None):
+    calls = []
+
+    def make(version):
+        def apply(conn):
+            if version == fail:
+                raise RuntimeError(f'migration {version} broke')
+            calls.append(version)
+        return apply
+
+    return [migrations.Migration(v, f'm{v}', make(v)) for v in versions], calls
+
+
+def _recorded(cursor):
+    return [params[0] for sql, params in cursor.executed if sql.startswith('INSERT INTO schema_version')]
+
+
+class TestMigrate:
+
+    def test_applies_pending_in_order(self):
+        registry, calls = _registry(1, 2, 3)
+        cursor = SchemaCursor(applied={1})
+        conn = RecordingConnection(cursor)
+
+        with patch.object(migrations, 'MIGRATIONS', registry):
+            applied = migrations.migrate(conn, log=lambda msg: None)
+
+        assert applied == calls == [2, 3]
+        assert _recorded(cursor) == [2, 3]
+        assert conn.commits >= 3
+
+    def test_fresh_database_applies_everything(self):
+        registry, calls = _registry(1, 2)
+        cursor = SchemaCursor(applied=None)
+
+        with patch.object(migrations, 'MIGRATIONS', registry):
+            migrations.migrate(RecordingConnection(cursor), log=lambda msg: None)
+
+        assert calls == [1, 2]
+        assert any('CREATE TABLE IF NOT EXISTS schema_version' in sql for sql, _ in cursor.executed)
+
+    def test_runs_under_advisory_lock(self):
+        registry, _ = _registry(1)
+        cursor = SchemaCursor(applied=set())
+
+        with patch.object(migrations, 'MIGRATIONS', registry):
+            migrations.migrate(RecordingConnection(cursor), log=lambda msg: None)
+
+        statements = [sql for sql, _ in cursor.executed]
+        assert 'pg_advisory_lock' in statements[0]
+        assert 'pg_advisory_unlock' in statements[-1]
+
+    def test_failure_rolls_back_and_stops(self):
+        registry, calls = _registry(1, 2, 3, fail=2)
+        cursor = SchemaCursor(applied=set())
+        conn = RecordingConnection(cursor)
+
+        with patch.object(migrations, 'MIGRATIONS', registry):
+            with pytest.raises(RuntimeError, match='migration 2 broke'):
+                migrations.migrate(conn, log=lambda msg: None)
+
+        assert calls == [1]
+        assert _recorded(cursor) == [1]
+        assert conn.rollbacks == 1
+        assert 'pg_advisory_unlock' in cursor.executed[-1][0]
+
+    def test_non_transactional_runs_in_autocommit(self):
+        modes = []
+
+        class Conn(RecordingConnection):
+            autocommit = False
+
+        cursor = SchemaCursor(applied=set())
+        conn = Conn(cursor)
+        registry = [migrations.Migration(1, 'm1', lambda c: modes.append(c.autocommit)),
+                    migrations.Migration(2, 'm2', lambda c: modes.append(c.autocommit), transactional=False)]
+
+        with patch.object(migrations, 'MIGRATIONS', registry):
+            migrations.migrate(conn, log=lambda msg: None)
+
+        assert modes == [False, True]
+        assert conn.autocommit is False
+        assert _recorded(cursor) == [1, 2]
+
+    def test_versions_must_increase(self):
+        with patch.object(migrations, 'MIGRATIONS', [migrations.Migration(5, 'm5', None)]):
+            with pytest.raises(ValueError):
+                migrations.migration(5, 'duplicate')(lambda conn: None)
+
+    def test_registry_is_ordered(self):
+        versions = [m.version for m in migrations.MIGRATIONS]
+        assert versions == sorted(set(versions))
+        assert versions[0] == 1
+
+    def test_baseline_fails_when_init_db_fails(self):
+        with patch.object(api, 'init_db', return_value=False):
+            with pytest.raises(RuntimeError):
+                migrations.baseline(None)
+
+
+class TestWorkerBoot:
+
+    def test_requests_do_not_run_init_db(self, client, mock_db):
+        mock_db({})
+
+        with patch.object(api, 'init_db') as init_db, patch.object(api, 'ensure_pet_table') as ensure_pet:
+            client.get('/api/health')
+
+        init_db.assert_not_called()
+        ensure_pet.assert_not_called()
+
+    def test_schema_check_warns_about_pending(self, capsys):
+        cursor = SchemaCursor(applied={1})
+
+        with patch.object(api, 'get_db_connection', return_value=RecordingConnection(cursor)), \
+             patch.object(migrations, 'MIGRATIONS', _registry(1, 2)[0]):
+            api.check_schema_version()
+
+        assert '1 schema migration(s) pending' in capsys.readouterr().out
+        assert not _recorded(cursor)
+
+
+class TestHotQueryIndexes:
+
+    def _run(self, columns, existing=None):
+        existing = existing or {}
+
+        class Cursor(RecordingCursor):
+            def execute(self, query, params=None):
+                self.executed.append((query, params))
+                if 'information_schema.columns' in query:
+                    self._rows = [(c,) for c in columns]
+                elif 'indisvalid' in query:
+                    self._rows = [existing[params[0]]] if params[0] in existing else []
+                return self
+
+            def fetchone(self):
+                return self._rows.pop(0) if self._rows else None
+
+            def fetchall(self):
+                rows, self._rows = self._rows, []
+                return rows
+
+        cursor = Cursor()
+        migrations.hot_query_indexes(RecordingConnection(cursor))
+        return [sql for sql, _ in cursor.executed]
+
+    def test_renames_legacy_mood_timestamp(self):
+        statements = self._run(['entry_timestamp'])
+        assert 'ALTER TABLE mood_logs RENAME COLUMN entry_timestamp TO entrestamp' in statements
+
+    def test_builds_indexes_concurrently(self):
+        statements = self._run(['entrestamp'], existing={'idx_mood_logs_user_time': (True,),
+                                                         'idx_chat_history_session_time': (False,)})
+        creates = [s for s in statements if s.startswith('CREATE INDEX')]
+
+        assert not any('RENAME' in s for s in statements)
+        assert all('CONCURRENTLY' in s for s in creates)
+        assert len(creates) == len(migrations.HOT_QUERY_INDEXES) - 1
+        assert 'DROP INDEX CONCURRENTLY IF EXISTS idx_chat_history_session_time' in statements
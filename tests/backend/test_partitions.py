@@ -0,0 +1,225 @@
+"""
+Tests for monthly partitioning and retention (partitions.py, migration 4).
+
+Covers:
+  - Month arithmetic, partition naming and bound parsing
+  - Upcoming partitions created, with rows moved out of the default partition
+  - Retention archives clinical partitions and drops operational ones
+  - Maintenance isolates per-table failures
+  - Partition pruning on the 7-day / 24-hour window queries (needs PostgreSQL)
+"""
+
+import json
+import os
+from datetime import date, datetime
+from unittest.mock import patch
+
+import pytest
+
+import partitions
+from partitions import PartitionPolicy
+from tests.backend.test_message_dispatcher import RecordingConnection, RecordingCursor
+
+TODAY = date(2026, 10, 19)
+
+
+class CatalogCursor(RecordingCursor):
+    """Answers catalog queries: partitioned tables and their (name, bound) partitions"""
+
+    def __init__(self, partitioned=None):
+        super().__init__()
+        self.partitioned = partitioned or {}
+        self._rows = []
+
+    def execute(self, query, params=None):
+        self.executed.append((query, params))
+        if "relkind = 'p'" in query:
+            self._rows = [(params[0] in self.partitioned,)]
+        elif 'pg_inherits' in query:
+            self._rows = list(self.partitioned.get(params[0], []))
+        else:
+            self._rows = []
+        return self
+
+    def fetchone(self):
+        return self._rows.pop(0) if self._rows else None
+
+    def fetchall(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+    def statements(self):
+        return [' '.join(sql.split()) for sql, _ in self.executed]
+
+
+def _bound(lower, upper):
+    lower = 'MINVALUE' if lower is None else f"'{lower} 00:00:00'"
+    return f"FOR VALUES FROM ({lower}) TO ('{upper} 00:00:00')"
+
+
+class TestMonths:
+
+    def test_add_months_crosses_years(self):
+        assert partitions.add_months(date(2026, 11, 1), 3) == date(2027, 2, 1)
+        assert partitions.add_months(date(2026, 1, 1), -1) == date(2025, 12, 1)
+
+    def test_partition_name(self):
+        assert partitions.partition_name('chat_history', date(2026, 3, 1)) == 'chat_history_p2026_03'
+
+    def test_upper_bound(self):
+        assert partitions.upper_bound(_bound(None, '2026-10-01')) == datetime(2026, 10, 1)
+        assert partitions.upper_bound('DEFAULT') is None
+
+    def test_retention_configurable_per_table(self):
+        with patch.dict(os.environ, {'NOTIFICATIONS_RETENTION_MONTHS': '3'}):
+            assert partitions._retention('notifications', 6) == 3
+        assert partitions._retention('notifications', 6) == 6
+
+
+class TestEnsurePartitions:
+
+    def test_creates_missing_months_from_default(self):
+        cursor = CatalogCursor({'notifications': [
+            ('notifications_default', 'DEFAULT'),
+            ('notifications_legacy', _bound(None, '2026-10-01')),
+            ('notifications_p2026_10', _bound('2026-10-01', '2026-11-01')),
+        ]})
+
+        created = partitions.ensure_partitions(cursor, 'notifications', today=TODAY, ahead=2)
+
+        assert created == ['notifications_p2026_11', 'notifications_p2026_12']
+        statements = cursor.statements()
+        move = next(s for s in statements if 'DELETE FROM notifications_default' in s)
+        assert '"created_at" >= %s AND "created_at" < %s' in move
+        attach = [(s, p) for (_, p), s in zip(cursor.executed, statements) if 'ATTACH PARTITION' in s]
+        assert attach[0][1] == (date(2026, 11, 1), date(2026, 12, 1))
+
+
+class TestRetention:
+
+    PARTITIONS = [
+        ('{t}_default', 'DEFAULT'),
+        ('{t}_legacy', _bound(None, '2026-02-01')),
+        ('{t}_p2026_03', _bound('2026-03-01', '2026-04-01')),
+        ('{t}_p2026_04', _bound('2026-04-01', '2026-05-01')),
+        ('{t}_p2026_10', _bound('2026-10-01', '2026-11-01')),
+    ]
+
+    def _cursor(self, table):
+        return CatalogCursor({table: [(n.format(t=table), b) for n, b in self.PARTITIONS]})
+
+    def test_operational_partitions_dropped(self):
+        cursor = self._cursor('notifications')  # 6 months: keep April onwards
+
+        with patch.dict(partitions.PARTITIONED_TABLES,
+                        {'notifications': PartitionPolicy('created_at', 6, clinical=False)}):
+            actions = partitions.apply_retention(cursor, 'notifications', today=TODAY)
+
+        assert actions == [('notifications_legacy', 'drop'), ('notifications_p2026_03', 'drop')]
+        statements = cursor.statements()
+        assert 'ALTER TABLE notifications DETACH PARTITION notifications_legacy' in statements
+        assert 'DROP TABLE notifications_p2026_03' in statements
+        assert not any('p2026_04' in s or '_default' in s for s in statements)
+
+    def test_clinical_partitions_archived_never_dropped(self):
+        cursor = self._cursor('chat_history')
+
+        with patch.dict(partitions.PARTITIONED_TABLES,
+                        {'chat_history': PartitionPolicy('timestamp', 6, clinical=True)}):
+            actions = partitions.apply_retention(cursor, 'chat_history', today=TODAY)
+
+        assert {action for _, action in actions} == {'archive'}
+        statements = cursor.statements()
+        assert 'ALTER TABLE chat_history_p2026_03 SET SCHEMA archive' in statements
+        assert not any(s.startswith('DROP') for s in statements)
+
+    def test_dry_run_changes_nothing(self):
+        cursor = self._cursor('ai_activity_log')
+
+        with patch.dict(partitions.PARTITIONED_TABLES,
+                        {'ai_activity_log': PartitionPolicy('activity_timestamp', 1, clinical=False)}):
+            actions = partitions.apply_retention(cursor, 'ai_activity_log', today=TODAY, dry_run=True)
+
+        assert len(actions) == 3  # the current month stays
+        assert not any('DETACH' in s for s in cursor.statements())
+
+    def test_zero_retention_keeps_everything(self):
+        cursor = self._cursor('audit_logs')
+
+        with patch.dict(partitions.PARTITIONED_TABLES,
+                        {'audit_logs': PartitionPolicy('timestamp', 0, clinical=True)}):
+            assert partitions.apply_retention(cursor, 'audit_logs', today=TODAY) == []
+
+
+class TestMaintain:
+
+    def test_unpartitioned_tables_skipped_and_failures_isolated(self):
+        cursor = CatalogCursor({'chat_history': [], 'notifications': []})
+        conn = RecordingConnection(cursor)
+        logged = []
+
+        def ensure(cur, table, today=None):
+            if table == 'chat_history':
+                raise RuntimeError('lock timeout')
+            return [f'{table}_p2026_10']
+
+        with patch.object(partitions, 'ensure_partitions', side_effect=ensure):
+            summary = partitions.maintain(conn, today=TODAY, log=logged.append)
+
+        assert summary == {'notifications': {'created': ['notifications_p2026_10'], 'retired': []}}
+        assert any('chat_history' in line and 'lock timeout' in line for line in logged)
+        assert conn.commits == 1
+
+
+# ==================== PRUNING (PostgreSQL) ====================
+
+WINDOW_QUERIES = [
+    # fetch_user_memory
+    ('ai_memory_events', 7,
+     "SELECT event_type, event_data, event_timestamp FROM ai_memory_events "
+     "WHERE username = %s AND event_timestamp >= NOW() - INTERVAL '7 days' ORDER BY event_timestamp DESC LIMIT 20",
+     ('prune_user',)),
+    ('ai_activity_log', 1,
+     "SELECT activity_type, COUNT(*), MAX(activity_timestamp) FROM ai_activity_log "
+     "WHERE username = %s AND activity_timestamp >= NOW() - INTERVAL '24 hours' GROUP BY activity_type",
+     ('prune_user',)),
+    # analytics dashboard / developer stats
+    ('chat_history', 7,
+     "SELECT DISTINCT sender FROM chat_history WHERE timestamp > CURRENT_TIMESTAMP - INTERVAL '7 days'", ()),
+    ('chat_history', 1,
+     "SELECT COUNT(*) FROM chat_history WHERE timestamp > CURRENT_TIMESTAMP - INTERVAL '24 hours'", ()),
+]
+
+
+def _relations(plan):
+    if plan.get('Relation Name'):
+        yield plan['Relation Name']
+    for child in plan.get('Plans', []):
+        yield from _relations(child)
+
+
+@pytest.mark.skipif(not os.getenv('DATABASE_URL'), reason='needs a PostgreSQL DATABASE_URL')
+@pytest.mark.parametrize('table,days,query,params', WINDOW_QUERIES,
+                         ids=[f"{q[0]}-{q[1]}d" for q in WINDOW_QUERIES])
+def test_window_queries_prune_old_partitions(table, days, query, params):
+    import migrations
+    migrations.migrate(log=lambda msg: None)
+    conn = migrations.get_db_connection()
+    try:
+        cur = conn.cursor()
+        bounds = dict(partitions.list_partitions(cur, table))
+        cur.execute("SELECT NOW()::timestamp - make_interval(days => %s)", (days,))
+        window_start = cur.fetchone()[0]
+
+        cur.execute(f"EXPLAIN (ANALYZE, FORMAT JSON) {query}", params)
+        plan = cur.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        scanned = set(_relations(plan[0]['Plan']))
+    finally:
+        conn.rollback()
+        conn.close()
+
+    assert scanned, f"{table} not scanned"
+    stale = {name for name in scanned if bounds.get(name) is not None and bounds[name] <= window_start}
+    assert not stale, f"{table} partitions outside the window were scanned: {sorted(stale)}"
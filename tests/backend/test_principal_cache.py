@@ -0,0 +1,145 @@
+"""
+Tests for the session principal cache (principal_cache.py, api.get_current_principal).
+
+Covers:
+  - Identity and role resolved at most once per request (g.principal)
+  - Principals reused across requests until TTL / invalidation
+  - Role mismatches and deleted users clearing the session
+  - Invalidations that race a lookup are not cached
+  - Writes that change a principal NOTIFY other workers
+"""
+
+from unittest.mock import patch
+
+import api
+from principal_cache import ALL_PRINCIPALS, PRINCIPAL_CHANNEL, Principal, PrincipalCache
+from tests.conftest import MockConnection
+from tests.backend.test_message_dispatcher import RecordingCursor
+
+
+def _db(rows):
+    cursor = RecordingCursor(rows)
+    conn = MockConnection(cursor)
+    return (patch.object(api, 'get_db_connection', return_value=conn),
+            patch.object(api, 'get_wrapped_cursor', return_value=cursor),
+            cursor)
+
+
+def _request(client, username='test_clinician', role='clinician'):
+    context = client.application.test_request_context()
+    context.push()
+    api.session['username'] = username
+    api.session['role'] = role
+    return context
+
+
+class TestPrincipalCache:
+
+    def test_expired_entry_missed(self):
+        cache = PrincipalCache(ttl=0, listen=False)
+        cache.put(Principal('alice', 'user', 'dr_bob'))
+        assert cache.get('alice') is None
+
+    def test_invalidation_during_lookup_not_cached(self):
+        cache = PrincipalCache(listen=False)
+        generation = cache.generation
+        cache.invalidate('alice')  # another worker's NOTIFY lands mid-query
+
+        cache.put(Principal('alice', 'user', None), generation)
+
+        assert cache.get('alice') is None
+
+    def test_notify_evicts_locally_and_broadcasts(self):
+        cache = PrincipalCache(listen=False)
+        cache.put(Principal('alice', 'user', None))
+        cursor = RecordingCursor()
+
+        cache.notify(cursor, 'alice')
+
+        assert cache.get('alice') is None
+        assert cursor.executed == [('SELECT pg_notify(%s, %s)', (PRINCIPAL_CHANNEL, 'alice'))]
+
+    def test_wildcard_clears_everything(self):
+        cache = PrincipalCache(listen=False)
+        cache.put(Principal('alice', 'user', None))
+        cache.put(Principal('bob', 'clinician', None))
+
+        cache.invalidate(ALL_PRINCIPALS)
+
+        assert cache.get('alice') is None and cache.get('bob') is None
+
+
+class TestRequestPrincipal:
+
+    def test_resolved_once_per_request(self, client):
+        p_db, p_cursor, cursor = _db([('clinician', None)])
+        context = _request(client)
+        try:
+            with p_db, p_cursor:
+                assert api.get_authenticated_username() == 'test_clinician'
+                assert api.get_authenticated_username() == 'test_clinician'
+                assert api.get_user_role_row(cursor, 'test_clinician') == ('clinician',)
+        finally:
+            context.pop()
+
+        assert len(cursor.executed) == 1
+        assert api.principal_cache.get('test_clinician') == Principal('test_clinician', 'clinician', None)
+
+    def test_cached_across_requests(self, client):
+        api.principal_cache.put(Principal('test_clinician', 'clinician', None))
+        p_db, p_cursor, cursor = _db([])
+        context = _request(client)
+        try:
+            with p_db, p_cursor:
+                assert api.get_authenticated_username() == 'test_clinician'
+        finally:
+            context.pop()
+
+        assert cursor.executed == []
+
+    def test_other_users_still_queried(self, client):
+        p_db, p_cursor, cursor = _db([('clinician', None), ('user',)])
+        context = _request(client)
+        try:
+            with p_db, p_cursor:
+                api.get_authenticated_username()
+                assert api.get_user_role_row(cursor, 'test_patient') == ('user',)
+        finally:
+            context.pop()
+
+        assert len(cursor.executed) == 2
+
+    def test_role_mismatch_clears_session(self, client):
+        api.principal_cache.put(Principal('test_clinician', 'user', None))
+        context = _request(client)
+        try:
+            assert api.get_authenticated_username() is None
+            assert 'username' not in api.session
+        finally:
+            context.pop()
+
+    def test_logout_within_request(self, client):
+        api.principal_cache.put(Principal('test_clinician', 'clinician', None))
+        context = _request(client)
+        try:
+            assert api.get_authenticated_username() == 'test_clinician'
+            api.session.clear()
+            assert api.get_authenticated_username() is None
+        finally:
+            context.pop()
+
+
+class TestInvalidationSites:
+
+    def test_delete_user_notifies(self, client, mock_db):
+        mock_db({})
+        roles = {'dev': ('developer',), 'test_patient': ('user',)}
+
+        with patch.object(api, 'get_user_role_row', side_effect=lambda cur, username: roles.get(username)), \
+             patch.object(api.principal_cache, 'notify') as notify, patch.object(api, 'log_event'):
+            resp = client.post('/api/developer/users/delete',
+                               json={'username': 'dev', 'target_username': 'test_patient'})
+
+        assert resp.status_code == 200
+        notify.assert_called_once()
+        assert notify.call_args.args[1] == 'test_patient'
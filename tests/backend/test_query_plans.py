@@ -0,0 +1,167 @@
+"""
+EXPLAIN regression tests for the hot queries (migration 3, migrations.HOT_QUERY_INDEXES)
+and the date-range filters (migration 6, date_range.py).
+
+Applies migrations to the database in DATABASE_URL, seeds realistic volumes
+inside a transaction that is rolled back, ANALYZEs, and fails if any hot
+query's plan reads its table with a sequential scan. Skipped without a
+PostgreSQL DATABASE_URL.
+"""
+
+import json
+import os
+
+import pytest
+
+import migrations
+from date_range import parse_date_range, range_query
+
+pytestmark = pytest.mark.skipif(not os.getenv('DATABASE_URL'), reason='needs a PostgreSQL DATABASE_URL')
+
+USERS = 500
+
+SEED = [
+    f"""INSERT INTO users (username, role)
+        SELECT 'plan_u' || i, 'user' FROM generate_series(0, {USERS - 1}) i
+        ON CONFLICT (username) DO NOTHING""",
+    f"""INSERT INTO mood_logs (username, mood_val, entrestamp)
+        SELECT 'plan_u' || (i % {USERS}), i % 10, NOW() - i * INTERVAL '7 minutes'
+        FROM generate_series(1, 50000) i""",
+    f"""INSERT INTO clinical_scales (username, scale_name, score, entry_timestamp)
+        SELECT 'plan_u' || (i % {USERS}), (ARRAY['PHQ-9', 'GAD-7', 'CORE-10', 'WEMWBS'])[1 + i % 4], i % 27,
+               NOW() - i * INTERVAL '11 minutes'
+        FROM generate_series(1, 50000) i""",
+    """INSERT INTO chat_history (session_id, sender, message, timestamp, chat_session_id)
+       SELECT 'plan_s' || (i % 2000), 'user', 'hello', NOW() - i * INTERVAL '1 minute', i % 2000
+       FROM generate_series(1, 100000) i""",
+    f"""INSERT INTO risk_alerts (patient_username, alert_type, title, acknowledged)
+        SELECT 'plan_u' || (i % {USERS}), 'keyword', 'Risk', i % 5 <> 0
+        FROM generate_series(1, 20000) i""",
+    f"""INSERT INTO risk_assessments (patient_username, risk_score, assessed_at)
+        SELECT 'plan_u' || (i % {USERS}), i % 100, NOW() - i * INTERVAL '13 minutes'
+        FROM generate_series(1, 20000) i""",
+    f"""INSERT INTO predictive_risk_flags (patient_username, signal_type, title, is_active)
+        SELECT 'plan_u' || (i % {USERS}), 'plan_signal_' || i, 'Flag', i % 10 = 0
+        FROM generate_series(1, 20000) i""",
+    f"""INSERT INTO community_posts (username, message)
+        SELECT 'plan_u' || (i % {USERS}), 'post' FROM generate_series(1, 2000) i""",
+    f"""INSERT INTO community_likes (post_id, username)
+        SELECT p.id, 'plan_u' || (i % {USERS})
+        FROM generate_series(1, 40000) i
+        JOIN (SELECT id, row_number() OVER () AS n FROM community_posts) p ON p.n = 1 + i % 2000""",
+    f"""INSERT INTO conversations (created_by)
+        SELECT 'plan_u' || (i % {USERS}) FROM generate_series(1, 2000) i""",
+    f"""INSERT INTO messages (sender_username, recipient_username, content, conversation_id, sent_at)
+        SELECT 'plan_u' || (i % {USERS}), 'plan_u' || ((i + 1) % {USERS}), 'hi', c.id,
+               NOW() - i * INTERVAL '3 minutes'
+        FROM generate_series(1, 40000) i
+        JOIN (SELECT id, row_number() OVER () AS n FROM conversations) c ON c.n = 1 + i % 2000""",
+    f"""INSERT INTO gratitude_logs (username, entry, entry_timestamp)
+        SELECT 'plan_u' || (i % {USERS}), 'thanks', NOW() - i * INTERVAL '17 minutes'
+        FROM generate_series(1, 30000) i""",
+    f"""INSERT INTO cbt_records (username, situation, thought, evidence, entry_timestamp)
+        SELECT 'plan_u' || (i % {USERS}), 's', 't', 'e', NOW() - i * INTERVAL '17 minutes'
+        FROM generate_series(1, 30000) i""",
+    f"""INSERT INTO alerts (username, alert_type, details, created_at)
+        SELECT 'plan_u' || (i % {USERS}), 'risk', 'd', NOW() - i * INTERVAL '19 minutes'
+        FROM generate_series(1, 30000) i""",
+]
+
+ANALYZE = ['users', 'mood_logs', 'clinical_scales', 'chat_history', 'risk_alerts', 'risk_assessments',
+           'predictive_risk_flags', 'community_posts', 'community_likes', 'conversations', 'messages',
+           'gratitude_logs', 'cbt_records', 'alerts']
+
+# Insights / clinical summary date-range queries, built as the endpoints build them
+WINDOW = parse_date_range('2026-09-01', '2026-09-30')
+
+# (table, query as the app issues it, params)
+HOT_QUERIES = [
+    ('mood_logs',
+     "SELECT mood_val, notes, entrestamp FROM mood_logs WHERE username = %s ORDER BY entrestamp DESC LIMIT 5",
+     ('plan_u7',)),
+    ('mood_logs',
+     "SELECT COUNT(*) FROM mood_logs WHERE username = %s AND entrestamp >= CURRENT_TIMESTAMP - INTERVAL '14 days'",
+     ('plan_u7',)),
+    ('clinical_scales',
+     "SELECT score, severity FROM clinical_scales WHERE username = %s AND scale_name = 'PHQ-9' "
+     "ORDER BY entry_timestamp DESC LIMIT 1",
+     ('plan_u7',)),
+    ('chat_history',
+     "SELECT sender, message FROM chat_history WHERE chat_session_id = %s ORDER BY id DESC LIMIT 10",
+     (42,)),
+    ('chat_history',
+     "SELECT sender, message, timestamp FROM chat_history WHERE session_id = %s ORDER BY timestamp ASC",
+     ('plan_s42',)),
+    ('risk_alerts',
+     "SELECT COUNT(*) FROM risk_alerts WHERE patient_username IN (%s, %s) AND acknowledged = FALSE",
+     ('plan_u7', 'plan_u8')),
+    ('risk_assessments',
+     "SELECT risk_score, risk_level, assessed_at FROM risk_assessments WHERE patient_username = %s "
+     "ORDER BY assessed_at DESC LIMIT 1",
+     ('plan_u7',)),
+    ('predictive_risk_flags',
+     "SELECT flag_level, COUNT(*) FROM predictive_risk_flags WHERE patient_username = %s AND is_active = TRUE "
+     "GROUP BY flag_level",
+     ('plan_u7',)),
+    ('community_likes',
+     "SELECT COUNT(*) FROM community_likes WHERE post_id = (SELECT MIN(id) FROM community_posts)",
+     ()),
+    ('messages',
+     "SELECT id, content, sent_at FROM messages WHERE conversation_id = (SELECT MIN(id) FROM conversations) "
+     "ORDER BY sent_at DESC LIMIT 50",
+     ()),
+    ('mood_logs', *range_query(
+        "SELECT mood_val, sleep_val, entrestamp, notes FROM mood_logs WHERE username = %s",
+        ['plan_u7'], 'entrestamp', WINDOW)),
+    ('chat_history', *range_query(
+        "SELECT sender, message, timestamp FROM chat_history WHERE session_id = %s",
+        ['plan_s42'], 'timestamp', WINDOW, limit=10)),
+    ('gratitude_logs', *range_query(
+        "SELECT entry, entry_timestamp FROM gratitude_logs WHERE username = %s",
+        ['plan_u7'], 'entry_timestamp', WINDOW, limit=5)),
+    ('cbt_records', *range_query(
+        "SELECT situation, thought, evidence, entry_timestamp FROM cbt_records WHERE username = %s",
+        ['plan_u7'], 'entry_timestamp', WINDOW, limit=5)),
+    ('clinical_scales', *range_query(
+        "SELECT scale_name, score, severity, entry_timestamp FROM clinical_scales WHERE username = %s",
+        ['plan_u7'], 'entry_timestamp', WINDOW)),
+    ('alerts', *range_query(
+        "SELECT alert_type, details, created_at FROM alerts WHERE username = %s",
+        ['plan_u7'], 'created_at', WINDOW)),
+]
+
+
+def _scans(plan):
+    """(node type, relation) for every node in an EXPLAIN (FORMAT JSON) plan"""
+    yield plan['Node Type'], plan.get('Relation Name')
+    for child in plan.get('Plans', []):
+        yield from _scans(child)
+
+
+@pytest.fixture(scope='module')
+def seeded():
+    migrations.migrate(log=lambda msg: None)
+    conn = migrations.get_db_connection()
+    cur = conn.cursor()
+    try:
+        for statement in SEED:
+            cur.execute(statement)
+        for table in ANALYZE:
+            cur.execute(f"ANALYZE {table}")
+        yield cur
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+@pytest.mark.parametrize('table,query,params', HOT_QUERIES, ids=[f"{q[0]}-{i}" for i, q in enumerate(HOT_QUERIES)])
+def test_hot_query_uses_an_index(seeded, table, query, params):
+    seeded.execute(f"EXPLAIN (FORMAT JSON) {query}", params)
+    plan = seeded.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+
+    scans = list(_scans(plan[0]['Plan']))
+
+    assert ('Seq Scan', table) not in scans, f"{table} sequential scan:\n{json.dumps(plan, indent=1)}"
+    assert any(relation == table for _, relation in scans)
@@ -0,0 +1,303 @@
+"""
+Tests for the GCRA rate limiter (rate_limit.py) and api.check_rate_limit.
+
+Covers:
+  - Burst of max_requests, then the sustained rate
+  - One call returns allow / retry-after
+  - Expired entries dropped a window at a time (bounded memory under churn)
+  - 429 responses with Retry-After
+  - Shared (cross-worker) limiting: leased batches, cached denials,
+    fallback when the store is down, limits held across processes
+"""
+
+import multiprocessing
+import os
+import time
+
+import pytest
+from unittest.mock import MagicMock, patch
+
+import api
+import migrations
+from rate_limit import GCRALimiter, PostgresLimitStore, SharedGCRALimiter, _benchmark, gcra_acquire
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+class TestGCRA:
+
+    def test_burst_then_sustained_rate(self, clock):
+        limiter = GCRALimiter({'default': (5, 60)}, clock=clock)
+
+        assert all(limiter.check('k').allowed for _ in range(5))
+        denied = limiter.check('k')
+        assert not denied.allowed
+        assert denied.retry_after == pytest.approx(12.0)  # one request per 60/5 seconds
+
+        clock.now += 12
+        assert limiter.check('k').allowed
+        assert not limiter.check('k').allowed
+
+    def test_rejections_do_not_extend_wait(self, clock):
+        limiter = GCRALimiter({'default': (1, 60)}, clock=clock)
+        limiter.check('k')
+
+        for _ in range(10):
+            limiter.check('k')
+        clock.now += 60
+
+        assert limiter.check('k').allowed
+
+    def test_keys_and_types_independent(self, clock):
+        limiter = GCRALimiter({'default': (1, 60), 'login': (1, 60)}, clock=clock)
+
+        assert limiter.check('a').allowed
+        assert limiter.check('b').allowed
+        assert limiter.check('a', 'login').allowed
+        assert not limiter.check('a').allowed
+
+    def test_unknown_type_uses_default(self, clock):
+        limiter = GCRALimiter({'default': (1, 60)}, clock=clock)
+        limiter.check('a', 'nonexistent')
+        assert not limiter.check('a', 'nonexistent').allowed
+
+    def test_limit_survives_first_rotation(self, clock):
+        limiter = GCRALimiter({'default': (2, 60)}, clock=clock)
+        limiter.check('k')
+        limiter.check('k')
+
+        clock.now += 59.9  # next slot opens at +30 for one request; at +60 for the second
+        assert limiter.check('k').allowed
+        assert not limiter.check('k').allowed
+
+    def test_expired_entries_dropped(self, clock):
+        limiter = GCRALimiter({'default': (5, 60)}, clock=clock)
+        for i in range(100):
+            limiter.check(f'k{i}')
+
+        clock.now += 121
+        limiter.check('fresh')
+
+        assert len(limiter) == 1
+
+    def test_reset(self, clock):
+        limiter = GCRALimiter({'default': (1, 60)}, clock=clock)
+        limiter.check('k')
+        limiter.reset('k')
+        assert limiter.check('k').allowed
+
+
+class TestMemoryBenchmark:
+
+    @pytest.mark.slow
+    def test_constant_memory_under_key_churn(self):
+        samples, peak, _ = _benchmark(100_000, per_window=1_000)
+
+        live = [entries for _, entries, _ in samples]
+        memory = [current for _, _, current in samples]
+        assert max(live) <= 2 * 1_000 + 1
+        # Memory after 90k distinct keys is no larger than after 10k
+        assert memory[-1] < memory[0] * 1.5
+
+
+class TestCheckRateLimit:
+
+    def test_429_with_retry_after(self, client, clock):
+        limiter = GCRALimiter({'login': (1, 60), 'default': (60, 60)}, clock=clock)
+
+        with patch.object(api, 'rate_limiter', limiter), patch.object(api, 'log_event'):
+            first = client.post('/api/auth/login', json={})
+            second = client.post('/api/auth/login', json={})
+
+        assert first.status_code != 429
+        assert second.status_code == 429
+        assert second.headers['Retry-After'] == '60'
+        assert second.get_json()['retry_after'] == 60
+
+
+class SharedStore:
+    """rate_limit_acquire() over a dict shared by processes (a Manager proxy)"""
+
+    def __init__(self, tats, lock):
+        self.tats = tats
+        self.lock = lock
+        self.calls = 0
+
+    def acquire(self, limit_type, key, interval, window, want):
+        self.calls += 1
+        with self.lock:
+            granted, tat, retry_after = gcra_acquire(self.tats.get((limit_type, key)), time.time(),
+                                                     interval, window, want)
+            if granted:
+                self.tats[(limit_type, key)] = tat
+            return granted, retry_after
+
+    def reset(self, limit_type, key):
+        self.tats.pop((limit_type, key), None)
+
+    def sweep(self):
+        pass
+
+
+def _local_store():
+    return SharedStore({}, multiprocessing.Lock())
+
+
+def _worker(store, limits, limit_type, attempts, results):
+    limiter = SharedGCRALimiter(limits, store)
+    results.put(sum(limiter.check('ip:10.0.0.1', limit_type).allowed for _ in range(attempts)))
+
+
+class TestSharedGCRA:
+
+    def test_gcra_acquire_grants_what_is_available(self):
+        assert gcra_acquire(None, 0.0, 10.0, 60.0, want=3) == (3, 30.0, 0.0)
+        granted, tat, _ = gcra_acquire(50.0, 0.0, 10.0, 60.0, want=3)
+        assert (granted, tat) == (1, 60.0)
+        assert gcra_acquire(60.0, 0.0, 10.0, 60.0, want=3) == (0, 60.0, 10.0)
+
+    def test_high_volume_limit_leases_batches(self, clock):
+        store = _local_store()
+        limiter = SharedGCRALimiter({'default': (60, 60)}, store, clock=clock)
+
+        assert all(limiter.check('k').allowed for _ in range(60))
+        assert store.calls == 10  # 6 slots per round-trip
+
+    def test_strict_limit_checks_store_every_time(self, clock):
+        store = _local_store()
+        limiter = SharedGCRALimiter({'default': (60, 60), 'login': (5, 60)}, store, clock=clock)
+
+        for _ in range(5):
+            limiter.check('k', 'login')
+
+        assert store.calls == 5
+
+    def test_expired_lease_forfeited(self, clock):
+        store = _local_store()
+        limiter = SharedGCRALimiter({'default': (60, 60)}, store, clock=clock)
+        limiter.check('k')
+
+        clock.now += 2
+        limiter.check('k')
+
+        assert store.calls == 2
+
+    def test_denial_answered_locally(self, clock):
+        store = _local_store()
+        limiter = SharedGCRALimiter({'default': (1, 3600)}, store, clock=clock)
+        limiter.check('k')
+
+        decisions = [limiter.check('k') for _ in range(100)]
+
+        assert not any(d.allowed for d in decisions)
+        assert decisions[-1].retry_after > 3500
+        assert store.calls == 2
+
+    def test_store_down_falls_back_to_process_limits(self, clock):
+        store = MagicMock()
+        store.acquire.side_effect = RuntimeError('connection refused')
+        limiter = SharedGCRALimiter({'default': (2, 60)}, store, clock=clock)
+
+        assert [limiter.check('k').allowed for _ in range(3)] == [True, True, False]
+
+    def test_limits_hold_across_worker_processes(self):
+        ctx = multiprocessing.get_context('fork')
+        manager = ctx.Manager()
+        store = SharedStore(manager.dict(), manager.Lock())
+        results = ctx.Queue()
+        workers = [ctx.Process(target=_worker, args=(store, {'default': (60, 60), 'login': (5, 3600)},
+                                                     'login', 5, results))
+                   for _ in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join(timeout=30)
+        allowed = sum(results.get(timeout=5) for _ in workers)
+        manager.shutdown()
+
+        # Four per-process limiters would have allowed 20
+        assert allowed == 5
+
+    def test_leased_limits_hold_across_worker_processes(self):
+        ctx = multiprocessing.get_context('fork')
+        manager = ctx.Manager()
+        store = SharedStore(manager.dict(), manager.Lock())
+        results = ctx.Queue()
+        workers = [ctx.Process(target=_worker, args=(store, {'default': (100, 3600)}, 'default', 100, results))
+                   for _ in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join(timeout=30)
+        allowed = sum(results.get(timeout=5) for _ in workers)
+        manager.shutdown()
+
+        assert allowed == 100
+
+
+class TestPostgresLimitStore:
+
+    def test_acquire_calls_sql_function(self):
+        cursor = MagicMock(description=[('granted',), ('retry_after',)])
+        cursor.fetchone.return_value = (3, 0.0)
+        conn = MagicMock(closed=False)
+        conn.cursor.return_value = cursor
+        store = PostgresLimitStore(connect=lambda: conn)
+
+        assert store.acquire('default', 'ip:1', 1.0, 60.0, 6) == (3, 0.0)
+        sql, params = cursor.execute.call_args.args
+        assert 'rate_limit_acquire' in sql
+        assert params == ('default', 'ip:1', 1.0, 60.0, 6)
+
+    def test_reconnects_after_error_and_fork(self):
+        conns = []
+
+        def connect():
+            conn = MagicMock(closed=False)
+            conn.cursor.return_value.fetchone.return_value = (1, 0.0)
+            conns.append(conn)
+            return conn
+
+        store = PostgresLimitStore(connect=connect)
+        store.acquire('default', 'k', 1.0, 60.0, 1)
+        conns[0].cursor.return_value.execute.side_effect = RuntimeError('server closed the connection')
+        with pytest.raises(RuntimeError):
+            store.acquire('default', 'k', 1.0, 60.0, 1)
+        store.acquire('default', 'k', 1.0, 60.0, 1)
+        store._pid = os.getpid() + 1
+        store.acquire('default', 'k', 1.0, 60.0, 1)
+
+        assert len(conns) == 3
+
+    @pytest.mark.skipif(not os.getenv('DATABASE_URL'), reason='needs a PostgreSQL DATABASE_URL')
+    def test_limits_hold_across_processes_against_postgres(self):
+        ctx = multiprocessing.get_context('fork')
+        migrations.migrate(log=lambda msg: None)
+        conn = api.get_db_connection()
+        try:
+            cur = conn.cursor()
+            cur.execute("DELETE FROM rate_limits WHERE key = 'ip:10.0.0.1'")
+            conn.commit()
+        finally:
+            conn.close()
+        results = ctx.Queue()
+        workers = [ctx.Process(target=_worker, args=(PostgresLimitStore(), {'default': (60, 60), 'login': (5, 3600)},
+                                                     'login', 5, results))
+                   for _ in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join(timeout=30)
+
+        assert sum(results.get(timeout=5) for _ in workers) == 5
@@ -0,0 +1,182 @@
+"""
+Tests for cached report artifacts and background rendering (report_service.py).
+
+Covers:
+  - Cache keys change with the patient's data version
+  - ReportWorker claim/render/notify and retry on failure
+  - GET /api/export/pdf cache hit vs queued render
+  - GET /api/reports/artifacts/<id> ownership
+  - POST /api/reports/generate served from cache
+"""
+
+import json
+
+import pytest
+from unittest.mock import patch
+
+import api
+import report_service
+from report_service import ReportWorker, report_cache_key, REPORT_WELLNESS_PDF
+from tests.backend.test_message_dispatcher import RecordingCursor, RecordingConnection
+
+
+def _artifact_row(status='ready', requested_by='test_patient', content=b'%PDF-1.4 cached'):
+    return (7, 'test_patient', REPORT_WELLNESS_PDF, status, 'application/pdf',
+            'test_patient_wellness_report.pdf', requested_by, None, '2026-10-01T10:00:00',
+            '2026-10-01T10:00:05', content)
+
+
+class TestCacheKey:
+
+    def test_key_changes_with_data_version(self):
+        a = report_cache_key('pat', REPORT_WELLNESS_PDF, None, None, 'v1', 'pat')
+        b = report_cache_key('pat', REPORT_WELLNESS_PDF, None, None, 'v2', 'pat')
+        assert a != b
+        assert a == report_cache_key('pat', REPORT_WELLNESS_PDF, None, None, 'v1', 'pat')
+
+    def test_key_scoped_to_range_and_requester(self):
+        base = report_cache_key('pat', 'clinical_summary', '2026-01-01', '2026-02-01', 'v1', 'clin_a')
+        assert base != report_cache_key('pat', 'clinical_summary', '2026-01-01', '2026-03-01', 'v1', 'clin_a')
+        assert base != report_cache_key('pat', 'clinical_summary', '2026-01-01', '2026-02-01', 'v1', 'clin_b')
+
+
+class TestReportWorker:
+
+    def _renderers(self, render):
+        return {REPORT_WELLNESS_PDF: (lambda cur, username: {'username': username}, render,
+                                      'application/pdf', '{username}_wellness_report.pdf')}
+
+    def test_renders_and_notifies(self):
+        cursor = RecordingCursor([(7, 'test_patient', REPORT_WELLNESS_PDF, 'test_patient', 1)])
+        conn = RecordingConnection(cursor)
+        worker = ReportWorker(conn)
+
+        with patch.dict(report_service.BACKGROUND_RENDERERS, self._renderers(lambda data: b'%PDF')):
+            assert worker.render_batch() == {'ready': 1, 'failed': 0}
+
+        claim_sql = cursor.executed[0][0]
+        assert 'FOR UPDATE SKIP LOCKED' in claim_sql
+        ready = [p for q, p in cursor.executed if "SET status = 'ready'" in q]
+        assert ready[0][1:] == ('application/pdf', 'test_patient_wellness_report.pdf', 7)
+        assert any('DELETE FROM report_artifacts old' in q for q, _ in cursor.executed)
+        assert any('INSERT INTO notifications' in q for q, _ in cursor.executed)
+        assert ('NOTIFY report_ready, %s', ('7',)) in cursor.executed
+        assert conn.commits == 2  # claim + results
+
+    def test_failed_render_requeued(self):
+        cursor = RecordingCursor([(7, 'test_patient', REPORT_WELLNESS_PDF, 'test_patient', 1)])
+        worker = ReportWorker(RecordingConnection(cursor))
+
+        def broken(data):
+            raise RuntimeError('font missing')
+
+        with patch.dict(report_service.BACKGROUND_RENDERERS, self._renderers(broken)):
+            assert worker.render_batch() == {'ready': 0, 'failed': 1}
+
+        update = [p for q, p in cursor.executed if 'SET status = %s, error = %s' in q][0]
+        assert update == ('queued', 'font missing', 7)
+        assert not any('INSERT INTO notifications' in q for q, _ in cursor.executed)
+
+    def test_empty_queue_does_no_work(self):
+        cursor = RecordingCursor([])
+        worker = ReportWorker(RecordingConnection(cursor))
+        assert worker.render_batch() == {'ready': 0, 'failed': 0}
+        assert len(cursor.executed) == 1
+
+    def test_wellness_pdf_renders(self):
+        pytest.importorskip('reportlab')
+        data = {'username': 'pat', 'generated_at': 'October 19, 2026',
+                'moods': [('2026-10-18', 7, 8, 'sertraline', 30)],
+                'gratitudes': [('2026-10-18', 'A walk in the park')]}
+        assert report_service.render_wellness_pdf(data).startswith(b'%PDF')
+
+
+class TestExportPdf:
+
+    def test_requires_auth(self, client, mock_db):
+        mock_db()
+        assert client.get('/api/export/pdf?username=test_patient').status_code == 401
+
+    def test_cannot_export_other_user(self, auth_patient, mock_db):
+        mock_db()
+        client, _ = auth_patient
+        assert client.get('/api/export/pdf?username=someone_else').status_code == 403
+
+    def test_cache_hit_served_instantly(self, auth_patient, mock_db):
+        conn, cursor = mock_db({
+            'SELECT md5(': [('v1',)],
+            'FROM report_artifacts WHERE cache_key': [_artifact_row()],
+        })
+        client, _ = auth_patient
+
+        resp = client.get('/api/export/pdf?username=test_patient')
+
+        assert resp.status_code == 200
+        assert resp.data == b'%PDF-1.4 cached'
+        assert resp.headers['X-Report-Cache'] == 'hit'
+
+    def test_miss_queues_render(self, auth_patient, mock_db):
+        conn, cursor = mock_db({
+            'SELECT md5(': [('v1',)],
+            'INSERT INTO report_artifacts': [(9, 'queued')],
+        })
+        client, _ = auth_patient
+
+        resp = client.get('/api/export/pdf?username=test_patient')
+        data = resp.get_json()
+
+        assert resp.status_code == 202
+        assert data['artifact_id'] == 9
+        assert data['status_url'] == '/api/reports/artifacts/9'
+
+
+class TestArtifactEndpoints:
+
+    def test_status_hidden_from_other_users(self, auth_patient, mock_db):
+        mock_db({'FROM report_artifacts WHERE id': [_artifact_row(requested_by='someone_else')]})
+        client, _ = auth_patient
+        assert client.get('/api/reports/artifacts/7').status_code == 404
+
+    def test_ready_status_has_download_url(self, auth_patient, mock_db):
+        mock_db({'FROM report_artifacts WHERE id': [_artifact_row()[:10]]})
+        client, _ = auth_patient
+
+        data = client.get('/api/reports/artifacts/7').get_json()
+        assert data['status'] == 'ready'
+        assert data['download_url'] == '/api/reports/artifacts/7/download'
+
+    def test_download_not_ready(self, auth_patient, mock_db):
+        mock_db({'FROM report_artifacts WHERE id': [_artifact_row(status='rendering', content=None)]})
+        client, _ = auth_patient
+        assert client.get('/api/reports/artifacts/7/download').status_code == 409
+
+
+class TestClinicalReportCache:
+
+    def test_cached_report_skips_queries(self, auth_clinician, mock_db):
+        cached = json.dumps({'success': True, 'report_content': 'PROGRESS REPORT', 'report_type': 'progress',
+                             'patient': 'test_patient'}).encode()
+        conn, cursor = mock_db({
+            'SELECT status FROM patient_approvals': ('approved',),
+            'SELECT full_name, dob, email, phone, conditions, created_at': ('Test Patient', '1990-01-01', 'p@test.com', '07700', 'anxiety', '2025-01-01'),
+            'SELECT md5(': [('v1',)],
+            'FROM report_artifacts WHERE cache_key': [(1, 'test_patient', 'progress', 'ready', 'application/json',
+                                                       None, 'test_clinician', None, None, None, cached)],
+        })
+        client, _ = auth_clinician
+
+        with patch.object(api, 'log_event'):
+            resp = client.post('/api/reports/generate',
+                               json={'username': 'test_patient', 'report_type': 'progress',
+                                     'clinician': 'test_clinician'})
+
+        assert resp.status_code == 200
+        assert resp.get_json()['report_content'] == 'PROGRESS REPORT'
+        assert 'AVG(mood_val)' not in cursor._last_query
+
+    def test_unknown_report_type(self, auth_clinician, mock_db):
+        mock_db()
+        client, _ = auth_clinician
+        resp = client.post('/api/reports/generate',
+                           json={'username': 'test_patient', 'report_type': 'bogus', 'clinician': 'test_clinician'})
+        assert resp.status_code == 400
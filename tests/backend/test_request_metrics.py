@@ -0,0 +1,251 @@
+"""
+Tests for per-endpoint request metrics (request_metrics.py, /metrics).
+
+Covers:
+  - Histogram bucketing, quantile estimates and Prometheus exposition
+  - Workers add their counters to the shared store periodically, keeping
+    them locally when the store is down
+  - /metrics reports every worker's totals from the store
+  - Request hooks record route templates, statuses and in-flight requests
+  - Token / developer authentication on /metrics and the dashboard summary
+"""
+
+import os
+from unittest.mock import patch
+
+import pytest
+
+import api
+import migrations
+from request_metrics import (LATENCY_BUCKETS, EndpointStats, MetricsSnapshot, PostgresMetricsStore,
+                             RequestMetrics, render_prometheus, summarize)
+
+
+class FakeStore:
+    """Keeps running totals like PostgresMetricsStore"""
+
+    def __init__(self):
+        self.totals = {}
+        self.workers = {}
+        self.fail = False
+        self.adds = 0
+
+    def add(self, worker, deltas, in_flight):
+        if self.fail:
+            raise ConnectionError('store down')
+        self.adds += 1
+        for key, stats in deltas.items():
+            self.totals.setdefault(key, EndpointStats()).add(stats)
+        self.workers[worker] = in_flight
+
+    def load(self, stale_seconds):
+        return dict(self.totals), sum(self.workers.values())
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestEndpointStats:
+
+    def test_observations_land_in_le_buckets(self):
+        stats = EndpointStats()
+        for duration in (0.001, 0.005, 0.2, 30.0):
+            stats.observe(duration, 200, 100)
+
+        assert stats.buckets[0] == 2                       # <= 5ms, inclusive
+        assert stats.buckets[LATENCY_BUCKETS.index(0.25)] == 1
+        assert stats.buckets[-1] == 1                      # +Inf
+        assert stats.response_bytes == 400
+
+    def test_quantile_interpolates(self):
+        stats = EndpointStats()
+        for _ in range(100):
+            stats.observe(0.07, 200, 0)                    # all in (0.05, 0.1]
+
+        assert stats.quantile(0.5) == pytest.approx(0.075)
+        assert EndpointStats().quantile(0.95) is None
+
+
+class TestRequestMetrics:
+
+    def test_flushes_deltas_every_interval(self):
+        store, clock = FakeStore(), Clock()
+        metrics = RequestMetrics(store, clock=clock, flush_interval=10)
+
+        for _ in range(3):
+            metrics.request_started()
+            metrics.request_finished('/api/health', 'GET', 200, 0.002)
+        assert store.adds == 0
+
+        clock.now = 11
+        metrics.request_started()
+        metrics.request_finished('/api/health', 'GET', 503, 0.002)
+
+        assert store.adds == 1
+        assert store.totals[('/api/health', 'GET')].requests == 4
+        assert store.totals[('/api/health', 'GET')].errors == 1
+        assert metrics.pending == {}
+
+    def test_store_failure_keeps_counters(self):
+        store, clock = FakeStore(), Clock()
+        metrics = RequestMetrics(store, clock=clock, flush_interval=10)
+        store.fail = True
+
+        metrics.request_finished('/api/x', 'POST', 200, 0.01)
+        assert metrics.flush() is False
+        store.fail = False
+        metrics.request_finished('/api/x', 'POST', 200, 0.01)
+        metrics.flush()
+
+        assert store.totals[('/api/x', 'POST')].requests == 2
+
+    def test_snapshot_covers_every_worker(self):
+        store = FakeStore()
+        worker_a, worker_b = RequestMetrics(store), RequestMetrics(store)
+        worker_a._pid, worker_a._worker = os.getpid(), 'a'
+        worker_b._pid, worker_b._worker = os.getpid(), 'b'
+
+        worker_a.request_finished('/api/a', 'GET', 200, 0.01)
+        worker_b.request_finished('/api/a', 'GET', 200, 0.01)
+        worker_b.request_finished('/api/b', 'GET', 200, 0.01)
+        worker_b.flush()
+
+        snapshot = worker_a.snapshot()
+
+        assert snapshot.aggregated is True
+        assert snapshot.series[('/api/a', 'GET')].requests == 2
+        assert ('/api/b', 'GET') in snapshot.series
+
+    def test_snapshot_falls_back_to_local(self):
+        store = FakeStore()
+        metrics = RequestMetrics(store)
+        metrics.request_finished('/api/a', 'GET', 200, 0.01)
+        store.fail = True
+
+        snapshot = metrics.snapshot()
+
+        assert snapshot.aggregated is False
+        assert snapshot.series[('/api/a', 'GET')].requests == 1
+
+    @pytest.mark.skipif(not os.getenv('DATABASE_URL'), reason='needs a PostgreSQL DATABASE_URL')
+    def test_postgres_store_sums_workers(self):
+        migrations.migrate(log=lambda msg: None)
+        key = ('/test/metrics/<id>', 'GET')
+        store = PostgresMetricsStore()
+        store._cursor().execute("DELETE FROM request_metrics WHERE endpoint = %s", (key[0],))
+
+        for worker, duration in (('test-a', 0.02), ('test-b', 3.0)):
+            stats = EndpointStats()
+            stats.observe(duration, 200, 10)
+            store.add(worker, {key: stats}, 1)
+        series, in_flight = store.load()
+
+        assert series[key].requests == 2
+        assert series[key].buckets[LATENCY_BUCKETS.index(0.025)] == 1
+        assert series[key].buckets[LATENCY_BUCKETS.index(5.0)] == 1
+        assert in_flight >= 2
+
+
+class TestExposition:
+
+    def _snapshot(self):
+        stats = EndpointStats()
+        stats.observe(0.02, 200, 512)
+        stats.observe(0.3, 500, 64)
+        return MetricsSnapshot({('/api/patient/<username>', 'GET'): stats}, 2, True)
+
+    def test_prometheus_text(self):
+        text = render_prometheus(self._snapshot())
+        labels = 'endpoint="/api/patient/<username>",method="GET"'
+
+        assert '# TYPE healing_space_http_request_duration_seconds histogram' in text
+        assert f'healing_space_http_requests_total{{{labels}}} 2' in text
+        assert f'healing_space_http_request_errors_total{{{labels}}} 1' in text
+        assert f'healing_space_http_request_duration_seconds_bucket{{{labels},le="0.025"}} 1' in text
+        assert f'healing_space_http_request_duration_seconds_bucket{{{labels},le="+Inf"}} 2' in text
+        assert f'healing_space_http_response_size_bytes_sum{{{labels}}} 576' in text
+        assert 'healing_space_http_requests_in_flight 2' in text
+
+    def test_label_values_escaped(self):
+        snapshot = MetricsSnapshot({('/a"b', 'GET'): EndpointStats()}, 0, False)
+        assert 'endpoint="/a\\"b"' in render_prometheus(snapshot)
+
+    def test_summary_rows(self):
+        rows = summarize(self._snapshot())
+
+        assert rows[0]['requests'] == 2
+        assert rows[0]['error_rate'] == 0.5
+        assert rows[0]['avg_bytes'] == 288
+
+
+class TestRequestHooks:
+
+    def test_records_route_template(self, client):
+        metrics = RequestMetrics()
+        with patch.object(api, 'request_metrics', metrics):
+            client.get('/api/health')
+            client.get('/no/such/page')
+
+        assert metrics.totals[('/api/health', 'GET')].requests == 1
+        assert ('unmatched', 'GET') in metrics.totals
+        assert metrics.in_flight == 0
+
+
+    def test_backends_selected_independently(self):
+        env = {'TESTING': '0', 'RATE_LIMIT_BACKEND': 'memory', 'METRICS_BACKEND': 'postgres'}
+        with patch.dict(os.environ, env):
+            os.environ.pop('SQL_PROFILER_BACKEND', None)
+            assert api.use_memory_backend('RATE_LIMIT_BACKEND')
+            assert not api.use_memory_backend('METRICS_BACKEND')
+            assert not api.use_memory_backend('SQL_PROFILER_BACKEND')
+
+
+class TestMetricsEndpoint:
+
+    def test_token_required_when_configured(self, client):
+        with patch.dict(os.environ, {'METRICS_TOKEN': 's3cret'}):
+            denied = client.get('/metrics', headers={'Authorization': 'Bearer wrong'})
+            allowed = client.get('/metrics', headers={'Authorization': 'Bearer s3cret'})
+
+        assert denied.status_code == 401
+        assert allowed.status_code == 200
+        assert allowed.mimetype == 'text/plain'
+        assert b'healing_space_http_requests_in_flight' in allowed.data
+
+    def test_developer_session_when_token_configured(self, client, mock_db):
+        mock_db({'SELECT role': ('developer',)})
+
+        with patch.dict(os.environ, {'METRICS_TOKEN': 's3cret'}), \
+             patch.object(api, 'get_authenticated_username', return_value='dev'):
+            resp = client.get('/metrics')
+
+        assert resp.status_code == 200
+
+    def test_developer_session_without_token(self, auth_patient, mock_db):
+        client, _ = auth_patient
+        mock_db({'SELECT role': ('user',)})
+
+        with patch.dict(os.environ):
+            os.environ.pop('METRICS_TOKEN', None)
+            resp = client.get('/metrics')
+
+        assert resp.status_code == 403
+
+    def test_dashboard_summary(self, client, mock_db):
+        mock_db({'SELECT role': ('developer',)})
+        metrics = RequestMetrics()
+        metrics.request_finished('/api/insights', 'GET', 200, 1.2, 2048)
+
+        with patch.object(api, 'get_authenticated_username', return_value='dev'), \
+             patch.object(api, 'request_metrics', metrics):
+            resp = client.get('/api/developer/metrics/summary')
+
+        data = resp.get_json()
+        assert resp.status_code == 200
+        assert data['endpoints'][0]['endpoint'] == '/api/insights'
+        assert data['all_workers'] is False
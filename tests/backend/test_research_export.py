@@ -0,0 +1,222 @@
+"""
+Tests for the Parquet research export (research_export.py).
+
+Covers:
+  - Vectorized PII scrubbing matches TrainingDataManager.strip_pii
+  - Only consented patients are exported, under their anonymized id
+  - Year/month partitioning
+  - Incremental exports append from the watermark
+  - Newly consented participants are backfilled; withdrawn ones removed
+"""
+
+import os
+from datetime import datetime
+from unittest.mock import patch
+
+import pytest
+
+pa = pytest.importorskip('pyarrow')
+pq = pytest.importorskip('pyarrow.parquet')
+
+from research_export import ResearchExporter, consented_participants, scrub_pii_array
+from training_data_manager import TrainingDataManager
+
+
+SALT = 'a' * 64
+
+
+@pytest.fixture(autouse=True)
+def anonymization_salt():
+    with patch.dict(os.environ, {'ANONYMIZATION_SALT': SALT}):
+        yield
+
+
+class ExportCursor:
+    """Serves consent/user/watermark lookups and named-cursor dataset rows."""
+
+    def __init__(self, conn, named=False):
+        self.conn = conn
+        self.named = named
+        self.rows = []
+
+    def execute(self, query, params=None):
+        self.conn.executed.append((query, params))
+        if self.named:
+            names, from_id = params
+            self.rows = [r for r in self.conn.dataset_rows if r[0] > from_id and r[1] in names]
+        elif 'FROM data_consent' in query:
+            self.rows = [(h,) for h in self.conn.consented]
+        elif 'FROM users' in query:
+            self.rows = [(u,) for u in self.conn.users]
+        elif 'FROM research_export_watermarks' in query:
+            self.rows = [(self.conn.watermark,)] if self.conn.watermark is not None else []
+        elif 'INSERT INTO research_export_watermarks' in query:
+            self.conn.watermark = params[1]
+            self.rows = []
+        elif 'SELECT participant_id FROM research_export_participants' in query:
+            self.rows = [(p,) for p in sorted(self.conn.exported)]
+        elif 'INSERT INTO research_export_participants' in query:
+            self.conn.exported |= set(params[1])
+            self.rows = []
+        elif 'DELETE FROM research_export_participants' in query:
+            self.conn.exported -= set(params[1]) if len(params) > 1 else set(self.conn.exported)
+            self.rows = []
+        return self
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def fetchall(self):
+        return list(self.rows)
+
+    def fetchmany(self, size):
+        batch, self.rows = self.rows[:size], self.rows[size:]
+        return batch
+
+    def close(self):
+        pass
+
+
+class ExportConnection:
+    def __init__(self, dataset_rows, users=('alice', 'bob'), consented_users=('alice',), watermark=None,
+                 exported_users=None):
+        manager = TrainingDataManager()
+        self.dataset_rows = dataset_rows
+        self.users = list(users)
+        self.consented = [manager.anonymize_username(u) for u in consented_users]
+        self.watermark = watermark
+        if exported_users is None:
+            exported_users = consented_users if watermark else ()
+        self.exported = {manager.anonymize_username(u) for u in exported_users}
+        self.executed = []
+        self.commits = 0
+
+    def cursor(self, name=None):
+        return ExportCursor(self, named=bool(name))
+
+    def commit(self):
+        self.commits += 1
+
+
+def _scale_rows():
+    return [
+        (1, 'alice', datetime(2026, 8, 30, 9, 0), 'PHQ-9', 14, 'moderate'),
+        (2, 'alice', datetime(2026, 9, 2, 9, 0), 'GAD-7', 9, 'mild'),
+        (3, 'alice', datetime(2026, 9, 20, 9, 0), 'PHQ-9', 8, 'mild'),
+    ]
+
+
+def _read(path):
+    return pq.read_table(path).to_pylist()
+
+
+class TestScrubbing:
+
+    def test_matches_strip_pii(self):
+        samples = [
+            'email me at jane.doe@example.com please',
+            'call 555-123-4567 or +44 7700 900 123',
+            'My name is Jane and I live at 12 Baker Street',
+            "i'm Sam, born 01/02/1990, ssn 123-45-6789",
+            'nothing to see here',
+            None,
+        ]
+        manager = TrainingDataManager()
+        assert scrub_pii_array(pa.array(samples)).to_pylist() == [manager.strip_pii(s) for s in samples]
+
+
+class TestConsent:
+
+    def test_only_consented_patients(self):
+        conn = ExportConnection([], users=('alice', 'bob', 'carol'), consented_users=('alice', 'carol'))
+        participants = consented_participants(conn.cursor())
+
+        manager = TrainingDataManager()
+        assert participants == {'alice': manager.anonymize_username('alice'),
+                                'carol': manager.anonymize_username('carol')}
+
+    def test_no_consent_skips_user_scan(self):
+        conn = ExportConnection([], consented_users=())
+        assert consented_participants(conn.cursor()) == {}
+        assert not any('FROM users' in q for q, _ in conn.executed)
+
+
+class TestExporter:
+
+    def test_partitions_by_month_with_anonymized_ids(self, tmp_path):
+        conn = ExportConnection(_scale_rows())
+        result = ResearchExporter(conn, str(tmp_path)).run(['clinical_scales'])
+
+        assert result == {'clinical_scales': {'rows': 3, 'last_id': 3, 'backfilled': 0, 'withdrawn': 0}}
+        august = _read(tmp_path / 'clinical_scales' / 'year=2026' / 'month=08' / 'part-000000000000.parquet')
+        september = _read(tmp_path / 'clinical_scales' / 'year=2026' / 'month=09' / 'part-000000000000.parquet')
+        assert [r['score'] for r in august] == [14]
+        assert [r['scale'] for r in september] == ['GAD-7', 'PHQ-9']
+        assert {r['participant_id'] for r in august + september} == {TrainingDataManager().anonymize_username('alice')}
+        assert 'username' not in pq.read_schema(
+            tmp_path / 'clinical_scales' / 'year=2026' / 'month=08' / 'part-000000000000.parquet').names
+        assert conn.watermark == 3
+        assert conn.commits == 1
+
+    def test_incremental_appends_from_watermark(self, tmp_path):
+        conn = ExportConnection(_scale_rows(), watermark=2)
+        result = ResearchExporter(conn, str(tmp_path)).run(['clinical_scales'])
+
+        assert result['clinical_scales'] == {'rows': 1, 'last_id': 3, 'backfilled': 0, 'withdrawn': 0}
+        named = [p for q, p in conn.executed if 'FROM clinical_scales' in q]
+        assert named[0] == (['alice'], 2)
+        files = sorted(p.name for p in tmp_path.rglob('*.parquet'))
+        assert files == ['part-000000000002.parquet']
+
+    def test_free_text_scrubbed(self, tmp_path):
+        rows = [(5, 'alice', datetime(2026, 10, 1, 8, 0), 6, 7, 'sertraline', 'my name is Alice, call 555-123-4567')]
+        conn = ExportConnection(rows)
+        ResearchExporter(conn, str(tmp_path)).run(['mood'])
+
+        [record] = _read(next(tmp_path.rglob('*.parquet')))
+        assert record['notes'] == 'my name is [NAME], call [PHONE]'
+        assert record['recorded_at'] == datetime(2026, 10, 1, 8, 0)
+
+    def test_nothing_new_keeps_watermark(self, tmp_path):
+        conn = ExportConnection(_scale_rows(), watermark=3)
+        result = ResearchExporter(conn, str(tmp_path)).run(['clinical_scales'])
+
+        assert result['clinical_scales'] == {'rows': 0, 'last_id': 3, 'backfilled': 0, 'withdrawn': 0}
+        assert not list(tmp_path.rglob('*.parquet'))
+
+
+
+class TestConsentChanges:
+
+    def _rows(self):
+        return _scale_rows() + [
+            (4, 'bob', datetime(2026, 9, 3, 9, 0), 'PHQ-9', 18, 'moderately severe'),
+            (5, 'bob', datetime(2026, 9, 25, 9, 0), 'PHQ-9', 12, 'moderate'),
+        ]
+
+    def test_new_consent_backfilled_below_watermark(self, tmp_path):
+        conn = ExportConnection(self._rows(), consented_users=('alice', 'bob'), watermark=4,
+                                exported_users=('alice',))
+        result = ResearchExporter(conn, str(tmp_path)).run(['clinical_scales'])
+
+        assert result['clinical_scales'] == {'rows': 1, 'last_id': 5, 'backfilled': 1, 'withdrawn': 0}
+        [backfill] = list(tmp_path.rglob('part-000000000004-backfill-*.parquet'))
+        bob = TrainingDataManager().anonymize_username('bob')
+        assert [(r['participant_id'], r['score']) for r in _read(backfill)] == [(bob, 18)]
+        assert bob in conn.exported
+
+    def test_withdrawal_removed_from_published_parts(self, tmp_path):
+        first = ExportConnection(self._rows(), consented_users=('alice', 'bob'))
+        ResearchExporter(first, str(tmp_path)).run(['clinical_scales'])
+        september = tmp_path / 'clinical_scales' / 'year=2026' / 'month=09' / 'part-000000000000.parquet'
+        assert len(_read(september)) == 4
+
+        second = ExportConnection(self._rows(), consented_users=('alice',), watermark=5,
+                                  exported_users=('alice', 'bob'))
+        result = ResearchExporter(second, str(tmp_path)).run(['clinical_scales'])
+
+        assert result['clinical_scales']['withdrawn'] == 1
+        alice = TrainingDataManager().anonymize_username('alice')
+        assert {r['participant_id'] for r in _read(september)} == {alice}
+        assert len(_read(september)) == 2
+        assert second.exported == {alice}
@@ -24,17 +24,21 @@ from tests.conftest import make_mock_db
 class TestFHIRExport:
     """Tests for GET /api/export/fhir"""
 
-    def test_fhir_export_success(self, client, mock_db):
-        """Valid FHIR export returns bundle."""
-        mock_bundle = json.dumps({
+    def _fhir(self):
+        mock_fhir = MagicMock()
+        mock_fhir.export_patient_fhir.return_value = json.dumps({
             'resourceType': 'Bundle',
             'type': 'collection',
             'entry': [],
         })
-
-        mock_fhir = MagicMock()
-        mock_fhir.export_patient_fhir.return_value = mock_bundle
         mock_fhir.ENCRYPTION_KEY = None
+        return mock_fhir
+
+    def test_fhir_export_success(self, auth_patient, mock_db):
+        """Patient exporting their own record gets the bundle."""
+        client, _ = auth_patient
+        mock_db({})
+        mock_fhir = self._fhir()
         with patch('api.fhir_export', mock_fhir, create=True), \
              patch.object(api, 'log_event'):
             resp = client.get('/api/export/fhir?username=test_patient')
@@ -43,11 +47,36 @@ class TestFHIRExport:
         assert resp.status_code == 200
         assert data['success'] is True
         assert data['bundle']['resourceType'] == 'Bundle'
+        assert mock_fhir.export_patient_fhir.call_args[0][0] == 'test_patient'
 
-    def test_fhir_export_missing_username(self, client, mock_db):
-        """Missing username returns 400."""
-        resp = client.get('/api/export/fhir')
-        assert resp.status_code == 400
+    def test_fhir_export_requires_authentication(self, client, mock_db):
+        """Anonymous callers cannot export anyone's record."""
+        mock_fhir = self._fhir()
+        with patch('api.fhir_export', mock_fhir, create=True):
+            resp = client.get('/api/export/fhir?username=test_patient')
+
+        assert resp.status_code == 401
+        mock_fhir.export_patient_fhir.assert_not_called()
+
+    def test_fhir_export_other_patient_forbidden(self, auth_clinician, mock_db):
+        """Clinicians can only export patients they are approved for."""
+        client, _ = auth_clinician
+        mock_db({'FROM patient_approvals': None})
+        mock_fhir = self._fhir()
+        with patch('api.fhir_export', mock_fhir, create=True):
+            resp = client.get('/api/export/fhir?username=someone_else')
+
+        assert resp.status_code == 403
+        mock_fhir.export_patient_fhir.assert_not_called()
+
+    def test_fhir_export_approved_clinician(self, auth_clinician, mock_db):
+        client, _ = auth_clinician
+        mock_db({'FROM patient_approvals': (1,)})
+        with patch('api.fhir_export', self._fhir(), create=True), \
+             patch.object(api, 'log_event'):
+            resp = client.get('/api/export/fhir?username=test_patient')
+
+        assert resp.status_code == 200
 
 
 # ==================== PATIENT PROFILE ====================
@@ -0,0 +1,178 @@
+"""
+Tests for the per-request SQL profiler (sql_profiler.py).
+
+Covers:
+  - Normalized statements: literals, IN lists and VALUES rows folded
+  - Query-count budget and repeated-statement (N+1) flags, with one log line
+  - Profiling cursors and PostgreSQLCursorWrapper only record inside a profile
+  - Request hooks profile each request and feed the developer dashboard
+"""
+
+import os
+from unittest.mock import MagicMock, patch
+
+import psycopg2
+import pytest
+
+import api
+import migrations
+from sql_profiler import (PostgresProfileStore, ProfilingCursor, ProfilingCursorMixin, SQLProfiler,
+                          normalize_sql, profile_execute)
+from tests.backend.test_message_dispatcher import RecordingConnection, RecordingCursor
+
+
+class ProfiledRecordingCursor(ProfilingCursorMixin, RecordingCursor):
+    pass
+
+
+def _run(profiler, statements, cursor=None, endpoint='/api/community/posts'):
+    cursor = cursor or ProfiledRecordingCursor([('x',)])
+    token = profiler.begin()
+    for sql, params in statements:
+        cursor.execute(sql, params)
+    return profiler.end(token, endpoint, 'GET', 0.25)
+
+
+class TestNormalizeSql:
+
+    def test_literals_and_whitespace(self):
+        sql = "SELECT *\n  FROM posts WHERE id = 17 AND author = 'o''brien' AND score > -2.5"
+        assert normalize_sql(sql) == "SELECT * FROM posts WHERE id = ? AND author = ? AND score > ?"
+
+    def test_identifiers_keep_digits(self):
+        assert normalize_sql("SELECT 1 FROM chat_history_p2026_10") == "SELECT ? FROM chat_history_p2026_10"
+
+    def test_lists_fold(self):
+        assert normalize_sql("SELECT 1 FROM t WHERE id IN (%s, %s, %s)") == "SELECT ? FROM t WHERE id IN (...)"
+        assert normalize_sql("DELETE FROM t WHERE id IN (3,4)") == "DELETE FROM t WHERE id IN (...)"
+        assert (normalize_sql("INSERT INTO t (a, b) VALUES (%s, %s), (%s, %s), (%s, %s)")
+                == "INSERT INTO t (a, b) VALUES (%s, %s), ...")
+
+
+class TestSQLProfiler:
+
+    def test_within_limits_not_flagged(self):
+        log = []
+        profiler = SQLProfiler(enabled=True, query_budget=5, repeat_limit=3, log=log.append)
+
+        report = _run(profiler, [("SELECT 1 FROM posts WHERE id = %s", (i,)) for i in range(3)])
+
+        assert report is None
+        assert log == []
+
+    def test_repeated_statement_is_n_plus_one(self):
+        log = []
+        profiler = SQLProfiler(enabled=True, query_budget=50, repeat_limit=3, log=log.append)
+        statements = [("SELECT * FROM posts LIMIT 20", None)]
+        statements += [(f"SELECT COUNT(*) FROM post_likes WHERE post_id = {i}", None) for i in range(6)]
+
+        report = _run(profiler, statements)
+
+        assert report.n_plus_one and not report.over_budget
+        assert report.queries == 7
+        assert report.repeats == 6
+        assert report.repeated_sql == "SELECT COUNT(*) FROM post_likes WHERE post_id = ?"
+        assert len(log) == 1 and '6x SELECT COUNT(*) FROM post_likes' in log[0]
+        assert profiler.store.top_offenders()[0]['max_repeats'] == 6
+
+    def test_query_budget(self):
+        profiler = SQLProfiler(enabled=True, query_budget=4, repeat_limit=10, log=lambda msg: None)
+
+        report = _run(profiler, [(f"SELECT {i} FROM t{i}", None) for i in range(5)])
+
+        assert report.over_budget and not report.n_plus_one
+
+    def test_store_failure_is_logged(self):
+        log = []
+        store = MagicMock()
+        store.record.side_effect = ConnectionError('down')
+        profiler = SQLProfiler(enabled=True, query_budget=0, repeat_limit=10, store=store, log=log.append)
+
+        assert _run(profiler, [("SELECT 1", None)]) is not None
+        assert 'store unavailable' in log[-1]
+
+    def test_disabled_records_nothing(self):
+        profiler = SQLProfiler(enabled=False, query_budget=0, repeat_limit=0)
+        cursor = ProfiledRecordingCursor()
+
+        assert _run(profiler, [("SELECT 1", None)], cursor) is None
+        assert cursor.executed == [("SELECT 1", None)]
+
+
+class TestRecording:
+
+    def test_wrapper_records_plain_cursors_once(self):
+        profiler = SQLProfiler(enabled=True, query_budget=0, repeat_limit=10, log=lambda msg: None)
+        plain, profiled = RecordingCursor(), ProfiledRecordingCursor()
+
+        token = profiler.begin()
+        api.PostgreSQLCursorWrapper(plain).execute("SELECT 1 FROM a", ())
+        api.PostgreSQLCursorWrapper(profiled).execute("SELECT 1 FROM b", ())
+        report = profiler.end(token, '/x', 'GET', 0.01)
+
+        assert report.queries == 2
+        assert plain.executed == [("SELECT 1 FROM a", ())]
+
+    def test_outside_profile_passes_through(self):
+        cursor = RecordingCursor()
+        profile_execute(cursor, "SELECT 1", None)
+        assert cursor.executed == [("SELECT 1", None)]
+
+    @pytest.mark.skipif(not os.getenv('DATABASE_URL'), reason='needs a PostgreSQL DATABASE_URL')
+    def test_psycopg2_cursor_factory(self):
+        profiler = SQLProfiler(enabled=True, query_budget=0, repeat_limit=1, log=lambda msg: None)
+        conn = psycopg2.connect(os.environ['DATABASE_URL'], cursor_factory=ProfilingCursor)
+        try:
+            cur = api.get_wrapped_cursor(conn)
+            assert isinstance(cur, api.PostgreSQLCursorWrapper)
+            token = profiler.begin()
+            for i in range(3):
+                assert cur.execute("SELECT %s", (i,)).fetchone() == (i,)
+            report = profiler.end(token, '/x', 'GET', 0.01)
+        finally:
+            conn.close()
+
+        assert report.queries == 3 and report.n_plus_one
+
+    @pytest.mark.skipif(not os.getenv('DATABASE_URL'), reason='needs a PostgreSQL DATABASE_URL')
+    def test_postgres_store_keeps_worst(self):
+        migrations.migrate(log=lambda msg: None)
+        store = PostgresProfileStore()
+        store._cursor().execute("DELETE FROM sql_profile_offenders WHERE endpoint = %s", ('/test/sql',))
+        profiler = SQLProfiler(enabled=True, query_budget=100, repeat_limit=1, store=store, log=lambda msg: None)
+
+        for repeats in (5, 2):
+            _run(profiler, [("SELECT 1 FROM t WHERE id = %s", (i,)) for i in range(repeats)], endpoint='/test/sql')
+        row = next(r for r in store.top_offenders(200) if r['endpoint'] == '/test/sql')
+
+        assert (row['flagged_requests'], row['max_repeats'], row['last_queries']) == (2, 5, 2)
+        assert row['repeated_sql'] == "SELECT ? FROM t WHERE id = %s"
+
+
+class TestRequestHooks:
+
+    def test_profiles_request_and_lists_offenders(self, client):
+        profiler = SQLProfiler(enabled=True, query_budget=0, repeat_limit=10, log=lambda msg: None)
+        cursor = ProfiledRecordingCursor([('developer',)])
+
+        with patch.object(api, 'sql_profiler', profiler), \
+             patch.object(api, 'get_authenticated_username', return_value='dev'), \
+             patch.object(api, 'get_db_connection', return_value=RecordingConnection(cursor)):
+            first = client.get('/api/developer/sql-profile')
+            cursor._result_index = 0
+            second = client.get('/api/developer/sql-profile')
+
+        assert first.status_code == 200
+        data = second.get_json()
+        assert data['enabled'] is True
+        offender = data['offenders'][0]
+        assert (offender['endpoint'], offender['method']) == ('/api/developer/sql-profile', 'GET')
+        assert offender['repeated_sql'] == "SELECT role FROM users WHERE username = %s"
+
+    def test_developer_role_required(self, auth_patient, mock_db):
+        client, _ = auth_patient
+        mock_db({'SELECT role': ('user',)})
+
+        resp = client.get('/api/developer/sql-profile')
+
+        assert resp.status_code == 403
@@ -0,0 +1,235 @@
+"""
+Tests for the training-consent cache in TrainingDataManager.
+
+Covers:
+  - Repeat consent checks served from the per-worker cache
+  - Consent lookups and chat writes reuse one connection per worker
+  - Memoized username hashes
+  - set_user_consent / delete_user_training_data invalidate and NOTIFY
+  - Invalidations that race a lookup are not cached
+  - The LISTEN thread evicting entries changed by other workers
+"""
+
+import os
+
+import pytest
+from unittest.mock import patch
+
+from training_data_manager import CONSENT_CHANNEL, TrainingDataManager, _hash_username
+from tests.backend.test_message_dispatcher import RecordingCursor, RecordingConnection
+
+
+SALT = 'b' * 64
+
+
+@pytest.fixture(autouse=True)
+def environment():
+    with patch.dict(os.environ, {'ANONYMIZATION_SALT': SALT}):
+        os.environ.pop('DATABASE_URL', None)
+        yield
+
+
+def _connect(rows):
+    """psycopg2.connect stand-in; every connection shares one recording cursor."""
+    cursor = RecordingCursor(rows)
+    connections = []
+
+    def connect(*args, **kwargs):
+        cursor._result_index = 0
+        conn = RecordingConnection(cursor)
+        connections.append(conn)
+        return conn
+
+    return connect, cursor, connections
+
+
+class TestConsentCache:
+
+    def test_repeat_checks_use_cache(self):
+        manager = TrainingDataManager()
+        connect, cursor, connections = _connect([(1, 0)])
+
+        with patch('training_data_manager.psycopg2.connect', side_effect=connect):
+            assert manager.check_user_consent('alice') is True
+            assert manager.check_user_consent('alice') is True
+
+        assert len(connections) == 1
+
+    def test_no_consent_is_cached_too(self):
+        manager = TrainingDataManager()
+        connect, cursor, connections = _connect([])
+
+        with patch('training_data_manager.psycopg2.connect', side_effect=connect):
+            for _ in range(5):
+                assert manager.check_user_consent('bob') is False
+
+        assert len(connections) == 1
+
+    def test_withdrawn_consent(self):
+        manager = TrainingDataManager()
+        connect, _, _ = _connect([(1, 1)])
+
+        with patch('training_data_manager.psycopg2.connect', side_effect=connect):
+            assert manager.check_user_consent('carol') is False
+
+    def test_expired_entry_requeried(self):
+        manager = TrainingDataManager(consent_ttl=0)
+        connect, cursor, connections = _connect([(1, 0)])
+
+        with patch('training_data_manager.psycopg2.connect', side_effect=connect):
+            manager.check_user_consent('alice')
+            manager.check_user_consent('alice')
+
+        assert len(cursor.executed) == 2
+        assert len(connections) == 1
+
+    def test_chat_writes_share_the_lookup_connection(self):
+        manager = TrainingDataManager()
+        connect, cursor, connections = _connect([])
+
+        with patch('training_data_manager.psycopg2.connect', side_effect=connect), \
+             patch.object(cursor, 'executemany', create=True) as executemany:
+            manager.check_user_consent('alice')
+            for _ in range(3):
+                manager.collect_therapy_session('alice', [{'role': 'user', 'content': 'hi'},
+                                                          {'role': 'ai', 'content': 'hello'}])
+
+        assert executemany.call_count == 3
+        assert len(connections) == 1
+        assert connections[0].commits == 4
+
+    def test_failed_connection_replaced(self):
+        manager = TrainingDataManager()
+        connect, cursor, connections = _connect([(1, 0)])
+
+        with patch('training_data_manager.psycopg2.connect', side_effect=connect), \
+             patch.object(cursor, 'executemany', create=True, side_effect=RuntimeError('server closed the connection')):
+            with pytest.raises(RuntimeError):
+                manager.collect_therapy_session('alice', [{'role': 'user', 'content': 'hi'}])
+            assert manager.check_user_consent('alice') is True
+
+        assert len(connections) == 2
+
+    def test_username_hash_memoized(self):
+        manager = TrainingDataManager()
+        _hash_username.cache_clear()
+
+        first = manager.anonymize_username('dave')
+        assert manager.anonymize_username('dave') == first
+        assert _hash_username.cache_info().hits == 1
+
+
+class TestInvalidation:
+
+    def test_set_consent_notifies_and_updates_cache(self):
+        manager = TrainingDataManager()
+        connect, cursor, connections = _connect([])
+        user_hash = manager.anonymize_username('alice')
+
+        with patch('training_data_manager.psycopg2.connect', side_effect=connect):
+            assert manager.check_user_consent('alice') is False
+            manager.set_user_consent('alice', consent=True)
+            assert manager.check_user_consent('alice') is True
+
+        assert ('SELECT pg_notify(%s, %s)', (CONSENT_CHANNEL, user_hash)) in cursor.executed
+        assert len(connections) == 2  # initial lookup + the consent write
+
+    def test_delete_training_data_invalidates(self):
+        manager = TrainingDataManager()
+        connect, cursor, connections = _connect([(1, 0)])
+        user_hash = manager.anonymize_username('alice')
+
+        with patch('training_data_manager.psycopg2.connect', side_effect=connect):
+            manager.check_user_consent('alice')
+            manager.delete_user_training_data('alice')
+            manager.check_user_consent('alice')
+
+        assert ('SELECT pg_notify(%s, %s)', (CONSENT_CHANNEL, user_hash)) in cursor.executed
+        assert sum('FROM data_consent' in q for q, _ in cursor.executed) == 2
+        assert len(connections) == 2  # the shared lookup connection + the delete
+
+    def test_invalidation_during_lookup_not_cached(self):
+        manager = TrainingDataManager()
+        user_hash = manager.anonymize_username('alice')
+        cursor = RecordingCursor([(0, 0)])
+
+        def connect(*args, **kwargs):
+            # Another worker's NOTIFY lands while our query is in flight
+            manager.invalidate_consent(user_hash)
+            return RecordingConnection(cursor)
+
+        with patch('training_data_manager.psycopg2.connect', side_effect=connect):
+            assert manager.check_user_consent('alice') is False
+
+        assert user_hash not in manager._consent_cache
+
+
+class StopListener(BaseException):
+    pass
+
+
+class Notify:
+    def __init__(self, payload):
+        self.payload = payload
+
+
+class ListenConnection:
+    def __init__(self, payloads):
+        self.cursor_ = RecordingCursor()
+        self.notifies = [Notify(p) for p in payloads]
+        self.autocommit = False
+        self.closed = False
+
+    def cursor(self):
+        return self.cursor_
+
+    def poll(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class TestListener:
+
+    def test_notifications_evict_entries(self):
+        manager = TrainingDataManager()
+        manager._cache_consent('hash_a', True)
+        listen_conn = ListenConnection(['hash_a'])
+        selects = iter([([listen_conn], [], [])])
+
+        def fake_select(*args):
+            manager._cache_consent('hash_b', False)
+            try:
+                return next(selects)
+            except StopIteration:
+                raise RuntimeError('connection lost')
+
+        with patch.dict(os.environ, {'DATABASE_URL': 'postgresql://test'}), \
+             patch('training_data_manager.psycopg2.connect', return_value=listen_conn), \
+             patch('training_data_manager.select.select', side_effect=fake_select), \
+             patch('training_data_manager.time.sleep', side_effect=StopListener):
+            with pytest.raises(StopListener):
+                manager._listen_for_consent_changes()
+
+        assert listen_conn.cursor_.executed == [(f'LISTEN {CONSENT_CHANNEL}', None)]
+        assert listen_conn.autocommit
+        assert listen_conn.closed  # the failed connection is closed before reconnecting
+        assert 'hash_a' not in manager._consent_cache
+        assert 'hash_b' in manager._consent_cache
+
+    def test_listener_started_once_per_process(self):
+        manager = TrainingDataManager()
+
+        with patch.dict(os.environ, {'DATABASE_URL': 'postgresql://test'}), \
+             patch('training_data_manager.threading.Thread') as thread:
+            manager._ensure_consent_listener()
+            manager._ensure_consent_listener()
+
+        assert thread.call_count == 1
+
+    def test_no_listener_without_database(self):
+        manager = TrainingDataManager()
+        with patch('training_data_manager.threading.Thread') as thread:
+            manager._ensure_consent_listener()
+        thread.assert_not_called()
@@ -0,0 +1,136 @@
+"""
+Tests for auto-training scheduling (training_jobs.py, train_scheduler.py).
+
+Covers:
+  - O(1) watermark pre-check on the chat path
+  - Advisory-locked, single-active-job enqueue
+  - Watermark release on job completion / failure / cancellation
+  - Claiming (incl. stale jobs), heartbeats and cancel requests
+"""
+
+from training_jobs import (NOTIFY_CHANNEL, TRAINING_LOCK_KEY, cancel_job, claim_job, finish_job, heartbeat,
+                           schedule_training, should_schedule)
+from tests.backend.test_message_dispatcher import RecordingCursor, RecordingConnection
+
+
+class TestShouldSchedule:
+
+    def test_below_threshold(self):
+        assert not should_schedule(RecordingCursor([(99, None)]), 100)
+
+    def test_threshold_reached(self):
+        cursor = RecordingCursor([(100, None)])
+        assert should_schedule(cursor, 100)
+        assert len(cursor.executed) == 1
+        assert 'WHERE id = 1' in cursor.executed[0][0]
+
+    def test_job_already_scheduled(self):
+        assert not should_schedule(RecordingCursor([(500, 12)]), 100)
+
+    def test_missing_watermark(self):
+        assert not should_schedule(RecordingCursor([]), 100)
+
+
+class TestScheduleTraining:
+
+    def test_enqueues_and_notifies(self):
+        cursor = RecordingCursor([(True,), (150, 40, None), (9,)])
+
+        assert schedule_training(cursor, 100) == 9
+
+        assert cursor.executed[0] == ('SELECT pg_try_advisory_xact_lock(%s)', (TRAINING_LOCK_KEY,))
+        insert = [p for q, p in cursor.executed if 'INSERT INTO training_jobs' in q][0]
+        assert insert == ('auto', None, 150, 40)
+        assert ('UPDATE training_watermark SET scheduled_job_id = %s WHERE id = 1', (9,)) in cursor.executed
+        assert (f'NOTIFY {NOTIFY_CHANNEL}', None) in cursor.executed
+
+    def test_lock_held_elsewhere(self):
+        cursor = RecordingCursor([(False,)])
+
+        assert schedule_training(cursor, 100) is None
+        assert len(cursor.executed) == 1
+
+    def test_lost_race_after_lock(self):
+        cursor = RecordingCursor([(True,), (150, 40, 8)])
+
+        assert schedule_training(cursor, 100) is None
+        assert not any('INSERT INTO training_jobs' in q for q, _ in cursor.executed)
+
+    def test_active_job_conflict(self):
+        cursor = RecordingCursor([(True,), (150, 40, None)])
+
+        assert schedule_training(cursor, 100) is None
+        assert not any('NOTIFY' in q for q, _ in cursor.executed)
+
+
+class TestFinishJob:
+
+    def test_success_moves_watermark(self):
+        cursor = RecordingCursor()
+        finish_job(cursor, 9, True, 480)
+
+        assert cursor.executed[0][1] == ('completed', None, 480, 9)
+        watermark_sql, params = cursor.executed[1]
+        assert 'pending_rows = (SELECT COUNT(*) FROM training_chats WHERE id > %s)' in watermark_sql
+        assert 'scheduled_job_id = NULL' in watermark_sql
+        assert params == (480, 480)
+
+    def test_failure_only_releases(self):
+        cursor = RecordingCursor()
+        finish_job(cursor, 9, False, error='OOM')
+
+        assert cursor.executed[0][1] == ('failed', 'OOM', None, 9)
+        assert 'last_trained_id' not in cursor.executed[1][0]
+        assert cursor.executed[1][1] == (9,)
+
+
+    def test_cancelled_releases(self):
+        cursor = RecordingCursor()
+        finish_job(cursor, 9, False, cancelled=True)
+
+        assert cursor.executed[0][1] == ('cancelled', None, None, 9)
+        assert cursor.executed[1][1] == (9,)
+
+
+class TestClaim:
+
+    def test_claims_queued_or_stale(self):
+        cursor = RecordingCursor([(9, 'auto', None, 40, 480, 1)])
+
+        job = claim_job(cursor)
+
+        assert job == {'id': 9, 'trigger': 'auto', 'requested_by': None, 'from_id': 40, 'to_id': 480, 'attempts': 1}
+        sql = cursor.executed[0][0]
+        assert 'FOR UPDATE SKIP LOCKED' in sql
+        assert "status = 'running' AND heartbeat_at <" in sql
+        assert 'to_id = COALESCE(to_id,' in sql  # pinned once, so a resumed job trains the same rows
+
+    def test_nothing_to_claim(self):
+        assert claim_job(RecordingCursor([])) is None
+
+
+class TestHeartbeatAndCancel:
+
+    def test_heartbeat_reports_progress(self):
+        cursor = RecordingCursor([(False,)])
+
+        assert heartbeat(cursor, 9, {'step': 5, 'max_steps': 10}) is False
+        assert cursor.executed[0][1] == ('{"step": 5, "max_steps": 10}', 9)
+
+    def test_heartbeat_sees_cancel(self):
+        assert heartbeat(RecordingCursor([(True,)]), 9) is True
+
+    def test_cancel_queued_releases_watermark(self):
+        cursor = RecordingCursor([('cancelled',)])
+
+        assert cancel_job(cursor, 9) == 'cancelled'
+        assert 'scheduled_job_id = NULL' in cursor.executed[1][0]
+
+    def test_cancel_running_only_flags(self):
+        cursor = RecordingCursor([('running',)])
+
+        assert cancel_job(cursor, 9) == 'running'
+        assert len(cursor.executed) == 1
+
+    def test_cancel_finished_job(self):
+        assert cancel_job(RecordingCursor([]), 9) is None
@@ -0,0 +1,306 @@
+"""
+Tests for the out-of-process training runner (train_scheduler.py, ai_trainer.ProgressCallback).
+
+Covers:
+  - Jobs run in a child process; exit codes mapped to job outcomes
+  - Crashed children re-queued for resume, then failed after MAX_ATTEMPTS
+  - Cancellation: the child stops itself, or is terminated after the grace period
+  - The child is stopped when supervision fails; listen() survives DB errors
+  - CPU thread limits and niceness applied in the child
+  - Progress reporting / cancel requests through ProgressCallback
+  - POST /api/ai/trigger-training and the developer training job endpoints
+"""
+
+import os
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import psycopg2
+import pytest
+
+import api
+import train_scheduler
+from ai_trainer import ProgressCallback
+from train_scheduler import EXIT_CANCELLED, EXIT_NO_DATA, EXIT_TRAINED, TrainingRunner
+from training_jobs import MAX_ATTEMPTS
+from tests.backend.test_message_dispatcher import RecordingCursor, RecordingConnection
+
+
+class FakeProcess:
+    """multiprocessing.Process stand-in that 'exits' after a number of join() calls."""
+
+    def __init__(self, exitcode, alive_joins=0):
+        self._exitcode = exitcode
+        self.alive_joins = alive_joins
+        self.exitcode = None
+        self.started = False
+        self.terminated = False
+
+    def __call__(self, target, args, name):
+        self.target, self.args, self.name = target, args, name
+        return self
+
+    def start(self):
+        self.started = True
+
+    def join(self, timeout=None):
+        if self.terminated or self.alive_joins <= 0:
+            self.exitcode = -15 if self.terminated else self._exitcode
+        self.alive_joins -= 1
+
+    def terminate(self):
+        self.terminated = True
+
+
+def _status_update(cursor):
+    return [p for q, p in cursor.executed if 'UPDATE training_jobs' in q and 'status = %s' in q]
+
+
+def _runner(results, process, **kwargs):
+    cursor = RecordingCursor(results)
+    conn = RecordingConnection(cursor)
+    return TrainingRunner(conn, threads=2, niceness=10, process_factory=process, **kwargs), cursor, conn
+
+
+class TestTrainingRunner:
+
+    def test_trained_job_moves_watermark(self):
+        process = FakeProcess(EXIT_TRAINED)
+        runner, cursor, conn = _runner([(9, 'auto', None, 40, 480, 1)], process)
+
+        job = runner.run_next()
+
+        assert process.started
+        assert process.target is train_scheduler.run_job_process
+        assert process.args == (job, 2, 10)
+        assert job['status'] == 'completed' and job['trained_to_id'] == 480
+        assert _status_update(cursor)[0][:3] == ('completed', None, 480)
+        assert conn.commits == 2
+
+    def test_no_new_data_still_moves_watermark(self):
+        runner, cursor, _ = _runner([(9, 'cron', None, 40, 480, 1)], FakeProcess(EXIT_NO_DATA))
+
+        job = runner.run_next()
+
+        assert job['status'] == 'completed' and job['trained_to_id'] == 480
+        assert _status_update(cursor)[0][:3] == ('completed', None, 480)
+        assert [p for q, p in cursor.executed if 'SET last_trained_id' in q] == [(480, 480)]
+
+    def test_heartbeats_while_child_runs(self):
+        runner, cursor, _ = _runner([(9, 'auto', None, 40, 480, 1), (False,), (False,)],
+                                    FakeProcess(EXIT_TRAINED, alive_joins=2))
+
+        runner.run_next()
+
+        assert sum('SET heartbeat_at' in q for q, _ in cursor.executed) == 2
+
+    def test_crash_requeued_for_resume(self):
+        runner, cursor, _ = _runner([(9, 'auto', None, 40, 480, 1)], FakeProcess(-9))
+
+        job = runner.run_next()
+
+        assert job['status'] == 'queued'
+        assert job['error'] == 'training process exited with code -9'
+        assert ("UPDATE training_jobs SET status = 'queued', error = %s WHERE id = %s",
+                (job['error'], 9)) in cursor.executed
+        assert not _status_update(cursor)
+
+    def test_crash_on_last_attempt_fails(self):
+        runner, cursor, _ = _runner([(9, 'auto', None, 40, 480, MAX_ATTEMPTS)], FakeProcess(1))
+
+        job = runner.run_next()
+
+        assert job['status'] == 'failed'
+        assert _status_update(cursor)[0][:2] == ('failed', 'training process exited with code 1')
+
+    def test_stale_job_past_attempts_not_rerun(self):
+        process = FakeProcess(EXIT_TRAINED)
+        runner, cursor, _ = _runner([(9, 'auto', None, 40, 480, MAX_ATTEMPTS + 1)], process)
+
+        job = runner.run_next()
+
+        assert not process.started
+        assert job['status'] == 'failed'
+
+    def test_child_stopped_on_cancel(self):
+        runner, cursor, _ = _runner([(9, 'manual', 'dev', 40, 480, 1)], FakeProcess(EXIT_CANCELLED))
+
+        job = runner.run_next()
+
+        assert job['status'] == 'cancelled'
+        assert _status_update(cursor)[0][0] == 'cancelled'
+
+    def test_unresponsive_child_terminated(self):
+        process = FakeProcess(EXIT_TRAINED, alive_joins=100)
+        runner, cursor, _ = _runner([(9, 'manual', 'dev', 40, 480, 1)] + [(True,)] * 100, process)
+
+        with patch.object(train_scheduler, 'CANCEL_GRACE_SECONDS', 0):
+            job = runner.run_next()
+
+        assert process.terminated
+        assert job['status'] == 'cancelled'
+
+    def test_nothing_queued(self):
+        process = FakeProcess(EXIT_TRAINED)
+        runner, _, _ = _runner([], process)
+
+        assert runner.run_next() is None
+        assert not process.started
+
+    def test_supervision_error_stops_child_before_failing_job(self):
+        process = FakeProcess(EXIT_TRAINED, alive_joins=5)
+        runner, cursor, conn = _runner([(9, 'auto', None, 40, 480, 1)], process)
+        recorded_at = []
+        process.terminate = lambda: (recorded_at.append(len(_status_update(cursor))),
+                                     setattr(process, 'terminated', True))
+
+        with patch('training_jobs.heartbeat', side_effect=psycopg2.OperationalError('connection lost')):
+            job = runner.run_next()
+
+        assert process.terminated and process.exitcode == -15
+        assert recorded_at == [0]
+        assert job['status'] == 'failed'
+        assert _status_update(cursor)[0][:2] == ('failed', 'connection lost')
+        assert conn.rollbacks == 1
+
+
+class StopListening(BaseException):
+    pass
+
+
+class TestListen:
+
+    def test_reconnects_and_relistens_after_db_error(self):
+        lost = RecordingConnection(RecordingCursor())
+        fresh = RecordingConnection(RecordingCursor())
+        connections = iter([lost, fresh])
+
+        def rollback():
+            raise psycopg2.InterfaceError('connection already closed')
+        lost.rollback = rollback
+        lost.close = lambda: setattr(lost, 'closed', True)
+
+        with patch.object(train_scheduler, 'get_db_connection', side_effect=lambda: next(connections)), \
+             patch.object(TrainingRunner, 'run_next',
+                          side_effect=[psycopg2.OperationalError('server closed the connection'), None]), \
+             patch.object(train_scheduler.select, 'select', side_effect=StopListening), \
+             patch.object(train_scheduler.time, 'sleep'):
+            with pytest.raises(StopListening):
+                train_scheduler.listen(interval=0)
+
+        assert lost.closed
+        assert lost._cursor.executed == fresh._cursor.executed == [('LISTEN training_jobs', None)]
+
+
+class TestResourceLimits:
+
+    def test_threads_and_niceness(self):
+        with patch.dict(os.environ), patch.object(train_scheduler.os, 'nice') as nice:
+            train_scheduler.limit_resources(3, 12)
+
+            assert os.environ['OMP_NUM_THREADS'] == '3'
+            assert os.environ['MKL_NUM_THREADS'] == '3'
+            assert os.environ['TOKENIZERS_PARALLELISM'] == 'false'
+        nice.assert_called_once_with(12)
+
+
+class TestProgressCallback:
+
+    @staticmethod
+    def _state(step, max_steps=100, epoch=0.5):
+        return SimpleNamespace(global_step=step, max_steps=max_steps, epoch=epoch)
+
+    def test_reports_throttled_progress(self):
+        reports = []
+        now = [0.0]
+        callback = ProgressCallback(lambda p: reports.append(p), interval=10, clock=lambda: now[0])
+        control = SimpleNamespace(should_training_stop=False)
+
+        callback.on_train_begin(None, self._state(0), control)
+        callback.on_log(None, self._state(5), control, logs={'loss': 2.5})
+        now[0] = 5
+        callback.on_step_end(None, self._state(5), control)
+        now[0] = 11
+        callback.on_step_end(None, self._state(25), control)
+
+        assert [r['step'] for r in reports] == [0, 25]
+        assert reports[-1]['percent'] == 25.0
+        assert reports[-1]['loss'] == 2.5
+        assert not control.should_training_stop
+
+    def test_cancel_stops_training(self):
+        callback = ProgressCallback(lambda p: False, interval=0)
+        control = SimpleNamespace(should_training_stop=False)
+
+        callback.on_step_end(None, self._state(3), control)
+
+        assert callback.cancelled
+        assert control.should_training_stop
+
+
+class TestTrainingEndpoints:
+
+    def test_trigger_queues_job(self, auth_clinician, mock_db):
+        mock_db({'SELECT role': ('clinician',)})
+        client, _ = auth_clinician
+
+        with patch.object(api.training_jobs, 'schedule_training', return_value=7) as schedule:
+            resp = client.post('/api/ai/trigger-training', json={'username': 'someone_else'})
+
+        assert resp.status_code == 202
+        assert resp.get_json()['job_id'] == 7
+        # The authenticated user, not the request body, is recorded
+        assert schedule.call_args.kwargs == {'trigger': 'manual', 'requested_by': 'test_clinician'}
+
+    def test_trigger_conflict_when_active(self, auth_developer, mock_db):
+        mock_db({
+            'SELECT role': ('developer',),
+            'pg_try_advisory_xact_lock': (True,),
+            'FROM training_watermark': (12, 40, 6),
+        })
+        client, _ = auth_developer
+
+        assert client.post('/api/ai/trigger-training', json={}).status_code == 409
+
+    def test_trigger_rejects_patient(self, auth_patient, mock_db):
+        mock_db({'SELECT role': ('user',)})
+        client, _ = auth_patient
+
+        assert client.post('/api/ai/trigger-training', json={'username': 'test_clinician'}).status_code == 403
+
+    def test_list_jobs(self, auth_developer, mock_db):
+        mock_db({
+            'SELECT role': ('developer',),
+            'FROM training_jobs': [(7, 'manual', 'test_developer', 'running', {'step': 5, 'max_steps': 10},
+                                    12, 40, 52, None, 1, False, None, None, None, None, None)],
+            'FROM training_watermark': (40, 12, None),
+        })
+        client, _ = auth_developer
+
+        resp = client.get('/api/developer/training/jobs')
+        data = resp.get_json()
+
+        assert resp.status_code == 200
+        assert data['jobs'][0]['progress'] == {'step': 5, 'max_steps': 10}
+        assert data['watermark']['pending_rows'] == 12
+
+    def test_cancel_job(self, auth_developer, mock_db):
+        mock_db({'SELECT role': ('developer',), 'UPDATE training_jobs': ('running',)})
+        client, _ = auth_developer
+
+        resp = client.post('/api/developer/training/jobs/7/cancel')
+
+        assert resp.status_code == 200
+        assert resp.get_json()['status'] == 'running'
+
+    def test_cancel_finished_job(self, auth_developer, mock_db):
+        mock_db({'SELECT role': ('developer',)})
+        client, _ = auth_developer
+
+        assert client.post('/api/developer/training/jobs/7/cancel').status_code == 404
+
+    def test_jobs_require_developer(self, auth_clinician, mock_db):
+        mock_db({'SELECT role': ('clinician',)})
+        client, _ = auth_clinician
+
+        assert client.get('/api/developer/training/jobs').status_code == 403
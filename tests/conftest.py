@@ -76,6 +76,11 @@ class MockCursor:
         self._result_index = len(self._results)
         return results
 
+    def fetchmany(self, size=1):
+        results = self._results[self._result_index:self._result_index + size]
+        self._result_index += len(results)
+        return results
+
     def close(self):
         pass
 
@@ -86,7 +91,7 @@ class MockConnection:
     def __init__(self, cursor=None):
         self._cursor = cursor or MockCursor()
 
-    def cursor(self):
+    def cursor(self, name=None):
         return self._cursor
 
     def commit(self):
@@ -218,6 +223,14 @@ def unauth_client(client):
 
 # ==================== MOCK DB FIXTURE ====================
 
+@pytest.fixture(autouse=True)
+def clear_principal_cache():
+    """Principals cached by one test must not answer another test's auth lookup."""
+    api.principal_cache.invalidate()
+    yield
+    api.principal_cache.invalidate()
+
+
 @pytest.fixture
 def mock_db():
     """
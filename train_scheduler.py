@@ -14,24 +14,280 @@ Example Windows Task Scheduler:
   - Program: python
   - Arguments: train_scheduler.py
     - Start in: C:\path\to\Healing Space UK
+
+Auto-training queued from the chat path (see training_jobs.py) is picked up
+by a long-running listener (Procfile: `trainer: python train_scheduler.py --listen`),
+so training never runs inside a web worker. Every run - cron or queued - goes
+through the training_jobs table, so two trainings never overlap. Each job
+trains in a child process with TRAINING_THREADS CPU threads at niceness
+TRAINING_NICENESS, reports progress to the developer dashboard, can be
+cancelled from there, and resumes from its last checkpoint if the runner dies.
 """
 
+import argparse
+import multiprocessing
 import os
+import select
 import sys
+import time
 from datetime import datetime
-import json
+
+import psycopg2
 
 # Add current directory to path
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
-def main():
+TRAINING_THREADS = int(os.getenv('TRAINING_THREADS', '2'))
+TRAINING_NICENESS = int(os.getenv('TRAINING_NICENESS', '10'))
+HEARTBEAT_SECONDS = 30
+CANCEL_GRACE_SECONDS = 60
+THREAD_ENV_VARS = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS')
+
+# Child process exit codes
+EXIT_TRAINED = 0
+EXIT_NO_DATA = 10
+EXIT_CANCELLED = 11
+
+def get_db_connection():
+    """Open a dedicated PostgreSQL connection for the trainer (fail closed)."""
+    database_url = os.getenv('DATABASE_URL')
+    if database_url:
+        return psycopg2.connect(database_url)
+
+    host = os.getenv('DB_HOST')
+    name = os.getenv('DB_NAME')
+    user = os.getenv('DB_USER')
+    password = os.getenv('DB_PASSWORD')
+    if not all([host, name, user, password]):
+        raise RuntimeError(
+            "CRITICAL: Database credentials incomplete. "
+            "Required: DATABASE_URL or (DB_HOST, DB_NAME, DB_USER, DB_PASSWORD)"
+        )
+    return psycopg2.connect(host=host, port=int(os.getenv('DB_PORT', '5432')),
+                            database=name, user=user, password=password)
+
+
+def limit_resources(threads, niceness):
+    """Keep training off the web tier's CPUs: lower priority and cap BLAS/torch threads."""
+    if niceness:
+        os.nice(niceness)
+    for var in THREAD_ENV_VARS:
+        os.environ[var] = str(threads)
+    os.environ['TOKENIZERS_PARALLELISM'] = 'false'
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+
+
+def train_once(to_id=None, output_dir=None, callbacks=None):
+    """Train on new data. Returns the last trained training_chats id, or None if there was nothing new."""
+    from ai_trainer import BackgroundAITrainer
+    from training_config import get_training_config
+
+    config = get_training_config()
+    trainer = BackgroundAITrainer()
+    if not trainer.train_incremental(num_epochs=config['epochs'], batch_size=config['batch_size'],
+                                     max_length=config['max_length'], to_id=to_id,
+                                     output_dir=output_dir, callbacks=callbacks):
+        return None
+    return trainer.last_trained_id
+
+
+def run_job_process(job, threads, niceness):
+    """Child process entry point: train one job, reporting progress, and exit with its outcome."""
+    limit_resources(threads, niceness)
+
+    import training_jobs
+    from ai_trainer import CHECKPOINT_DIR, ProgressCallback, TrainingCancelled
+
+    conn = get_db_connection()
+
+    def report(progress):
+        try:
+            cancel = training_jobs.heartbeat(conn.cursor(), job['id'], progress)
+            conn.commit()
+        except psycopg2.Error as e:
+            conn.rollback()
+            print(f"⚠️  Could not report training progress: {e}")
+            return True
+        return not cancel
+
+    try:
+        trained_to_id = train_once(job['to_id'], os.path.join(CHECKPOINT_DIR, f"job-{job['id']}"),
+                                   [ProgressCallback(report)])
+    except TrainingCancelled as e:
+        print(f"🛑 {e}")
+        sys.exit(EXIT_CANCELLED)
+    finally:
+        conn.close()
+    sys.exit(EXIT_TRAINED if trained_to_id is not None else EXIT_NO_DATA)
+
+
+class TrainingRunner:
+    """
+    Claims queued training jobs and runs each in a child process.
+
+    The child trains with capped threads and raised niceness and reports
+    progress itself; this process heartbeats the job while the child is
+    alive, enforces cancellation (killing the child if it has not stopped
+    within CANCEL_GRACE_SECONDS) and records the outcome. A crashed child's
+    job is re-queued and resumes from its last checkpoint.
+    """
+
+    def __init__(self, conn, threads=TRAINING_THREADS, niceness=TRAINING_NICENESS, process_factory=None):
+        self.conn = conn
+        self.threads = threads
+        self.niceness = niceness
+        self.process_factory = process_factory or multiprocessing.get_context('spawn').Process
+
+    def run_next(self):
+        """Run the next queued job. Returns the job (status, trained_to_id, error filled in) or None."""
+        import training_jobs
+
+        cur = self.conn.cursor()
+        job = training_jobs.claim_job(cur)
+        self.conn.commit()
+        if not job:
+            return None
+
+        job['trained_to_id'], job['error'] = None, None
+        if job['attempts'] > training_jobs.MAX_ATTEMPTS:
+            exitcode = None
+            job['error'] = f"gave up after {training_jobs.MAX_ATTEMPTS} attempts"
+        else:
+            print(f"🧵 Running training job {job['id']} ({job['trigger']}, attempt {job['attempts']})")
+            try:
+                exitcode = self._supervise(cur, job)
+            except Exception as e:
+                self.conn.rollback()
+                exitcode = None
+                job['error'] = str(e)
+
+        if exitcode == EXIT_TRAINED:
+            job['status'], job['trained_to_id'] = 'completed', job['to_id']
+            training_jobs.finish_job(cur, job['id'], True, job['to_id'])
+        elif exitcode == EXIT_NO_DATA:
+            # Nothing trainable in (from_id, to_id]; still move the watermark past
+            # it, or pending_rows stays over the threshold and re-queues the range
+            job['status'], job['trained_to_id'] = 'completed', job['to_id']
+            training_jobs.finish_job(cur, job['id'], True, job['to_id'])
+        elif exitcode == EXIT_CANCELLED:
+            job['status'] = 'cancelled'
+            training_jobs.finish_job(cur, job['id'], False, cancelled=True)
+        else:
+            job['error'] = job['error'] or f"training process exited with code {exitcode}"
+            if exitcode is not None and job['attempts'] < training_jobs.MAX_ATTEMPTS:
+                job['status'] = 'queued'
+                training_jobs.requeue_job(cur, job['id'], job['error'])
+            else:
+                job['status'] = 'failed'
+                training_jobs.finish_job(cur, job['id'], False, error=job['error'])
+            print(f"❌ Training job {job['id']} {job['status']}: {job['error']}")
+        self.conn.commit()
+        return job
+
+    def _supervise(self, cur, job):
+        """Start the child and wait for it, heartbeating and honouring cancellation. Returns its exit code."""
+        import training_jobs
+
+        process = self.process_factory(target=run_job_process, args=(job, self.threads, self.niceness),
+                                       name=f"training-job-{job['id']}")
+        process.start()
+        kill_at = None
+        try:
+            while True:
+                process.join(HEARTBEAT_SECONDS)
+                if process.exitcode is not None:
+                    return process.exitcode
+                cancel = training_jobs.heartbeat(cur, job['id'])
+                self.conn.commit()
+                if cancel and kill_at is None:
+                    kill_at = time.monotonic() + CANCEL_GRACE_SECONDS
+                if kill_at is not None and time.monotonic() >= kill_at:
+                    print(f"🛑 Training job {job['id']} did not stop after cancellation - terminating")
+                    process.terminate()
+                    process.join()
+                    return EXIT_CANCELLED
+        finally:
+            # Supervision failed (e.g. the heartbeat hit a DB error): stop the child
+            # before the job is recorded, so no second job trains alongside it
+            if process.exitcode is None:
+                print(f"🛑 Stopping training job {job['id']} after a supervision error")
+                process.terminate()
+                process.join()
+
+
+def listen(interval=60.0, threads=TRAINING_THREADS, niceness=TRAINING_NICENESS):
+    """Run queued jobs as NOTIFYs arrive (or every interval seconds) until interrupted.
+
+    Database errors are logged and the connection is rolled back (or reopened if
+    it was lost) before LISTEN is re-issued, so a dropped connection does not
+    stop the worker.
+    """
+    import training_jobs
+
+    conn = None
+    runner = TrainingRunner(None, threads, niceness)
+    listening = False
+    print(f"👂 Training runner listening on '{training_jobs.NOTIFY_CHANNEL}' "
+          f"({threads} thread(s), nice {niceness})")
+    try:
+        while True:
+            try:
+                if conn is None or conn.closed:
+                    conn = runner.conn = get_db_connection()
+                    listening = False
+                if not listening:
+                    cur = conn.cursor()
+                    cur.execute(f"LISTEN {training_jobs.NOTIFY_CHANNEL}")
+                    conn.commit()
+                    listening = True
+                while runner.run_next():
+                    pass
+                if select.select([conn], [], [], interval) != ([], [], []):
+                    conn.poll()
+                    conn.notifies.clear()
+            except psycopg2.Error as e:
+                print(f"⚠️  Training runner database error: {e}")
+                listening = False
+                if conn is not None and not conn.closed:
+                    try:
+                        conn.rollback()
+                    except psycopg2.Error:
+                        conn.close()
+                time.sleep(interval)
+    finally:
+        if conn is not None:
+            conn.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run background AI training')
+    parser.add_argument('--listen', action='store_true', help='run queued training jobs as they arrive')
+    parser.add_argument('--interval', type=float, default=60.0,
+                        help='max seconds between queue polls when no NOTIFY arrives')
+    parser.add_argument('--threads', type=int, default=TRAINING_THREADS,
+                        help='CPU threads for the training process (default: TRAINING_THREADS or 2)')
+    parser.add_argument('--nice', type=int, default=TRAINING_NICENESS,
+                        help='niceness increment for the training process (default: TRAINING_NICENESS or 10)')
+    args = parser.parse_args(argv)
+
+    if args.listen:
+        try:
+            listen(args.interval, args.threads, args.nice)
+        except KeyboardInterrupt:
+            pass
+        return 0
+
     print(f"\n{'='*70}")
     print(f"🤖 Healing Space UK AI Training Scheduler")
     print(f"⏰ Started: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
     print(f"{'='*70}\n")
     
     try:
-        from ai_trainer import train_background_model, BackgroundAITrainer
+        from ai_trainer import BackgroundAITrainer
         
         # Check if training data is available
         trainer = BackgroundAITrainer()
@@ -49,8 +305,19 @@ def main():
         print(f"🚀 Starting training...")
         print(f"{'='*70}\n")
         
-        # Train with 3 epochs (adjust as needed)
-        success = train_background_model(epochs=3)
+        # Go through the job queue so a cron run never overlaps a queued auto-training run
+        import training_jobs
+        conn = get_db_connection()
+        try:
+            job_id = training_jobs.schedule_training(conn.cursor(), trigger='cron')
+            conn.commit()
+            if not job_id:
+                print("ℹ️  A training job is already queued or running - skipping")
+                return 0
+            job = TrainingRunner(conn, args.threads, args.nice).run_next()
+            success = bool(job and job['trained_to_id'] is not None)
+        finally:
+            conn.close()
         
         print(f"\n{'='*70}")
         if success:
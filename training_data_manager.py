@@ -17,8 +17,13 @@ NOTE: Now using PostgreSQL instead of SQLite for consistency
 
 import hashlib
 import json
+import logging
 import re
+import select
+import threading
+import time
 from datetime import datetime
+from functools import lru_cache
 import os
 import psycopg2
 import secrets
@@ -69,47 +74,72 @@ def get_anonymization_salt():
     return salt
 
 
+# PII scrubbing rules, applied in order. Shared with research_export.py,
+# which applies the same rules to whole Arrow columns at once.
+PII_PATTERNS = [
+    # Email addresses
+    (r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b', '[EMAIL]', 0),
+    # Phone numbers (various formats)
+    (r'\b\d{3}[-.]?\d{3}[-.]?\d{4}\b', '[PHONE]', 0),
+    (r'\b\+\d{1,3}\s?\d{3,4}\s?\d{3,4}\s?\d{3,4}\b', '[PHONE]', 0),
+    # Common name patterns (basic - improve as needed)
+    (r'\bmy name is [A-Za-z]+\b', 'my name is [NAME]', re.IGNORECASE),
+    (r"\bI'm [A-Za-z]+\b", "I'm [NAME]", re.IGNORECASE),
+    # Addresses (basic patterns)
+    (r'\b\d{1,5}\s\w+\s(Street|St|Avenue|Ave|Road|Rd|Boulevard|Blvd)\b', '[ADDRESS]', re.IGNORECASE),
+    # Dates of birth
+    (r'\b\d{1,2}[/-]\d{1,2}[/-]\d{2,4}\b', '[DATE]', 0),
+    # SSN patterns
+    (r'\b\d{3}-\d{2}-\d{4}\b', '[SSN]', 0),
+]
+
+
+# Consent status is cached per worker. Changes are NOTIFYed on this channel so
+# every worker evicts the entry immediately; the TTL only bounds staleness
+# while a worker's listener connection is down.
+CONSENT_CHANNEL = 'training_consent'
+CONSENT_CACHE_TTL = int(os.getenv('CONSENT_CACHE_TTL', '300'))
+CONSENT_CACHE_MAX = 50000
+
+logger = logging.getLogger('training_data_manager')
+
+
+@lru_cache(maxsize=CONSENT_CACHE_MAX)
+def _hash_username(username, salt):
+    return hashlib.sha256(f"{username}{salt}".encode()).hexdigest()[:16]
+
+
 class TrainingDataManager:
     """Manages GDPR-compliant training data collection
     
     NOTE: Constructor now accepts no arguments (PostgreSQL used automatically)
     """
     
-    def __init__(self, production_db_path=None):
+    def __init__(self, production_db_path=None, consent_ttl=CONSENT_CACHE_TTL):
         # Deprecated: production_db_path argument is ignored
         # All operations now use PostgreSQL via get_db_connection()
-        pass
+        self.consent_ttl = consent_ttl
+        self._consent_cache = {}  # user_hash -> (consented, expires_at)
+        self._consent_lock = threading.Lock()
+        self._consent_generation = 0  # bumped on every invalidation
+        self._listener_pid = None
+        self._conn = None  # reused by check_user_consent / collect_therapy_session
+        self._conn_pid = None
+        self._conn_lock = threading.Lock()
     
     def anonymize_username(self, username):
         """Create irreversible hash of username for anonymization"""
         # TIER 1.10: Use environment-based salt (not hardcoded)
         salt = get_anonymization_salt()
-        return hashlib.sha256(f"{username}{salt}".encode()).hexdigest()[:16]
+        return _hash_username(username, salt)
     
     def strip_pii(self, text):
         """Remove personally identifiable information from text"""
         if not text:
             return text
         
-        # Remove email addresses
-        text = re.sub(r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b', '[EMAIL]', text)
-        
-        # Remove phone numbers (various formats)
-        text = re.sub(r'\b\d{3}[-.]?\d{3}[-.]?\d{4}\b', '[PHONE]', text)
-        text = re.sub(r'\b\+\d{1,3}\s?\d{3,4}\s?\d{3,4}\s?\d{3,4}\b', '[PHONE]', text)
-        
-        # Remove common name patterns (basic - improve as needed)
-        text = re.sub(r'\bmy name is [A-Za-z]+\b', 'my name is [NAME]', text, flags=re.IGNORECASE)
-        text = re.sub(r"\bI'm [A-Za-z]+\b", "I'm [NAME]", text, flags=re.IGNORECASE)
-        
-        # Remove addresses (basic patterns)
-        text = re.sub(r'\b\d{1,5}\s\w+\s(Street|St|Avenue|Ave|Road|Rd|Boulevard|Blvd)\b', '[ADDRESS]', text, flags=re.IGNORECASE)
-        
-        # Remove dates of birth
-        text = re.sub(r'\b\d{1,2}[/-]\d{1,2}[/-]\d{2,4}\b', '[DATE]', text)
-        
-        # Remove SSN patterns
-        text = re.sub(r'\b\d{3}-\d{2}-\d{4}\b', '[SSN]', text)
+        for pattern, replacement, flags in PII_PATTERNS:
+            text = re.sub(pattern, replacement, text, flags=flags)
         
         return text
     
@@ -145,31 +175,132 @@ class TrainingDataManager:
                VALUES (%s, %s, %s)''',
             (user_hash, action, f'User consent status changed to: {consent}')
         )
+        cur.execute('SELECT pg_notify(%s, %s)', (CONSENT_CHANNEL, user_hash))
         
         conn.commit()
         conn.close()
         
+        self._cache_consent(user_hash, bool(consent))
+        
         return True
     
     def check_user_consent(self, username):
-        """Check if user has given consent for training data"""
+        """Check if user has given consent for training data (cached per worker)"""
         user_hash = self.anonymize_username(username)
         
-        conn = psycopg2.connect(os.getenv("DATABASE_URL"))
-        cur = conn.cursor()
+        cached = self._consent_cache.get(user_hash)
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
         
-        result = cur.execute(
-            '''SELECT consent_given, consent_withdrawn 
-               FROM data_consent WHERE user_hash=%s''',
-            (user_hash,)
-        ).fetchone()
+        self._ensure_consent_listener()
+        generation = self._consent_generation
         
-        conn.close()
+        def lookup(cur):
+            cur.execute(
+                '''SELECT consent_given, consent_withdrawn 
+                   FROM data_consent WHERE user_hash=%s''',
+                (user_hash,)
+            )
+            return cur.fetchone()
+        
+        result = self._run_on_shared_connection(lookup)
         
-        if not result:
-            return False
+        consented = bool(result) and result[0] == 1 and result[1] == 0
+        self._cache_consent(user_hash, consented, generation)
+        return consented
+    
+    def _run_on_shared_connection(self, work):
+        """Run work(cursor) and commit, on this worker's reused connection
+        
+        The connection is opened on first use and again after a fork; on any
+        error it is closed so the next call starts from a fresh one.
+        """
+        with self._conn_lock:
+            if self._conn is None or self._conn.closed or self._conn_pid != os.getpid():
+                self._conn = psycopg2.connect(os.getenv("DATABASE_URL"))
+                self._conn_pid = os.getpid()
+            conn = self._conn
+            try:
+                result = work(conn.cursor())
+                conn.commit()
+                return result
+            except Exception:
+                self._conn = None
+                try:
+                    conn.close()
+                except psycopg2.Error:
+                    pass
+                raise
+    
+    def _cache_consent(self, user_hash, consented, generation=None):
+        with self._consent_lock:
+            # An invalidation that landed mid-query means the row we read may be stale
+            if generation is not None and generation != self._consent_generation:
+                return
+            if len(self._consent_cache) >= CONSENT_CACHE_MAX:
+                self._consent_cache.clear()
+            self._consent_cache[user_hash] = (consented, time.monotonic() + self.consent_ttl)
+    
+    def invalidate_consent(self, user_hash=None):
+        """Drop one cached consent entry (or all of them if user_hash is None)"""
+        with self._consent_lock:
+            self._consent_generation += 1
+            if user_hash is None:
+                self._consent_cache.clear()
+            else:
+                self._consent_cache.pop(user_hash, None)
+    
+    def _ensure_consent_listener(self):
+        """Start this worker's invalidation listener (once per process, after fork)"""
+        if self._listener_pid == os.getpid() or not os.getenv("DATABASE_URL"):
+            return
+        self._listener_pid = os.getpid()
+        threading.Thread(target=self._listen_for_consent_changes, name='consent-listener', daemon=True).start()
+    
+    def _listen_for_consent_changes(self, poll_interval=30):
+        """Evict cached consent as other workers NOTIFY changes; reconnect on failure"""
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(os.getenv("DATABASE_URL"))
+                conn.autocommit = True
+                conn.cursor().execute(f'LISTEN {CONSENT_CHANNEL}')
+                # Changes made while we were not listening were missed
+                self.invalidate_consent()
+                while True:
+                    if select.select([conn], [], [], poll_interval) != ([], [], []):
+                        conn.poll()
+                        while conn.notifies:
+                            self.invalidate_consent(conn.notifies.pop(0).payload)
+            except Exception as e:
+                logger.warning(f"Consent listener error: {e}")
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except psycopg2.Error:
+                        pass
+                time.sleep(poll_interval)
+    
+    def collect_therapy_session(self, username, messages, mood_context=None):
+        """Store one anonymized live-chat exchange from a consented user
         
-        return result[0] == 1 and result[1] == 0
+        training_chats inserts bump training_watermark.pending_rows (via trigger),
+        which is what the auto-training check reads.
+        """
+        user_hash = self.anonymize_username(username)
+        session_hash = hashlib.md5(f"{user_hash}{datetime.now().date()}".encode()).hexdigest()[:12]
+        now = datetime.now()
+        
+        rows = [(session_hash, user_hash, m['role'], self.strip_pii(m['content']), now, mood_context)
+                for m in messages]
+        self._run_on_shared_connection(lambda cur: cur.executemany(
+            '''INSERT INTO training_chats 
+               (session_hash, user_hash, message_role, message_content, timestamp, mood_context)
+               VALUES (%s, %s, %s, %s, %s, %s)''',
+            rows
+        ))
+        
+        return len(messages)
     
     def export_chat_session(self, username):
         """Export anonymized chat session for training"""
@@ -393,10 +524,13 @@ class TrainingDataManager:
                VALUES (%s, %s, %s)''',
             (user_hash, 'data_deleted', 'User exercised right to deletion')
         )
+        cur.execute('SELECT pg_notify(%s, %s)', (CONSENT_CHANNEL, user_hash))
         
         conn.commit()
         conn.close()
         
+        self.invalidate_consent(user_hash)
+        
         return True, "All your training data has been permanently deleted"
     
     def export_all_consented_data(self):
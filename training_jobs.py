@@ -0,0 +1,190 @@
+"""
+Training Jobs - scheduling background model training from the chat path.
+
+training_chats rows are counted as they are inserted (statement-level
+trigger into the training_watermark singleton), so deciding whether enough
+new data has arrived is a single primary-key read instead of a COUNT(*)
+per chat message.
+
+Training never runs inside a web worker. When the threshold is crossed the
+API enqueues a training_jobs row and NOTIFYs; train_scheduler.py claims it
+and trains in its own process. At most one job is queued or running
+cluster-wide: scheduling takes a transaction-scoped advisory lock, the
+watermark remembers the scheduled job, and a partial unique index rejects
+a second active row outright.
+
+While a job runs the runner heartbeats progress into the row (shown on the
+developer dashboard) and reads back cancel_requested. A job whose runner
+died stops heartbeating and is re-claimed, resuming from its last Trainer
+checkpoint over the same fixed row range (to_id).
+"""
+
+import json
+from typing import Any, Dict, List, Optional
+
+NOTIFY_CHANNEL = 'training_jobs'
+STALE_AFTER_SECONDS = 600
+MAX_ATTEMPTS = 3
+
+# pg_advisory_xact_lock key guarding "check watermark + enqueue"
+TRAINING_LOCK_KEY = 0x7472_6169  # 'trai'
+
+ACTIVE_STATUSES = ('queued', 'running')
+
+
+def should_schedule(cur, threshold: int) -> bool:
+    """O(1) pre-check for the chat path: enough new rows and nothing already scheduled."""
+    cur.execute("SELECT pending_rows, scheduled_job_id FROM training_watermark WHERE id = 1")
+    row = cur.fetchone()
+    return bool(row) and row[1] is None and row[0] >= threshold
+
+
+def schedule_training(cur, threshold: int = 0, trigger: str = 'auto',
+                      requested_by: Optional[str] = None) -> Optional[int]:
+    """
+    Enqueue a training job if the watermark allows it. Returns the new job id,
+    or None when below threshold, another job is active, or another worker
+    holds the scheduling lock. The caller commits.
+    """
+    cur.execute("SELECT pg_try_advisory_xact_lock(%s)", (TRAINING_LOCK_KEY,))
+    locked = cur.fetchone()
+    if not locked or not locked[0]:
+        return None
+
+    cur.execute("""
+        SELECT pending_rows, last_trained_id, scheduled_job_id
+        FROM training_watermark WHERE id = 1
+        FOR UPDATE
+    """)
+    row = cur.fetchone()
+    if not row or row[2] is not None or row[0] < threshold:
+        return None
+
+    cur.execute("""
+        INSERT INTO training_jobs (trigger, requested_by, pending_rows, from_id)
+        VALUES (%s, %s, %s, %s)
+        ON CONFLICT DO NOTHING
+        RETURNING id
+    """, (trigger, requested_by, row[0], row[1]))
+    job = cur.fetchone()
+    if not job:
+        return None
+
+    cur.execute("UPDATE training_watermark SET scheduled_job_id = %s WHERE id = 1", (job[0],))
+    cur.execute(f"NOTIFY {NOTIFY_CHANNEL}")
+    return job[0]
+
+
+def claim_job(cur) -> Optional[Dict[str, Any]]:
+    """
+    Mark the oldest queued job (or a running job whose runner stopped
+    heartbeating) running. The first claim pins to_id, the last
+    training_chats row the job covers. The caller commits.
+    """
+    cur.execute(f"""
+        UPDATE training_jobs
+        SET status = 'running',
+            started_at = COALESCE(started_at, CURRENT_TIMESTAMP),
+            heartbeat_at = CURRENT_TIMESTAMP,
+            attempts = attempts + 1,
+            to_id = COALESCE(to_id, (SELECT COALESCE(MAX(id), 0) FROM training_chats))
+        WHERE id = (
+            SELECT id FROM training_jobs
+            WHERE status = 'queued'
+               OR (status = 'running' AND heartbeat_at < CURRENT_TIMESTAMP - INTERVAL '{STALE_AFTER_SECONDS} seconds')
+            ORDER BY created_at, id
+            FOR UPDATE SKIP LOCKED
+            LIMIT 1
+        )
+        RETURNING id, trigger, requested_by, from_id, to_id, attempts
+    """)
+    row = cur.fetchone()
+    if not row:
+        return None
+    return {'id': row[0], 'trigger': row[1], 'requested_by': row[2], 'from_id': row[3],
+            'to_id': row[4], 'attempts': row[5]}
+
+
+def heartbeat(cur, job_id: int, progress: Optional[Dict[str, Any]] = None) -> bool:
+    """Record liveness (and progress, if given). Returns True if cancellation was requested."""
+    if progress is None:
+        cur.execute("""
+            UPDATE training_jobs SET heartbeat_at = CURRENT_TIMESTAMP WHERE id = %s
+            RETURNING cancel_requested
+        """, (job_id,))
+    else:
+        cur.execute("""
+            UPDATE training_jobs SET heartbeat_at = CURRENT_TIMESTAMP, progress = %s WHERE id = %s
+            RETURNING cancel_requested
+        """, (json.dumps(progress), job_id))
+    row = cur.fetchone()
+    return bool(row and row[0])
+
+
+def cancel_job(cur, job_id: int) -> Optional[str]:
+    """
+    Request cancellation. A queued job is cancelled outright; a running one
+    is flagged and stopped by its runner. Returns the job's status, or None
+    if it was not active. The caller commits.
+    """
+    cur.execute("""
+        UPDATE training_jobs
+        SET cancel_requested = TRUE,
+            status = CASE WHEN status = 'queued' THEN 'cancelled' ELSE status END,
+            finished_at = CASE WHEN status = 'queued' THEN CURRENT_TIMESTAMP ELSE finished_at END
+        WHERE id = %s AND status IN ('queued', 'running')
+        RETURNING status
+    """, (job_id,))
+    row = cur.fetchone()
+    if not row:
+        return None
+    if row[0] == 'cancelled':
+        cur.execute("UPDATE training_watermark SET scheduled_job_id = NULL WHERE id = 1 AND scheduled_job_id = %s",
+                    (job_id,))
+    return row[0]
+
+
+def requeue_job(cur, job_id: int, error: str):
+    """Put a job whose runner crashed back in the queue; it resumes from its checkpoint."""
+    cur.execute("UPDATE training_jobs SET status = 'queued', error = %s WHERE id = %s", (error, job_id))
+
+
+def recent_jobs(cur, limit: int = 20) -> List[Dict[str, Any]]:
+    cur.execute("""
+        SELECT id, trigger, requested_by, status, progress, pending_rows, from_id, to_id, trained_to_id,
+               attempts, cancel_requested, error, created_at, started_at, heartbeat_at, finished_at
+        FROM training_jobs
+        ORDER BY id DESC
+        LIMIT %s
+    """, (limit,))
+    keys = ('id', 'trigger', 'requested_by', 'status', 'progress', 'pending_rows', 'from_id', 'to_id',
+            'trained_to_id', 'attempts', 'cancel_requested', 'error', 'created_at', 'started_at',
+            'heartbeat_at', 'finished_at')
+    return [dict(zip(keys, row)) for row in cur.fetchall()]
+
+
+def finish_job(cur, job_id: int, success: bool, last_trained_id: Optional[int] = None,
+               error: Optional[str] = None, cancelled: bool = False):
+    """
+    Record the outcome and release the watermark. On success the watermark
+    moves to last_trained_id and pending_rows is recounted once, which also
+    corrects any drift from deleted rows.
+    """
+    status = 'cancelled' if cancelled else ('completed' if success else 'failed')
+    cur.execute("""
+        UPDATE training_jobs
+        SET status = %s, finished_at = CURRENT_TIMESTAMP, error = %s, trained_to_id = %s
+        WHERE id = %s
+    """, (status, error, last_trained_id, job_id))
+    if success and last_trained_id is not None:
+        cur.execute("""
+            UPDATE training_watermark
+            SET last_trained_id = %s,
+                pending_rows = (SELECT COUNT(*) FROM training_chats WHERE id > %s),
+                trained_at = CURRENT_TIMESTAMP,
+                scheduled_job_id = NULL
+            WHERE id = 1
+        """, (last_trained_id, last_trained_id))
+    else:
+        cur.execute("UPDATE training_watermark SET scheduled_job_id = NULL WHERE id = 1 AND scheduled_job_id = %s",
+                    (job_id,))